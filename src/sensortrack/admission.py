@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Admission control and load shedding for SmartApp lifecycle requests.
+
+Without limits, a burst of EVENT redeliveries piles up threads and memory until every
+request times out together.  Instead, each lifecycle type (EVENT, INSTALL, CONFIRMATION,
+etc.) can be given its own limits: the number of requests being dispatched at once, and
+the number of requests allowed to wait for one of those slots.  A request that would
+exceed the queue depth, or that waits longer than the queue timeout, is shed right away
+with a 503 and a Retry-After header, which SmartThings honors by redelivering later.
+
+Since each lifecycle type has its own limits, bulk EVENT traffic can never use up the
+capacity for lifecycle requests like CONFIRMATION and INSTALL.  A `default` limit applies
+to any lifecycle type that isn't configured explicitly.  The total concurrency across
+lifecycle types must be below the size of the server's thread pool (40, the default for
+anyio), so that admitted lifecycle requests always have a thread available even when
+EVENT traffic is at its limit; a configuration that doesn't fit is rejected.
+
+Admission happens before the request signature is verified, since verification may have
+to fetch a public key, and that is exactly the kind of work shedding is meant to avoid.
+An unauthenticated request could otherwise use up the capacity for any lifecycle type it
+claims to be, so two cheap checks come first.  When signatures are checked, a request
+without an `Authorization` header that looks like an HTTP signature is rejected with
+SignatureError before it takes a slot; a forged signature still takes a slot until the
+dispatcher rejects it.  The lifecycle type is taken from the top-level `lifecycle`
+member of the body, parsing the JSON only as far as that member, so a `lifecycle`
+string nested elsewhere in the body can't pick the gate.
+"""
+import asyncio
+import logging
+import re
+from collections import deque
+from contextlib import asynccontextmanager
+from json import JSONDecoder
+from threading import Lock
+from typing import AsyncIterator, Deque, List, Mapping, Optional, Tuple, Union
+
+from attrs import frozen
+from smartapp.interface import SignatureError, SmartAppRequestContext
+
+from sensortrack.config import AdmissionConfig, ConfigError, config
+
+DEFAULT = "default"  # limits that apply to lifecycle types without their own
+THREAD_POOL_SIZE = 40  # threads available to dispatch requests, which is anyio's default thread limiter
+
+_DECODER = JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+Waiter = Tuple[asyncio.AbstractEventLoop, "asyncio.Future[None]"]
+
+
+@frozen
+class OverloadedError(Exception):
+    """A request was shed because its lifecycle type is over its limits."""
+
+    message: str
+    retry_after_sec: int
+
+
+@frozen(kw_only=True)
+class GateStatus:
+    """Current status of the gate for a lifecycle type."""
+
+    lifecycle: str
+    active: int
+    queued: int
+    admitted: int
+    shed: int
+
+
+def _skip(text: str, index: int) -> int:
+    return _WHITESPACE.match(text, index).end()  # type: ignore[union-attr]
+
+
+def lifecycle(body: Union[str, bytes]) -> Optional[str]:
+    """
+    Find the lifecycle type of a request, returning None if it can't be found.
+
+    Only the top-level members of the body are considered, and the JSON is parsed only as
+    far as the `lifecycle` member, which SmartThings sends near the start of the body.
+    """
+    text = body.decode("UTF-8", errors="replace") if isinstance(body, bytes) else body
+    try:
+        index = _skip(text, 0)
+        if text[index : index + 1] != "{":
+            return None
+        index = _skip(text, index + 1)
+        while text[index : index + 1] == '"':
+            key, index = _DECODER.raw_decode(text, index)
+            index = _skip(text, index)
+            if text[index : index + 1] != ":":
+                return None
+            value, index = _DECODER.raw_decode(text, _skip(text, index + 1))
+            if key == "lifecycle":
+                return value if isinstance(value, str) else None
+            index = _skip(text, index)
+            if text[index : index + 1] != ",":
+                return None
+            index = _skip(text, index + 1)
+    except ValueError:  # JSONDecodeError is a subclass of ValueError
+        pass
+    return None
+
+
+def signed(headers: Mapping[str, str]) -> bool:
+    """Whether a request has an Authorization header that looks like an HTTP signature, without verifying it."""
+    signature = SmartAppRequestContext(headers=headers).signature
+    return bool(signature and signature.startswith("Signature ") and 'keyId="' in signature and 'signature="' in signature)
+
+
+class Gate:
+    """
+    Limits the requests dispatched at once, with a bounded queue of requests waiting for a slot.
+
+    Slots are handed directly from a finishing request to the first waiter, in order.  The
+    gate is shared across event loops (a TestClient runs its own), so waiters are woken
+    via their own loop rather than with asyncio synchronization primitives.
+    """
+
+    def __init__(self, name: str, concurrency: int, queue_depth: int) -> None:
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.active = 0
+        self.admitted = 0
+        self.shed = 0
+        self._waiters: Deque[Waiter] = deque()
+        self._lock = Lock()
+
+    def status(self) -> GateStatus:
+        with self._lock:
+            return GateStatus(
+                lifecycle=self.name, active=self.active, queued=len(self._waiters), admitted=self.admitted, shed=self.shed
+            )
+
+    async def acquire(self, timeout_sec: float) -> bool:
+        """Acquire a slot, waiting in the queue up to a timeout, returning False if the request must be shed."""
+        with self._lock:
+            if self.active < self.concurrency and not self._waiters:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if len(self._waiters) >= self.queue_depth:
+                self.shed += 1
+                return False
+            waiter = (asyncio.get_running_loop(), asyncio.get_running_loop().create_future())
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout_sec)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if waiter in self._waiters:  # otherwise, the slot was just handed over, and _grant() passes it along
+                    self._waiters.remove(waiter)
+                self.shed += 1
+            return False
+        with self._lock:
+            self.admitted += 1
+        return True
+
+    def release(self) -> None:
+        """Release a slot, handing it directly to the first waiter if there is one."""
+        with self._lock:
+            if self._waiters:
+                loop, future = self._waiters.popleft()
+                loop.call_soon_threadsafe(self._grant, future)
+            else:
+                self.active -= 1
+
+    def _grant(self, future: "asyncio.Future[None]") -> None:
+        if future.done():  # the waiter timed out or was cancelled, so pass the slot along
+            self.release()
+        else:
+            future.set_result(None)
+
+
+class AdmissionController:
+    """Gates for each configured lifecycle type."""
+
+    def __init__(self, settings: AdmissionConfig) -> None:
+        for name, limit in settings.limits.items():
+            if limit.concurrency <= 0:
+                raise ConfigError("Admission concurrency for %s must be greater than zero" % name)
+            if limit.queue_depth < 0:
+                raise ConfigError("Admission queue depth for %s must not be negative" % name)
+        total = sum(limit.concurrency for limit in settings.limits.values())
+        if total >= THREAD_POOL_SIZE:
+            raise ConfigError(
+                "Total admission concurrency (%d) must be less than the thread pool size (%d)" % (total, THREAD_POOL_SIZE)
+            )
+        self.queue_timeout_sec = settings.queue_timeout_sec
+        self.retry_after_sec = settings.retry_after_sec
+        self.gates = {name: Gate(name, limit.concurrency, limit.queue_depth) for name, limit in settings.limits.items()}
+
+    def gate(self, name: Optional[str]) -> Optional[Gate]:
+        """Return the gate for a lifecycle type, or None if it has no limits."""
+        return self.gates.get(name or DEFAULT) or self.gates.get(DEFAULT)
+
+    def status(self) -> List[GateStatus]:
+        return [gate.status() for gate in self.gates.values()]
+
+
+_CONTROLLER: Optional[AdmissionController] = None
+_CONFIGURED = False
+
+
+def reset() -> None:
+    """Reset the admission controller singleton, forcing it to be reloaded when next used."""
+    global _CONTROLLER, _CONFIGURED  # pylint: disable=global-statement
+    _CONTROLLER = None
+    _CONFIGURED = False
+
+
+def controller() -> Optional[AdmissionController]:
+    """Return the configured admission controller, or None if admission control is disabled, caching the instance."""
+    global _CONTROLLER, _CONFIGURED  # pylint: disable=global-statement
+    if not _CONFIGURED:
+        configured = config().admission
+        _CONTROLLER = AdmissionController(configured) if configured and configured.limits else None
+        _CONFIGURED = True
+    return _CONTROLLER
+
+
+@asynccontextmanager
+async def admitted(body: Union[str, bytes], headers: Mapping[str, str]) -> AsyncIterator[None]:
+    """
+    Hold a slot for a request while it is dispatched, raising OverloadedError if it must be shed.
+
+    When signatures are checked, a request with no signature is rejected with SignatureError
+    before it can take a slot.
+    """
+    admission = controller()
+    name = lifecycle(body) if admission else None
+    gate = admission.gate(name) if admission else None
+    if not admission or not gate:
+        yield
+        return
+    if config().dispatcher.check_signatures and not signed(headers):
+        raise SignatureError("Authorization header is not a signature", SmartAppRequestContext(headers=headers).correlation_id)
+    if not await gate.acquire(admission.queue_timeout_sec):
+        logging.warning("Shedding %s request, over limits for %s", name or "unknown", gate.name)
+        raise OverloadedError("Over limits for %s" % gate.name, admission.retry_after_sec)
+    try:
+        yield
+    finally:
+        gate.release()
+
+
+def admission_status() -> List[GateStatus]:
+    """Return the status of each gate, or nothing if admission control is disabled."""
+    admission = controller()
+    return admission.status() if admission else []
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Streaming windowed aggregation of sensor readings before they are written.
+
+Readings are accumulated per series, identified by (location, device, attribute), into
+fixed windows aligned to the epoch.  Each series needs only constant state per open
+window (count, min, max and sum).  Because every series shares the same window
+boundaries, closing windows is just a matter of checking the oldest open window, so the
+cost per reading stays constant no matter how many series are active.
+
+Closed windows are emitted as points in the configured measurement (`sensor_1m` by
+default), timestamped at the start of the window.  As for rollup buckets, the mean
+keeps the original field name and the other aggregates are stored in fields suffixed
+with `_min`, `_max` and `_count`.
+
+Windows are removed as they are collected, so concurrent callers never write the same
+window twice.  If the write fails, the caller restores the collected results, so the
+windows are written again on the next attempt.  Readings are only added once the raw
+points for their request have been written, so a slow request can add a reading to a
+window that another request has already collected.  Every series shares the same window
+boundaries and closed windows are collected for every series at once, so a single
+watermark records how far windows have been collected.  A reading for a window before
+the watermark that isn't open again (restored after a failed write) is dropped and
+counted, since writing the window again would overwrite the full aggregate with a
+partial one.
+"""
+import logging
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Dict, List, Optional
+
+from attrs import frozen
+from influxdb_client import Point
+
+from sensortrack.config import config
+from sensortrack.devices import directory
+from sensortrack.recent import SeriesKey
+
+
+class _Aggregate:
+    """Running aggregate for one series in one window."""
+
+    __slots__ = ["count", "low", "high", "total"]
+
+    def __init__(self, value: float) -> None:
+        self.count = 1
+        self.low = value
+        self.high = value
+        self.total = value
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.low = min(self.low, value)
+        self.high = max(self.high, value)
+        self.total += value
+
+    def merge(self, count: int, low: float, high: float, total: float) -> None:
+        self.count += count
+        self.low = min(self.low, low)
+        self.high = max(self.high, high)
+        self.total += total
+
+
+@frozen(kw_only=True)
+class WindowResult:
+    """Aggregates for one series over a closed window."""
+
+    start: int
+    key: SeriesKey
+    count: int
+    low: float
+    high: float
+    mean: float
+
+
+class WindowAggregator:
+    """Aggregates readings into fixed windows, emitting results as windows close."""
+
+    def __init__(self, window_sec: int, measurement: str, keep_raw: bool = False) -> None:
+        self.window_sec = window_sec
+        self.measurement = measurement
+        self.keep_raw = keep_raw
+        self.late = 0  # readings dropped because their window had already been collected
+        self._windows: Dict[int, Dict[SeriesKey, _Aggregate]] = {}
+        self._collected_through = 0  # windows starting before this have been collected for every series
+        self._lock = Lock()
+
+    def add(self, key: SeriesKey, timestamp: float, value: float) -> None:
+        """Add a reading to the window containing its timestamp, unless that window has already been collected."""
+        start = int(timestamp // self.window_sec) * self.window_sec
+        with self._lock:
+            if start < self._collected_through and start not in self._windows:
+                self.late += 1
+                logging.debug(
+                    "Dropped reading at %s, its window was already collected through %s", timestamp, self._collected_through
+                )
+                return
+            window = self._windows.setdefault(start, {})
+            aggregate = window.get(key)
+            if aggregate is None:
+                window[key] = _Aggregate(value)
+            else:
+                aggregate.add(value)
+
+    def collect(self, now: Optional[float] = None) -> List[WindowResult]:
+        """Remove and return results for windows that have closed as of now, or for all windows if now is None."""
+        results: List[WindowResult] = []
+        with self._lock:
+            for start in sorted(self._windows):
+                if now is not None and start + self.window_sec > now:
+                    break
+                self._collected_through = max(self._collected_through, start + self.window_sec)
+                for key, aggregate in self._windows.pop(start).items():
+                    results.append(
+                        WindowResult(
+                            start=start,
+                            key=key,
+                            count=aggregate.count,
+                            low=aggregate.low,
+                            high=aggregate.high,
+                            mean=aggregate.total / aggregate.count,
+                        )
+                    )
+        return results
+
+    def restore(self, results: List[WindowResult]) -> None:
+        """Restore collected results that could not be written, merging them with anything added since."""
+        with self._lock:
+            for result in results:
+                window = self._windows.setdefault(result.start, {})
+                aggregate = window.get(result.key)
+                if aggregate is None:
+                    aggregate = window[result.key] = _Aggregate(result.low)
+                    aggregate.count, aggregate.total = 0, 0.0
+                aggregate.merge(result.count, result.low, result.high, result.mean * result.count)
+
+    def points(self, results: List[WindowResult]) -> List[Point]:
+        """Convert results into points to be written."""
+        points = []
+        for result in results:
+            location_id, device_id, attribute = result.key
+            point = (
+                Point(self.measurement)
+                .tag("location", location_id)
+                .tag("device", device_id)
+                .field(attribute, round(result.mean, 2))
+                .field("%s_min" % attribute, result.low)
+                .field("%s_max" % attribute, result.high)
+                .field("%s_count" % attribute, result.count)
+                .time(datetime.fromtimestamp(result.start, tz=timezone.utc))
+            )
+            for tag, value in directory().tags(location_id, device_id).items():
+                point.tag(tag, value)
+            points.append(point)
+        return points
+
+
+_AGGREGATOR: Optional[WindowAggregator] = None
+_CONFIGURED = False
+
+
+def reset() -> None:
+    """Reset the aggregator singleton, discarding all open windows."""
+    global _AGGREGATOR, _CONFIGURED  # pylint: disable=global-statement
+    _AGGREGATOR = None
+    _CONFIGURED = False
+
+
+def aggregator() -> Optional[WindowAggregator]:
+    """Return the configured aggregator, or None if aggregation is disabled, creating it once and caching the instance."""
+    global _AGGREGATOR, _CONFIGURED  # pylint: disable=global-statement
+    if not _CONFIGURED:
+        aggregation = config().aggregation
+        if aggregation:
+            _AGGREGATOR = WindowAggregator(aggregation.window_sec, aggregation.measurement, aggregation.keep_raw)
+        _CONFIGURED = True
+    return _AGGREGATOR
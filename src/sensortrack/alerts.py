@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=too-many-positional-arguments:
+
+"""
+Streaming threshold and anomaly alerts on sensor readings.
+
+Readings are offered to the alert engine as they are processed by the event handler.
+Offering a reading only places it on a bounded queue, so alerting never adds latency to
+the write path; if the queue is full, the reading is dropped and counted.  A single
+worker thread evaluates each reading against the configured rules and delivers any
+resulting alerts to the configured sinks.
+
+State is constant per rule and series, identified by (location, device, attribute):
+
+- Threshold rules remember whether the series was last in the alerting state, so an
+  alert fires when the value crosses the threshold rather than on every reading.
+
+- Anomaly rules keep an exponentially-weighted moving average and variance, and fire
+  when a value is more than threshold standard deviations away from the average.
+
+Repeated alerts for the same rule and series are suppressed until the cooldown expires.  A
+threshold crossing that is suppressed doesn't count as entering the alerting state, so the
+rule fires on the first reading past the threshold once the cooldown has expired.
+
+See: https://fanf2.user.srcf.net/hermes/doc/antiforgery/stats.pdf (Finch, incremental EWMA variance)
+"""
+import json
+import logging
+import math
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from queue import Full, Queue
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from attrs import asdict, frozen
+
+from sensortrack.config import AlertCondition, AlertRuleConfig, AlertSinkConfig, AlertSinkType, ConfigError, config
+from sensortrack.recent import SeriesKey
+
+_CLIENT_TIMEOUT_SEC = 5.0  # timeout for webhook deliveries
+_MAX_STATES = 16384  # rule/series states tracked in total; the least recently used state is discarded beyond this
+
+Offered = Tuple[str, str, str, float, float]  # (location, device, attribute, value, timestamp)
+
+
+@frozen(kw_only=True)
+class Alert:
+    """An alert raised by a rule for a series."""
+
+    rule: str
+    location_id: str
+    device_id: str
+    attribute: str
+    value: float
+    timestamp: float
+    message: str
+
+
+class AlertSink(ABC):
+    """A destination that alerts are delivered to."""
+
+    @abstractmethod
+    def send(self, alert: Alert) -> None:
+        """Deliver an alert, raising an exception on failure."""
+
+
+class LogSink(AlertSink):
+    """Delivers alerts to the application log."""
+
+    def send(self, alert: Alert) -> None:
+        logging.warning("Alert [%s]: %s", alert.rule, alert.message)
+
+
+class WebhookSink(AlertSink):
+    """Delivers alerts by POSTing them as JSON to a URL."""
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+
+    def send(self, alert: Alert) -> None:
+        response = requests.post(url=self.url, json=asdict(alert), timeout=_CLIENT_TIMEOUT_SEC)
+        response.raise_for_status()
+
+
+class FileSink(AlertSink):
+    """Delivers alerts by appending them as JSON lines to a file."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def send(self, alert: Alert) -> None:
+        with open(self.path, "a", encoding="utf-8") as fp:
+            fp.write(json.dumps(asdict(alert)) + "\n")
+
+
+def create_sink(sink: AlertSinkConfig) -> AlertSink:
+    """Create a sink based on configuration."""
+    if sink.type == AlertSinkType.WEBHOOK:
+        if not sink.url:
+            raise ConfigError("Webhook alert sink requires a url")
+        return WebhookSink(sink.url)
+    if sink.type == AlertSinkType.FILE:
+        if not sink.path:
+            raise ConfigError("File alert sink requires a path")
+        return FileSink(sink.path)
+    return LogSink()
+
+
+class _RuleState:
+    """Evaluation state for one rule and series."""
+
+    __slots__ = ["count", "mean", "variance", "active", "last_fired"]
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.mean = 0.0
+        self.variance = 0.0
+        self.active = False
+        self.last_fired = -math.inf
+
+
+class AlertEngine:
+    """Evaluates rules against readings on a worker thread, delivering alerts to sinks."""
+
+    def __init__(self, rules: List[AlertRuleConfig], sinks: List[AlertSink], queue_size: int) -> None:
+        self.rules = rules
+        self.sinks = sinks
+        self.dropped = 0
+        self._by_attribute: Dict[str, List[AlertRuleConfig]] = {}
+        for rule in rules:
+            self._by_attribute.setdefault(rule.attribute, []).append(rule)
+        self._states: "OrderedDict[Tuple[str, SeriesKey], _RuleState]" = OrderedDict()
+        self._queue: "Queue[Optional[Offered]]" = Queue(maxsize=queue_size)
+        self._lock = Lock()
+        self._stopping = Event()  # lets the worker stop once the queue is empty, if the queue was too full to signal it
+        self._worker: Optional[Thread] = None
+
+    def start(self) -> None:
+        """Start the worker thread."""
+        self._stopping.clear()
+        self._worker = Thread(target=self._run, name="alerts", daemon=True)
+        self._worker.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Stop the worker thread once it has evaluated all queued readings, waiting no longer than the timeout."""
+        if self._worker:
+            self._stopping.set()
+            try:
+                self._queue.put_nowait(None)
+            except Full:
+                pass  # the worker stops when it finds the queue empty
+            self._worker.join(timeout)
+            self._worker = None
+
+    def offer(self, location_id: str, device_id: str, attribute: str, value: float, timestamp: Optional[float] = None) -> None:
+        """Queue a reading for evaluation without blocking, dropping it if the queue is full."""
+        if attribute not in self._by_attribute:
+            return
+        try:
+            self._queue.put_nowait((location_id, device_id, attribute, value, time.time() if timestamp is None else timestamp))
+        except Full:
+            with self._lock:
+                self.dropped += 1
+
+    def evaluate(self, location_id: str, device_id: str, attribute: str, value: float, timestamp: float) -> List[Alert]:
+        """Evaluate a reading against all applicable rules, returning any alerts raised."""
+        raised = []
+        key = (location_id, device_id, attribute)
+        for rule in self._by_attribute.get(attribute, []):
+            if rule.device and rule.device != device_id:
+                continue
+            state = self._states.get((rule.name, key))
+            if state is None:
+                if len(self._states) >= _MAX_STATES:
+                    self._states.popitem(last=False)
+                state = self._states[(rule.name, key)] = _RuleState()
+            else:
+                self._states.move_to_end((rule.name, key))
+            message = self._check(rule, state, value)
+            if message and timestamp - state.last_fired >= rule.cooldown_sec:
+                state.last_fired = timestamp
+                state.active = True  # only a crossing that fires enters the alerting state
+                raised.append(
+                    Alert(
+                        rule=rule.name,
+                        location_id=location_id,
+                        device_id=device_id,
+                        attribute=attribute,
+                        value=value,
+                        timestamp=timestamp,
+                        message="%s on %s/%s: %s" % (attribute, location_id, device_id, message),
+                    )
+                )
+        return raised
+
+    def _check(self, rule: AlertRuleConfig, state: _RuleState, value: float) -> Optional[str]:
+        """Update state for a reading, returning a message if the rule should fire."""
+        if rule.condition == AlertCondition.ABOVE:
+            return self._crossing(state, value > rule.threshold, "%s is above %s" % (value, rule.threshold))
+        if rule.condition == AlertCondition.BELOW:
+            return self._crossing(state, value < rule.threshold, "%s is below %s" % (value, rule.threshold))
+        message = None
+        if state.count >= rule.min_samples and state.variance > 0:
+            deviations = abs(value - state.mean) / math.sqrt(state.variance)
+            if deviations > rule.threshold:
+                message = "%s is %.1f standard deviations from average %.2f" % (value, deviations, state.mean)
+        if state.count == 0:
+            state.mean = value
+        else:
+            delta = value - state.mean
+            state.mean += rule.alpha * delta
+            state.variance = (1.0 - rule.alpha) * (state.variance + rule.alpha * delta * delta)
+        state.count += 1
+        return message
+
+    @staticmethod
+    def _crossing(state: _RuleState, alerting: bool, message: str) -> Optional[str]:
+        """Return the message only when a series enters the alerting state, which it does when the alert fires."""
+        if not alerting:
+            state.active = False
+            return None
+        return None if state.active else message
+
+    def _deliver(self, alert: Alert) -> None:
+        for sink in self.sinks:
+            try:
+                sink.send(alert)
+            except Exception:  # pylint: disable=broad-except:
+                logging.exception("Failed to deliver alert to %s", type(sink).__name__)
+
+    def _run(self) -> None:
+        while True:
+            offered = self._queue.get()
+            if offered is None:
+                return
+            try:
+                for alert in self.evaluate(*offered):
+                    self._deliver(alert)
+            except Exception:  # pylint: disable=broad-except:
+                logging.exception("Failed to evaluate alert rules")
+            if self._stopping.is_set() and self._queue.empty():
+                return
+
+
+_ENGINE: Optional[AlertEngine] = None
+_CONFIGURED = False
+
+
+def shutdown() -> None:
+    """Stop the alert engine, if it was started, once all queued readings have been evaluated."""
+    if _ENGINE:
+        _ENGINE.stop()
+
+
+def reset() -> None:
+    """Reset the alert engine singleton, stopping the engine if it is running."""
+    global _ENGINE, _CONFIGURED  # pylint: disable=global-statement
+    shutdown()
+    _ENGINE = None
+    _CONFIGURED = False
+
+
+def alerts() -> Optional[AlertEngine]:
+    """Return the configured alert engine, or None if alerts are disabled, starting it once and caching the instance."""
+    global _ENGINE, _CONFIGURED  # pylint: disable=global-statement
+    if not _CONFIGURED:
+        configured = config().alerts
+        if configured and configured.rules:
+            _ENGINE = AlertEngine(configured.rules, [create_sink(sink) for sink in configured.sinks], configured.queue_size)
+            _ENGINE.start()
+        _CONFIGURED = True
+    return _ENGINE
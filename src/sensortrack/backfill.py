@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Backfill of historical weather from National Weather Service observations.
+
+The event handler only ever records the latest observation, so any time the SmartApp
+isn't running leaves a permanent gap in the weather measurement.  The backfill retrieves
+the station's historical observations over a time range, one page at a time, and writes
+each one as a weather point stamped with its observation time, including the derived
+dew point and heat index.
+
+Hours that already have weather data for the location are skipped, so a backfill only
+fills the gaps, and running it again over the same range writes nothing new.  Points are
+written to the configured output sinks in batches.
+"""
+import logging
+from datetime import datetime, timezone
+from typing import List, Set
+
+from attrs import define
+from influxdb_client import InfluxDBClient, Point
+
+from sensortrack.comfort import DEW_POINT, HEAT_INDEX, HUMIDITY, TEMPERATURE, dew_point, heat_index
+from sensortrack.config import config
+from sensortrack.sinks import destination, sink
+from sensortrack.weather import Observation, retrieve_observations
+
+_HOUR_SEC = 60 * 60
+
+
+@define
+class BackfillResult:
+    """Counts of observations processed by a backfill."""
+
+    observed: int = 0
+    present: int = 0
+    invalid: int = 0
+    written: int = 0
+
+
+def weather_point(location_id: str, observation: Observation) -> Point:
+    """Build a weather point for an observation, which must have a timestamp and at least one value."""
+    point = Point("weather").tag("location", location_id)
+    if observation.temperature is not None:
+        point.field(TEMPERATURE, observation.temperature)
+    if observation.humidity is not None:
+        point.field(HUMIDITY, observation.humidity)
+    if observation.temperature is not None and observation.humidity is not None:
+        point.field(DEW_POINT, dew_point(observation.temperature, observation.humidity))
+        point.field(HEAT_INDEX, heat_index(observation.temperature, observation.humidity))
+    return point.time(datetime.fromtimestamp(observation.timestamp or 0.0, tz=timezone.utc))
+
+
+def _present_hours(location_id: str, start: datetime, end: datetime) -> Set[int]:
+    """Return the hours, in epoch hours, that already have weather data for a location."""
+    influxdb = destination(config().influxdb, "weather", location_id)  # wherever weather for this location is routed
+    query = (
+        'from(bucket: "%s")\n'
+        "  |> range(start: params.start, stop: params.stop)\n"
+        '  |> filter(fn: (r) => r._measurement == "weather" and r.location == params.location)\n'
+        '  |> filter(fn: (r) => r._field == "temperature" or r._field == "humidity")\n'
+        '  |> keep(columns: ["_time"])'
+    ) % influxdb.bucket
+    params = {"start": start, "stop": end, "location": location_id}
+    hours = set()
+    with InfluxDBClient(url=influxdb.url, org=influxdb.org, token=influxdb.token) as client:
+        for record in client.query_api().query_stream(query, params=params):
+            hours.add(int(record.values["_time"].timestamp()) // _HOUR_SEC)
+    return hours
+
+
+def backfill_weather(
+    location_id: str, latitude: float, longitude: float, start: datetime, end: datetime, *, batch_size: int = 500
+) -> BackfillResult:
+    """Backfill weather for a location over a time range, skipping hours that already have weather data."""
+    result = BackfillResult()
+    present = _present_hours(location_id, start, end) if config().sinks.influxdb else set()
+    logging.info("Found %d hour(s) that already have weather data", len(present))
+    batch: List[Point] = []
+    for observation in retrieve_observations(latitude, longitude, start, end):
+        result.observed += 1
+        if observation.timestamp is None or (observation.temperature is None and observation.humidity is None):
+            result.invalid += 1
+        elif int(observation.timestamp) // _HOUR_SEC in present:
+            result.present += 1
+        else:
+            batch.append(weather_point(location_id, observation))
+            if len(batch) >= batch_size:
+                sink().write(batch, block=True)
+                result.written += len(batch)
+                batch = []
+                logging.info("Wrote %d weather point(s) so far", result.written)
+    if batch:
+        sink().write(batch, block=True)
+        result.written += len(batch)
+    sink().flush(final=True)
+    return result
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Shared cache, with pluggable backends for running more than one node.
+
+Station lookups, location details and the EVENT redelivery check are all cached.  With
+a single process, an in-memory cache is all that's needed.  With several processes or
+nodes behind a load balancer, each would otherwise keep its own copy, multiplying calls
+to the upstream APIs and missing redeliveries that land on a different node.  The
+backend is configurable:
+
+- `memory`: a bounded LRU cache in the process, the default.
+
+- `file`: one small JSON file per entry in a local directory, shared by every process
+  on the host.  The number of files is bounded, and the oldest are pruned first.
+
+- `redis`: any server speaking the Redis protocol (Redis, Valkey, KeyDB, etc.), shared
+  by every node.  The client is built in, so no additional package is needed.  It keeps
+  a small pool of connections, and stops trying for a while after repeated connection
+  failures.  Size is bounded by the server's own `maxmemory` policy.
+
+Each user of the cache works in its own namespace, with its own TTL, and values are
+stored as JSON.  The cache is only ever an optimization, so a failing backend is logged
+and treated as a miss rather than failing the request.
+"""
+import fcntl
+import json
+import logging
+import os
+import socket
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock, get_ident
+from typing import Any, BinaryIO, List, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+from attrs import frozen
+
+from sensortrack.config import CacheBackendType, CacheConfig, ConfigError, config
+from sensortrack.rest import CircuitBreaker
+
+PREFIX = "sensortrack"  # prefix for every key, so the cache can be shared with other applications
+
+_PRUNE_EVERY = 100  # file backend entries are pruned after this many writes
+_LOCK_FILE = ".lock"  # file backend lock, held while claiming an entry with add()
+_REDIS_PORT = 6379
+_REDIS_POOL_SIZE = 4  # idle connections kept open to the redis server
+_REDIS_FAILURE_THRESHOLD = 3  # consecutive connection failures before the redis backend stops trying
+_REDIS_RESET_TIMEOUT_SEC = 10.0  # how long the redis backend stops trying for
+
+Reply = Union[None, int, str, List[Any]]
+
+
+@frozen
+class CacheError(Exception):
+    """An error returned by a cache backend."""
+
+    message: str
+
+
+class CacheBackend(ABC):
+    """A store of string values with expiry, shared across namespaces."""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        """Return the value for a key, or None if it is missing or expired."""
+
+    @abstractmethod
+    def set(self, key: str, value: str, ttl_sec: float) -> None:
+        """Set the value for a key, expiring after a TTL."""
+
+    @abstractmethod
+    def add(self, key: str, value: str, ttl_sec: float) -> bool:
+        """Set the value for a key only if it is missing or expired, returning whether it was set."""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """Delete the value for a key, if there is one."""
+
+
+class MemoryBackend(CacheBackend):
+    """Bounded LRU cache in the process."""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, Tuple[float, str]] = OrderedDict()  # key -> (expires, value)
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: str, ttl_sec: float) -> None:
+        with self._lock:
+            self._set(key, value, ttl_sec)
+
+    def add(self, key: str, value: str, ttl_sec: float) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                return False
+            self._set(key, value, ttl_sec)
+            return True
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _set(self, key: str, value: str, ttl_sec: float) -> None:
+        self._entries[key] = (time.time() + ttl_sec, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class FileBackend(CacheBackend):
+    """One JSON file per entry in a local directory, shared by every process on the host."""
+
+    def __init__(self, path: str, max_entries: int) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self._writes = 0
+        self._lock = Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, "%s.json" % sha256(key.encode("UTF-8")).hexdigest())
+
+    def _read(self, path: str) -> Optional[str]:
+        try:
+            with open(path, "r", encoding="utf-8") as fp:
+                entry = json.load(fp)
+        except (OSError, ValueError):
+            return None  # missing, or being replaced right now
+        return entry["value"] if entry["expires"] > time.time() else None
+
+    def get(self, key: str) -> Optional[str]:
+        return self._read(self._file(key))
+
+    def _write(self, path: str, value: str, ttl_sec: float) -> None:
+        temporary = "%s.%d.%d.tmp" % (path, os.getpid(), get_ident())
+        with open(temporary, "w", encoding="utf-8") as fp:
+            json.dump({"expires": time.time() + ttl_sec, "value": value}, fp)
+        os.replace(temporary, path)  # so readers never see a partially-written entry
+        self._written()
+
+    def set(self, key: str, value: str, ttl_sec: float) -> None:
+        self._write(self._file(key), value, ttl_sec)
+
+    def add(self, key: str, value: str, ttl_sec: float) -> bool:
+        # The check and the write must be atomic, otherwise two processes (or threads) could both see an
+        # expired entry and both claim it, or one could remove an entry that another has just claimed
+        path = self._file(key)
+        with open(os.path.join(self.path, _LOCK_FILE), "a", encoding="utf-8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # released when the file is closed
+            if self._read(path) is not None:
+                return False
+            self._write(path, value, ttl_sec)
+            return True
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def _written(self) -> None:
+        with self._lock:
+            self._writes += 1
+            if self._writes % _PRUNE_EVERY:
+                return
+        self.prune()
+
+    def prune(self) -> None:
+        """Remove the oldest entries beyond the maximum."""
+        with os.scandir(self.path) as entries:
+            files = sorted(((entry.stat().st_mtime, entry.path) for entry in entries if entry.name.endswith(".json")), reverse=True)
+        for _, path in files[self.max_entries :]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class _RedisConnection:
+    """A single connection to a server speaking the Redis protocol."""
+
+    def __init__(self, host: str, port: int, timeout_sec: float) -> None:
+        self.socket = socket.create_connection((host, port), timeout=timeout_sec)
+        self.reader: BinaryIO = self.socket.makefile("rb")
+
+    def close(self) -> None:
+        self.reader.close()
+        self.socket.close()
+
+    def execute(self, *args: str) -> Reply:
+        encoded = [arg.encode("UTF-8") for arg in args]
+        self.socket.sendall(b"*%d\r\n" % len(encoded) + b"".join(b"$%d\r\n%s\r\n" % (len(arg), arg) for arg in encoded))
+        return self._reply()
+
+    def _reply(self) -> Reply:
+        line = self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by cache server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("UTF-8")
+        if kind == b"-":
+            raise CacheError(rest.decode("UTF-8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            return None if length < 0 else self.reader.read(length + 2)[:-2].decode("UTF-8")
+        if kind == b"*":
+            count = int(rest)
+            return None if count < 0 else [self._reply() for _ in range(count)]
+        raise ConnectionError("Unexpected reply from cache server")
+
+
+class RedisBackend(CacheBackend):
+    """
+    Client for a server speaking the Redis protocol.
+
+    Each command takes an idle connection from a small pool, or opens a new one, so
+    concurrent callers aren't serialized behind a single connection.  After repeated
+    connection failures, a circuit breaker fails commands fast for a while, rather than
+    every caller waiting on the connect timeout while the server is down.
+    """
+
+    def __init__(self, url: str, timeout_sec: float, pool_size: int = _REDIS_POOL_SIZE) -> None:
+        parsed = urlparse(url)
+        if parsed.scheme != "redis":
+            raise ConfigError("The redis cache backend requires a redis:// URL")
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or _REDIS_PORT
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or "0")
+        self.timeout_sec = timeout_sec
+        self.pool_size = pool_size
+        self.breaker = CircuitBreaker(failure_threshold=_REDIS_FAILURE_THRESHOLD, reset_timeout_sec=_REDIS_RESET_TIMEOUT_SEC)
+        self._idle: List[_RedisConnection] = []
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        return self.command("GET", key)  # type: ignore[return-value]
+
+    def set(self, key: str, value: str, ttl_sec: float) -> None:
+        self.command("SET", key, value, "PX", str(int(ttl_sec * 1000)))
+
+    def add(self, key: str, value: str, ttl_sec: float) -> bool:
+        return self.command("SET", key, value, "PX", str(int(ttl_sec * 1000)), "NX") is not None
+
+    def delete(self, key: str) -> None:
+        self.command("DEL", key)
+
+    def command(self, *args: str) -> Reply:
+        """Execute a command on a pooled connection, connecting first if necessary."""
+        if not self.breaker.allow():
+            raise CacheError("Cache server at %s:%d is unavailable" % (self.host, self.port))
+        try:
+            connection = self._acquire()
+            try:
+                reply = connection.execute(*args)
+            except CacheError:
+                self._release(connection)  # an error reply, but the connection is still usable
+                raise
+            except BaseException:
+                connection.close()  # the connection may be in any state, so don't reuse it
+                raise
+            self._release(connection)
+        except OSError:
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        self.breaker.record_success()
+        return reply
+
+    def close(self) -> None:
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def _acquire(self) -> _RedisConnection:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        connection = _RedisConnection(self.host, self.port, self.timeout_sec)
+        try:
+            if self.password:
+                connection.execute("AUTH", self.password)
+            if self.db:
+                connection.execute("SELECT", str(self.db))
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    def _release(self, connection: _RedisConnection) -> None:
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+
+def create_backend(settings: CacheConfig) -> CacheBackend:
+    """Create a cache backend based on configuration."""
+    if settings.backend == CacheBackendType.FILE:
+        if not settings.path:
+            raise ConfigError("The file cache backend requires a path")
+        return FileBackend(settings.path, settings.max_entries)
+    if settings.backend == CacheBackendType.REDIS:
+        if not settings.url:
+            raise ConfigError("The redis cache backend requires a url")
+        return RedisBackend(settings.url, settings.timeout_sec)
+    return MemoryBackend(settings.max_entries)
+
+
+class Cache:
+    """A namespace in the shared cache, holding JSON values with a TTL."""
+
+    def __init__(self, namespace: str, ttl_sec: float) -> None:
+        self.namespace = namespace
+        self.ttl_sec = ttl_sec
+
+    def _key(self, key: str) -> str:
+        return "%s:%s:%s" % (PREFIX, self.namespace, key)
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for a key, or None on a miss."""
+        try:
+            value = backend().get(self._key(key))
+            return json.loads(value) if value is not None else None
+        except Exception as e:  # pylint: disable=broad-except:
+            logging.warning("Cache get failed for %s: %s", self.namespace, e)
+            return None
+
+    def set(self, key: str, value: Any) -> None:
+        """Cache the value for a key."""
+        try:
+            backend().set(self._key(key), json.dumps(value), self.ttl_sec)
+        except Exception as e:  # pylint: disable=broad-except:
+            logging.warning("Cache set failed for %s: %s", self.namespace, e)
+
+    def add(self, key: str, value: Any = True, ttl_sec: Optional[float] = None) -> bool:
+        """Cache the value for a key only if there isn't one already, returning whether it was added."""
+        try:
+            return backend().add(self._key(key), json.dumps(value), ttl_sec if ttl_sec is not None else self.ttl_sec)
+        except Exception as e:  # pylint: disable=broad-except:
+            logging.warning("Cache add failed for %s: %s", self.namespace, e)
+            return True  # as if the key were missing
+
+    def delete(self, key: str) -> None:
+        """Remove the cached value for a key."""
+        try:
+            backend().delete(self._key(key))
+        except Exception as e:  # pylint: disable=broad-except:
+            logging.warning("Cache delete failed for %s: %s", self.namespace, e)
+
+
+_BACKEND: Optional[CacheBackend] = None
+_LOCK = Lock()
+
+
+def reset() -> None:
+    """Reset the cache backend singleton, discarding everything cached in memory."""
+    global _BACKEND  # pylint: disable=global-statement
+    with _LOCK:
+        if isinstance(_BACKEND, RedisBackend):
+            _BACKEND.close()
+        _BACKEND = None
+
+
+def backend() -> CacheBackend:
+    """Return the configured cache backend, creating it once and caching the instance."""
+    global _BACKEND  # pylint: disable=global-statement
+    with _LOCK:
+        if _BACKEND is None:
+            _BACKEND = create_backend(config().cache)
+        return _BACKEND
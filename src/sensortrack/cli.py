@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Command line interface for offline maintenance tasks.
+
+Commands use the same server configuration as the SmartApp, taken either from the
+--config option or from $SENSORTRACK_CONFIG_PATH.
+"""
+import argparse
+import logging
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, List, Optional
+
+from influxdb_client.client.exceptions import InfluxDBError
+from urllib3.exceptions import HTTPError
+
+from sensortrack.backfill import backfill_weather
+from sensortrack.coldstart import benchmark
+from sensortrack.config import ConfigError, config
+from sensortrack.dispatcher import definition
+from sensortrack.export import ExportError, ExportFormat, export
+from sensortrack.fakes import FakeInfluxDb, FakeKeyServer, FakeSmartThings, FakeWeather, Faults
+from sensortrack.importer import BulkImportError, import_files
+from sensortrack.loadgen import KEY_ID, LoadGenerator, LoadProfile, RequestGenerator, RequestSigner, load_key
+from sensortrack.rest import RestClientError, RestDataError
+from sensortrack.sinks import WriteRejectedError
+
+
+def _timestamp(value: str) -> datetime:
+    """Parse an ISO 8601 timestamp, which is assumed to be UTC if no offset is given."""
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError("invalid timestamp: %s" % value) from e
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _positive(value: str) -> int:
+    """Parse a positive integer, for sizes and counts where zero or less would never make progress."""
+    try:
+        parsed = int(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError("invalid integer: %s" % value) from e
+    if parsed <= 0:
+        raise argparse.ArgumentTypeError("must be greater than zero: %s" % value)
+    return parsed
+
+
+def _export(args: argparse.Namespace) -> None:
+    rows = export(
+        output=args.output,
+        start=args.start,
+        stop=args.stop,
+        measurements=args.measurement,
+        file_format=ExportFormat(args.format),
+        chunk_sec=args.chunk_hours * 60 * 60,
+        workers=args.workers,
+    )
+    print("Exported %d row(s) to %s" % (rows, args.output))
+
+
+def _import(args: argparse.Namespace) -> None:
+    result = import_files(
+        paths=args.files,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        rate=args.rate,
+        deduplicate=not args.no_dedup,
+    )
+    print(
+        "Read %d row(s): wrote %d reading(s), skipped %d invalid and %d duplicate"
+        % (result.read, result.written, result.invalid, result.duplicate)
+    )
+
+
+def _backfill_weather(args: argparse.Namespace) -> None:
+    result = backfill_weather(
+        location_id=args.location,
+        latitude=args.latitude,
+        longitude=args.longitude,
+        start=args.start,
+        end=args.end,
+        batch_size=args.batch_size,
+    )
+    print(
+        "Retrieved %d observation(s): wrote %d, skipped %d already present and %d invalid"
+        % (result.observed, result.written, result.present, result.invalid)
+    )
+
+
+def _loadgen(args: argparse.Namespace) -> None:
+    key = load_key(args.key)
+    keyserver = None if args.no_keyserver else FakeKeyServer(key, KEY_ID, port=args.keyserver_port)
+    if keyserver:
+        keyserver.start()
+        print("Serving the signing key at %s, which must be the server's dispatcher.keyserverUrl" % keyserver.url)
+    try:
+        profile = LoadProfile(
+            locations=args.locations,
+            devices=args.devices,
+            batch_size=args.batch_size,
+            timer_ratio=args.timer_ratio,
+        )
+        signer = RequestSigner(key, target_url=args.target_url or definition().target_url)
+        generator = LoadGenerator(args.url, RequestGenerator(profile), signer, concurrency=args.concurrency)
+        print(generator.run(rate=args.rate, duration_sec=args.duration).summary())
+    finally:
+        if keyserver:
+            keyserver.stop()
+
+
+def _coldstart(args: argparse.Namespace) -> None:
+    key = load_key(args.key)
+    keyserver = None if args.no_keyserver else FakeKeyServer(key, KEY_ID, port=args.keyserver_port)
+    if keyserver:
+        keyserver.start()
+    try:
+        signer = RequestSigner(key, target_url=args.target_url or definition().target_url)
+        print(benchmark(signer, runs=args.runs, config_path=args.config).summary())
+    finally:
+        if keyserver:
+            keyserver.stop()
+
+
+def _fakes(args: argparse.Namespace) -> None:
+    faults = Faults(
+        latency_sec=args.latency_ms / 1000.0,
+        jitter_sec=args.jitter_ms / 1000.0,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        throttle_rate=args.throttle_rate,
+    )
+    services = [
+        FakeSmartThings(devices=args.devices, port=args.smartthings_port, faults=faults),
+        FakeWeather(fixture_dir=args.fixtures, port=args.weather_port, faults=faults),
+        FakeInfluxDb(port=args.influxdb_port, faults=faults),
+        FakeKeyServer(load_key(args.key), KEY_ID, port=args.keyserver_port, faults=faults),
+    ]
+    for service in services:
+        service.start()
+        print("Fake %s at %s" % (service.name, service.url))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for service in services:
+            service.stop()
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="sensortrack", description="Maintenance tasks for sensor data in InfluxDB")
+    parser.add_argument("--config", help="Path to the server configuration, overriding $SENSORTRACK_CONFIG_PATH")
+    parser.add_argument("--verbose", action="store_true", help="Log progress details")
+    parser.set_defaults(configured=True)
+    commands = parser.add_subparsers(dest="command", required=True)
+    _add_data_commands(commands)
+    _add_testing_commands(commands)
+    return parser
+
+
+def _add_data_commands(commands: Any) -> None:
+    """Add commands that move data in and out of InfluxDB."""
+    command = commands.add_parser("export", help="Export measurements from InfluxDB to CSV or Parquet files")
+    command.add_argument("--start", type=_timestamp, required=True, help="Start of the range, inclusive (ISO 8601)")
+    command.add_argument("--stop", type=_timestamp, required=True, help="End of the range, exclusive (ISO 8601)")
+    command.add_argument("--output", required=True, help="Output directory, which also holds the checkpoint")
+    command.add_argument("--format", choices=[item.value for item in ExportFormat], default=ExportFormat.CSV.value)
+    command.add_argument("--measurement", action="append", help="Measurement to export, may be repeated (default: all)")
+    command.add_argument("--chunk-hours", type=_positive, default=24, help="Size of the time range queried at once")
+    command.add_argument("--workers", type=_positive, default=4, help="Number of chunks queried in parallel")
+    command.set_defaults(handler=_export)
+
+    command = commands.add_parser("import", help="Import readings from CSV (export format) or line protocol files")
+    command.add_argument("files", nargs="+", help="Files to import, CSV if named *.csv and line protocol otherwise")
+    command.add_argument("--batch-size", type=_positive, default=5000, help="Number of readings written at once")
+    command.add_argument("--workers", type=_positive, default=4, help="Number of batches written in parallel")
+    command.add_argument("--rate", type=float, help="Maximum rows read per second (default: unlimited)")
+    command.add_argument("--no-dedup", action="store_true", help="Don't check for readings that already exist in InfluxDB")
+    command.set_defaults(handler=_import)
+
+    command = commands.add_parser("backfill-weather", help="Backfill gaps in weather data from historical observations")
+    command.add_argument("--location", required=True, help="SmartThings location id that weather is recorded for")
+    command.add_argument("--latitude", type=float, required=True, help="Latitude of the location")
+    command.add_argument("--longitude", type=float, required=True, help="Longitude of the location")
+    command.add_argument("--start", type=_timestamp, required=True, help="Start of the range (ISO 8601)")
+    command.add_argument("--end", type=_timestamp, required=True, help="End of the range (ISO 8601)")
+    command.add_argument("--batch-size", type=_positive, default=500, help="Number of points written at once")
+    command.set_defaults(handler=_backfill_weather)
+
+
+def _add_testing_commands(commands: Any) -> None:
+    """Add commands used for load and chaos testing, which don't need server configuration."""
+    command = commands.add_parser("loadgen", help="Send signed EVENT requests to a SmartApp server at a target rate")
+    command.add_argument("--url", default="http://localhost:8080/smartapp", help="SmartApp endpoint to send requests to")
+    command.add_argument("--rate", type=float, default=10.0, help="Target requests per second")
+    command.add_argument("--duration", type=float, default=60.0, help="Duration of the run in seconds")
+    command.add_argument("--locations", type=int, default=1, help="Number of locations")
+    command.add_argument("--devices", type=int, default=10, help="Number of devices per location")
+    command.add_argument("--batch-size", type=int, default=1, help="Number of device events per request")
+    command.add_argument("--timer-ratio", type=float, default=0.0, help="Fraction of requests that are weather timer events")
+    command.add_argument("--concurrency", type=int, default=16, help="Maximum requests in flight")
+    command.add_argument("--key", help="PEM file with the RSA signing key (default: generate a new key)")
+    command.add_argument("--keyserver-port", type=int, default=8090, help="Port for the local key server")
+    command.add_argument("--no-keyserver", action="store_true", help="Don't serve the key, because fakes are serving it")
+    command.add_argument("--target-url", help="Target URL the server was registered with (default: from the definition)")
+    command.set_defaults(handler=_loadgen, configured=False)
+
+    command = commands.add_parser("fakes", help="Run local fake upstream services until interrupted")
+    command.add_argument("--smartthings-port", type=int, default=8091, help="Port for the fake SmartThings API")
+    command.add_argument("--weather-port", type=int, default=8092, help="Port for the fake weather.gov API")
+    command.add_argument("--influxdb-port", type=int, default=8093, help="Port for the fake InfluxDB")
+    command.add_argument("--keyserver-port", type=int, default=8090, help="Port for the fake key server")
+    command.add_argument("--key", help="PEM file with the RSA signing key, shared with loadgen (default: generate a new key)")
+    command.add_argument("--devices", type=int, default=10, help="Number of devices per location")
+    command.add_argument("--fixtures", help="Directory of recorded weather fixtures to serve, like tests/fixtures")
+    command.add_argument("--latency-ms", type=float, default=0.0, help="Latency added to every response")
+    command.add_argument("--jitter-ms", type=float, default=0.0, help="Random additional latency, up to this amount")
+    command.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    command.add_argument("--error-status", type=int, default=500, help="Status returned for failed requests")
+    command.add_argument(
+        "--throttle-rate", type=float, help="Maximum requests per second per service, beyond which 429 is returned"
+    )
+    command.set_defaults(handler=_fakes, configured=False)
+
+    command = commands.add_parser("coldstart", help="Measure import and first-request time of the serverless entry point")
+    command.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to measure")
+    command.add_argument("--key", help="PEM file with the RSA signing key (default: generate a new key)")
+    command.add_argument("--keyserver-port", type=int, default=8090, help="Port for the local key server")
+    command.add_argument("--no-keyserver", action="store_true", help="Don't serve the key, because fakes are serving it")
+    command.add_argument("--target-url", help="Target URL the server was registered with (default: from the definition)")
+    command.set_defaults(handler=_coldstart, configured=False)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run the command line interface, returning the process exit status."""
+    args = _parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        if args.configured:
+            config(args.config)
+        args.handler(args)
+        return 0
+    except (ConfigError, ExportError, BulkImportError, RestClientError, RestDataError, WriteRejectedError) as e:
+        print("Error: %s" % e.message, file=sys.stderr)
+        return 1
+    except InfluxDBError as e:
+        print("Error: InfluxDB error: %s" % e.message, file=sys.stderr)
+        return 1
+    except (OSError, HTTPError) as e:  # files that can't be read or written, or an upstream that can't be reached
+        print("Error: %s" % e, file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Cold start benchmark for the serverless entry point.
+
+Each run starts a fresh Python interpreter, as a new function instance would, and
+measures how long it takes to import the entry point and then to handle a first
+request.  The request is a signed CONFIGURATION request, which exercises request
+parsing, signature verification and the dispatcher without calling SmartThings, the
+weather API or InfluxDB.  The benchmark also reports whether any of the modules that
+the entry point is supposed to avoid were loaded along the way.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import uuid
+from typing import Any, Dict, List, Optional
+
+from attrs import define, field
+
+from sensortrack.config import CONFIG_VAR
+from sensortrack.loadgen import RequestSigner
+
+# Modules that are only needed by the FastAPI server, which the entry point must not load
+AVOIDED_MODULES = ["fastapi", "pydantic", "starlette", "uvicorn"]
+
+# Runs in the fresh interpreter, with the event as its only argument, and prints the measurements as JSON
+_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+from sensortrack.serverless import handler
+imported = time.perf_counter()
+response = handler(json.loads(sys.argv[1]))
+finished = time.perf_counter()
+avoided = %r
+print(json.dumps({
+    "importSec": imported - started,
+    "firstRequestSec": finished - imported,
+    "statusCode": response["statusCode"],
+    "loaded": [name for name in avoided if name in sys.modules],
+}))
+"""
+
+_TIMEOUT_SEC = 120.0
+
+
+def configuration_event(signer: RequestSigner) -> Dict[str, Any]:
+    """Build a function URL event for a signed CONFIGURATION/INITIALIZE request."""
+    request = {
+        "lifecycle": "CONFIGURATION",
+        "executionId": str(uuid.uuid4()),
+        "locale": "en",
+        "version": "0.1.0",
+        "configurationData": {
+            "installedAppId": "coldstart",
+            "phase": "INITIALIZE",
+            "pageId": "",
+            "previousPageId": "",
+            "config": {},
+        },
+        "settings": {},
+    }
+    body = json.dumps(request).encode()
+    return {"headers": signer.headers(body), "body": body.decode(), "isBase64Encoded": False}
+
+
+@define
+class ColdStartReport:
+    """Results of a cold start benchmark, with times in seconds."""
+
+    imports: List[float] = field(factory=list)
+    first_requests: List[float] = field(factory=list)
+    statuses: List[int] = field(factory=list)
+    loaded: List[str] = field(factory=list)
+
+    def summary(self) -> str:
+        def stats(values: List[float]) -> str:
+            return "median=%.1f min=%.1f max=%.1f" % tuple(
+                1000.0 * x for x in (statistics.median(values), min(values), max(values))
+            )
+
+        lines = [
+            "Runs: %d, status codes: %s" % (len(self.statuses), " ".join(str(status) for status in sorted(set(self.statuses)))),
+            "Import (ms): %s" % stats(self.imports),
+            "First request (ms): %s" % stats(self.first_requests),
+            "Avoided modules loaded: %s" % (", ".join(self.loaded) if self.loaded else "none"),
+        ]
+        return "\n".join(lines)
+
+
+def measure(event: Dict[str, Any], config_path: Optional[str] = None) -> Dict[str, Any]:
+    """Measure import and first-request time for an event in a fresh interpreter."""
+    env = dict(os.environ)
+    if config_path:
+        env[CONFIG_VAR] = config_path
+    command = [sys.executable, "-c", _SCRIPT % AVOIDED_MODULES, json.dumps(event)]
+    result = subprocess.run(command, env=env, capture_output=True, text=True, timeout=_TIMEOUT_SEC, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])  # type: ignore
+
+
+def benchmark(signer: RequestSigner, runs: int = 5, config_path: Optional[str] = None) -> ColdStartReport:
+    """Run the cold start benchmark several times, returning the results."""
+    report = ColdStartReport()
+    for _ in range(runs):
+        result = measure(configuration_event(signer), config_path)
+        report.imports.append(result["importSec"])
+        report.first_requests.append(result["firstRequestSec"])
+        report.statuses.append(result["statusCode"])
+        report.loaded.extend(name for name in result["loaded"] if name not in report.loaded)
+    return report
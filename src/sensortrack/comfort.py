@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Derived comfort metrics, computed incrementally as readings arrive.
+
+Temperature and humidity arrive as separate readings, so the latest value of each is
+kept per device, identified by (location, device).  Whenever either one is updated and
+both are known, dew point and heat index are computed and written alongside the raw
+readings, so they don't need to be derived at query time.  Weather readings are joined
+the same way, against the pseudo-device `WEATHER_DEVICE`.
+
+Device temperatures are reported in either degrees F or degrees C, per the unit on each
+event, and weather readings are always in degrees F.  Temperatures are converted to
+degrees F for the formulas, and the dew point and heat index are returned in the unit of
+the device's latest temperature, so they are comparable with it.  A temperature in any
+other unit is ignored.
+
+Temperature and humidity are only paired if they were read within a maximum age of each
+other, so a device that stops reporting one of them doesn't keep producing metrics
+from a stale value.
+
+See: https://www.wpc.ncep.noaa.gov/html/heatindex_equation.shtml
+     https://en.wikipedia.org/wiki/Dew_point#Calculating_the_dew_point
+"""
+import math
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from attrs import frozen
+
+TEMPERATURE = "temperature"
+HUMIDITY = "humidity"
+DEW_POINT = "dew_point"
+HEAT_INDEX = "heat_index"
+
+FAHRENHEIT = "F"
+CELSIUS = "C"
+
+_MAX_DEVICES = 4096  # devices tracked in total; the least-recently-updated device is forgotten first
+_MAX_AGE_SEC = 30 * 60  # maximum time between a temperature and humidity for them to be paired
+_MAGNUS_B = 17.625  # Magnus coefficients, per Alduchov & Eskridge (1996)
+_MAGNUS_C = 243.04
+
+DeviceKey = Tuple[str, str]  # (location, device)
+Reading = Tuple[float, float, str]  # (value, timestamp, unit), with temperatures in degrees F and their original unit
+
+
+@frozen(kw_only=True)
+class Comfort:
+    """Comfort metrics derived from a temperature and humidity."""
+
+    dew_point: float
+    heat_index: float
+
+    def fields(self) -> List[Tuple[str, float]]:
+        """Return the metrics as (attribute, value) pairs."""
+        return [(DEW_POINT, self.dew_point), (HEAT_INDEX, self.heat_index)]
+
+
+def to_fahrenheit(temperature: float, unit: str) -> float:
+    """Convert a temperature in degrees F or C to degrees F."""
+    return temperature * 9.0 / 5.0 + 32.0 if unit == CELSIUS else temperature
+
+
+def from_fahrenheit(temperature: float, unit: str) -> float:
+    """Convert a temperature in degrees F to degrees F or C, rounded like the formulas."""
+    return round((temperature - 32.0) * 5.0 / 9.0, 2) if unit == CELSIUS else temperature
+
+
+def dew_point(temperature: float, humidity: float) -> float:
+    """Dew point in degrees F for a temperature in degrees F and a relative humidity in percent."""
+    celsius = (temperature - 32.0) * 5.0 / 9.0
+    gamma = math.log(max(humidity, 0.1) / 100.0) + (_MAGNUS_B * celsius) / (_MAGNUS_C + celsius)
+    return round((_MAGNUS_C * gamma / (_MAGNUS_B - gamma)) * 9.0 / 5.0 + 32.0, 2)
+
+
+def heat_index(temperature: float, humidity: float) -> float:
+    """Heat index in degrees F for a temperature in degrees F and a relative humidity in percent, per the NWS algorithm."""
+    simple = 0.5 * (temperature + 61.0 + ((temperature - 68.0) * 1.2) + (humidity * 0.094))
+    if (simple + temperature) / 2.0 < 80.0:
+        return round(simple, 2)
+    t, rh = temperature, humidity
+    result = (
+        -42.379
+        + 2.04901523 * t
+        + 10.14333127 * rh
+        - 0.22475541 * t * rh
+        - 0.00683783 * t * t
+        - 0.05481717 * rh * rh
+        + 0.00122874 * t * t * rh
+        + 0.00085282 * t * rh * rh
+        - 0.00000199 * t * t * rh * rh
+    )
+    if rh < 13.0 and 80.0 <= t <= 112.0:
+        result -= ((13.0 - rh) / 4.0) * math.sqrt((17.0 - abs(t - 95.0)) / 17.0)
+    elif rh > 85.0 and 80.0 <= t <= 87.0:
+        result += ((rh - 85.0) / 10.0) * ((87.0 - t) / 5.0)
+    return round(result, 2)
+
+
+class ComfortJoin:
+    """Joins the latest temperature and humidity per device, computing comfort metrics as either one changes."""
+
+    def __init__(self, max_devices: int = _MAX_DEVICES, max_age_sec: float = _MAX_AGE_SEC) -> None:
+        self.max_devices = max_devices
+        self.max_age_sec = max_age_sec
+        self._latest: OrderedDict[DeviceKey, Dict[str, Reading]] = OrderedDict()
+        self._lock = Lock()
+
+    def update(
+        self,
+        location_id: str,
+        device_id: str,
+        attribute: str,
+        value: float,
+        *,
+        timestamp: Optional[float] = None,
+        unit: Optional[str] = None,
+    ) -> Optional[Comfort]:
+        """
+        Update the latest value for a device, returning comfort metrics if both temperature and humidity are known.
+
+        The timestamp defaults to now, and the unit of a temperature defaults to degrees F.
+        """
+        if attribute not in (TEMPERATURE, HUMIDITY):
+            return None
+        unit = (unit or FAHRENHEIT).upper()
+        if attribute == TEMPERATURE:
+            if unit not in (FAHRENHEIT, CELSIUS):
+                return None
+            value = to_fahrenheit(value, unit)
+        key = (location_id, device_id)
+        with self._lock:
+            latest = self._latest.get(key)
+            if latest is None:
+                latest = {}
+                self._latest[key] = latest
+                if len(self._latest) > self.max_devices:
+                    self._latest.popitem(last=False)
+            else:
+                self._latest.move_to_end(key)
+            latest[attribute] = (value, time.time() if timestamp is None else timestamp, unit)
+            temperature, humidity = latest.get(TEMPERATURE), latest.get(HUMIDITY)
+        if temperature is None or humidity is None or abs(temperature[1] - humidity[1]) > self.max_age_sec:
+            return None
+        return Comfort(
+            dew_point=from_fahrenheit(dew_point(temperature[0], humidity[0]), temperature[2]),
+            heat_index=from_fahrenheit(heat_index(temperature[0], humidity[0]), temperature[2]),
+        )
+
+
+_COMFORT: Optional[ComfortJoin] = None
+
+
+def reset() -> None:
+    """Reset the comfort join singleton, discarding all state."""
+    global _COMFORT  # pylint: disable=global-statement
+    _COMFORT = None
+
+
+def comfort() -> ComfortJoin:
+    """Return the comfort join, creating it once and caching the instance."""
+    global _COMFORT  # pylint: disable=global-statement
+    if _COMFORT is None:
+        _COMFORT = ComfortJoin()
+    return _COMFORT
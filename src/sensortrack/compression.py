@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Compression of sensor readings before they are written.
+
+Compression is applied per series, identified by (location, device, attribute), and is
+configured with an error bound (the deviation) and a maximum interval between points:
+
+- Deadband: a reading is written only if it differs from the last written reading by
+  more than the deviation.
+
+- Swinging door: a reading is written only when the series can no longer be represented
+  by a straight line from the last written point that stays within the deviation of
+  every reading since.  When that happens, the previous reading (with its original
+  timestamp) is written and becomes the new pivot.  If the previous reading itself lies
+  outside the doors, which happens when earlier readings narrowed them, the point on the
+  nearest door at its timestamp is written instead; that point is within the deviation of
+  the previous reading, too.  Linear interpolation between written points is therefore
+  always within the deviation of the original readings.
+
+In both cases, a reading is always written once the maximum interval has elapsed since
+the last written point, so flat series still get periodic points, along with any held
+reading so the error bound still holds.  Because the swinging door holds back the most
+recent reading, held readings are flushed at shutdown.
+
+Offering a reading changes the state of its series before anything has been written.
+Callers can pass in a dict to save the prior state of each series they touch, and
+restore it if the write fails, so readings that are retried aren't compressed away.
+
+See: Bristol, E.H. "Swinging Door Trending: Adaptive Trend Recording?" ISA National Conference Proceedings, 1990
+"""
+import logging
+import math
+from collections import OrderedDict
+from copy import copy
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from sensortrack.config import CompressionMethod, config
+
+_MAX_SERIES = 4096  # series tracked in total; the least-recently-updated series is forgotten first
+
+SeriesKey = Tuple[str, str, str]  # (location, device, attribute)
+Reading = Tuple[float, float]  # (timestamp in epoch seconds, value)
+Saved = Dict[SeriesKey, Optional["_SeriesState"]]  # state of each series before it was changed, None if it was new
+
+
+class _SeriesState:
+    """Compression state for a single series."""
+
+    def __init__(self, timestamp: float, value: float) -> None:
+        self.pivot: Reading = (timestamp, value)  # the last written reading
+        self.held: Optional[Reading] = None  # the most recent reading not yet written, if any
+        self.upper = math.inf  # smallest slope of the upper door
+        self.lower = -math.inf  # largest slope of the lower door
+
+    def archived(self) -> Optional[Reading]:
+        """Return the held reading as it should be written, moved onto the nearest door if it lies outside the doors."""
+        if self.held is None:
+            return None
+        timestamp, value = self.held[0], self.held[1]
+        elapsed = timestamp - self.pivot[0]
+        slope = (value - self.pivot[1]) / elapsed
+        if self.lower <= slope <= self.upper:
+            return self.held
+        return timestamp, self.pivot[1] + min(max(slope, self.lower), self.upper) * elapsed
+
+    def restart(self, pivot: Reading) -> None:
+        self.pivot = pivot
+        self.held = None
+        self.upper = math.inf
+        self.lower = -math.inf
+
+
+class Compressor:
+    """Stateful per-series compressor."""
+
+    def __init__(self, method: CompressionMethod, deviation: float, max_interval_sec: float, max_series: int = _MAX_SERIES) -> None:
+        self.method = method
+        self.deviation = deviation
+        self.max_interval_sec = max_interval_sec
+        self.max_series = max_series
+        self.dropped = 0  # readings dropped because they were not newer than the last written point
+        self._series: OrderedDict[SeriesKey, _SeriesState] = OrderedDict()
+        self._lock = Lock()
+
+    def offer(self, key: SeriesKey, timestamp: float, value: float, saved: Optional[Saved] = None) -> List[Reading]:
+        """
+        Offer a reading for a series, returning the readings (if any) that should be written now.
+
+        If `saved` is passed, the state of the series is saved into it before its first change,
+        so the change can be undone with restore().
+        """
+        with self._lock:
+            state = self._series.get(key)
+            if saved is not None and key not in saved:
+                saved[key] = copy(state) if state else None
+            if state is None:
+                self._series[key] = _SeriesState(timestamp, value)
+                if len(self._series) > self.max_series:
+                    self._series.popitem(last=False)
+                return [(timestamp, value)]
+            self._series.move_to_end(key)
+            if timestamp - state.pivot[0] >= self.max_interval_sec:
+                held = state.archived()
+                state.restart((timestamp, value))
+                return [held, (timestamp, value)] if held else [(timestamp, value)]
+            if self.method == CompressionMethod.DEADBAND:
+                return self._deadband(state, timestamp, value)
+            return self._swinging_door(state, timestamp, value)
+
+    def _deadband(self, state: _SeriesState, timestamp: float, value: float) -> List[Reading]:
+        if abs(value - state.pivot[1]) > self.deviation:
+            state.restart((timestamp, value))
+            return [(timestamp, value)]
+        return []
+
+    def _swinging_door(self, state: _SeriesState, timestamp: float, value: float) -> List[Reading]:
+        elapsed = timestamp - state.pivot[0]
+        if elapsed <= 0:
+            # out-of-order or duplicate timestamp; nothing sensible to do with it
+            self.dropped += 1
+            logging.debug("Dropped reading at %s, not newer than the last written point at %s", timestamp, state.pivot[0])
+            return []
+        upper = min(state.upper, (value + self.deviation - state.pivot[1]) / elapsed)
+        lower = max(state.lower, (value - self.deviation - state.pivot[1]) / elapsed)
+        if lower <= upper:
+            state.upper, state.lower, state.held = upper, lower, (timestamp, value)
+            return []
+        # The doors have opened past parallel, so the held reading is archived and becomes the new pivot
+        archived = state.archived() or state.pivot
+        state.restart(archived)
+        elapsed = timestamp - archived[0]
+        state.upper = (value + self.deviation - archived[1]) / elapsed
+        state.lower = (value - self.deviation - archived[1]) / elapsed
+        state.held = (timestamp, value)
+        return [archived]
+
+    def flush(self, saved: Optional[Saved] = None) -> List[Tuple[SeriesKey, Reading]]:
+        """Return and clear all held readings, so they can be written at shutdown, optionally saving state as for offer()."""
+        held: List[Tuple[SeriesKey, Reading]] = []
+        with self._lock:
+            for key, state in self._series.items():
+                archived = state.archived()
+                if archived:
+                    if saved is not None and key not in saved:
+                        saved[key] = copy(state)
+                    held.append((key, archived))
+                    state.restart(archived)
+        return held
+
+    def restore(self, saved: Saved) -> None:
+        """Restore the state saved by offer() or flush(), undoing changes for readings that were not written."""
+        with self._lock:
+            for key, state in saved.items():
+                if state is None:
+                    self._series.pop(key, None)
+                else:
+                    self._series[key] = state
+
+
+_COMPRESSOR: Optional[Compressor] = None
+_CONFIGURED = False
+
+
+def reset() -> None:
+    """Reset the compressor singleton, discarding all state."""
+    global _COMPRESSOR, _CONFIGURED  # pylint: disable=global-statement
+    _COMPRESSOR = None
+    _CONFIGURED = False
+
+
+def compressor() -> Optional[Compressor]:
+    """Return the configured compressor, or None if compression is disabled, creating it once and caching the instance."""
+    global _COMPRESSOR, _CONFIGURED  # pylint: disable=global-statement
+    if not _CONFIGURED:
+        compression = config().compression
+        if compression:
+            _COMPRESSOR = Compressor(compression.method, compression.deviation, compression.max_interval_sec)
+        _CONFIGURED = True
+    return _COMPRESSOR
@@ -5,11 +5,12 @@
 Server configuration
 """
 import os
+from enum import Enum
 from os import R_OK, access
 from os.path import isfile
-from typing import Optional
+from typing import Dict, List, Optional
 
-from attrs import frozen
+from attrs import field, frozen
 from smartapp.converter import StandardConverter
 
 # We read this environment variable to find the server configuration YAML file on disk
@@ -39,6 +40,31 @@ class SmartThingsApiConfig:
     base_url: str
 
 
+@frozen
+class RollupConfig:
+    """A rollup bucket holding min/mean/max aggregates of the raw bucket over a fixed window."""
+
+    bucket: str
+    every: str  # Flux duration literal, like "5m" or "1h"
+    retention_sec: int = 0  # 0 means infinite retention
+
+
+@frozen
+class InfluxDbRouteConfig:
+    """A rule routing points for a location or measurement to their own InfluxDB destination and writer queue."""
+
+    name: str  # identifies the route in logs and metrics
+    location: Optional[str] = None  # if set, only points for this location id match
+    measurement: Optional[str] = None  # if set, only points for this measurement match
+    url: Optional[str] = None  # the url, org, token and bucket each default to the main InfluxDB configuration
+    org: Optional[str] = None
+    token: Optional[str] = None
+    bucket: Optional[str] = None
+    batch_size: int = 500  # maximum points written at once
+    flush_interval_sec: float = 1.0  # maximum time a point waits for a batch to fill
+    queue_size: int = 10000  # points waiting to be written; writes are rejected rather than blocking when full
+
+
 @frozen
 class InfluxDbConfig:
     """InfluxDB configuration."""
@@ -47,16 +73,216 @@ class InfluxDbConfig:
     org: str
     token: str
     bucket: str
+    rollups: List[RollupConfig] = field(factory=list)
+    routes: List[InfluxDbRouteConfig] = field(factory=list)  # if set, every destination is written by its own queue
+
+
+class CompressionMethod(str, Enum):
+    """Compression methods for sensor readings."""
+
+    DEADBAND = "deadband"
+    SWINGING_DOOR = "swinging-door"
+
+
+@frozen
+class CompressionConfig:
+    """Compression of sensor readings before they are written."""
+
+    method: CompressionMethod
+    deviation: float  # error bound, in the units of the reading
+    max_interval_sec: int = 900  # a reading is always written at least this often
+
+
+@frozen
+class AggregationConfig:
+    """Windowed aggregation of sensor readings before they are written."""
+
+    window_sec: int = 60
+    measurement: str = "sensor_1m"
+    keep_raw: bool = False  # whether raw readings are also written, in addition to the aggregates
+
+
+class AlertCondition(str, Enum):
+    """Conditions that an alert rule can evaluate."""
+
+    ABOVE = "above"  # value rises above the threshold
+    BELOW = "below"  # value falls below the threshold
+    ANOMALY = "anomaly"  # value deviates from the moving average by more than threshold standard deviations
+
+
+@frozen
+class AlertRuleConfig:
+    """A rule evaluated against each sensor reading for an attribute."""
+
+    name: str
+    attribute: str
+    condition: AlertCondition
+    threshold: float
+    device: Optional[str] = None  # if set, the rule only applies to this device id
+    alpha: float = 0.1  # smoothing factor for the moving average and variance used by anomaly rules
+    min_samples: int = 30  # anomaly rules only fire once a series has at least this many readings
+    cooldown_sec: int = 900  # minimum time between repeated alerts for the same rule and series
+
+
+class AlertSinkType(str, Enum):
+    """Types of sink that alerts can be delivered to."""
+
+    LOG = "log"
+    WEBHOOK = "webhook"
+    FILE = "file"
+
+
+@frozen
+class AlertSinkConfig:
+    """A sink that alerts are delivered to."""
+
+    type: AlertSinkType
+    url: Optional[str] = None  # required for webhook sinks
+    path: Optional[str] = None  # required for file sinks
+
+
+@frozen
+class AlertsConfig:
+    """Streaming alerts on sensor readings."""
+
+    rules: List[AlertRuleConfig]
+    sinks: List[AlertSinkConfig]
+    queue_size: int = 10000  # readings waiting to be evaluated; readings are dropped rather than blocking when full
+
+
+class ColumnarFormat(str, Enum):
+    """File formats supported by the columnar file sink."""
+
+    PARQUET = "parquet"
+    ARROW = "arrow"
+
+
+@frozen
+class ColumnarSinkConfig:
+    """Local columnar file sink, partitioned by measurement and day."""
+
+    path: str
+    format: ColumnarFormat = ColumnarFormat.PARQUET
+    max_rows: int = 10000  # a partition's buffered rows are written to a new file once it has this many
+    max_age_sec: int = 300  # buffered rows are written at least this often
+
+
+@frozen
+class SinksConfig:
+    """Output sinks that points are written to."""
+
+    influxdb: bool = True
+    columnar: Optional[ColumnarSinkConfig] = None
+
+
+class OverflowPolicy(str, Enum):
+    """What happens to readings from an installed app that is over its quota."""
+
+    DROP = "drop"
+    AGGREGATE = "aggregate"
+    SPOOL = "spool"
+
+
+@frozen
+class QuotaConfig:
+    """Per-installed-app write quotas."""
+
+    points_per_sec: float  # sustained rate of readings written per installed app
+    burst: int = 0  # readings that may be written at once above the sustained rate; 0 means one second's worth
+    max_series: int = 0  # distinct (location, device, attribute) series per installed app; 0 means unlimited
+    overflow: OverflowPolicy = OverflowPolicy.DROP
+    aggregate_sec: int = 60  # window for readings aggregated on overflow
+    aggregate_measurement: str = "sensor_overflow"  # measurement that aggregated readings are written to
+    spool_path: Optional[str] = None  # directory that readings are spooled to on overflow, as line protocol
+
+
+@frozen
+class LoggingConfig:
+    """Asynchronous logging, with sampled logging of request and response bodies."""
+
+    queue_size: int = 10000  # records waiting to be written; records are dropped rather than blocking when full
+    body_sample_rate: float = 0.0  # fraction of correlation ids whose request and response bodies are logged
+
+
+@frozen
+class AdmissionLimitConfig:
+    """Limits for a lifecycle type."""
+
+    concurrency: int  # requests dispatched at once
+    queue_depth: int = 0  # requests waiting for a slot; requests beyond this are shed
+
+
+@frozen
+class AdmissionConfig:
+    """Admission control for SmartApp lifecycle requests."""
+
+    limits: Dict[str, AdmissionLimitConfig] = field(factory=dict)  # by lifecycle type, like EVENT, or "default"
+    queue_timeout_sec: float = 5.0  # requests waiting longer than this for a slot are shed
+    retry_after_sec: int = 5  # Retry-After returned with a 503 when a request is shed
+
+
+@frozen
+class ReadinessConfig:
+    """Background dependency checks that back the readiness endpoint."""
+
+    interval_sec: float = 15.0  # how often dependencies are checked
+    timeout_sec: float = 5.0  # timeout for the InfluxDB ping
+    max_pending_points: int = 0  # not ready if more points than this are waiting to be written; 0 means no limit
+    max_spool_bytes: int = 0  # not ready if the quota spool is larger than this; 0 means no limit
+
+
+class CacheBackendType(str, Enum):
+    """Backends for the shared cache."""
+
+    MEMORY = "memory"
+    FILE = "file"
+    REDIS = "redis"
+
+
+@frozen
+class CacheConfig:
+    """Shared cache for station lookups, locations and redelivered events."""
+
+    backend: CacheBackendType = CacheBackendType.MEMORY
+    path: Optional[str] = None  # directory for the file backend
+    url: Optional[str] = None  # server for the redis backend, like redis://:password@host:6379/0
+    max_entries: int = 10000  # bound for the memory and file backends; redis is bounded by its maxmemory policy
+    timeout_sec: float = 0.5  # connect and read timeout for the redis backend
+
+
+@frozen
+class WarmupConfig:
+    """Startup warm-up."""
+
+    budget_sec: float = 10.0  # warm-up steps that would start after this are skipped
+
+
+@frozen
+class DataApiConfig:
+    """Access to the endpoints that serve sensor history, which are disabled unless configured."""
+
+    token: str  # bearer token that /recent and /series requests must present
 
 
 @frozen
-class ServerConfig:
+class ServerConfig:  # pylint: disable=too-many-instance-attributes:
     """Server configuration."""
 
     dispatcher: SmartAppDispatcherConfig
     smartthings: SmartThingsApiConfig
     weather: WeatherApiConfig
     influxdb: InfluxDbConfig
+    compression: Optional[CompressionConfig] = None
+    aggregation: Optional[AggregationConfig] = None
+    alerts: Optional[AlertsConfig] = None
+    sinks: SinksConfig = field(factory=SinksConfig)
+    logging: Optional[LoggingConfig] = None
+    admission: Optional[AdmissionConfig] = None
+    quotas: Optional[QuotaConfig] = None
+    readiness: ReadinessConfig = field(factory=ReadinessConfig)
+    warmup: WarmupConfig = field(factory=WarmupConfig)
+    cache: CacheConfig = field(factory=CacheConfig)
+    data_api: Optional[DataApiConfig] = None
 
 
 _CONFIG: Optional[ServerConfig] = None
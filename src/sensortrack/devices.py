@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Directory of device names and rooms, used to enrich sensor points with readable tags.
+
+Sensor points are tagged with opaque location and device ids.  The directory maps each
+device to its label and room, as retrieved from the SmartThings API, so points can also
+be tagged with `device_name` and `room` without an API call per event.
+
+The directory for a location is populated in bulk when the SmartApp is installed or
+updated, and is refreshed lazily when it is older than its TTL.  If a device is seen
+that the directory doesn't know about, the directory is refreshed early, but no more
+often than the retry interval, which also applies after a failed refresh.  Lazy
+refreshes run in the background, one at a time per location, and events are tagged
+from the existing (stale) directory in the meantime, so an EVENT request never waits
+on the SmartThings API.
+
+Every new tag value starts a new series in InfluxDB, so tag cardinality is bounded:
+
+- Tag values are normalized (whitespace collapsed) and truncated, so trivial edits to
+  a label don't produce a new value.
+
+- Names are only picked up at refresh time, so a device that is repeatedly renamed
+  contributes at most one new name per TTL.
+
+- The number of devices tracked is bounded, with the least-recently-refreshed devices
+  evicted first.
+
+Because the name and room are tags, renaming a device or moving it to another room
+starts a new series for it in InfluxDB, and a Flux query that groups by all tags will
+see its history split across the old and new series.  Query by the `device` tag to
+follow a device across renames.
+"""
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Optional, Set, Tuple
+
+from attrs import frozen
+
+from sensortrack.smartthings import retrieve_devices, retrieve_rooms
+
+_TTL_SEC = 24 * 60 * 60  # how long a location's directory is used before being refreshed
+_RETRY_SEC = 5 * 60  # minimum time between refreshes when a device is unknown, or after a failure
+_MAX_DEVICES = 4096  # devices tracked in total
+_MAX_TAG_LENGTH = 64  # tag values are truncated to this length
+
+DeviceKey = Tuple[str, str]  # (location, device)
+
+
+@frozen(kw_only=True)
+class DeviceInfo:
+    """Name and room for a device."""
+
+    name: str
+    room: Optional[str] = None
+
+
+def normalize_tag(value: str) -> str:
+    """Normalize a value for use as a tag, collapsing whitespace and truncating."""
+    return " ".join(value.split())[:_MAX_TAG_LENGTH]
+
+
+class DeviceDirectory:
+    """Cache of device names and rooms, refreshed per location."""
+
+    def __init__(self, ttl_sec: float = _TTL_SEC, retry_sec: float = _RETRY_SEC, max_devices: int = _MAX_DEVICES) -> None:
+        self.ttl_sec = ttl_sec
+        self.retry_sec = retry_sec
+        self.max_devices = max_devices
+        self._devices: OrderedDict[DeviceKey, DeviceInfo] = OrderedDict()
+        self._refreshed: Dict[str, float] = {}  # when each location was last refreshed or attempted
+        self._unknown: Set[str] = set()  # locations where an unknown device has been seen since the last refresh
+        self._refreshing: Set[str] = set()  # locations with a refresh in progress
+        self._lock = Lock()
+
+    def populate(self, location_id: str, devices: Dict[str, DeviceInfo]) -> None:
+        """Replace the directory for a location."""
+        with self._lock:
+            for key in [key for key in self._devices if key[0] == location_id]:
+                del self._devices[key]
+            for device_id, info in devices.items():
+                room = normalize_tag(info.room) if info.room else None
+                self._devices[(location_id, device_id)] = DeviceInfo(name=normalize_tag(info.name), room=room)
+            while len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+            self._refreshed[location_id] = time.time()
+            self._unknown.discard(location_id)
+            self._refreshing.discard(location_id)
+
+    def failed(self, location_id: str) -> None:
+        """Record a failed refresh for a location, so it isn't retried until the retry interval has passed."""
+        with self._lock:
+            self._refreshed[location_id] = time.time() - self.ttl_sec + self.retry_sec
+            self._refreshing.discard(location_id)
+
+    def is_stale(self, location_id: str) -> bool:
+        """Whether the directory for a location should be refreshed."""
+        with self._lock:
+            return self._is_stale(location_id)
+
+    def _is_stale(self, location_id: str) -> bool:
+        refreshed = self._refreshed.get(location_id)
+        if refreshed is None:
+            return True
+        age = time.time() - refreshed
+        return age >= self.ttl_sec or (location_id in self._unknown and age >= self.retry_sec)
+
+    def claim_refresh(self, location_id: str) -> bool:
+        """Claim the refresh of a stale location, returning False if it isn't stale or is already being refreshed."""
+        with self._lock:
+            if location_id in self._refreshing or not self._is_stale(location_id):
+                return False
+            self._refreshing.add(location_id)
+            return True
+
+    def tags(self, location_id: str, device_id: str) -> Dict[str, str]:
+        """Return the name and room tags for a device, which are empty if the device is unknown."""
+        with self._lock:
+            info = self._devices.get((location_id, device_id))
+            if info is None:
+                self._unknown.add(location_id)
+                return {}
+        return {"device_name": info.name, "room": info.room} if info.room else {"device_name": info.name}
+
+
+_DIRECTORY: Optional[DeviceDirectory] = None
+
+
+def reset() -> None:
+    """Reset the device directory singleton, discarding all devices."""
+    global _DIRECTORY  # pylint: disable=global-statement
+    _DIRECTORY = None
+
+
+def directory() -> DeviceDirectory:
+    """Return the device directory, creating it once and caching the instance."""
+    global _DIRECTORY  # pylint: disable=global-statement
+    if _DIRECTORY is None:
+        _DIRECTORY = DeviceDirectory()
+    return _DIRECTORY
+
+
+def refresh_directory(location_id: str) -> None:
+    """Refresh the directory for a location from the SmartThings API, which must be called within a SmartThings context."""
+    started = time.monotonic()
+    rooms = {room.room_id: room.name for room in retrieve_rooms()}
+    devices = {
+        device.device_id: DeviceInfo(name=device.label, room=rooms.get(device.room_id) if device.room_id else None)
+        for device in retrieve_devices()
+    }
+    directory().populate(location_id, devices)
+    logging.info("Refreshed device directory with %d device(s) in %.3f seconds", len(devices), time.monotonic() - started)
@@ -4,7 +4,8 @@
 """
 SmartApp dispatcher.
 """
-from typing import Optional
+from hashlib import sha256
+from typing import Optional, Tuple
 
 from importlib_resources import files
 from smartapp.converter import CONVERTER
@@ -19,19 +20,31 @@
 _DEFINITION_FILE = "definition.yaml"  # definition of the SmartApp
 
 
-def _load_definition() -> SmartAppDefinition:
+def _load_definition() -> Tuple[SmartAppDefinition, str]:
+    """Load the definition, along with its version, which is a digest of the definition file."""
     yaml = files(sensortrack.data).joinpath(_DEFINITION_FILE).read_text()
-    return CONVERTER.from_yaml(yaml, SmartAppDefinition)
+    return CONVERTER.from_yaml(yaml, SmartAppDefinition), sha256(yaml.encode("UTF-8")).hexdigest()
 
 
 _DISPATCHER: Optional[SmartAppDispatcher] = None
-_DEFINITION = _load_definition()
+_DEFINITION, _DEFINITION_VERSION = _load_definition()
 
 
 def reset() -> None:
-    """Reset the config singleton, forcing it to be reloaded when next used."""
-    global _DISPATCHER  # pylint: disable=global-statement
+    """Reset the config singleton and reload the definition, forcing them to be reloaded when next used."""
+    global _DISPATCHER, _DEFINITION, _DEFINITION_VERSION  # pylint: disable=global-statement
     _DISPATCHER = None
+    _DEFINITION, _DEFINITION_VERSION = _load_definition()
+
+
+def definition() -> SmartAppDefinition:
+    """Return the SmartApp definition."""
+    return _DEFINITION
+
+
+def definition_version() -> str:
+    """Return the version of the SmartApp definition, which changes whenever the definition file changes."""
+    return _DEFINITION_VERSION
 
 
 def dispatcher() -> SmartAppDispatcher:
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=import-outside-toplevel,too-many-positional-arguments:
+
+"""
+Bulk export of measurements from InfluxDB to CSV or Parquet files.
+
+The time range is split into fixed chunks, which are queried in parallel.  Each chunk is
+streamed record by record from InfluxDB into its own part file, so memory use does not
+depend on the size of the range, only on the number of workers.  Part files are written
+under a temporary name and renamed once complete.
+
+Completed chunks are recorded in a checkpoint file in the output directory.  If an export
+is interrupted, running it again with the same arguments skips the chunks that were
+already completed.
+
+Rows are exported in long format, one row per field value, with the columns listed in
+`COLUMNS`.  This is the same format accepted by the bulk import.
+"""
+import csv
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from enum import Enum
+from importlib.util import find_spec
+from threading import Lock
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from attrs import frozen
+from influxdb_client import InfluxDBClient
+
+from sensortrack.config import config
+from sensortrack.sinks import destinations
+
+COLUMNS = ["time", "measurement", "location", "device", "device_name", "room", "field", "value"]
+CHECKPOINT_FILE = ".checkpoint.json"
+
+_BATCH_ROWS = 10000  # rows per Parquet row group, which bounds the memory used per worker
+_MEASUREMENT = re.compile(r"^[A-Za-z0-9_]+$")
+
+Chunk = Tuple[int, int]  # [start, stop) in epoch seconds
+
+
+class ExportFormat(str, Enum):
+    """File formats supported for export."""
+
+    CSV = "csv"
+    PARQUET = "parquet"
+
+
+@frozen
+class ExportError(Exception):
+    """An error related to bulk export."""
+
+    message: str
+
+
+def chunks(start: datetime, stop: datetime, chunk_sec: int) -> List[Chunk]:
+    """Split [start, stop) into chunks of at most chunk_sec seconds."""
+    result = []
+    current, end = int(start.timestamp()), int(stop.timestamp())
+    while current < end:
+        result.append((current, min(current + chunk_sec, end)))
+        current += chunk_sec
+    return result
+
+
+def _flux_time(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def export_flux(bucket: str, measurements: Sequence[str], chunk: Chunk) -> str:
+    """Flux that retrieves all field values for a set of measurements over a chunk."""
+    condition = " or ".join('r._measurement == "%s"' % measurement for measurement in measurements)
+    return (
+        'from(bucket: "%s")\n' "  |> range(start: %s, stop: %s)\n" "  |> filter(fn: (r) => %s)\n" '  |> sort(columns: ["_time"])'
+    ) % (bucket, _flux_time(chunk[0]), _flux_time(chunk[1]), condition)
+
+
+def _rows(records: Iterable[Any]) -> Iterator[List[Any]]:
+    """Convert query records into export rows."""
+    for record in records:
+        values = record.values
+        yield [
+            values["_time"].astimezone(timezone.utc).isoformat(),
+            values["_measurement"],
+            values.get("location"),
+            values.get("device"),
+            values.get("device_name"),
+            values.get("room"),
+            values["_field"],
+            values["_value"],
+        ]
+
+
+def _write_csv(path: str, rows: Iterable[List[Any]]) -> int:
+    """Stream rows to a CSV file, returning the number of rows written."""
+    count = 0
+    with open(path, "w", encoding="utf-8", newline="") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(COLUMNS)
+        for row in rows:
+            writer.writerow(["" if value is None else value for value in row])
+            count += 1
+    return count
+
+
+def _write_parquet(path: str, rows: Iterable[List[Any]]) -> int:
+    """Stream rows to a Parquet file in fixed-size row groups, returning the number of rows written."""
+    import pyarrow  # pylint: disable=import-error:
+    import pyarrow.parquet  # pylint: disable=import-error:
+
+    schema = pyarrow.schema([(column, pyarrow.float64() if column == "value" else pyarrow.string()) for column in COLUMNS])
+    count = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        batch: List[List[Any]] = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= _BATCH_ROWS:
+                writer.write_table(pyarrow.Table.from_pylist([dict(zip(COLUMNS, row)) for row in batch], schema=schema))
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(pyarrow.Table.from_pylist([dict(zip(COLUMNS, row)) for row in batch], schema=schema))
+            count += len(batch)
+    return count
+
+
+class Checkpoint:
+    """Record of the completed chunks for an export, persisted as JSON."""
+
+    def __init__(self, path: str, settings: Dict[str, Any]) -> None:
+        self.path = path
+        self.settings = settings
+        self.completed: Set[int] = set()
+        self._lock = Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as fp:
+                saved = json.load(fp)
+            if saved["settings"] != settings:
+                raise ExportError("Output directory contains a checkpoint for a different export: %s" % path)
+            self.completed = set(saved["completed"])
+
+    def complete(self, chunk: Chunk) -> None:
+        """Mark a chunk as completed."""
+        with self._lock:
+            self.completed.add(chunk[0])
+            temporary = "%s.tmp" % self.path
+            with open(temporary, "w", encoding="utf-8") as fp:
+                json.dump({"settings": self.settings, "completed": sorted(self.completed)}, fp)
+            os.replace(temporary, self.path)
+
+
+def _query_chunk(measurements: Sequence[str], chunk: Chunk) -> Iterator[List[Any]]:
+    """Query rows for a chunk from every InfluxDB destination in turn, since points may be routed to any of them."""
+    for influxdb in destinations(config().influxdb):
+        with InfluxDBClient(url=influxdb.url, org=influxdb.org, token=influxdb.token) as client:
+            yield from _rows(client.query_api().query_stream(export_flux(influxdb.bucket, measurements, chunk), org=influxdb.org))
+
+
+def _export_chunk(output: str, measurements: Sequence[str], chunk: Chunk, file_format: ExportFormat, checkpoint: Checkpoint) -> int:
+    """Export a single chunk to its own part file, returning the number of rows exported."""
+    stamp = datetime.fromtimestamp(chunk[0], tz=timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    path = os.path.join(output, "part-%s.%s" % (stamp, file_format.value))
+    temporary = "%s.tmp" % path
+    writer = _write_parquet if file_format == ExportFormat.PARQUET else _write_csv
+    try:
+        count = writer(temporary, _query_chunk(measurements, chunk))
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)  # the chunk is exported again from scratch next time
+        raise
+    os.replace(temporary, path)
+    checkpoint.complete(chunk)
+    return count
+
+
+def _validate(measurements: Sequence[str], file_format: ExportFormat, chunk_sec: int, workers: int) -> None:
+    if chunk_sec <= 0:
+        raise ExportError("Chunk size must be greater than zero: %d" % chunk_sec)
+    if workers <= 0:
+        raise ExportError("Number of workers must be greater than zero: %d" % workers)
+    for measurement in measurements:
+        if not _MEASUREMENT.match(measurement):
+            raise ExportError("Invalid measurement: %s" % measurement)
+    if file_format == ExportFormat.PARQUET and find_spec("pyarrow") is None:
+        raise ExportError("Parquet export requires pyarrow, which is not installed")
+
+
+def export(
+    output: str,
+    start: datetime,
+    stop: datetime,
+    measurements: Optional[Sequence[str]] = None,
+    file_format: ExportFormat = ExportFormat.CSV,
+    chunk_sec: int = 24 * 60 * 60,
+    workers: int = 4,
+) -> int:
+    """Export measurements over [start, stop) into part files in an output directory, returning the number of rows exported."""
+    measurements = list(measurements or ["sensor", "weather"])
+    _validate(measurements, file_format, chunk_sec, workers)
+    os.makedirs(output, exist_ok=True)
+    checkpoint = Checkpoint(
+        os.path.join(output, CHECKPOINT_FILE),
+        settings={
+            "start": int(start.timestamp()),
+            "stop": int(stop.timestamp()),
+            "measurements": measurements,
+            "format": file_format.value,
+            "chunkSec": chunk_sec,
+        },
+    )
+    pending = [chunk for chunk in chunks(start, stop, chunk_sec) if chunk[0] not in checkpoint.completed]
+    logging.info("Exporting %d chunk(s), %d already completed", len(pending), len(checkpoint.completed))
+    started = time.monotonic()
+    total = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_export_chunk, output, measurements, chunk, file_format, checkpoint): chunk for chunk in pending}
+        for done, future in enumerate(as_completed(futures), start=1):
+            total += future.result()
+            logging.info(
+                "Completed chunk %d of %d (%s), %d row(s) so far", done, len(pending), _flux_time(futures[future][0]), total
+            )
+    logging.info("Exported %d row(s) in %.1f seconds", total, time.monotonic() - started)
+    return total
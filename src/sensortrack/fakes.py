@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Local stand-in servers for the upstream services, for benchmarks and chaos testing.
+
+Each fake is a small HTTP server running in a background thread, implementing just the
+endpoints this application uses:
+
+- `FakeSmartThings`: locations, rooms, devices, schedules and subscriptions
+- `FakeWeather`: the weather.gov points, stations and observations endpoints
+- `FakeInfluxDb`: the write endpoint, capturing line protocol, plus an empty query endpoint
+- `FakeKeyServer`: the signing key server, serving a public key for signed requests
+
+There is also `FakeRedis`, a small server speaking the Redis protocol, as a stand-in for
+a shared cache.  It implements just the commands the cache client uses, and is not an
+HTTP server, so it doesn't accept faults.
+
+Responses have the same shape as the real APIs (and as the test fixtures), with data
+generated on the fly, so any location or device id works.  Device ids for a location
+follow the load generator's scheme, so events sent by `sensortrack loadgen` refer to
+devices that the fake SmartThings API knows about.  Optionally, the weather fake can
+serve recorded station and observation fixtures from a directory instead.
+
+Every fake accepts `Faults`, to inject latency, errors and throttling:
+
+- Latency is a fixed delay plus random jitter, applied to every request.
+- Errors are returned for a random fraction of requests, with a configurable status.
+- Throttling limits each fake to a maximum request rate, returning 429 with a
+  Retry-After header for requests over the limit, like a rate-limited upstream.
+"""
+import gzip
+import json
+import logging
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Deque, Dict, List, Optional, Pattern, Tuple
+
+from attrs import frozen
+from Cryptodome.PublicKey import RSA
+
+Response = Tuple[int, str]  # (status, JSON or text body)
+Route = Tuple[str, Pattern[str], Callable[..., Response]]  # (method, path pattern, handler)
+
+_MAX_RECORDED = 10000  # requests and lines recorded per fake, oldest discarded first
+_PAGE_SIZE = 100  # items per page for paginated responses
+
+
+@frozen(kw_only=True)
+class Faults:
+    """Faults injected into a fake's responses."""
+
+    latency_sec: float = 0.0  # fixed delay for every request
+    jitter_sec: float = 0.0  # additional random delay, up to this amount
+    error_rate: float = 0.0  # fraction of requests that fail
+    error_status: int = 500  # status returned for failed requests
+    throttle_rate: Optional[float] = None  # maximum requests per second, or None for no limit
+
+
+class FakeService:
+    """HTTP server for a fake upstream service, with fault injection."""
+
+    name = "fake"
+
+    def __init__(self, host: str = "localhost", port: int = 0, faults: Optional[Faults] = None) -> None:
+        self.faults = faults or Faults()
+        self.requests: Deque[Tuple[str, str]] = deque(maxlen=_MAX_RECORDED)  # (method, path) for every request
+        self._routes: List[Route] = []
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        self._window: Deque[float] = deque()  # times of recent requests, for throttling
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self) -> None:
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                status, content, headers = service.handle(self.command, self.path, body)
+                encoded = content.encode()
+                self.send_response(status)
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.send_header("Content-Length", str(len(encoded)))
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _handle  # pylint: disable=invalid-name:
+
+            def log_message(self, format: str, *args: Any) -> None:  # pylint: disable=redefined-builtin:
+                logging.debug("%s: " + format, service.name, *args)  # pylint: disable=logging-not-lazy:
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.1,), name=self.name, daemon=True)
+
+    @property
+    def url(self) -> str:
+        """Base URL for the fake."""
+        host, port = self._server.server_address[:2]
+        return "http://%s:%d" % (host if isinstance(host, str) else host.decode(), port)
+
+    def route(self, method: str, pattern: str, handler: Callable[..., Response]) -> None:
+        """Add a route, with path parameters captured by the pattern's groups and passed to the handler."""
+        self._routes.append((method, re.compile("^%s$" % pattern), handler))
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _throttled(self) -> bool:
+        if not self.faults.throttle_rate:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            while self._window and now - self._window[0] >= 1.0:
+                self._window.popleft()
+            if len(self._window) >= self.faults.throttle_rate:
+                return True
+            self._window.append(now)
+            return False
+
+    def handle(self, method: str, target: str, body: bytes) -> Tuple[int, str, Dict[str, str]]:
+        """Handle a request, returning (status, content, headers)."""
+        parts = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        self.requests.append((method, target))
+        delay = self.faults.latency_sec + self._random.uniform(0.0, self.faults.jitter_sec)
+        if delay > 0:
+            time.sleep(delay)
+        if self._throttled():
+            return 429, "", {"Retry-After": "1"}
+        if self._random.random() < self.faults.error_rate:
+            return self.faults.error_status, "", {}
+        for route_method, pattern, handler in self._routes:
+            match = pattern.match(parts.path)
+            if route_method == method and match:
+                status, content = handler(*match.groups(), query=query, body=body)
+                content_type = "application/json" if content.startswith(("{", "[")) else "text/plain"
+                return status, content, {"Content-Type": content_type}
+        return 404, "", {}
+
+
+class FakeSmartThings(FakeService):
+    """Fake SmartThings API, with the same devices and rooms for every location."""
+
+    name = "smartthings"
+
+    def __init__(
+        self, devices: int = 10, rooms: int = 3, latitude: float = 41.02, longitude: float = -97.37, **kwargs: Any
+    ) -> None:
+        super().__init__(**kwargs)
+        self.devices = devices
+        self.rooms = rooms
+        self.latitude = latitude
+        self.longitude = longitude
+        self.route("GET", r"/locations/([^/]+)", self._location)
+        self.route("GET", r"/locations/([^/]+)/rooms", self._rooms)
+        self.route("GET", r"/devices", self._devices)
+        self.route("POST", r"/installedapps/([^/]+)/schedules", self._accepted)
+        self.route("DELETE", r"/installedapps/([^/]+)/schedules/([^/]+)", self._accepted)
+        self.route("POST", r"/installedapps/([^/]+)/subscriptions", self._accepted)
+
+    @staticmethod
+    def device_id(location_id: str, device: int) -> str:
+        """Device id for a device at a location, matching the load generator's scheme."""
+        return "%s-%04d" % (location_id.replace("location", "device", 1), device)
+
+    def _location(self, location_id: str, **_: Any) -> Response:
+        location = {
+            "locationId": location_id,
+            "name": "Fake %s" % location_id,
+            "countryCode": "USA",
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "temperatureScale": "F",
+            "timeZoneId": "America/Chicago",
+            "locale": "en-US",
+        }
+        return 200, json.dumps(location)
+
+    def _rooms(self, location_id: str, **_: Any) -> Response:
+        items = [
+            {"roomId": "%s-room-%d" % (location_id, room), "locationId": location_id, "name": "Room %d" % room}
+            for room in range(self.rooms)
+        ]
+        return 200, json.dumps({"items": items, "_links": {}})
+
+    def _devices(self, query: Dict[str, str], **_: Any) -> Response:
+        location_id = query.get("locationId", "location")
+        page = int(query.get("page", "0"))
+        items = [
+            {
+                "deviceId": self.device_id(location_id, device),
+                "name": "fake-sensor",
+                "label": "Sensor %d" % device,
+                "locationId": location_id,
+                "roomId": "%s-room-%d" % (location_id, device % self.rooms) if self.rooms else None,
+            }
+            for device in range(page * _PAGE_SIZE, min((page + 1) * _PAGE_SIZE, self.devices))
+        ]
+        more = (page + 1) * _PAGE_SIZE < self.devices
+        query = {"locationId": location_id, "page": str(page + 1)}
+        links = {"next": {"href": "%s/devices?%s" % (self.url, urllib.parse.urlencode(query))}} if more else {}
+        return 200, json.dumps({"items": items, "_links": links})
+
+    def _accepted(self, *_: str, body: bytes, **__: Any) -> Response:
+        return 200, body.decode() or "{}"
+
+
+class FakeWeather(FakeService):
+    """Fake weather.gov API, with a single station and hourly observations."""
+
+    name = "weather"
+
+    def __init__(self, fixture_dir: Optional[str] = None, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.fixture_dir = fixture_dir
+        self.route("GET", r"/points/([^/]+)/stations", self._stations)
+        self.route("GET", r"/stations/([^/]+)/observations/latest", self._latest)
+        self.route("GET", r"/stations/([^/]+)/observations", self._observations)
+
+    def _fixture(self, *path: str) -> Optional[str]:
+        """Load a recorded fixture, rewritten to point at this fake, if a fixture directory is configured."""
+        if not self.fixture_dir:
+            return None
+        with open(os.path.join(self.fixture_dir, *path), "r", encoding="utf-8") as fp:
+            return fp.read().replace("https://api.weather.gov", self.url)
+
+    @staticmethod
+    def _observation(station: str, stamp: datetime) -> Dict[str, Any]:
+        hour = stamp.hour + stamp.minute / 60.0
+        celsius = round(20.0 + 5.0 * (1.0 - abs(hour - 14.0) / 12.0), 1)  # warmest in mid-afternoon
+        return {
+            "id": "%s/observations/%s" % (station, stamp.isoformat()),
+            "type": "Feature",
+            "properties": {
+                "timestamp": stamp.isoformat(),
+                "temperature": {"unitCode": "wmoUnit:degC", "value": celsius, "qualityControl": "V"},
+                "relativeHumidity": {"unitCode": "wmoUnit:percent", "value": round(70.0 - celsius, 1), "qualityControl": "V"},
+            },
+        }
+
+    def _stations(self, _: str, **__: Any) -> Response:
+        fixture = self._fixture("weather", "stations", "stations.json")
+        if fixture:
+            return 200, fixture
+        return 200, json.dumps(
+            {"type": "FeatureCollection", "features": [{"id": "%s/stations/FAKE" % self.url, "type": "Feature"}]}
+        )
+
+    def _latest(self, station: str, **_: Any) -> Response:
+        fixture = self._fixture("weather", "observations", "valid.json")
+        if fixture:
+            return 200, fixture
+        now = datetime.now(tz=timezone.utc).replace(minute=54, second=0, microsecond=0)
+        return 200, json.dumps(self._observation("%s/stations/%s" % (self.url, station), now))
+
+    def _observations(self, station: str, query: Dict[str, str], **_: Any) -> Response:
+        # Observations are hourly at 54 past the hour, newest first as for the real API, paged with an opaque cursor
+        end = datetime.fromisoformat(query.get("cursor") or query["end"])
+        start = datetime.fromisoformat(query["start"])
+        limit = int(query.get("limit", _PAGE_SIZE))
+        stamp = end.replace(minute=54, second=0, microsecond=0)
+        stamp = stamp if stamp < end else stamp - timedelta(hours=1)
+        features: List[Dict[str, Any]] = []
+        while stamp >= start and len(features) < limit:
+            features.append(self._observation("%s/stations/%s" % (self.url, station), stamp))
+            stamp -= timedelta(hours=1)
+        cursor = {
+            "start": query["start"],
+            "end": query["end"],
+            "limit": str(limit),
+            "cursor": (stamp + timedelta(seconds=1)).isoformat(),
+        }
+        next_url = "%s/stations/%s/observations?%s" % (self.url, station, urllib.parse.urlencode(cursor))
+        return 200, json.dumps({"type": "FeatureCollection", "features": features, "pagination": {"next": next_url}})
+
+
+class FakeInfluxDb(FakeService):
+    """Fake InfluxDB, capturing written line protocol; queries always return no data."""
+
+    name = "influxdb"
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.lines: Deque[str] = deque(maxlen=_MAX_RECORDED)
+        self.written = 0  # total lines written, including any no longer recorded
+        self.route("POST", r"/api/v2/write", self._write)
+        self.route("POST", r"/api/v2/query", self._query)
+        self.route("GET", r"/(?:health|ping)", self._health)
+
+    def _write(self, body: bytes, **_: Any) -> Response:
+        lines = [line for line in body.decode().splitlines() if line.strip()]
+        with self._lock:
+            self.lines.extend(lines)
+            self.written += len(lines)
+        return 204, ""
+
+    def _query(self, **_: Any) -> Response:
+        return 200, ""
+
+    def _health(self, **_: Any) -> Response:
+        return 200, json.dumps({"name": "influxdb", "status": "pass"})
+
+
+class FakeKeyServer(FakeService):
+    """Fake SmartThings key server, serving the public key for signed requests."""
+
+    name = "keyserver"
+
+    def __init__(self, key: RSA.RsaKey, key_id: str, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        public_key = key.public_key().export_key().decode()
+        self.route("GET", re.escape("/%s" % key_id.lstrip("/")), lambda **_: (200, public_key))
+
+
+class FakeRedis:
+    """Fake Redis server, implementing PING, AUTH, SELECT, GET, SET (with EX, PX and NX) and DEL."""
+
+    name = "redis"
+
+    def __init__(self, host: str = "localhost", port: int = 0, password: Optional[str] = None) -> None:
+        self.password = password
+        self.commands: Deque[List[str]] = deque(maxlen=_MAX_RECORDED)  # every command received
+        self._data: Dict[Tuple[int, str], Tuple[Optional[float], str]] = {}  # (db, key) -> (expires, value)
+        self._lock = threading.Lock()
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                state = {"db": 0, "authenticated": service.password is None}
+                while True:
+                    args = service.read(self.rfile)
+                    if args is None:
+                        return
+                    self.wfile.write(service.execute(state, args))
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.1,), name=self.name, daemon=True)
+
+    @property
+    def url(self) -> str:
+        """URL for the fake, without credentials."""
+        host, port = self._server.server_address[:2]
+        return "redis://%s:%d" % (host if isinstance(host, str) else host.decode(), port)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    @staticmethod
+    def read(reader: Any) -> Optional[List[str]]:
+        """Read a command as an array of bulk strings, returning None once the connection is closed."""
+        line = reader.readline()
+        if not line.startswith(b"*"):
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(reader.readline()[1:])
+            args.append(reader.read(length + 2)[:-2].decode("UTF-8"))
+        return args
+
+    def execute(self, state: Dict[str, Any], args: List[str]) -> bytes:
+        """Execute a command, returning the encoded reply."""
+        self.commands.append(args)
+        command = args[0].upper()
+        if command == "AUTH":
+            state["authenticated"] = args[-1] == self.password
+            return b"+OK\r\n" if state["authenticated"] else b"-WRONGPASS invalid password\r\n"
+        if not state["authenticated"]:
+            return b"-NOAUTH Authentication required\r\n"
+        if command == "PING":
+            return b"+PONG\r\n"
+        if command == "SELECT":
+            state["db"] = int(args[1])
+            return b"+OK\r\n"
+        with self._lock:
+            if command == "GET":
+                value = self._get(state["db"], args[1])
+                return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value.encode()), value.encode())
+            if command == "SET":
+                return self._set(state["db"], args[1], args[2], [option.upper() for option in args[3:]])
+            if command == "DEL":
+                return b":%d\r\n" % sum(1 for key in args[1:] if self._data.pop((state["db"], key), None) is not None)
+        return b"-ERR unknown command '%s'\r\n" % args[0].encode()
+
+    def _get(self, db: int, key: str) -> Optional[str]:
+        entry = self._data.get((db, key))
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] <= time.time():
+            del self._data[(db, key)]
+            return None
+        return entry[1]
+
+    def _set(self, db: int, key: str, value: str, options: List[str]) -> bytes:
+        expires = None
+        if "EX" in options:
+            expires = time.time() + float(options[options.index("EX") + 1])
+        if "PX" in options:
+            expires = time.time() + float(options[options.index("PX") + 1]) / 1000.0
+        if "NX" in options and self._get(db, key) is not None:
+            return b"$-1\r\n"
+        self._data[(db, key)] = (expires, value)
+        return b"+OK\r\n"
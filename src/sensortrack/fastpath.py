@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Lean ASGI fast path for the SmartApp lifecycle endpoint.
+
+Every SmartThings request goes to `POST /smartapp`, so that route is worth handling
+without FastAPI routing, `Request` construction and the exception handler stack.  The
+`API` application here handles `POST /smartapp` directly as raw ASGI, and passes every
+other request (and the lifespan) through to the FastAPI application in `server.py`.  To
+use it, run uvicorn with `sensortrack.fastpath:API` instead of `sensortrack.server:API`.
+
+Requests are dispatched with `responses.dispatch()`, the same as for the FastAPI route,
+so the lifecycle handling and the precomputed CONFIRMATION and CONFIGURATION responses
+are exactly the same.  Status codes and error logging are the same as for the exception
+handlers in `server.py`, and admission control applies just the same (see
+`admission.py`).
+"""
+import logging
+from typing import List, Tuple
+
+from anyio.to_thread import run_sync
+from influxdb_client.client.exceptions import InfluxDBError
+from smartapp.interface import CORRELATION_ID_HEADER, BadRequestError, SignatureError, SmartAppError
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from sensortrack.admission import OverloadedError, admitted
+from sensortrack.logs import log_exchange
+from sensortrack.responses import dispatch, responses
+from sensortrack.rest import RestClientError
+from sensortrack.server import API as SERVER_API
+
+PATH = "/smartapp"
+
+Headers = List[Tuple[bytes, bytes]]
+
+
+def _headers(content: bytes) -> Headers:
+    return [(b"content-type", b"application/json"), (b"content-length", str(len(content)).encode("latin-1"))]
+
+
+_EMPTY_HEADERS: Headers = [(b"content-length", b"0")]
+
+
+def _error(e: Exception) -> int:
+    """Log an error the same way as the exception handlers in server.py, returning the status code."""
+    if isinstance(e, BadRequestError):
+        status_code, message = 400, "[%s] Bad request: %s" % (e.correlation_id, e)
+    elif isinstance(e, SignatureError):
+        status_code, message = 401, "[%s] Signature error: %s" % (e.correlation_id, e)
+    elif isinstance(e, SmartAppError):
+        status_code, message = 500, "[%s] SmartApp error: %s" % (e.correlation_id, e)
+    elif isinstance(e, RestClientError):
+        status_code, message = 500, "%s" % e
+    elif isinstance(e, InfluxDBError):
+        status_code, message = 500, "InfluxDB error: %s" % e
+    else:
+        status_code, message = 500, "Internal error: %s" % e
+    logging.error(message, exc_info=e)
+    return status_code
+
+
+async def _body(receive: Receive) -> bytes:
+    """Read the whole request body, which may arrive in several messages."""
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+
+class SmartAppFastPath:
+    """ASGI application that handles POST /smartapp directly, passing everything else to another application."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        responses()  # build the precomputed responses at startup, rather than on the first request
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] != PATH:
+            await self.app(scope, receive, send)
+            return
+        status_code, headers, content = 200, _EMPTY_HEADERS, b""
+        try:
+            body = await _body(receive)
+            decoded = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+            # The dispatcher is synchronous and may wait on upstream APIs, so run it in a worker thread
+            async with admitted(body, decoded):
+                content = await run_sync(dispatch, decoded, body)
+            log_exchange(decoded.get(CORRELATION_ID_HEADER), body, content)
+            headers = _headers(content)
+        except OverloadedError as e:
+            status_code, headers = 503, [(b"retry-after", str(e.retry_after_sec).encode("latin-1")), *_EMPTY_HEADERS]
+        except Exception as e:  # pylint: disable=broad-except:
+            status_code = _error(e)
+        await send({"type": "http.response.start", "status": status_code, "headers": headers})
+        await send({"type": "http.response.body", "body": content})
+
+
+API = SmartAppFastPath(SERVER_API)
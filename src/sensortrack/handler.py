@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
 # vim: set ft=python ts=4 sw=4 expandtab:
-# pylint: disable=unnecessary-pass,too-many-locals:
+# pylint: disable=unnecessary-pass,too-many-locals,too-many-branches:
 
 """
 SmartApp event handler.
 """
 import logging
-from typing import Any, Dict, List, Optional, Union
+import time
+from datetime import datetime, timezone
+from functools import partial
+from threading import Thread
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import requests
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
+from attrs import define, field
+from influxdb_client import Point
 from smartapp.interface import (
     ConfigurationRequest,
     ConfirmationRequest,
@@ -23,8 +27,16 @@
     UpdateRequest,
 )
 
-from sensortrack.config import config
+from sensortrack.aggregation import WindowResult, aggregator
+from sensortrack.alerts import alerts
+from sensortrack.cache import Cache
+from sensortrack.comfort import comfort
+from sensortrack.compression import Saved, compressor
+from sensortrack.devices import directory, refresh_directory
+from sensortrack.quotas import quotas
+from sensortrack.recent import WEATHER_DEVICE, SeriesKey, recent
 from sensortrack.rest import RestClientError, RestDataError
+from sensortrack.sinks import PartialWriteError, sink
 from sensortrack.smartthings import (
     SmartThings,
     retrieve_location,
@@ -35,6 +47,10 @@
 from sensortrack.weather import retrieve_current_conditions
 
 WEATHER_LOOKUP = "weather-lookup"  # name/id of the weather lookup timer event
+DELIVERY_TTL_SEC = 60 * 60  # how long a handled EVENT execution id is remembered, to skip redeliveries
+CLAIM_TTL_SEC = 5 * 60  # how long an EVENT execution id is claimed while being handled, in case the process dies
+
+_DELIVERIES = Cache("deliveries", DELIVERY_TTL_SEC)  # execution id -> True, once claimed or handled
 
 
 def is_weather_lookup(event: Dict[str, Any]) -> bool:
@@ -42,6 +58,84 @@ def is_weather_lookup(event: Dict[str, Any]) -> bool:
     return "name" in event and event["name"] == WEATHER_LOOKUP
 
 
+def sensor_point(location_id: str, device_id: str, attribute: str, measurement: float, timestamp: Optional[float] = None) -> Point:
+    """Build a sensor point, tagged with device name and room if known, optionally with an explicit timestamp in epoch seconds."""
+    point = Point("sensor").tag("location", location_id).tag("device", device_id).field(attribute, measurement)
+    for tag, value in directory().tags(location_id, device_id).items():
+        point.tag(tag, value)
+    return point.time(datetime.fromtimestamp(timestamp, tz=timezone.utc)) if timestamp is not None else point
+
+
+def write_points(points: List[Point]) -> None:
+    """Write points to the configured output sinks."""
+    sink().write(points)
+
+
+@define
+class Pending:
+    """
+    Points to be written, along with the write pipeline changes that depend on them.
+
+    Compression, aggregation and quota overflow keep state across requests.  That state must only
+    move forward once the points are written; otherwise, when a failed request is
+    redelivered, its readings would be compressed away or counted twice.
+    """
+
+    points: List[Point] = field(factory=list)
+    compressed: Saved = field(factory=dict)  # compression state before this request, restored if the write fails
+    collected: List[WindowResult] = field(factory=list)  # closed windows in the points, restored if the write fails
+    overflow: List[WindowResult] = field(factory=list)  # closed quota overflow windows in the points, likewise
+    aggregated: List[Tuple[SeriesKey, float, float]] = field(factory=list)  # readings aggregated once the write succeeds
+
+
+def write_pending(pending: Pending) -> None:
+    """Write pending points, then apply the changes that depend on them, or undo them if the write fails."""
+    compression = compressor()
+    aggregation = aggregator()
+    quota = quotas()
+    try:
+        write_points(pending.points)
+    except PartialWriteError:
+        pass  # already logged; some sinks have the points, so they're treated as written rather than delivered again
+    except Exception:
+        if compression:
+            compression.restore(pending.compressed)
+        if aggregation:
+            aggregation.restore(pending.collected)
+        if quota:
+            quota.restore(pending.overflow)
+        raise
+    if aggregation:
+        for key, timestamp, value in pending.aggregated:
+            aggregation.add(key, timestamp, value)
+
+
+def flush(final: bool = True) -> None:
+    """
+    Flush readings that the write pipeline is still holding back.
+
+    This is called periodically to write aggregation windows that have closed even though
+    no further events have arrived, and with final=True at shutdown to write everything.
+    """
+    pending = Pending()
+    aggregation = aggregator()
+    if aggregation:
+        pending.collected = aggregation.collect(None if final else time.time())
+        pending.points.extend(aggregation.points(pending.collected))
+    quota = quotas()
+    if quota:
+        pending.overflow = quota.collect(None if final else time.time())
+        pending.points.extend(quota.points(pending.overflow))
+    compression = compressor()
+    if compression and final:
+        for (location_id, device_id, attribute), (timestamp, value) in compression.flush(pending.compressed):
+            pending.points.append(sensor_point(location_id, device_id, attribute, value, timestamp))
+    if pending.points:
+        write_pending(pending)
+        logging.info("Flushed %d held point(s) of data", len(pending.points))
+    sink().flush(final)
+
+
 # noinspection PyMethodMayBeStatic
 class EventHandler(SmartAppEventHandler):
     """SmartApp event handler."""
@@ -72,17 +166,22 @@ def handle_oauth_callback(self, correlation_id: Optional[str], request: OauthCal
         pass  # no action needed for this event, since we don't use any special oauth integration
 
     def handle_event(self, correlation_id: Optional[str], request: EventRequest) -> None:
-        """Handle an EVENT lifecycle request."""
-        url = config().influxdb.url
-        org = config().influxdb.org
-        token = config().influxdb.token
-        bucket = config().influxdb.bucket
-        with InfluxDBClient(url=url, org=org, token=token) as client:
-            points = []  # type: List[Point]
-            self._handle_weather_lookup_events(correlation_id, request, points)
-            self._handle_sensor_events(request, points)
-            client.write_api(write_options=SYNCHRONOUS).write(bucket=bucket, record=points)
-            logging.debug("[%s] Completed persisting %d point(s) of data", correlation_id, len(points))
+        """Handle an EVENT lifecycle request, skipping redeliveries of a request that was already handled."""
+        # The execution id is claimed up front, so a redelivery landing on another node while this one is still
+        # handling the request is skipped too, and released again on failure, so a failed request is handled again
+        if not _DELIVERIES.add(request.execution_id, ttl_sec=CLAIM_TTL_SEC):
+            logging.info("[%s] Skipping redelivered EVENT request %s", correlation_id, request.execution_id)
+            return
+        try:
+            pending = Pending()
+            self._handle_weather_lookup_events(correlation_id, request, pending.points)
+            self._handle_sensor_events(correlation_id, request, pending)
+            write_pending(pending)
+        except BaseException:
+            _DELIVERIES.delete(request.execution_id)
+            raise
+        _DELIVERIES.set(request.execution_id, True)  # remembered for longer, once persisted
+        logging.debug("[%s] Completed persisting %d point(s) of data", correlation_id, len(pending.points))
 
     def _handle_config_refresh(
         self, correlation_id: Optional[str], request: Union[InstallRequest, UpdateRequest], subscribe: bool
@@ -97,6 +196,20 @@ def _handle_config_refresh(
                 subscribe_to_temperature_events()
                 subscribe_to_humidity_events()
                 logging.info("[%s] Completed subscribing to device events", correlation_id)
+            self._refresh_directory(correlation_id, request.location_id())
+
+    def _refresh_directory(self, correlation_id: Optional[str], location_id: str) -> None:
+        """Refresh the device directory for a location, within a SmartThings context; failures are logged, not raised."""
+        try:
+            refresh_directory(location_id)
+        except Exception:  # pylint: disable=broad-except:
+            directory().failed(location_id)
+            logging.exception("[%s] Failed to refresh device directory", correlation_id)
+
+    def _refresh_directory_in_background(self, correlation_id: Optional[str], request: EventRequest) -> None:
+        """Refresh the device directory for an EVENT request's location, run on a thread of its own."""
+        with SmartThings(request=request):  # the context isn't inherited from the request's thread
+            self._refresh_directory(correlation_id, request.location_id())
 
     def _handle_weather_lookup_events(self, correlation_id: Optional[str], request: EventRequest, points: List[Point]) -> None:
         """Handle weather event lookup timer events, appending any points to be persisted to InfluxDB."""
@@ -106,10 +219,21 @@ def _handle_weather_lookup_events(self, correlation_id: Optional[str], request:
                 if location.country_code == "USA" and location.latitude is not None and location.longitude is not None:
                     try:
                         temperature, humidity = retrieve_current_conditions(location.latitude, location.longitude)
+                        derived = None
                         if temperature:
                             points.append(Point("weather").tag("location", location.location_id).field("temperature", temperature))
+                            recent().record(location.location_id, WEATHER_DEVICE, "temperature", temperature)
+                            derived = comfort().update(location.location_id, WEATHER_DEVICE, "temperature", temperature)
                         if humidity:
                             points.append(Point("weather").tag("location", location.location_id).field("humidity", humidity))
+                            recent().record(location.location_id, WEATHER_DEVICE, "humidity", humidity)
+                            derived = comfort().update(location.location_id, WEATHER_DEVICE, "humidity", humidity)
+                        if derived:
+                            point = Point("weather").tag("location", location.location_id)
+                            for attribute, value in derived.fields():
+                                point.field(attribute, value)
+                                recent().record(location.location_id, WEATHER_DEVICE, attribute, value)
+                            points.append(point)
                     except RestClientError as e:
                         logging.error("[%s] Call to weather.gov failed: %s", correlation_id, e.message)
                     except RestDataError as e:
@@ -118,11 +242,49 @@ def _handle_weather_lookup_events(self, correlation_id: Optional[str], request:
                         # it's hard to get any other specifics from the exception, so we just go with the exception type
                         logging.error("[%s] Call to weather.gov failed: %s", correlation_id, type(e).__name__)
 
-    def _handle_sensor_events(self, request: EventRequest, points: List[Point]) -> None:
-        """Handle received events from sensors, appending any points to be persisted to InfluxDB."""
-        for event in request.event_data.filter(event_type=EventType.DEVICE_EVENT):
+    def _handle_sensor_events(self, correlation_id: Optional[str], request: EventRequest, pending: Pending) -> None:
+        """Handle received events from sensors, adding any points to be persisted to InfluxDB and recording readings."""
+        events = request.event_data.filter(event_type=EventType.DEVICE_EVENT)
+        if events and directory().claim_refresh(request.location_id()):
+            # Refreshed in the background, so this request is tagged from the stale directory rather than waiting on the API
+            Thread(
+                target=self._refresh_directory_in_background, args=(correlation_id, request), name="directory-refresh", daemon=True
+            ).start()
+        now = time.time()
+        compression = compressor()
+        aggregation = aggregator()
+        alerting = alerts()
+        quota = quotas()
+        installed_app_id = request.event_data.installed_app.installed_app_id
+        for event in events:
             location_id = event["locationId"]
             device_id = event["deviceId"]
-            attribute = event["attribute"]  # "temperature" or "humidity"
-            measurement = round(float(event["value"]), 2)
-            points.append(Point("sensor").tag("location", location_id).tag("device", device_id).field(attribute, measurement))
+            readings = [(event["attribute"], round(float(event["value"]), 2))]  # attribute is "temperature" or "humidity"
+            derived = comfort().update(location_id, device_id, *readings[0], timestamp=now, unit=event.get("unit"))
+            if derived:
+                readings.extend(derived.fields())  # derived metrics are handled just like any other reading
+            for attribute, measurement in readings:
+                recent().record(location_id, device_id, attribute, measurement)
+                if alerting:
+                    alerting.offer(location_id, device_id, attribute, measurement, now)
+                if quota and not quota.admit(installed_app_id, (location_id, device_id, attribute), now):
+                    spooled = partial(sensor_point, location_id, device_id, attribute, measurement, now)
+                    quota.overflow(installed_app_id, (location_id, device_id, attribute), now, measurement, point=spooled)
+                    continue
+                if aggregation:
+                    pending.aggregated.append(((location_id, device_id, attribute), now, measurement))
+                    if not aggregation.keep_raw:
+                        continue
+                if compression:
+                    # compressed readings may be written later than received, so they need an explicit timestamp
+                    key = (location_id, device_id, attribute)
+                    for timestamp, value in compression.offer(key, now, measurement, pending.compressed):
+                        pending.points.append(sensor_point(location_id, device_id, attribute, value, timestamp))
+                else:
+                    pending.points.append(sensor_point(location_id, device_id, attribute, measurement))
+        if aggregation:
+            pending.collected = aggregation.collect(now)
+            pending.points.extend(aggregation.points(pending.collected))
+        if quota:
+            pending.overflow = quota.collect(now)
+            pending.points.extend(quota.points(pending.overflow))
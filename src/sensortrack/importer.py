@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Bulk import of historical readings into the configured output sinks.
+
+Input files are either CSV files in the format written by the bulk export, or InfluxDB
+line protocol files.  Files are streamed, never loaded into memory all at once.  Each
+input line is validated against the schema that the event handler produces, i.e. the
+`sensor` and `weather` measurements with their expected tags and fields, and converted
+to readings.  Invalid lines are logged and counted, and do not stop the import.
+
+Readings are grouped into batches.  Before a batch is written, readings duplicated
+within the batch are dropped, and so are readings that already exist in InfluxDB, as
+determined by a query over the time range of the batch.  InfluxDB would overwrite an
+identical point anyway, but this avoids rewriting data that is already present, which
+matters when the same files are imported more than once.
+
+Batches are written by a pool of parallel writers, with the number of batches in flight
+bounded so memory use stays constant.  Reading is throttled to a maximum rate, so a
+large import does not starve the live event handler, and progress is logged as rows per
+second as the import goes.
+"""
+import csv
+import logging
+import math
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from attrs import define, field, frozen
+from influxdb_client import InfluxDBClient, Point, WritePrecision
+
+from sensortrack.config import InfluxDbConfig, config
+from sensortrack.export import COLUMNS
+from sensortrack.sinks import destination, sink
+
+# Measurements written by the event handler, with the tags that each one requires
+SCHEMA = {
+    "sensor": ["location", "device"],
+    "weather": ["location"],
+}
+
+# Fields written by the event handler, for either measurement
+FIELDS = {"temperature", "humidity", "dew_point", "heat_index"}
+
+# Tags that may optionally be present, as added by the device directory
+OPTIONAL_TAGS = {"device_name", "room"}
+
+_REPORT_SEC = 10.0  # how often progress is logged
+
+ReadingKey = Tuple[str, Tuple[Tuple[str, str], ...], str, int]  # (measurement, tags, field, timestamp)
+
+
+@frozen
+class BulkImportError(Exception):
+    """An error related to bulk import."""
+
+    message: str
+
+
+@frozen(kw_only=True)
+class Reading:
+    """A single validated field value, with its timestamp in epoch nanoseconds."""
+
+    measurement: str
+    tags: Tuple[Tuple[str, str], ...]
+    field: str
+    value: float
+    timestamp: int
+
+    def key(self) -> ReadingKey:
+        # InfluxDB query results only have microsecond resolution, so keys are compared at that resolution
+        return self.measurement, self.tags, self.field, self.timestamp - self.timestamp % 1_000
+
+    def point(self) -> Point:
+        point = Point(self.measurement)
+        for tag, value in self.tags:
+            point.tag(tag, value)
+        # the stubs declare numbers.Integral, which mypy can't check an int against, but an int is what the client expects
+        return point.field(self.field, self.value).time(self.timestamp, WritePrecision.NS)  # type: ignore[arg-type]
+
+
+@define
+class ImportResult:
+    """Counts of rows processed by an import."""
+
+    read: int = 0
+    invalid: int = 0
+    duplicate: int = 0
+    written: int = 0
+
+
+def reading(measurement: str, tags: Dict[str, str], name: str, value: float, timestamp: int) -> Reading:
+    """Validate a field value against the handler schema and build a reading, raising ValueError if it is invalid."""
+    if measurement not in SCHEMA:
+        raise ValueError("unknown measurement: %s" % measurement)
+    for tag in SCHEMA[measurement]:
+        if not tags.get(tag):
+            raise ValueError("missing tag: %s" % tag)
+    unexpected = set(tags) - set(SCHEMA[measurement]) - OPTIONAL_TAGS
+    if unexpected:
+        raise ValueError("unexpected tag: %s" % ", ".join(sorted(unexpected)))
+    if name not in FIELDS:
+        raise ValueError("unknown field: %s" % name)
+    if not math.isfinite(value):
+        raise ValueError("invalid value: %s" % value)
+    present = tuple(sorted((tag, value) for tag, value in tags.items() if value))
+    return Reading(measurement=measurement, tags=present, field=name, value=round(value, 2), timestamp=timestamp)
+
+
+def _nanoseconds(stamp: datetime) -> int:
+    stamp = stamp if stamp.tzinfo else stamp.replace(tzinfo=timezone.utc)
+    whole = stamp.replace(microsecond=0)
+    return int(whole.timestamp()) * 1_000_000_000 + stamp.microsecond * 1_000
+
+
+def parse_csv_row(row: Dict[str, str]) -> Reading:
+    """Parse a row in the bulk export format."""
+    tags = {tag: row.get(tag) or "" for tag in ("location", "device", "device_name", "room")}
+    timestamp = _nanoseconds(datetime.fromisoformat(row["time"].replace("Z", "+00:00")))
+    return reading(row["measurement"], {k: v for k, v in tags.items() if v}, row["field"], float(row["value"]), timestamp)
+
+
+def _split(text: str, separator: str) -> List[str]:
+    """Split line protocol on a separator, honoring backslash escapes and quoted strings, and removing escapes."""
+    parts: List[str] = []
+    current: List[str] = []
+    escaped, quoted = False, False
+    for character in text:
+        if escaped:
+            current.append(character)
+            escaped = False
+        elif character == "\\":
+            escaped = True
+        elif character == '"':
+            quoted = not quoted
+            current.append(character)
+        elif character == separator and not quoted:
+            parts.append("".join(current))
+            current = []
+        else:
+            current.append(character)
+    parts.append("".join(current))
+    return parts
+
+
+def parse_line_protocol(line: str) -> List[Reading]:
+    """Parse a line of InfluxDB line protocol with a nanosecond timestamp, which may contain several fields."""
+    sections = _split(line.strip(), " ")
+    if len(sections) != 3:
+        raise ValueError("expected measurement, fields and timestamp")
+    series, fields, timestamp = sections[0], sections[1], sections[2]
+    measurement, *pairs = _split(series, ",")
+    tags = dict(pair.split("=", 1) for pair in pairs)
+    readings = []
+    for pair in _split(fields, ","):
+        name, value = pair.split("=", 1)
+        if value.startswith('"') or value in ("t", "f", "true", "false", "T", "F", "True", "False", "TRUE", "FALSE"):
+            raise ValueError("field is not numeric: %s" % name)
+        readings.append(reading(measurement, tags, name, float(value.rstrip("iu")), int(timestamp)))
+    return readings
+
+
+def read_file(path: str, result: ImportResult) -> Iterator[Reading]:
+    """Stream readings from a CSV or line protocol file, logging and counting invalid lines."""
+    with open(path, "r", encoding="utf-8", newline="") as fp:
+        lines: Iterator[Tuple[int, Any]]
+        parse: Callable[[Any], List[Reading]]
+        if path.endswith(".csv"):
+            reader = csv.DictReader(fp)
+            if reader.fieldnames != COLUMNS:
+                raise BulkImportError("CSV file does not have the expected columns %s: %s" % (",".join(COLUMNS), path))
+            lines = ((reader.line_num, row) for row in reader)
+            parse = lambda row: [parse_csv_row(row)]  # pylint: disable=unnecessary-lambda-assignment:
+        else:
+            lines = ((number, line) for number, line in enumerate(fp, start=1) if line.strip() and not line.startswith("#"))
+            parse = parse_line_protocol
+        for number, line in lines:
+            result.read += 1
+            try:
+                readings = parse(line)
+            except (ValueError, KeyError, TypeError) as e:
+                result.invalid += 1
+                logging.warning("Skipping invalid input at %s:%d: %s", path, number, e)
+                continue
+            yield from readings
+
+
+def _flux_time(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp // 1_000_000_000, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def existing_flux(bucket: str, batch: List[Reading]) -> str:
+    """Flux that retrieves the keys of points that already exist over the time range of a batch."""
+    start = min(item.timestamp for item in batch)
+    stop = max(item.timestamp for item in batch) + 1_000_000_000  # range stop is exclusive, at a resolution of seconds
+    measurements = " or ".join('r._measurement == "%s"' % name for name in sorted({item.measurement for item in batch}))
+    return (
+        'from(bucket: "%s")\n'
+        "  |> range(start: %s, stop: %s)\n"
+        "  |> filter(fn: (r) => %s)\n"
+        '  |> drop(columns: ["_start", "_stop", "_value"])'
+    ) % (bucket, _flux_time(start), _flux_time(stop), measurements)
+
+
+def _existing(batch: List[Reading]) -> Set[ReadingKey]:
+    """Return the keys in a batch of readings that already exist in InfluxDB, checking wherever each reading is routed."""
+    routed: Dict[Tuple[str, str, str], Tuple[InfluxDbConfig, List[Reading]]] = {}
+    for item in batch:
+        influxdb = destination(config().influxdb, item.measurement, dict(item.tags).get("location"))
+        routed.setdefault((influxdb.url, influxdb.org, influxdb.bucket), (influxdb, []))[1].append(item)
+    keys = set()
+    for influxdb, items in routed.values():
+        with InfluxDBClient(url=influxdb.url, org=influxdb.org, token=influxdb.token) as client:
+            for record in client.query_api().query_stream(existing_flux(influxdb.bucket, items), org=influxdb.org):
+                values = dict(record.values)
+                stamp = values.pop("_time")
+                measurement, name = values.pop("_measurement"), values.pop("_field")
+                tags = tuple(
+                    sorted((k, v) for k, v in values.items() if not k.startswith("_") and k not in ("result", "table") and v)
+                )
+                keys.add((measurement, tags, name, _nanoseconds(stamp)))
+    return keys
+
+
+def _write_batch(batch: List[Reading], deduplicate: bool) -> Tuple[int, int]:
+    """Deduplicate and write a batch, returning the number of duplicate and written readings."""
+    unique: Dict[ReadingKey, Reading] = {}
+    for item in batch:
+        unique.setdefault(item.key(), item)
+    existing = _existing(batch) if deduplicate and unique else set()
+    points = [item.point() for key, item in unique.items() if key not in existing]
+    if points:
+        sink().write(points, block=True)
+    return len(batch) - len(points), len(points)
+
+
+class RateLimiter:
+    """Token bucket limiting the rate at which rows are read, with a burst of one second."""
+
+    def __init__(self, rate: Optional[float]) -> None:
+        self.rate = rate
+        self._tokens = rate or 0.0
+        self._updated = time.monotonic()
+
+    def acquire(self, count: int) -> None:
+        """Wait until count rows may proceed."""
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate) - count
+        self._updated = now
+        if self._tokens < 0:
+            time.sleep(-self._tokens / self.rate)
+
+
+@define
+class _Progress:
+    """Periodic progress reporting, shared by the writers."""
+
+    result: ImportResult
+    started: float = field(factory=time.monotonic)
+    reported: float = field(factory=time.monotonic)
+    lock: Lock = field(factory=Lock)
+
+    def record(self, duplicate: int, written: int) -> None:
+        with self.lock:
+            self.result.duplicate += duplicate
+            self.result.written += written
+            now = time.monotonic()
+            if now - self.reported >= _REPORT_SEC:
+                self.reported = now
+                self.log(now)
+
+    def log(self, now: float) -> None:
+        elapsed = max(now - self.started, 0.001)
+        logging.info(
+            "Read %d row(s), wrote %d reading(s) at %.0f rows/sec, skipped %d invalid and %d duplicate",
+            self.result.read,
+            self.result.written,
+            self.result.read / elapsed,
+            self.result.invalid,
+            self.result.duplicate,
+        )
+
+
+def import_files(
+    paths: List[str], batch_size: int = 5000, workers: int = 4, rate: Optional[float] = None, deduplicate: bool = True
+) -> ImportResult:
+    """Import readings from CSV or line protocol files, returning counts of what was processed."""
+    result = ImportResult()
+    progress = _Progress(result)
+    limiter = RateLimiter(rate)
+    deduplicate = deduplicate and config().sinks.influxdb  # existing points can only be checked in InfluxDB
+    pending: Set[Future[Tuple[int, int]]] = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def submit(batch: List[Reading]) -> None:
+            while len(pending) >= workers * 2:  # bound the batches in flight, so memory stays constant
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    progress.record(*future.result())
+            limiter.acquire(len(batch))
+            pending.add(executor.submit(_write_batch, batch, deduplicate))
+
+        batch: List[Reading] = []
+        for path in paths:
+            for item in read_file(path, result):
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    submit(batch)
+                    batch = []
+        if batch:
+            submit(batch)
+        for future in pending:
+            progress.record(*future.result())
+    sink().flush(final=True)
+    progress.log(time.monotonic())
+    return result
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Load generator that drives the SmartApp endpoint with signed EVENT requests.
+
+Requests are built in the same format SmartThings uses, with a configurable number of
+locations and devices, device events per request, and a fraction of requests that are
+weather lookup timer events.  Each request is signed with a local RSA key, using the
+same HTTP signature scheme as SmartThings.  The public key is served by a local fake key
+server, so the server under test verifies signatures exactly as it would in production;
+it just needs `dispatcher.keyserverUrl` to point at the fake key server.
+
+Requests are sent open-loop at a target rate: each request has a scheduled send time,
+and latency is measured from that scheduled time rather than from when the request was
+actually sent.  That way, if the server falls behind, the queueing delay shows up in
+the latency percentiles instead of silently lowering the request rate.
+
+Note that sensor events trigger device directory refreshes and timer events trigger
+weather lookups, so the server under test should be pointed at the fake upstream services
+in `fakes.py` rather than the real SmartThings and weather.gov APIs.
+"""
+import json
+import logging
+import math
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import formatdate
+from hashlib import sha256
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+from attrs import define, field, frozen
+from Cryptodome.Hash import SHA256
+from Cryptodome.PublicKey import RSA
+from Cryptodome.Signature import pkcs1_15
+
+KEY_ID = "/loadgen"  # key id that requests are signed with
+SIGNED_HEADERS = "(request-target) digest date"  # headers covered by the signature
+
+_CLIENT_TIMEOUT_SEC = 30.0
+
+
+@frozen(kw_only=True)
+class LoadProfile:
+    """Shape of the generated load."""
+
+    locations: int = 1
+    devices: int = 10  # devices per location
+    batch_size: int = 1  # device events per request
+    timer_ratio: float = 0.0  # fraction of requests that are weather lookup timer events
+
+
+def _event_time() -> str:
+    return datetime.now(tz=timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def device_event(location_id: str, device_id: str, attribute: str, value: float) -> Dict[str, Any]:
+    """Build a DEVICE_EVENT for a temperature or humidity reading."""
+    return {
+        "eventTime": _event_time(),
+        "eventType": "DEVICE_EVENT",
+        "deviceEvent": {
+            "subscriptionName": "%s-events" % attribute,
+            "eventId": str(uuid.uuid4()),
+            "locationId": location_id,
+            "ownerId": location_id,
+            "ownerType": "LOCATION",
+            "deviceId": device_id,
+            "componentId": "main",
+            "capability": "temperatureMeasurement" if attribute == "temperature" else "relativeHumidityMeasurement",
+            "attribute": attribute,
+            "value": value,
+            "valueType": "number",
+            "stateChange": True,
+        },
+    }
+
+
+def timer_event() -> Dict[str, Any]:
+    """Build a TIMER_EVENT for the weather lookup schedule."""
+    return {
+        "eventTime": _event_time(),
+        "eventType": "TIMER_EVENT",
+        "timerEvent": {
+            "eventId": str(uuid.uuid4()),
+            "name": "weather-lookup",
+            "type": "CRON",
+            "time": _event_time(),
+            "expression": "0 * * * ? *",
+        },
+    }
+
+
+def event_request(location_id: str, events: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Build an EVENT lifecycle request for a location."""
+    return {
+        "lifecycle": "EVENT",
+        "executionId": str(uuid.uuid4()),
+        "locale": "en",
+        "version": "0.1.0",
+        "eventData": {
+            "authToken": "loadgen-token",
+            "installedApp": {
+                "installedAppId": "loadgen-%s" % location_id,
+                "locationId": location_id,
+                "config": {
+                    "retrieve-weather-enabled": [{"valueType": "STRING", "stringConfig": {"value": "true"}}],
+                    "retrieve-weather-cron": [{"valueType": "STRING", "stringConfig": {"value": "0 * * * ? *"}}],
+                },
+                "permissions": ["r:devices:*", "r:locations:*"],
+            },
+            "events": events,
+        },
+        "settings": {},
+    }
+
+
+class RequestGenerator:
+    """Generates EVENT requests per a load profile, with readings that wander like real sensors."""
+
+    def __init__(self, profile: LoadProfile, seed: Optional[int] = None) -> None:
+        self.profile = profile
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._readings: Dict[Tuple[int, int, str], float] = {}
+
+    def _reading(self, location: int, device: int, attribute: str) -> float:
+        start = 70.0 if attribute == "temperature" else 45.0
+        value = self._readings.get((location, device, attribute), start) + self._random.uniform(-0.5, 0.5)
+        self._readings[(location, device, attribute)] = value
+        return round(value, 2)
+
+    def next(self) -> Dict[str, Any]:
+        """Generate the next request."""
+        with self._lock:
+            location = self._random.randrange(self.profile.locations)
+            location_id = "location-%04d" % location
+            if self._random.random() < self.profile.timer_ratio:
+                return event_request(location_id, [timer_event()])
+            events = []
+            for _ in range(self.profile.batch_size):
+                device = self._random.randrange(self.profile.devices)
+                attribute = self._random.choice(["temperature", "humidity"])
+                value = self._reading(location, device, attribute)
+                events.append(device_event(location_id, "device-%04d-%04d" % (location, device), attribute, value))
+            return event_request(location_id, events)
+
+
+class RequestSigner:
+    """Signs requests using the Joyent HTTP signature scheme, as SmartThings does."""
+
+    def __init__(self, key: RSA.RsaKey, target_url: str, key_id: str = KEY_ID) -> None:
+        self.key = key
+        self.key_id = key_id
+        parts = urllib.parse.urlsplit(target_url)
+        self.path = "%s?%s" % (parts.path, parts.query) if parts.query else parts.path  # as seen by the verifier
+
+    def headers(self, body: bytes) -> Dict[str, str]:
+        """Return the headers for a signed request with a body."""
+        date = formatdate(usegmt=True)
+        digest = "SHA-256=%s" % b64encode(sha256(body).digest()).decode()
+        signing_string = "(request-target): post %s\ndigest: %s\ndate: %s" % (self.path, digest, date)
+        signature = b64encode(pkcs1_15.new(self.key).sign(SHA256.new(signing_string.encode()))).decode()
+        authorization = 'Signature keyId="%s",signature="%s",headers="%s",algorithm="rsa-sha256"' % (
+            self.key_id,
+            signature,
+            SIGNED_HEADERS,
+        )
+        return {"Content-Type": "application/json", "Date": date, "Digest": digest, "Authorization": authorization}
+
+
+def _percentile(ordered: List[float], percentile: float) -> float:
+    """Nearest-rank percentile of an ordered list."""
+    if not ordered:
+        return 0.0
+    rank = max(1, math.ceil(percentile / 100.0 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+@define
+class LoadReport:
+    """Results of a load run."""
+
+    elapsed: float = 0.0
+    latencies: List[float] = field(factory=list)  # seconds, for every request that completed
+    errors: Dict[str, int] = field(factory=dict)  # count by HTTP status or exception type
+
+    @property
+    def requests(self) -> int:
+        return len(self.latencies)
+
+    @property
+    def error_count(self) -> int:
+        return sum(self.errors.values())
+
+    def throughput(self) -> float:
+        """Achieved requests per second."""
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+    def error_rate(self) -> float:
+        """Fraction of requests that failed."""
+        return self.error_count / self.requests if self.requests else 0.0
+
+    def percentile(self, percentile: float) -> float:
+        """Latency at a percentile, in seconds."""
+        return _percentile(sorted(self.latencies), percentile)
+
+    def summary(self) -> str:
+        ordered = sorted(self.latencies)
+        lines = [
+            "Requests: %d in %.1f seconds (%.1f/sec)" % (self.requests, self.elapsed, self.throughput()),
+            "Errors: %d (%.2f%%)%s"
+            % (
+                self.error_count,
+                100.0 * self.error_rate(),
+                "".join(" %s=%d" % (key, count) for key, count in sorted(self.errors.items())),
+            ),
+            "Latency (ms): %s" % " ".join("p%s=%.1f" % (p, 1000.0 * _percentile(ordered, p)) for p in (50, 90, 95, 99, 99.9, 100)),
+        ]
+        return "\n".join(lines)
+
+
+class LoadGenerator:
+    """Sends signed requests to a SmartApp endpoint at a target rate."""
+
+    def __init__(self, url: str, generator: RequestGenerator, signer: RequestSigner, concurrency: int = 16) -> None:
+        self.url = url
+        self.generator = generator
+        self.signer = signer
+        self.concurrency = concurrency
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session  # type: ignore
+
+    def _send(self, scheduled: float, report: LoadReport) -> None:
+        body = json.dumps(self.generator.next()).encode()
+        error: Optional[str] = None
+        try:
+            response = self._session().post(self.url, data=body, headers=self.signer.headers(body), timeout=_CLIENT_TIMEOUT_SEC)
+            if response.status_code != 200:
+                error = str(response.status_code)
+        except requests.RequestException as e:
+            error = type(e).__name__
+        latency = time.monotonic() - scheduled
+        with self._lock:
+            report.latencies.append(latency)
+            if error:
+                report.errors[error] = report.errors.get(error, 0) + 1
+
+    def run(self, rate: float, duration_sec: float, report_sec: float = 10.0) -> LoadReport:
+        """Send requests at a target rate for a duration, returning the results."""
+        report = LoadReport()
+        started = time.monotonic()
+        reported = started
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for sequence in range(int(rate * duration_sec)):
+                scheduled = started + sequence / rate
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self._send, scheduled, report)
+                if time.monotonic() - reported >= report_sec:
+                    reported = time.monotonic()
+                    with self._lock:
+                        logging.info("Sent %d request(s), %d error(s)", report.requests, report.error_count)
+        report.elapsed = time.monotonic() - started
+        return report
+
+
+def load_key(path: Optional[str]) -> RSA.RsaKey:
+    """Load a private key from a PEM file, or generate a new one if there is no path."""
+    if not path:
+        return RSA.generate(2048)
+    with open(path, "r", encoding="utf-8") as fp:
+        return RSA.import_key(fp.read())
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Asynchronous logging pipeline, with sampled logging of request and response bodies.
+
+The logging configuration (`logging.yaml`) writes to synchronous stream handlers, so
+under load, formatting and blocking writes happen on the request path.  When the
+pipeline is enabled, the root logger's handlers are moved behind a bounded queue.
+Logging a record only places it on the queue, and a single listener thread formats
+records and passes them to the original handlers.  If the queue is full, the record is
+dropped and counted rather than blocking the caller.  The message is merged with its
+arguments before the record is queued, since the arguments may be changed by the caller
+before the listener gets to them, but the rest of the formatting is left to the listener.
+
+Logging the full JSON for every request (`dispatcher.logJson`) is far too expensive
+under load.  Instead, request and response bodies can be logged for a sample of
+correlation ids.  Sampling is based on a hash of the correlation id, so a request and
+its response are always sampled together, as is every redelivery of the same request.
+Sampled bodies are logged at INFO, so they appear with the default logging configuration.
+"""
+import copy
+import logging
+import random
+from hashlib import sha256
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+from threading import Lock
+from typing import List, Optional, Union
+
+from sensortrack.config import config
+
+_HASH_RANGE = 2**64
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue handler that drops records rather than blocking when the queue is full, and defers formatting."""
+
+    def __init__(self, queue: "Queue[logging.LogRecord]") -> None:
+        super().__init__(queue)
+        self.dropped = 0
+        self._lock = Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The standard handler formats the record here, on the caller's thread.  The queue
+        # never leaves this process, so only the message is merged with its arguments, which
+        # might otherwise change before the listener runs, and the listener's handlers do the
+        # rest of the formatting (including any traceback).
+        record = copy.copy(record)  # other handlers may still see the original
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            with self._lock:
+                self.dropped += 1
+
+
+def sampled(correlation_id: Optional[str], rate: float) -> bool:
+    """Whether a correlation id is sampled at a rate, consistently for the same id."""
+    if rate <= 0.0:
+        return False
+    if rate >= 1.0:
+        return True
+    if not correlation_id:
+        return random.random() < rate
+    digest = int.from_bytes(sha256(correlation_id.encode("UTF-8")).digest()[:8], "big")
+    return digest < rate * _HASH_RANGE
+
+
+class LogPipeline:
+    """Moves the root logger's handlers behind a bounded queue, serviced by a listener thread."""
+
+    def __init__(self, queue_size: int, sample_rate: float = 0.0) -> None:
+        self.sample_rate = sample_rate
+        self.queue: "Queue[logging.LogRecord]" = Queue(maxsize=queue_size)
+        self.handler = DroppingQueueHandler(self.queue)
+        self._handlers: List[logging.Handler] = []
+        self._listener: Optional[QueueListener] = None
+
+    @property
+    def dropped(self) -> int:
+        return self.handler.dropped
+
+    def start(self) -> None:
+        root = logging.getLogger()
+        self._handlers = list(root.handlers)
+        self._listener = QueueListener(self.queue, *self._handlers, respect_handler_level=True)
+        for handler in self._handlers:
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        self._listener.start()
+
+    def stop(self) -> None:
+        """Restore the original handlers, once all queued records have been written."""
+        if self._listener:
+            root = logging.getLogger()
+            root.removeHandler(self.handler)
+            for handler in self._handlers:
+                root.addHandler(handler)
+            self._listener.stop()
+            self._listener = None
+
+    def log_exchange(self, correlation_id: Optional[str], request: Union[str, bytes], response: Union[str, bytes]) -> None:
+        """Log the request and response bodies, if the correlation id is sampled."""
+        if sampled(correlation_id, self.sample_rate):
+            request = request.decode("UTF-8", errors="replace") if isinstance(request, bytes) else request
+            response = response.decode("UTF-8", errors="replace") if isinstance(response, bytes) else response
+            logging.info("[%s] Request body: \n%s", correlation_id, request)  # note: may contain secrets!
+            logging.info("[%s] Response body: \n%s", correlation_id, response)
+
+
+_PIPELINE: Optional[LogPipeline] = None
+_CONFIGURED = False
+
+
+def shutdown() -> None:
+    """Stop the logging pipeline, if it was started, once all queued records have been written."""
+    if _PIPELINE:
+        _PIPELINE.stop()
+
+
+def reset() -> None:
+    """Reset the logging pipeline singleton, stopping the pipeline if it is running."""
+    global _PIPELINE, _CONFIGURED  # pylint: disable=global-statement
+    shutdown()
+    _PIPELINE = None
+    _CONFIGURED = False
+
+
+def pipeline() -> Optional[LogPipeline]:
+    """Return the configured logging pipeline, or None if it is disabled, starting it once and caching the instance."""
+    global _PIPELINE, _CONFIGURED  # pylint: disable=global-statement
+    if not _CONFIGURED:
+        configured = config().logging
+        if configured:
+            _PIPELINE = LogPipeline(configured.queue_size, configured.body_sample_rate)
+            _PIPELINE.start()
+        _CONFIGURED = True
+    return _PIPELINE
+
+
+def log_exchange(correlation_id: Optional[str], request: Union[str, bytes], response: Union[str, bytes]) -> None:
+    """Log the request and response bodies for a SmartApp request, if logging is enabled and the request is sampled."""
+    logs = pipeline()
+    if logs:
+        logs.log_exchange(correlation_id, request, response)
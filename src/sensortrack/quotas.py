@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Per-installed-app write quotas and series cardinality accounting.
+
+Every installed app writes into the same InfluxDB bucket, so one location with hundreds
+of devices, or a single flapping sensor, could otherwise swamp writes for everyone.  Each
+installed app gets its own token bucket, which limits the rate of readings written, and
+its own count of the distinct (location, device, attribute) series it has written, which
+can optionally be capped.  Readings are counted before compression, so the limit applies
+to what a tenant sends rather than to what happens to be written after compression.
+
+A reading that is over the rate limit, or that would start a new series beyond the cap,
+is handled by the configured overflow policy:
+
+- `drop`: the reading is discarded and counted.
+
+- `aggregate`: the reading is folded into a fixed window per series, and the window is
+  written as a single point (mean, min, max and count, like the streaming aggregation)
+  into a separate measurement once it closes.
+
+- `spool`: the reading is appended as line protocol to a per-app file in the spool
+  directory.  Spooled files can be replayed later with `sensortrack import`, which
+  deletes nothing, so remove the files once they have been imported.
+
+Usage for each installed app is reported on the `/metrics` endpoint.  State is bounded:
+the least-recently-active installed apps are forgotten beyond a fixed number, and when
+the series count isn't capped, only the most recently written series are remembered, so
+the reported series count stops growing at that bound.  A forgotten installed app starts
+again with a full token bucket and no series.
+
+Overflow windows are collected in the same way as the streaming aggregation's windows,
+and are restored by the caller if the write fails.
+"""
+import os
+import re
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, List, Optional
+
+from attrs import define, field, frozen
+from influxdb_client import Point
+
+from sensortrack.aggregation import WindowAggregator, WindowResult
+from sensortrack.config import ConfigError, OverflowPolicy, QuotaConfig, config
+from sensortrack.recent import SeriesKey
+
+SPOOL_SUFFIX = ".lp"  # spool files hold line protocol, which `sensortrack import` accepts
+
+_MAX_TENANTS = 1024  # installed apps tracked in total; the least-recently-active installed app is forgotten first
+_MAX_SERIES = 4096  # series remembered per installed app when the series count isn't capped
+
+_UNSAFE = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+class TokenBucket:
+    """Token bucket allowing a sustained rate with a burst, refilled lazily as it is used."""
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now: float) -> bool:
+        """Take a token if one is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+
+@frozen(kw_only=True)
+class TenantUsage:
+    """Usage for an installed app."""
+
+    installed_app_id: str
+    series: int
+    written: int
+    dropped: int
+    aggregated: int
+    spooled: int
+
+
+@define
+class _Tenant:
+    bucket: TokenBucket
+    series: "OrderedDict[SeriesKey, None]" = field(factory=OrderedDict)  # least-recently-written first
+    written: int = 0
+    dropped: int = 0
+    aggregated: int = 0
+    spooled: int = 0
+
+
+class Spool:
+    """Appends overflow points to a line protocol file per installed app."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def append(self, installed_app_id: str, point: Point) -> None:
+        path = os.path.join(self.path, "%s%s" % (_UNSAFE.sub("_", installed_app_id), SPOOL_SUFFIX))
+        with self._lock:
+            with open(path, "a", encoding="utf-8") as fp:
+                fp.write(point.to_line_protocol())
+                fp.write("\n")
+
+    def backlog(self) -> int:
+        """Total size of the spool files in bytes, which drops as files are removed once they're replayed."""
+        with os.scandir(self.path) as entries:
+            return sum(entry.stat().st_size for entry in entries if entry.is_file() and entry.name.endswith(SPOOL_SUFFIX))
+
+
+class QuotaManager:
+    """Enforces write quotas for each installed app, applying the overflow policy to readings over quota."""
+
+    def __init__(self, settings: QuotaConfig) -> None:
+        if settings.overflow == OverflowPolicy.SPOOL and not settings.spool_path:
+            raise ConfigError("The spool overflow policy requires quotas.spoolPath")
+        self.settings = settings
+        self.burst = float(settings.burst or max(settings.points_per_sec, 1.0))
+        self.overflow_aggregator = WindowAggregator(settings.aggregate_sec, settings.aggregate_measurement)
+        self.spool = Spool(settings.spool_path) if settings.overflow == OverflowPolicy.SPOOL and settings.spool_path else None
+        self._tenants: OrderedDict[str, _Tenant] = OrderedDict()
+        self._lock = Lock()
+
+    def _tenant(self, installed_app_id: str, now: float) -> _Tenant:
+        tenant = self._tenants.get(installed_app_id)
+        if tenant is None:
+            tenant = _Tenant(bucket=TokenBucket(self.settings.points_per_sec, self.burst, now))
+            self._tenants[installed_app_id] = tenant
+            if len(self._tenants) > _MAX_TENANTS:
+                self._tenants.popitem(last=False)
+        else:
+            self._tenants.move_to_end(installed_app_id)
+        return tenant
+
+    def admit(self, installed_app_id: str, key: SeriesKey, now: Optional[float] = None) -> bool:
+        """Whether a reading for a series is within the installed app's quota, accounting for it if so."""
+        now = now if now is not None else time.time()
+        with self._lock:
+            tenant = self._tenant(installed_app_id, now)
+            if key not in tenant.series:
+                if self.settings.max_series and len(tenant.series) >= self.settings.max_series:
+                    return False
+            if not tenant.bucket.take(now):
+                return False
+            tenant.series[key] = None
+            tenant.series.move_to_end(key)
+            if not self.settings.max_series and len(tenant.series) > _MAX_SERIES:
+                tenant.series.popitem(last=False)
+            tenant.written += 1
+            return True
+
+    def overflow(self, installed_app_id: str, key: SeriesKey, now: float, value: float, *, point: Callable[[], Point]) -> None:
+        """Apply the overflow policy to a reading that was not admitted; the point is only built if it is spooled."""
+        if self.settings.overflow == OverflowPolicy.AGGREGATE:
+            self.overflow_aggregator.add(key, now, value)
+        elif self.spool:
+            self.spool.append(installed_app_id, point())
+        with self._lock:
+            tenant = self._tenant(installed_app_id, now)
+            if self.settings.overflow == OverflowPolicy.AGGREGATE:
+                tenant.aggregated += 1
+            elif self.spool:
+                tenant.spooled += 1
+            else:
+                tenant.dropped += 1
+
+    def collect(self, now: Optional[float] = None) -> List[WindowResult]:
+        """Remove and return overflow windows that have closed as of now, or all windows if now is None."""
+        return self.overflow_aggregator.collect(now)
+
+    def points(self, results: List[WindowResult]) -> List[Point]:
+        """Convert collected overflow windows into points to be written."""
+        return self.overflow_aggregator.points(results)
+
+    def restore(self, results: List[WindowResult]) -> None:
+        """Restore collected overflow windows that could not be written."""
+        self.overflow_aggregator.restore(results)
+
+    def usage(self) -> List[TenantUsage]:
+        with self._lock:
+            return [
+                TenantUsage(
+                    installed_app_id=installed_app_id,
+                    series=len(tenant.series),
+                    written=tenant.written,
+                    dropped=tenant.dropped,
+                    aggregated=tenant.aggregated,
+                    spooled=tenant.spooled,
+                )
+                for installed_app_id, tenant in sorted(self._tenants.items())
+            ]
+
+
+_QUOTAS: Optional[QuotaManager] = None
+_CONFIGURED = False
+
+
+def reset() -> None:
+    """Reset the quota manager singleton, discarding all usage and any aggregated overflow."""
+    global _QUOTAS, _CONFIGURED  # pylint: disable=global-statement
+    _QUOTAS = None
+    _CONFIGURED = False
+
+
+def quotas() -> Optional[QuotaManager]:
+    """Return the configured quota manager, or None if quotas are disabled, creating it once and caching the instance."""
+    global _QUOTAS, _CONFIGURED  # pylint: disable=global-statement
+    if not _CONFIGURED:
+        configured = config().quotas
+        if configured:
+            _QUOTAS = QuotaManager(configured)
+        _CONFIGURED = True
+    return _QUOTAS
+
+
+def tenant_usage() -> List[TenantUsage]:
+    """Return usage for each installed app, or nothing if quotas are disabled."""
+    manager = quotas()
+    return manager.usage() if manager else []
+
+
+def spool_backlog() -> int:
+    """Return the size of the overflow spool in bytes, or zero if nothing is spooled."""
+    manager = quotas()
+    return manager.spool.backlog() if manager and manager.spool else 0
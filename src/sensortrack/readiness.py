@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Readiness, backed by dependency checks that run in the background.
+
+The `/health` endpoint only says that the server is up.  Readiness also depends on
+whether points can actually be written, but checking that on every probe would put
+load on InfluxDB in proportion to the number of probes.  Instead, the checks run in the
+background on a fixed interval, and the `/ready` endpoint only returns the cached
+results, so a probe costs nothing.
+
+Each check pings InfluxDB (if the InfluxDB sink is enabled, including every routed
+destination), and records the number of
+points buffered in the output sinks waiting to be written, the size of the quota
+overflow spool, and the circuit breaker state for each upstream.  The server is ready
+when InfluxDB responds and the buffered points and spool are within their configured
+limits.  Upstream circuit breakers are reported but do not affect readiness, since
+events are still written while SmartThings or weather.gov are unavailable.  Results
+that are more than a few intervals old are reported as not ready, in case the checks
+themselves have stopped running.
+"""
+import logging
+import time
+from threading import Lock
+from typing import Dict, List, Optional
+
+from attrs import frozen
+from influxdb_client import InfluxDBClient
+
+from sensortrack.config import InfluxDbConfig, ReadinessConfig, config
+from sensortrack.quotas import spool_backlog
+from sensortrack.rest import upstream_status
+from sensortrack.sinks import destinations, sink
+
+STALE_INTERVALS = 3  # results are stale once they are older than this many intervals
+
+
+@frozen(kw_only=True)
+class ReadinessStatus:
+    """Results of the most recent readiness check."""
+
+    ready: bool
+    checked_at: Optional[float]  # epoch seconds, or None if no check has completed yet
+    influxdb: Optional[bool]  # None if the InfluxDB sink is disabled
+    pending_points: int
+    spool_bytes: int
+    upstreams: Dict[str, str]
+    reasons: List[str]
+
+
+NOT_CHECKED = ReadinessStatus(
+    ready=False,
+    checked_at=None,
+    influxdb=None,
+    pending_points=0,
+    spool_bytes=0,
+    upstreams={},
+    reasons=["Dependencies have not been checked yet"],
+)
+
+
+def ping_influxdb(influxdb: InfluxDbConfig, timeout_sec: float) -> bool:
+    """Ping InfluxDB, returning whether it responded."""
+    with InfluxDBClient(url=influxdb.url, org=influxdb.org, token=influxdb.token, timeout=int(timeout_sec * 1000)) as client:
+        return client.ping()
+
+
+class ReadinessChecker:
+    """Checks dependencies, caching the results."""
+
+    def __init__(self, settings: ReadinessConfig) -> None:
+        self.settings = settings
+        self._status: Optional[ReadinessStatus] = None
+        self._lock = Lock()
+
+    def check(self) -> ReadinessStatus:
+        """Check dependencies, returning the results without caching them."""
+        reasons: List[str] = []
+        influxdb: Optional[bool] = None
+        if config().sinks.influxdb:
+            failed = [
+                target.url for target in destinations(config().influxdb) if not ping_influxdb(target, self.settings.timeout_sec)
+            ]
+            reasons.extend("InfluxDB at %s did not respond to ping" % url for url in failed)
+            influxdb = not failed
+        pending_points = sink().pending()
+        if self.settings.max_pending_points and pending_points > self.settings.max_pending_points:
+            reasons.append("%d points waiting to be written" % pending_points)
+        spool_bytes = spool_backlog()
+        if self.settings.max_spool_bytes and spool_bytes > self.settings.max_spool_bytes:
+            reasons.append("%d bytes spooled" % spool_bytes)
+        return ReadinessStatus(
+            ready=not reasons,
+            checked_at=time.time(),
+            influxdb=influxdb,
+            pending_points=pending_points,
+            spool_bytes=spool_bytes,
+            upstreams={status.name: status.state.value for status in upstream_status()},
+            reasons=reasons,
+        )
+
+    def refresh(self) -> None:
+        """Check dependencies and cache the results."""
+        status = self.check()
+        if not status.ready:
+            logging.warning("Not ready: %s", "; ".join(status.reasons))
+        with self._lock:
+            self._status = status
+
+    def status(self, now: Optional[float] = None) -> ReadinessStatus:
+        """Return the cached results, marked not ready if they are stale."""
+        with self._lock:
+            status = self._status
+        if status is None or status.checked_at is None:
+            return NOT_CHECKED
+        now = now if now is not None else time.time()
+        if now - status.checked_at > STALE_INTERVALS * self.settings.interval_sec:
+            reason = "Last checked %d seconds ago" % (now - status.checked_at)
+            return ReadinessStatus(
+                ready=False,
+                checked_at=status.checked_at,
+                influxdb=status.influxdb,
+                pending_points=status.pending_points,
+                spool_bytes=status.spool_bytes,
+                upstreams=status.upstreams,
+                reasons=[*status.reasons, reason],
+            )
+        return status
+
+
+_CHECKER: Optional[ReadinessChecker] = None
+
+
+def reset() -> None:
+    """Reset the readiness checker singleton, discarding any cached results."""
+    global _CHECKER  # pylint: disable=global-statement
+    _CHECKER = None
+
+
+def checker() -> ReadinessChecker:
+    """Return the readiness checker, creating it once and caching the instance."""
+    global _CHECKER  # pylint: disable=global-statement
+    if _CHECKER is None:
+        _CHECKER = ReadinessChecker(config().readiness)
+    return _CHECKER
+
+
+def readiness_status() -> ReadinessStatus:
+    """Return the cached readiness results, without checking anything or loading configuration."""
+    return _CHECKER.status() if _CHECKER else NOT_CHECKED
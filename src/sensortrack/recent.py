@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+In-memory hot tier of recent readings.
+
+Each series, identified by (location, device, attribute), is kept in a fixed-size ring
+buffer of timestamp/value pairs backed by arrays of doubles.  Looking up the latest
+reading is O(1), and retrieving a recent window is O(window).  The number of series
+is bounded, with the least-recently-updated series evicted first, so total memory is
+bounded at roughly `max_series * capacity * 16` bytes.  Series are also indexed by
+location, so listing the devices at a location only visits that location's series.
+
+Weather readings are stored against the pseudo-device `WEATHER_DEVICE`.
+"""
+import time
+from array import array
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Optional, Set, Tuple
+
+from attrs import frozen
+
+WEATHER_DEVICE = "weather"  # pseudo-device used for weather readings at a location
+
+_CAPACITY = 360  # readings retained per series
+_MAX_SERIES = 1024  # series retained in total
+
+SeriesKey = Tuple[str, str, str]  # (location, device, attribute)
+Reading = Tuple[float, float]  # (timestamp in epoch seconds, value)
+
+
+@frozen(kw_only=True)
+class DeviceStatus:
+    """Latest known state of a device at a location."""
+
+    location_id: str
+    device_id: str
+    last_seen: float
+    staleness_sec: float
+    values: Dict[str, float]
+
+
+class RingBuffer:
+    """Fixed-size ring buffer of timestamp/value pairs."""
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.size = 0
+        self._next = 0
+        self._timestamps = array("d", bytes(8 * capacity))
+        self._values = array("d", bytes(8 * capacity))
+
+    def append(self, timestamp: float, value: float) -> None:
+        """Append a reading, overwriting the oldest reading once the buffer is full."""
+        self._timestamps[self._next] = timestamp
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def latest(self) -> Optional[Reading]:
+        """Return the most recent reading, if any."""
+        if self.size == 0:
+            return None
+        index = (self._next - 1) % self.capacity
+        return self._timestamps[index], self._values[index]
+
+    def window(self, since: float) -> List[Reading]:
+        """Return all readings with a timestamp at or after since, oldest first."""
+        result: List[Reading] = []
+        index = self._next
+        for _ in range(self.size):
+            index = (index - 1) % self.capacity
+            if self._timestamps[index] < since:
+                break
+            result.append((self._timestamps[index], self._values[index]))
+        result.reverse()
+        return result
+
+
+class RecentReadings:
+    """Bounded store of ring buffers, one per series."""
+
+    def __init__(self, capacity: int = _CAPACITY, max_series: int = _MAX_SERIES) -> None:
+        self.capacity = capacity
+        self.max_series = max_series
+        self._series: OrderedDict[SeriesKey, RingBuffer] = OrderedDict()
+        self._locations: Dict[str, Set[SeriesKey]] = {}  # location id -> series at that location
+        self._lock = Lock()
+
+    def record(self, location_id: str, device_id: str, attribute: str, value: float, *, timestamp: Optional[float] = None) -> None:
+        """Record a reading for a series, defaulting the timestamp to now."""
+        key = (location_id, device_id, attribute)
+        with self._lock:
+            buffer = self._series.get(key)
+            if buffer is None:
+                buffer = RingBuffer(self.capacity)
+                self._series[key] = buffer
+                self._locations.setdefault(location_id, set()).add(key)
+                if len(self._series) > self.max_series:
+                    evicted, _ = self._series.popitem(last=False)
+                    keys = self._locations[evicted[0]]
+                    keys.discard(evicted)
+                    if not keys:
+                        del self._locations[evicted[0]]
+            else:
+                self._series.move_to_end(key)
+            buffer.append(time.time() if timestamp is None else timestamp, value)
+
+    def latest(self, location_id: str, device_id: str, attribute: str) -> Optional[Reading]:
+        """Return the latest reading for a series, if any."""
+        with self._lock:
+            buffer = self._series.get((location_id, device_id, attribute))
+            return buffer.latest() if buffer else None
+
+    def window(self, location_id: str, device_id: str, attribute: str, seconds: float) -> Optional[List[Reading]]:
+        """Return readings from the last `seconds` for a series, or None if the series is unknown."""
+        since = time.time() - seconds
+        with self._lock:
+            buffer = self._series.get((location_id, device_id, attribute))
+            return buffer.window(since) if buffer else None
+
+    def devices(self, location_id: str) -> List[DeviceStatus]:
+        """Return the latest values, last-seen time and staleness for each device at a location."""
+        now = time.time()
+        latest: Dict[str, Dict[str, Reading]] = {}
+        with self._lock:
+            for key in self._locations.get(location_id, ()):
+                reading = self._series[key].latest()
+                if reading:
+                    _, device, attribute = key
+                    latest.setdefault(device, {})[attribute] = reading
+        result = []
+        for device, readings in sorted(latest.items()):
+            last_seen = max(timestamp for timestamp, _ in readings.values())
+            result.append(
+                DeviceStatus(
+                    location_id=location_id,
+                    device_id=device,
+                    last_seen=last_seen,
+                    staleness_sec=round(max(0.0, now - last_seen), 3),
+                    values={attribute: value for attribute, (_, value) in sorted(readings.items())},
+                )
+            )
+        return result
+
+
+_RECENT: Optional[RecentReadings] = None
+
+
+def reset() -> None:
+    """Reset the recent readings singleton, discarding all readings."""
+    global _RECENT  # pylint: disable=global-statement
+    _RECENT = None
+
+
+def recent() -> RecentReadings:
+    """Return the recent readings store, creating it once and caching the instance."""
+    global _RECENT  # pylint: disable=global-statement
+    if _RECENT is None:
+        _RECENT = RecentReadings()
+    return _RECENT
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=import-outside-toplevel:
+
+"""
+Lifecycle responses encoded as JSON bytes, precomputed where possible.
+
+Most lifecycle responses never vary: the INSTALL, UPDATE, UNINSTALL, OAUTH_CALLBACK and
+EVENT responses are empty, and the CONFIRMATION and CONFIGURATION responses depend only
+on the SmartApp definition, plus the phase and page id for CONFIGURATION.  All of these
+are encoded once and then served directly as bytes.  The precomputed responses are keyed
+by the definition's version (see `dispatcher.definition_version()`), and are rebuilt
+whenever the definition is reloaded (see `dispatcher.reset()`) with a different version.
+
+The `dispatch()` function here is used by both the FastAPI route in `server.py` and the
+fast path in `fastpath.py`, so both serve the precomputed responses.
+
+JSON is encoded and decoded with orjson if it is installed (the `fastpath` extra), and
+with the standard library otherwise.
+"""
+import json
+import logging
+from importlib.util import find_spec
+from json import JSONDecodeError
+from threading import Lock
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+
+from smartapp.converter import CONVERTER
+from smartapp.dispatcher import StaticConfigManager
+from smartapp.interface import (
+    ConfigPhase,
+    ConfigurationRequest,
+    ConfirmationRequest,
+    ConfirmationResponse,
+    EventResponse,
+    InstallResponse,
+    InternalError,
+    LifecycleRequest,
+    LifecycleResponse,
+    OauthCallbackResponse,
+    SmartAppDefinition,
+    SmartAppError,
+    SmartAppRequestContext,
+    UninstallResponse,
+    UpdateResponse,
+)
+from smartapp.signature import SignatureVerifier
+
+from sensortrack.dispatcher import definition, definition_version, dispatcher
+
+
+def _json_codec() -> Tuple[Callable[[bytes], Any], Callable[[Any], bytes]]:
+    """Return the fastest available JSON decoder and encoder, both working with bytes."""
+    if find_spec("orjson") is not None:
+        import orjson  # pylint: disable=import-error:
+
+        return orjson.loads, orjson.dumps
+    return json.loads, lambda value: json.dumps(value, separators=(",", ":")).encode("UTF-8")
+
+
+loads, dumps = _json_codec()
+
+# Responses that never vary, encoded once up front
+_STATIC: Dict[type, bytes] = {
+    response: dumps(CONVERTER.unstructure(response()))
+    for response in (InstallResponse, UpdateResponse, UninstallResponse, OauthCallbackResponse, EventResponse)
+}
+
+
+def encode(response: LifecycleResponse) -> bytes:
+    """Encode a lifecycle response as JSON bytes."""
+    static = _STATIC.get(type(response))
+    return static if static is not None else dumps(CONVERTER.unstructure(response))
+
+
+class PrecomputedResponses:
+    """CONFIRMATION and CONFIGURATION responses for a version of the definition, encoded once."""
+
+    def __init__(self, smartapp: SmartAppDefinition, version: str) -> None:
+        self.version = version
+        # The static config manager is the one the dispatcher uses, and it ignores the request entirely
+        manager = StaticConfigManager()
+        self.confirmation = encode(ConfirmationResponse(target_url=smartapp.target_url))
+        self.initialize = encode(manager.handle_initialize(None, smartapp))  # type: ignore[arg-type]
+        self.pages = {
+            page_id: encode(manager.handle_page(None, smartapp, page_id))  # type: ignore[arg-type]
+            for page_id in range(1, len(smartapp.config_pages or []) + 1)
+        }
+
+    def lookup(self, request: LifecycleRequest) -> Optional[bytes]:
+        """Return the precomputed response for a request, or None if there isn't one."""
+        if isinstance(request, ConfirmationRequest):
+            return self.confirmation
+        if isinstance(request, ConfigurationRequest):
+            if request.configuration_data.phase == ConfigPhase.INITIALIZE:
+                return self.initialize
+            try:
+                return self.pages.get(int(request.configuration_data.page_id))
+            except ValueError:
+                return None  # let the dispatcher reject it
+        return None
+
+
+_RESPONSES: Optional[PrecomputedResponses] = None
+_LOCK = Lock()
+
+_PRECOMPUTED = (b'"CONFIRMATION"', b'"CONFIGURATION"')  # lifecycles that may have a precomputed response
+
+
+def reset() -> None:
+    """Reset the precomputed responses singleton, forcing the responses to be rebuilt when next used."""
+    global _RESPONSES  # pylint: disable=global-statement
+    _RESPONSES = None
+
+
+def responses() -> PrecomputedResponses:
+    """Return the precomputed responses for the current definition version, rebuilding them if the version changed."""
+    global _RESPONSES  # pylint: disable=global-statement
+    with _LOCK:
+        version = definition_version()
+        if _RESPONSES is None or _RESPONSES.version != version:
+            _RESPONSES = PrecomputedResponses(definition(), version)
+            logging.debug("Precomputed lifecycle responses for %d configuration page(s)", len(_RESPONSES.pages))
+        return _RESPONSES
+
+
+def _precomputed(context: SmartAppRequestContext, body: bytes) -> Optional[bytes]:
+    """
+    Return the precomputed response for a CONFIRMATION or CONFIGURATION request, or None for any other request.
+
+    The request is verified and passed to the event handler just as `SmartAppDispatcher.dispatch()`
+    would, before the precomputed response is returned in place of the one it would build.
+    """
+    smartapp = dispatcher()
+    try:
+        request: LifecycleRequest = CONVERTER.structure(loads(body), LifecycleRequest)  # type: ignore
+        precomputed = responses().lookup(request)
+        if precomputed is None:
+            return None  # let the dispatcher handle (or reject) it
+        if smartapp.config.log_json:
+            logging.debug("[%s] Raw JSON: \n%s", context.correlation_id, context.body)  # note: may contain secrets!
+        logging.info("[%s] Handling %s request", context.correlation_id, request.lifecycle)
+        if smartapp.config.check_signatures:
+            SignatureVerifier(context=context, config=smartapp.config, definition=smartapp.definition).verify()
+        if isinstance(request, ConfirmationRequest):
+            smartapp.event_handler.handle_confirmation(context.correlation_id, request)
+            logging.info("CONFIRMATION [%s]: [%s]", request.app_id, request.confirmation_data.confirmation_url)
+        elif isinstance(request, ConfigurationRequest):
+            smartapp.event_handler.handle_configuration(context.correlation_id, request)
+        return precomputed
+    except SmartAppError as e:
+        raise e
+    except (JSONDecodeError, ValueError):  # orjson.JSONDecodeError is a subclass of JSONDecodeError
+        return None  # let the dispatcher reject it, with the same error it would always raise
+    except Exception as e:  # pylint: disable=broad-except:
+        raise InternalError("%s" % e, context.correlation_id) from e
+
+
+def dispatch(headers: Mapping[str, str], body: bytes) -> bytes:
+    """
+    Dispatch a request, returning the encoded response.
+
+    Anything that could be a CONFIRMATION or CONFIGURATION request is checked for a
+    precomputed response first.  This is a cheap scan of the body, so an EVENT request
+    is only decoded once, by the dispatcher.
+    """
+    context = SmartAppRequestContext(headers=headers, body=body.decode("UTF-8"))
+    if any(lifecycle in body for lifecycle in _PRECOMPUTED):
+        precomputed = _precomputed(context, body)
+        if precomputed is not None:
+            return precomputed
+    return dispatcher().dispatch(context).encode("UTF-8")
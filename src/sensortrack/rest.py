@@ -5,18 +5,23 @@
 """
 Shared functionality for REST clients.
 """
-from typing import Optional, Union
+import time
+from enum import Enum
+from functools import wraps
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, TypeVar, Union, cast
 
 import requests
 from attrs import frozen
 from requests import ConnectionError as RequestsConnectionError
 from requests.exceptions import ConnectionError as RequestsConnectionError
 from requests.exceptions import HTTPError
-from tenacity import retry
-from tenacity.retry import retry_if_exception_type
+from tenacity import RetryCallState, retry
 from tenacity.stop import stop_after_attempt
 from tenacity.wait import wait_exponential
 
+F = TypeVar("F", bound=Callable[..., Any])  # pylint: disable=invalid-name:
+
 
 @frozen
 class RestClientError(Exception):
@@ -25,6 +30,7 @@ class RestClientError(Exception):
     message: str
     request_body: Optional[Union[bytes, str]] = None
     response_body: Optional[str] = None
+    status_code: Optional[int] = None
 
 
 @frozen
@@ -34,6 +40,30 @@ class RestDataError(Exception):
     message: str
 
 
+@frozen
+class CircuitOpenError(RestClientError):
+    """A call that was rejected without being attempted, because the upstream's circuit breaker is open."""
+
+
+class CircuitState(str, Enum):
+    """States for a circuit breaker."""
+
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+
+@frozen(kw_only=True)
+class UpstreamStatus:
+    """Point-in-time status for an upstream, suitable for reporting via health and metrics."""
+
+    name: str
+    state: CircuitState
+    consecutive_failures: int
+    rejected_calls: int
+    retry_tokens: float
+
+
 def raise_for_status(response: requests.Response) -> None:
     """Check response status, raising RestClientError for errors"""
     try:
@@ -43,13 +73,254 @@ def raise_for_status(response: requests.Response) -> None:
             message="Failed API call [%s %s]: %s" % (response.request.method, response.request.url, e),
             request_body=response.request.body,
             response_body=response.text,
+            status_code=response.status_code,
         ) from e
 
 
-# This configures 4 retries (5 total attempts), waiting 0.25 seconds before first
-# retry, and limiting the wait between retries to 2 seconds.
-DECAYING_RETRY = retry(
-    stop=stop_after_attempt(5),
-    wait=wait_exponential(multiplier=0.25, max=2),
-    retry=retry_if_exception_type((RestClientError, RequestsConnectionError, HTTPError)),
-)
+class CircuitBreaker:
+    """
+    Circuit breaker that fails fast while an upstream is clearly down.
+
+    After a run of consecutive failures, the breaker opens and calls are rejected
+    immediately with CircuitOpenError.  Once the reset timeout has elapsed, the breaker
+    goes half-open and lets a limited number of probe calls through.  A successful probe
+    closes the breaker again, and a failed probe re-opens it for another reset timeout.
+    A probe that ends any other way is released, so another probe can be attempted.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout_sec: float = 30.0, half_open_max_calls: int = 1) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_sec = reset_timeout_sec
+        self.half_open_max_calls = half_open_max_calls
+        self.consecutive_failures = 0
+        self.rejected_calls = 0
+        self._state = CircuitState.CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = Lock()
+
+    @property
+    def state(self) -> CircuitState:
+        """Current state of the breaker, moving from OPEN to HALF_OPEN once the reset timeout has elapsed."""
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> CircuitState:
+        if self._state == CircuitState.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout_sec:
+            self._state = CircuitState.HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def allow(self) -> bool:
+        """Whether a call should be attempted right now."""
+        with self._lock:
+            state = self._current_state()
+            if state == CircuitState.CLOSED:
+                return True
+            if state == CircuitState.HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return True
+            self.rejected_calls += 1
+            return False
+
+    def record_success(self) -> None:
+        """Record a successful call, closing the breaker."""
+        with self._lock:
+            self.consecutive_failures = 0
+            self._state = CircuitState.CLOSED
+
+    def release(self) -> None:
+        """Release a call that neither succeeded nor failed, so a half-open probe slot isn't held forever."""
+        with self._lock:
+            if self._state == CircuitState.HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def record_failure(self) -> None:
+        """Record a failed call, opening the breaker if the failure threshold has been reached."""
+        with self._lock:
+            self.consecutive_failures += 1
+            if self._state == CircuitState.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self._state = CircuitState.OPEN
+                self._opened_at = time.monotonic()
+
+
+class RetryBudget:
+    """
+    Token bucket that limits retries to a fraction of the calls made to an upstream.
+
+    Every call deposits `ratio` tokens and every retry withdraws a whole token, so when
+    an upstream is degraded the retry traffic stays bounded relative to the real traffic
+    rather than multiplying it.  The bucket also refills at `min_per_sec`, so that
+    occasional transient failures on a quiet upstream can still be retried.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_sec: float = 1.0, max_tokens: float = 10.0) -> None:
+        self.ratio = ratio
+        self.min_per_sec = min_per_sec
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    @property
+    def tokens(self) -> float:
+        """Number of retry tokens currently available."""
+        with self._lock:
+            return self._refill()
+
+    def _refill(self) -> float:
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_per_sec)
+        self._updated = now
+        return self._tokens
+
+    def deposit(self) -> None:
+        """Deposit tokens for a new call."""
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._refill() + self.ratio)
+
+    def withdraw(self) -> bool:
+        """Withdraw a token for a retry, returning False if the budget is exhausted."""
+        with self._lock:
+            if self._refill() < 1.0:
+                return False
+            self._tokens -= 1.0
+            return True
+
+
+class Upstream:
+    """An upstream service, tracking its circuit breaker and retry budget."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.breaker = CircuitBreaker()
+        self.budget = RetryBudget()
+
+    def status(self) -> UpstreamStatus:
+        """Return the current status of the upstream."""
+        return UpstreamStatus(
+            name=self.name,
+            state=self.breaker.state,
+            consecutive_failures=self.breaker.consecutive_failures,
+            rejected_calls=self.breaker.rejected_calls,
+            retry_tokens=round(self.budget.tokens, 2),
+        )
+
+
+_UPSTREAMS: Dict[str, Upstream] = {}
+_UPSTREAMS_LOCK = Lock()
+
+# Failures that count against the circuit breaker and may be retried
+_RETRYABLE = (RestClientError, RequestsConnectionError, HTTPError)
+
+# Failures that count against the circuit breaker; timeouts are the usual sign of a degraded upstream,
+# but are not retried, since a retry would just wait out the same timeout again
+_FAILURES = (*_RETRYABLE, requests.Timeout)
+
+# Client error statuses that say the upstream is busy rather than that the request is bad
+_RETRY_STATUSES = [408, 429]
+
+# Limit on the total time spent waiting between retries for a single call, since the wait
+# blocks a threadpool worker that other requests might otherwise be using
+_MAX_BACKOFF_SEC = 2.0
+
+
+def upstream(name: str) -> Upstream:
+    """Return the named upstream, creating it the first time it is requested."""
+    with _UPSTREAMS_LOCK:
+        if name not in _UPSTREAMS:
+            _UPSTREAMS[name] = Upstream(name)
+        return _UPSTREAMS[name]
+
+
+def upstream_status() -> List[UpstreamStatus]:
+    """Return the status of all known upstreams, ordered by name."""
+    with _UPSTREAMS_LOCK:
+        targets = sorted(_UPSTREAMS.values(), key=lambda u: u.name)
+    return [target.status() for target in targets]
+
+
+def reset() -> None:
+    """Reset circuit breakers and retry budgets for all known upstreams."""
+    with _UPSTREAMS_LOCK:
+        for target in _UPSTREAMS.values():
+            target.breaker = CircuitBreaker()
+            target.budget = RetryBudget()
+
+
+def decaying_retry(name: str) -> Callable[[F], F]:
+    """
+    Build a retry decorator for calls to a named upstream.
+
+    This configures up to 4 retries (5 total attempts), waiting 0.25 seconds before first
+    retry, and doubling the wait for each retry after that.  The total wait for a call is
+    limited to 2 seconds, so a call gives up rather than tying up its threadpool worker
+    in a long backoff loop.  Each call is guarded by the upstream's circuit breaker, so
+    calls fail fast with CircuitOpenError while the upstream is down, and each retry is
+    paid for out of the upstream's retry budget.  Retries stop as soon as either the
+    breaker opens or the budget is exhausted.  Client errors (4xx, other than 408 and
+    429) mean the request itself is bad, so they are neither retried nor counted against
+    the breaker.
+    """
+
+    target = upstream(name)
+
+    def stop_retrying(retry_state: RetryCallState) -> bool:
+        if stop_after_attempt(5)(retry_state):
+            return True
+        if retry_state.idle_for + retry_state.upcoming_sleep > _MAX_BACKOFF_SEC:
+            return True
+        return target.breaker.state == CircuitState.OPEN or not target.budget.withdraw()
+
+    def decorator(func: F) -> F:
+        @wraps(func)
+        def guarded(*args: Any, **kwargs: Any) -> Any:
+            if not target.breaker.allow():
+                raise CircuitOpenError("Circuit breaker for upstream [%s] is open" % name)
+            try:
+                result = func(*args, **kwargs)
+            except _FAILURES as e:
+                if _is_client_error(e):
+                    target.breaker.release()  # the upstream answered, so it isn't a sign that it's down
+                else:
+                    target.breaker.record_failure()
+                raise
+            except BaseException:
+                target.breaker.release()
+                raise
+            target.breaker.record_success()
+            return result
+
+        retrying = retry(
+            stop=stop_retrying,
+            wait=wait_exponential(multiplier=0.25, max=2),
+            retry=_is_retryable,
+        )(guarded)
+
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            target.budget.deposit()
+            return retrying(*args, **kwargs)
+
+        return cast(F, wrapper)
+
+    return decorator
+
+
+def _is_client_error(e: BaseException) -> bool:
+    """Whether an exception is for a client error response, which retrying won't fix."""
+    if isinstance(e, RestClientError):
+        status_code = e.status_code
+    elif isinstance(e, HTTPError) and e.response is not None:
+        status_code = e.response.status_code
+    else:
+        return False
+    return isinstance(status_code, int) and 400 <= status_code < 500 and status_code not in _RETRY_STATUSES
+
+
+def _is_retryable(retry_state: RetryCallState) -> bool:
+    """Whether the outcome of an attempt should be retried; rejected calls and client errors are never retried."""
+    if retry_state.outcome is None or not retry_state.outcome.failed:
+        return False
+    exception = retry_state.outcome.exception()
+    return isinstance(exception, _RETRYABLE) and not isinstance(exception, CircuitOpenError) and not _is_client_error(exception)
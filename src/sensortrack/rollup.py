@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Rollup buckets maintained in InfluxDB.
+
+Each configured rollup is a separate bucket holding aggregates of the raw `sensor` and
+`weather` points over a fixed window.  The mean keeps the original field name (so the
+same query works against raw and rollup buckets) and the min and max are stored in
+fields suffixed with `_min` and `_max`.
+
+Rollups are kept current incrementally by an InfluxDB task per rollup, which re-aggregates
+the two most recent windows each time it runs.  Re-aggregating a window overwrites the
+same points, so this is idempotent.  When a rollup bucket is empty, existing raw data is
+backfilled in chunks on a background thread.
+
+Backfill progress is checkpointed in the rollup bucket itself, as a marker point in the
+`sensortrack_backfill` measurement recording how far the backfill has got and where it
+stops.  The marker is written before the first chunk and after every chunk, so if the
+server is stopped part way through, the backfill resumes from the last completed chunk
+the next time rollups are provisioned.
+"""
+import logging
+import re
+import time
+from datetime import datetime, timezone
+from threading import Thread
+from typing import List, Optional, Tuple
+
+from attrs import frozen
+from influxdb_client import BucketRetentionRules, InfluxDBClient, Point
+from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.domain.task_create_request import TaskCreateRequest
+from influxdb_client.domain.task_update_request import TaskUpdateRequest
+
+from sensortrack.config import ConfigError, InfluxDbConfig, RollupConfig, config
+
+TASK_PREFIX = "sensortrack-rollup-"  # prefix for the names of the tasks we manage
+BACKFILL_MEASUREMENT = "sensortrack_backfill"  # measurement for the backfill checkpoint in each rollup bucket
+
+_DURATION = re.compile(r"^(\d+)([smhdw])$")
+_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+_BACKFILL_CHUNK_SEC = 7 * 24 * 60 * 60  # approximate size of each backfill query
+_TASK_OFFSET = "1m"  # delay task execution a bit, so late-arriving points are included
+
+
+def parse_duration(duration: str) -> int:
+    """Parse a simple Flux duration literal like "5m" into seconds."""
+    match = _DURATION.match(duration)
+    if not match or int(match.group(1)) == 0:
+        raise ConfigError("Invalid rollup duration: %s" % duration)
+    return int(match.group(1)) * _UNITS[match.group(2)]
+
+
+def task_name(rollup: RollupConfig) -> str:
+    """Name of the InfluxDB task that maintains a rollup."""
+    return "%s%s" % (TASK_PREFIX, rollup.bucket)
+
+
+def rollup_flux(influxdb: InfluxDbConfig, rollup: RollupConfig, start: str, stop: Optional[str] = None) -> str:
+    """Flux that aggregates raw data in a time range and writes it to a rollup bucket."""
+    time_range = "range(start: %s, stop: %s)" % (start, stop) if stop else "range(start: %s)" % start
+    return (
+        'data = from(bucket: "{source}")\n'
+        "  |> {time_range}\n"
+        '  |> filter(fn: (r) => r._measurement == "sensor" or r._measurement == "weather")\n'
+        "mean = data\n"
+        "  |> aggregateWindow(every: {every}, fn: mean, createEmpty: false)\n"
+        "low = data\n"
+        "  |> aggregateWindow(every: {every}, fn: min, createEmpty: false)\n"
+        '  |> map(fn: (r) => ({{r with _field: r._field + "_min"}}))\n'
+        "high = data\n"
+        "  |> aggregateWindow(every: {every}, fn: max, createEmpty: false)\n"
+        '  |> map(fn: (r) => ({{r with _field: r._field + "_max"}}))\n'
+        "union(tables: [mean, low, high])\n"
+        '  |> to(bucket: "{target}", org: "{org}")\n'
+    ).format(source=influxdb.bucket, time_range=time_range, every=rollup.every, target=rollup.bucket, org=influxdb.org)
+
+
+def task_flux(influxdb: InfluxDbConfig, rollup: RollupConfig) -> str:
+    """Flux for the task that keeps a rollup current, re-aggregating the two most recent windows."""
+    lookback = "-%ds" % (2 * parse_duration(rollup.every))
+    header = 'option task = {name: "%s", every: %s, offset: %s}\n\n' % (task_name(rollup), rollup.every, _TASK_OFFSET)
+    return header + rollup_flux(influxdb, rollup, lookback)
+
+
+def _ensure_bucket(client: InfluxDBClient, influxdb: InfluxDbConfig, rollup: RollupConfig) -> None:
+    """Create the rollup bucket if it does not already exist."""
+    if client.buckets_api().find_bucket_by_name(rollup.bucket) is None:  # type: ignore[no-untyped-call]
+        rules = BucketRetentionRules(type="expire", every_seconds=rollup.retention_sec) if rollup.retention_sec else None
+        client.buckets_api().create_bucket(bucket_name=rollup.bucket, retention_rules=rules, org=influxdb.org)
+        logging.info("Created rollup bucket: %s", rollup.bucket)
+
+
+def _ensure_task(client: InfluxDBClient, influxdb: InfluxDbConfig, rollup: RollupConfig) -> None:
+    """Create the task for a rollup, or update it if its Flux has changed."""
+    flux = task_flux(influxdb, rollup)
+    tasks = client.tasks_api().find_tasks(name=task_name(rollup), org=influxdb.org)
+    if not tasks:
+        request = TaskCreateRequest(org=influxdb.org, flux=flux, status="active", description="Managed by sensortrack")
+        client.tasks_api().create_task(task_create_request=request)
+        logging.info("Created rollup task: %s", task_name(rollup))
+    elif tasks[0].flux != flux:
+        client.tasks_api().update_task_request(str(tasks[0].id), TaskUpdateRequest(flux=flux))
+        logging.info("Updated rollup task: %s", task_name(rollup))
+
+
+def _remove_stale_tasks(client: InfluxDBClient, influxdb: InfluxDbConfig) -> None:
+    """Remove managed tasks for rollups that are no longer configured."""
+    expected = {task_name(rollup) for rollup in influxdb.rollups}
+    for task in client.tasks_api().find_tasks(org=influxdb.org):
+        if task.name.startswith(TASK_PREFIX) and task.name not in expected:
+            client.tasks_api().delete_task(str(task.id))
+            logging.info("Removed stale rollup task: %s", task.name)
+
+
+def _earliest(client: InfluxDBClient, influxdb: InfluxDbConfig, bucket: str) -> Optional[datetime]:
+    """Return the timestamp of the earliest point in a bucket, or None if the bucket is empty."""
+    query = (
+        'from(bucket: "%s")\n'
+        "  |> range(start: 0)\n"
+        "  |> first()\n"
+        '  |> keep(columns: ["_time"])\n'
+        "  |> group()\n"
+        '  |> min(column: "_time")'
+    ) % bucket
+    for record in client.query_api().query_stream(query, org=influxdb.org):
+        return record.values["_time"]  # type: ignore[no-any-return]
+    return None
+
+
+def _checkpoint(client: InfluxDBClient, influxdb: InfluxDbConfig, bucket: str) -> Optional[Tuple[int, int]]:
+    """Return the backfill checkpoint for a rollup bucket as (through, stop) in epoch seconds, or None if there isn't one."""
+    query = ('from(bucket: "%s")\n' "  |> range(start: 0)\n" '  |> filter(fn: (r) => r._measurement == "%s")\n' "  |> last()") % (
+        bucket,
+        BACKFILL_MEASUREMENT,
+    )
+    fields = {
+        record.values["_field"]: record.values["_value"] for record in client.query_api().query_stream(query, org=influxdb.org)
+    }
+    if "through" not in fields or "stop" not in fields:
+        return None
+    return int(fields["through"]), int(fields["stop"])
+
+
+def _save_checkpoint(client: InfluxDBClient, influxdb: InfluxDbConfig, rollup: RollupConfig, through: int, stop: int) -> None:
+    """Record how far the backfill of a rollup bucket has got, and where it stops."""
+    point = Point(BACKFILL_MEASUREMENT).field("through", through).field("stop", stop)
+    client.write_api(write_options=SYNCHRONOUS).write(bucket=rollup.bucket, org=influxdb.org, record=point)
+
+
+def _flux_time(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+@frozen
+class Backfill:
+    """A rollup backfill over [start, stop), in epoch seconds."""
+
+    rollup: RollupConfig
+    start: int
+    stop: int
+
+
+def backfill_rollup(influxdb: InfluxDbConfig, rollup: RollupConfig, start: datetime, stop: datetime) -> None:
+    """Backfill a rollup from raw data in [start, stop), in chunks aligned to the rollup window, checkpointing each chunk."""
+    every = parse_duration(rollup.every)
+    chunk = max(every, (_BACKFILL_CHUNK_SEC // every) * every)
+    current = (int(start.timestamp()) // every) * every
+    end = int(stop.timestamp())
+    with InfluxDBClient(url=influxdb.url, org=influxdb.org, token=influxdb.token) as client:
+        while current < end:
+            flux = rollup_flux(influxdb, rollup, _flux_time(current), _flux_time(current + chunk))
+            client.query_api().query(flux, org=influxdb.org)
+            current += chunk
+            _save_checkpoint(client, influxdb, rollup, min(current, end), end)
+    logging.info("Completed backfill for rollup bucket: %s", rollup.bucket)
+
+
+def _backfill_all(influxdb: InfluxDbConfig, pending: List[Backfill]) -> None:
+    """Backfill a set of rollups, logging rather than raising any failures."""
+    for backfill in pending:
+        try:
+            start = datetime.fromtimestamp(backfill.start, tz=timezone.utc)
+            backfill_rollup(influxdb, backfill.rollup, start, datetime.fromtimestamp(backfill.stop, tz=timezone.utc))
+        except Exception:  # pylint: disable=broad-except:
+            logging.exception("Failed to backfill rollup bucket: %s", backfill.rollup.bucket)
+
+
+def provision_rollups(background: bool = True) -> Optional[Thread]:
+    """
+    Provision buckets and tasks for all configured rollups, backfilling any empty rollup buckets.
+
+    An empty rollup bucket is backfilled from the earliest raw data up to now, and a
+    backfill that was interrupted is resumed from its checkpoint.  Backfill can take a
+    while for a large raw bucket, so by default it runs on a daemon thread, which is
+    returned to the caller.
+    """
+    influxdb = config().influxdb
+    if not influxdb.rollups or not config().sinks.influxdb:
+        return None
+    started = time.monotonic()
+    pending: List[Backfill] = []
+    with InfluxDBClient(url=influxdb.url, org=influxdb.org, token=influxdb.token) as client:
+        empty: List[RollupConfig] = []
+        for rollup in influxdb.rollups:
+            _ensure_bucket(client, influxdb, rollup)
+            _ensure_task(client, influxdb, rollup)
+            checkpoint = _checkpoint(client, influxdb, rollup.bucket)
+            if checkpoint is not None:
+                if checkpoint[0] < checkpoint[1]:
+                    logging.info("Resuming backfill for rollup bucket %s at %s", rollup.bucket, _flux_time(checkpoint[0]))
+                    pending.append(Backfill(rollup, checkpoint[0], checkpoint[1]))
+            elif _earliest(client, influxdb, rollup.bucket) is None:
+                empty.append(rollup)
+        _remove_stale_tasks(client, influxdb)
+        earliest = _earliest(client, influxdb, influxdb.bucket) if empty else None
+        if earliest:
+            start, stop = int(earliest.timestamp()), int(time.time())
+            for rollup in empty:
+                _save_checkpoint(client, influxdb, rollup, start, stop)  # before any chunk, so even the first one is resumed
+                pending.append(Backfill(rollup, start, stop))
+    logging.info("Provisioned %d rollup(s) in %.3f seconds", len(influxdb.rollups), time.monotonic() - started)
+    if not pending:
+        return None
+    if not background:
+        _backfill_all(influxdb, pending)
+        return None
+    thread = Thread(target=_backfill_all, args=(influxdb, pending), name="rollup-backfill", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=too-many-locals,too-many-positional-arguments:
+
+"""
+Downsampled series retrieved from InfluxDB.
+
+Raw points for a series are fetched from InfluxDB in fixed, epoch-aligned chunks.  Chunks
+that lie entirely in the settled past are immutable, so they are kept in an LRU cache and
+a wide-range query only has to fetch the chunks it hasn't seen before.  The cache is
+bounded both by the number of chunks and by the total number of points they hold, since
+a dense series can have far more points per chunk than a sparse one.  A range spanning
+more chunks than the cache can hold bypasses the cache entirely and is fetched with a
+single query, since caching it would only evict its own earliest chunks (and everyone
+else's) before they could be reused.  The raw points are held in arrays of doubles and
+are then reduced to roughly the requested pixel width, either via
+Largest-Triangle-Three-Buckets (LTTB) or via min/max decimation.
+
+Timestamps must lie between `MIN_TIMESTAMP` and `MAX_TIMESTAMP`, the range that can be
+converted to a datetime for the InfluxDB query.
+
+See: https://skemman.is/bitstream/1946/15343/3/SS_MSthesis.pdf (Steinarsson, LTTB)
+"""
+import math
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime, timezone
+from enum import Enum
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from influxdb_client import InfluxDBClient
+
+from sensortrack.config import config
+from sensortrack.recent import WEATHER_DEVICE
+from sensortrack.sinks import destination
+
+_CHUNK_SEC = 6 * 60 * 60  # size of each chunk fetched from InfluxDB, aligned to the epoch
+_SETTLE_SEC = 5 * 60  # chunks ending more recently than this may still receive points, so they're not cached
+_MAX_CHUNKS = 512  # number of chunks retained in the cache
+_MAX_POINTS = 2_000_000  # points retained in the cache across all chunks, at 16 bytes per point
+
+MIN_TIMESTAMP = datetime(1970, 1, 1, tzinfo=timezone.utc).timestamp()  # earliest timestamp accepted for a series
+MAX_TIMESTAMP = datetime(9999, 12, 31, tzinfo=timezone.utc).timestamp()  # latest timestamp accepted for a series
+
+ChunkKey = Tuple[str, str, str, int]  # (location, device, attribute, chunk start)
+Chunk = Tuple["array[float]", "array[float]"]  # (timestamps in epoch seconds, values)
+
+
+class Downsample(str, Enum):
+    """Supported downsampling methods."""
+
+    LTTB = "lttb"
+    MINMAX = "minmax"
+
+
+def lttb(timestamps: "array[float]", values: "array[float]", threshold: int) -> Chunk:
+    """Downsample to at most threshold points using Largest-Triangle-Three-Buckets."""
+    size = len(timestamps)
+    if threshold >= size or threshold < 3:
+        return array("d", timestamps), array("d", values)
+    every = (size - 2) / (threshold - 2)
+    out_t, out_v = array("d", [timestamps[0]]), array("d", [values[0]])
+    selected = 0
+    for i in range(threshold - 2):
+        # average of the next bucket, which serves as the third vertex of the triangle
+        avg_start, avg_end = int((i + 1) * every) + 1, min(int((i + 2) * every) + 1, size)
+        avg_t = sum(timestamps[avg_start:avg_end]) / (avg_end - avg_start)
+        avg_v = sum(values[avg_start:avg_end]) / (avg_end - avg_start)
+        # choose the point in this bucket that forms the largest triangle with the previously-selected point
+        selected_t, selected_v = timestamps[selected], values[selected]
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((selected_t - avg_t) * (values[j] - selected_v) - (selected_t - timestamps[j]) * (avg_v - selected_v))
+            if area > best_area:
+                best, best_area = j, area
+        out_t.append(timestamps[best])
+        out_v.append(values[best])
+        selected = best
+    out_t.append(timestamps[size - 1])
+    out_v.append(values[size - 1])
+    return out_t, out_v
+
+
+def minmax(timestamps: "array[float]", values: "array[float]", buckets: int) -> Chunk:
+    """Downsample by keeping the minimum and maximum point in each of up to buckets equal-width time buckets."""
+    size = len(timestamps)
+    if buckets <= 0 or size <= 2 * buckets:
+        return array("d", timestamps), array("d", values)
+    start, width = timestamps[0], (timestamps[size - 1] - timestamps[0]) / buckets or 1.0
+    out_t, out_v = array("d"), array("d")
+    low = high = 0
+    current = 0
+    for i in range(size + 1):
+        bucket = min(int((timestamps[i] - start) / width), buckets - 1) if i < size else -1
+        if i == size or bucket != current:
+            for index in sorted({low, high}):
+                out_t.append(timestamps[index])
+                out_v.append(values[index])
+            if i == size:
+                break
+            low = high = i
+            current = bucket
+        elif values[i] < values[low]:
+            low = i
+        elif values[i] > values[high]:
+            high = i
+    return out_t, out_v
+
+
+class ChunkCache:
+    """LRU cache of settled chunks, bounded by the number of chunks and by the total number of points."""
+
+    def __init__(self, max_chunks: int = _MAX_CHUNKS, max_points: int = _MAX_POINTS) -> None:
+        self.max_chunks = max_chunks
+        self.max_points = max_points
+        self.points = 0
+        self._chunks: OrderedDict[ChunkKey, Chunk] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: ChunkKey) -> Optional[Chunk]:
+        """Return a cached chunk, if any."""
+        with self._lock:
+            chunk = self._chunks.get(key)
+            if chunk is not None:
+                self._chunks.move_to_end(key)
+            return chunk
+
+    def put(self, key: ChunkKey, chunk: Chunk) -> None:
+        """Add a chunk to the cache, evicting least-recently-used chunks if necessary; a chunk too large to cache is skipped."""
+        if len(chunk[0]) > self.max_points:
+            return
+        with self._lock:
+            replaced = self._chunks.pop(key, None)
+            if replaced is not None:
+                self.points -= len(replaced[0])
+            self._chunks[key] = chunk
+            self.points += len(chunk[0])
+            while len(self._chunks) > self.max_chunks or self.points > self.max_points:
+                _, evicted = self._chunks.popitem(last=False)
+                self.points -= len(evicted[0])
+
+
+_CACHE = ChunkCache()
+
+
+def reset() -> None:
+    """Reset the chunk cache, discarding all cached chunks."""
+    global _CACHE  # pylint: disable=global-statement
+    _CACHE = ChunkCache()
+
+
+def _to_datetime(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+def _query_raw(location_id: str, device_id: str, attribute: str, start: float, stop: float) -> Chunk:
+    """Query raw points for a series from InfluxDB, ordered by time."""
+    weather = device_id == WEATHER_DEVICE
+    measurement = "weather" if weather else "sensor"
+    influxdb = destination(config().influxdb, measurement, location_id)  # wherever this series is routed
+    query = (
+        'from(bucket: "%s")\n'
+        "  |> range(start: params.start, stop: params.stop)\n"
+        "  |> filter(fn: (r) => r._measurement == params.measurement and r._field == params.field)\n"
+        "  |> filter(fn: (r) => r.location == params.location%s)\n"
+        '  |> keep(columns: ["_time", "_value"])\n'
+        "  |> group()\n"
+        '  |> sort(columns: ["_time"])'
+    ) % (influxdb.bucket, "" if weather else " and r.device == params.device")
+    params = {
+        "start": _to_datetime(start),
+        "stop": _to_datetime(stop),
+        "measurement": measurement,
+        "field": attribute,
+        "location": location_id,
+        "device": device_id,
+    }
+    timestamps, values = array("d"), array("d")
+    with InfluxDBClient(url=influxdb.url, org=influxdb.org, token=influxdb.token) as client:
+        for record in client.query_api().query_stream(query, params=params):
+            timestamps.append(record.values["_time"].timestamp())
+            values.append(float(record.values["_value"]))
+    return timestamps, values
+
+
+def _slice(chunk: Chunk, start: float, stop: float) -> Chunk:
+    """Slice a chunk to the points in [start, stop)."""
+    timestamps, values = chunk
+    low, high = bisect_left(timestamps, start), bisect_left(timestamps, stop)
+    return timestamps[low:high], values[low:high]
+
+
+def _runs(starts: List[int]) -> List[Tuple[int, int]]:
+    """Group sorted chunk start times into runs of contiguous chunks, returned as [start, stop) ranges."""
+    runs: List[Tuple[int, int]] = []
+    for chunk_start in starts:
+        if runs and runs[-1][1] == chunk_start:
+            runs[-1] = (runs[-1][0], chunk_start + _CHUNK_SEC)
+        else:
+            runs.append((chunk_start, chunk_start + _CHUNK_SEC))
+    return runs
+
+
+def _load(location_id: str, device_id: str, attribute: str, start: float, stop: float) -> Chunk:
+    """Load raw points in [start, stop), using cached chunks where possible and fetching each run of missing chunks at once."""
+    settled = time.time() - _SETTLE_SEC
+    starts = range(int(start // _CHUNK_SEC) * _CHUNK_SEC, math.ceil(stop), _CHUNK_SEC)
+    if len(starts) > _CACHE.max_chunks:
+        return _slice(_query_raw(location_id, device_id, attribute, start, stop), start, stop)
+    loaded: Dict[int, Chunk] = {}
+    missing: List[int] = []
+    for chunk_start in starts:
+        chunk = _CACHE.get((location_id, device_id, attribute, chunk_start))
+        if chunk is None:
+            missing.append(chunk_start)
+        else:
+            loaded[chunk_start] = chunk
+    for run_start, run_stop in _runs(missing):
+        fetched = _query_raw(location_id, device_id, attribute, run_start, run_stop)
+        for chunk_start in range(run_start, run_stop, _CHUNK_SEC):
+            chunk = _slice(fetched, chunk_start, chunk_start + _CHUNK_SEC)
+            if chunk_start + _CHUNK_SEC <= settled:
+                _CACHE.put((location_id, device_id, attribute, chunk_start), chunk)
+            loaded[chunk_start] = chunk
+    timestamps, values = array("d"), array("d")
+    for chunk_start in starts:
+        sliced_t, sliced_v = _slice(loaded[chunk_start], start, stop)
+        timestamps.extend(sliced_t)
+        values.extend(sliced_v)
+    return timestamps, values
+
+
+def retrieve_series(
+    location_id: str, device_id: str, attribute: str, start: float, stop: float, width: int, method: Downsample = Downsample.LTTB
+) -> List[Tuple[float, float]]:
+    """Retrieve a series over [start, stop), downsampled to roughly width points."""
+    timestamps, values = _load(location_id, device_id, attribute, start, stop)
+    if method == Downsample.MINMAX:
+        timestamps, values = minmax(timestamps, values, width // 2)
+    else:
+        timestamps, values = lttb(timestamps, values, width)
+    return list(zip(timestamps, values))
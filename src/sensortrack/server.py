@@ -3,27 +3,195 @@
 
 """
 The RESTful API.
+
+The endpoints that serve sensor history (`/recent` and `/series`) would otherwise let
+anyone who knows a location id retrieve its data, so they are disabled (404) unless a
+data API token is configured, and then require it as a bearer token (401 without it).
 """
-import codecs
+import asyncio
+import hmac
 import logging
+from contextlib import asynccontextmanager
 from importlib.metadata import version as metadata_version
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
-from fastapi import FastAPI, Request, Response
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from influxdb_client.client.exceptions import InfluxDBError
 from pydantic import BaseModel, Field  # pylint: disable=no-name-in-module:
-from smartapp.interface import BadRequestError, SignatureError, SmartAppError, SmartAppRequestContext
+from smartapp.interface import CORRELATION_ID_HEADER, BadRequestError, SignatureError, SmartAppError
 
-from sensortrack.dispatcher import dispatcher
-from sensortrack.rest import RestClientError
+from sensortrack.admission import OverloadedError, admission_status, admitted
+from sensortrack.alerts import alerts
+from sensortrack.alerts import shutdown as shutdown_alerts
+from sensortrack.config import config
+from sensortrack.handler import flush
+from sensortrack.logs import log_exchange, pipeline
+from sensortrack.logs import shutdown as shutdown_logging
+from sensortrack.quotas import tenant_usage
+from sensortrack.readiness import checker, readiness_status
+from sensortrack.recent import recent
+from sensortrack.responses import dispatch, responses
+from sensortrack.rest import RestClientError, upstream_status
+from sensortrack.rollup import provision_rollups
+from sensortrack.series import MAX_TIMESTAMP, MIN_TIMESTAMP, Downsample, retrieve_series
+from sensortrack.sinks import writer_status
+from sensortrack.warmup import warm_up
 
 API_VERSION = "1.0.0"
-API = FastAPI(version=API_VERSION, docs_url=None, redoc_url=None)  # no Swagger or ReDoc endpoints
+FLUSH_INTERVAL_SEC = 15.0  # how often closed aggregation windows are flushed in the background
+
+
+async def _periodic_flush() -> None:
+    """Periodically flush held data that is ready to be written."""
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL_SEC)
+        try:
+            await run_in_threadpool(flush, final=False)
+        except Exception:  # pylint: disable=broad-except:
+            logging.exception("Failed to flush held data")
+
+
+async def _periodic_readiness() -> None:
+    """Periodically check dependencies in the background, caching the results for readiness probes."""
+    while True:
+        interval_sec = FLUSH_INTERVAL_SEC  # if the checker can't be created, try again after a while
+        try:
+            readiness = checker()
+            interval_sec = readiness.settings.interval_sec
+            await run_in_threadpool(readiness.refresh)
+        except Exception:  # pylint: disable=broad-except:
+            logging.exception("Failed to check readiness")
+        await asyncio.sleep(interval_sec)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    """Server lifespan, warming up and provisioning InfluxDB rollups, checking readiness, and flushing held data."""
+    try:
+        pipeline()  # start asynchronous logging first, so everything after it benefits
+    except Exception:  # pylint: disable=broad-except:
+        logging.exception("Failed to start the logging pipeline")
+    await run_in_threadpool(warm_up)  # failures are logged, and never stop startup
+    responses()  # build the precomputed responses at startup, rather than on the first request
+    try:
+        await run_in_threadpool(provision_rollups)
+    except Exception:  # pylint: disable=broad-except:
+        logging.exception("Failed to provision InfluxDB rollups")
+    flusher = asyncio.create_task(_periodic_flush())
+    checks = asyncio.create_task(_periodic_readiness())
+    yield
+    checks.cancel()
+    flusher.cancel()
+    try:
+        await run_in_threadpool(flush)
+    except Exception:  # pylint: disable=broad-except:
+        logging.exception("Failed to flush held data")
+    await run_in_threadpool(shutdown_alerts)
+    await run_in_threadpool(shutdown_logging)
+
+
+API = FastAPI(version=API_VERSION, docs_url=None, redoc_url=None, lifespan=lifespan)  # no Swagger or ReDoc endpoints
 
 
 class Health(BaseModel):
     """API health data"""
 
     status: str = Field(default="OK")
+    upstreams: Dict[str, str] = Field(default_factory=dict)
+
+
+class Readiness(BaseModel):
+    """API readiness data, as of the most recent background check"""
+
+    ready: bool = Field(...)
+    checked_at: Optional[float] = Field(default=None)
+    influxdb: Optional[bool] = Field(default=None)
+    pending_points: int = Field(default=0)
+    spool_bytes: int = Field(default=0)
+    upstreams: Dict[str, str] = Field(default_factory=dict)
+    reasons: List[str] = Field(default_factory=list)
+
+
+class UpstreamMetrics(BaseModel):
+    """Metrics for an upstream API"""
+
+    name: str = Field(...)
+    state: str = Field(...)
+    consecutive_failures: int = Field(...)
+    rejected_calls: int = Field(...)
+    retry_tokens: float = Field(...)
+
+
+class DeviceReadings(BaseModel):
+    """Latest readings for a device"""
+
+    device: str = Field(...)
+    last_seen: float = Field(...)
+    staleness_sec: float = Field(...)
+    values: Dict[str, float] = Field(...)
+
+
+class RecentReadings(BaseModel):
+    """Recent readings for a series, as (timestamp, value) pairs ordered oldest first"""
+
+    location: str = Field(...)
+    device: str = Field(...)
+    attribute: str = Field(...)
+    readings: List[Tuple[float, float]] = Field(...)
+
+
+class Series(BaseModel):
+    """Downsampled series, as (timestamp, value) pairs ordered oldest first"""
+
+    location: str = Field(...)
+    device: str = Field(...)
+    attribute: str = Field(...)
+    method: Downsample = Field(...)
+    readings: List[Tuple[float, float]] = Field(...)
+
+
+class AdmissionMetrics(BaseModel):
+    """Admission control metrics for a lifecycle type"""
+
+    lifecycle: str = Field(...)
+    active: int = Field(...)
+    queued: int = Field(...)
+    admitted: int = Field(...)
+    shed: int = Field(...)
+
+
+class TenantMetrics(BaseModel):
+    """Write quota usage for an installed app"""
+
+    installed_app_id: str = Field(...)
+    series: int = Field(...)
+    written: int = Field(...)
+    dropped: int = Field(...)
+    aggregated: int = Field(...)
+    spooled: int = Field(...)
+
+
+class WriterMetrics(BaseModel):
+    """Metrics for the writer queue of an InfluxDB destination"""
+
+    name: str = Field(...)
+    queued: int = Field(...)
+    written: int = Field(...)
+    failed: int = Field(...)
+    rejected: int = Field(...)
+    retrying: bool = Field(...)
+
+
+class Metrics(BaseModel):
+    """API metrics data"""
+
+    upstreams: List[UpstreamMetrics] = Field(default_factory=list)
+    admission: List[AdmissionMetrics] = Field(default_factory=list)
+    tenants: List[TenantMetrics] = Field(default_factory=list)
+    writers: List[WriterMetrics] = Field(default_factory=list)
+    alerts_dropped: int = Field(default=0)
+    logs_dropped: int = Field(default=0)
 
 
 class Version(BaseModel):
@@ -42,6 +210,12 @@ def _generic_error_handler(e: Exception, status_code: int, message: str) -> Resp
     return Response(status_code=status_code)
 
 
+@API.exception_handler(OverloadedError)
+async def overloaded_handler(_: Request, e: OverloadedError) -> Response:
+    # Shedding has to stay cheap, so this is not logged like the other errors; admitted() has already logged it
+    return Response(status_code=503, headers={"Retry-After": str(e.retry_after_sec)})
+
+
 @API.exception_handler(BadRequestError)
 async def bad_request_handler(_: Request, e: BadRequestError) -> Response:
     return _generic_error_handler(e, 400, "[%s] Bad request: %s" % (e.correlation_id, e))
@@ -74,8 +248,25 @@ async def exception_handler(_: Request, e: Exception) -> Response:
 
 @API.get("/health")
 async def health() -> Health:
-    """Return an API health indicator."""
-    return Health()
+    """Return an API health indicator, including the circuit breaker state for each upstream."""
+    return Health(upstreams={status.name: status.state.value for status in upstream_status()})
+
+
+@API.get("/ready")
+async def ready(response: Response) -> Readiness:
+    """Return cached readiness, with a 503 status if not ready; this never checks dependencies itself."""
+    status = readiness_status()
+    if not status.ready:
+        response.status_code = 503
+    return Readiness(
+        ready=status.ready,
+        checked_at=status.checked_at,
+        influxdb=status.influxdb,
+        pending_points=status.pending_points,
+        spool_bytes=status.spool_bytes,
+        upstreams=status.upstreams,
+        reasons=status.reasons,
+    )
 
 
 @API.get("/version")
@@ -84,11 +275,116 @@ async def version() -> Version:
     return Version(package=metadata_version("sensortrack"), api=API.version)
 
 
+@API.get("/metrics")
+async def metrics() -> Metrics:
+    """Return API metrics."""
+    engine = alerts()
+    logs = pipeline()
+    return Metrics(
+        upstreams=[
+            UpstreamMetrics(
+                name=status.name,
+                state=status.state.value,
+                consecutive_failures=status.consecutive_failures,
+                rejected_calls=status.rejected_calls,
+                retry_tokens=status.retry_tokens,
+            )
+            for status in upstream_status()
+        ],
+        admission=[
+            AdmissionMetrics(
+                lifecycle=status.lifecycle,
+                active=status.active,
+                queued=status.queued,
+                admitted=status.admitted,
+                shed=status.shed,
+            )
+            for status in admission_status()
+        ],
+        tenants=[
+            TenantMetrics(
+                installed_app_id=usage.installed_app_id,
+                series=usage.series,
+                written=usage.written,
+                dropped=usage.dropped,
+                aggregated=usage.aggregated,
+                spooled=usage.spooled,
+            )
+            for usage in tenant_usage()
+        ],
+        writers=[
+            WriterMetrics(
+                name=status.name,
+                queued=status.queued,
+                written=status.written,
+                failed=status.failed,
+                rejected=status.rejected,
+                retrying=status.retrying,
+            )
+            for status in writer_status()
+        ],
+        alerts_dropped=engine.dropped if engine else 0,
+        logs_dropped=logs.dropped if logs else 0,
+    )
+
+
+def data_api_access(authorization: Optional[str] = Header(default=None)) -> None:
+    """Require the configured bearer token for endpoints that serve sensor history, which are disabled unless configured."""
+    data_api = config().data_api
+    if data_api is None:
+        raise HTTPException(status_code=404)
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode("UTF-8"), data_api.token.encode("UTF-8")):
+        raise HTTPException(status_code=401, headers={"WWW-Authenticate": "Bearer"})
+
+
+@API.get("/recent/{location_id}", dependencies=[Depends(data_api_access)])
+async def recent_devices(location_id: str) -> List[DeviceReadings]:
+    """Return the latest values, last-seen time and staleness for each device at a location."""
+    return [
+        DeviceReadings(
+            device=status.device_id, last_seen=status.last_seen, staleness_sec=status.staleness_sec, values=status.values
+        )
+        for status in recent().devices(location_id)
+    ]
+
+
+@API.get("/recent/{location_id}/{device_id}/{attribute}", dependencies=[Depends(data_api_access)])
+async def recent_readings(
+    location_id: str, device_id: str, attribute: str, seconds: float = Query(default=3600.0, gt=0)
+) -> RecentReadings:
+    """Return readings for a series over a recent window, by default the last hour."""
+    readings = recent().window(location_id, device_id, attribute, seconds)
+    if readings is None:
+        raise HTTPException(status_code=404)
+    return RecentReadings(location=location_id, device=device_id, attribute=attribute, readings=readings)
+
+
+@API.get("/series/{location_id}/{device_id}/{attribute}", dependencies=[Depends(data_api_access)])
+def series(  # pylint: disable=too-many-positional-arguments:
+    location_id: str,
+    device_id: str,
+    attribute: str,
+    start: float = Query(...),
+    stop: float = Query(...),
+    width: int = Query(default=1000, gt=0, le=10000),
+    method: Downsample = Query(default=Downsample.LTTB),
+) -> Series:
+    """Return a series over [start, stop) in epoch seconds, downsampled to roughly width points."""
+    if not MIN_TIMESTAMP <= start <= MAX_TIMESTAMP or not MIN_TIMESTAMP <= stop <= MAX_TIMESTAMP:
+        raise HTTPException(status_code=400, detail="start and stop must be between %d and %d" % (MIN_TIMESTAMP, MAX_TIMESTAMP))
+    if stop <= start:
+        raise HTTPException(status_code=400, detail="stop must be after start")
+    readings = retrieve_series(location_id, device_id, attribute, start, stop, width, method)
+    return Series(location=location_id, device=device_id, attribute=attribute, method=method, readings=readings)
+
+
 @API.post("/smartapp")
 async def smartapp(request: Request) -> Response:
     """Handle the SmartApp lifecycle requests via the dispatcher implementation."""
-    headers = request.headers
-    body = codecs.decode(await request.body(), "UTF-8")
-    context = SmartAppRequestContext(headers=headers, body=body)
-    content = dispatcher().dispatch(context=context)
+    body = await request.body()
+    # The dispatcher is synchronous and may wait on upstream APIs, so run it in the threadpool rather than the event loop
+    async with admitted(body, request.headers):
+        content = await run_in_threadpool(dispatch, request.headers, body)
+    log_exchange(request.headers.get(CORRELATION_ID_HEADER), body, content)
     return Response(status_code=200, content=content, media_type="application/json")
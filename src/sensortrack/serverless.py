@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=import-outside-toplevel:
+
+"""
+Serverless entry point, for running the SmartApp as an AWS Lambda function.
+
+The handler accepts an API Gateway or Lambda function URL event, builds the SmartApp
+request context from the event headers and body, and invokes the same dispatcher as the
+`/smartapp` endpoint in `server.py`, with the same mapping of errors to HTTP status.
+
+Cold start time matters for a function, so this module imports nothing beyond the
+standard library.  It never loads FastAPI, pydantic or uvicorn, and the dispatcher and
+everything behind it are imported when the first request arrives.  Use the `sensortrack
+coldstart` command to measure import and first-request time in a fresh interpreter.
+
+There is no server lifespan in a function, so aggregation windows that have closed are
+flushed after each request rather than periodically in the background.
+"""
+import base64
+import logging
+from typing import Any, Dict, Mapping, Optional
+
+
+def _headers(event: Mapping[str, Any]) -> Dict[str, str]:
+    """Return the event headers, which may be missing entirely for some event sources."""
+    return {str(key): str(value) for key, value in (event.get("headers") or {}).items()}
+
+
+def _body(event: Mapping[str, Any]) -> str:
+    """Return the event body as a string, decoding it if the event source encoded it."""
+    body = event.get("body") or ""
+    return base64.b64decode(body).decode("UTF-8") if event.get("isBase64Encoded") else str(body)
+
+
+def _response(status_code: int, content: Optional[str] = None) -> Dict[str, Any]:
+    if content is None:
+        return {"statusCode": status_code}
+    return {"statusCode": status_code, "headers": {"Content-Type": "application/json"}, "body": content, "isBase64Encoded": False}
+
+
+def handler(event: Mapping[str, Any], _: Any = None) -> Dict[str, Any]:
+    """Handle a SmartApp lifecycle request delivered as a function event, returning the HTTP response."""
+    from smartapp.interface import BadRequestError, SignatureError, SmartAppError, SmartAppRequestContext
+
+    from sensortrack.dispatcher import dispatcher
+    from sensortrack.handler import flush
+
+    try:
+        context = SmartAppRequestContext(headers=_headers(event), body=_body(event))
+    except ValueError:
+        logging.exception("Bad request: could not decode body")
+        return _response(400)
+    try:
+        content = dispatcher().dispatch(context=context)
+    except BadRequestError as e:
+        logging.exception("[%s] Bad request: %s", e.correlation_id, e)
+        return _response(400)
+    except SignatureError as e:
+        logging.exception("[%s] Signature error: %s", e.correlation_id, e)
+        return _response(401)
+    except SmartAppError as e:
+        logging.exception("[%s] SmartApp error: %s", e.correlation_id, e)
+        return _response(500)
+    except Exception as e:  # pylint: disable=broad-except:
+        logging.exception("Internal error: %s", e)
+        return _response(500)
+    try:
+        flush(final=False)
+    except Exception:  # pylint: disable=broad-except:
+        logging.exception("Failed to flush held data")
+    return _response(200, content)
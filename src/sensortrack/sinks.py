@@ -0,0 +1,550 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=protected-access,import-outside-toplevel:
+
+"""
+Output sinks that points are written to.
+
+By default, points are written to InfluxDB.  Points can also be written to a local
+columnar file sink, either in addition to InfluxDB or instead of it.  When more than
+one sink is enabled, points are fanned out to all of them, in order, stopping at the
+first sink that fails so that a request that is delivered again isn't written twice to
+the sinks before it.  If a sink fails after an earlier sink has accepted the points,
+PartialWriteError is raised, and the caller treats the points as written, since
+delivering them again would duplicate them in the earlier sinks.
+
+If routes are configured for InfluxDB, points for a location or measurement can be
+sent to their own org, bucket or InfluxDB instance.  Each destination (including the
+default one) then gets its own bounded queue and writer thread, with its own batch
+settings, so a slow or failing destination never delays writes to any other.  Writes
+to a routed sink are asynchronous, so a batch that fails because InfluxDB can't be
+reached or returns a server error is retried with backoff until it is written.
+Meanwhile, writes that include points for that destination are rejected with
+WriteRejectedError, as are writes when a destination's queue is full.  The request
+then fails, and SmartThings delivers it again later, rather than points being lost.
+A batch that InfluxDB rejects as invalid (any other 4xx response, such as a field type
+conflict) would never be accepted, so it is logged, counted as failed and dropped
+rather than blocking the destination.  Queued points are written when the sink is
+flushed at shutdown; a batch that still can't be written then is logged and counted
+as failed.
+
+Bulk callers (import and weather backfill) write with `block=True`, which waits for
+room in a full queue instead of rejecting the write, since nothing would deliver the
+points again.
+
+Readers that look up a single series (`/series`, weather backfill and import
+deduplication) query whichever destination the series is routed to, and exports query
+every destination.  Rollup tasks run inside InfluxDB against the default bucket, so
+while rollups are configured, raw `sensor` and `weather` points can't be routed away
+from it.
+
+The columnar file sink buffers rows in memory per partition, and appends each batch of
+rows to its partition as a new Parquet or Arrow IPC file.  Partitions are laid out as
+`measurement=<name>/date=<YYYY-MM-DD>`, which most tools (pyarrow datasets, DuckDB,
+Polars, Spark) read directly as a hive-partitioned dataset.  A partition is written
+once it reaches its maximum number of rows, when its oldest row reaches the maximum
+age, and at shutdown.  If writing a partition fails, its rows are put back in the buffer
+to be written on the next flush.  A write whose rows have been buffered never fails, even
+if writing a partition that became due fails, so the points are never buffered twice.
+The columnar sink requires pyarrow, which is not installed by default; install the
+`columnar` extra (`sensortrack[columnar]`) to get it.
+"""
+import logging
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from importlib.util import find_spec
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from attrs import evolve, frozen
+from influxdb_client import InfluxDBClient, Point
+from influxdb_client.client.write_api import SYNCHRONOUS, WriteApi
+from influxdb_client.rest import ApiException
+from urllib3.exceptions import HTTPError
+
+from sensortrack.config import ColumnarFormat, ColumnarSinkConfig, ConfigError, InfluxDbConfig, InfluxDbRouteConfig, config
+
+PartitionKey = Tuple[str, str]  # (measurement, date)
+Row = Dict[str, Any]
+
+RAW_MEASUREMENTS = ["sensor", "weather"]  # measurements that rollup tasks read from the default bucket
+RETRY_MIN_SEC = 0.5  # first wait before retrying a failed batch
+RETRY_MAX_SEC = 30.0  # longest wait between retries of a failed batch
+RETRY_STATUSES = [408, 429]  # client errors that are worth retrying, unlike any other 4xx response
+BLOCK_WAIT_SEC = 60.0  # longest a blocking write waits for room in a full queue before it's rejected
+
+
+@frozen
+class WriteRejectedError(Exception):
+    """A write that was rejected because a destination can't accept points right now."""
+
+    message: str
+
+
+@frozen
+class PartialWriteError(Exception):
+    """A write that some sinks accepted before another sink failed."""
+
+    message: str
+
+
+def route_matches(route: InfluxDbRouteConfig, measurement: str, location: Optional[str]) -> bool:
+    """Whether a route matches points for a measurement and location."""
+    if route.measurement is not None and measurement != route.measurement:
+        return False
+    return route.location is None or location == route.location
+
+
+def route_destination(influxdb: InfluxDbConfig, route: InfluxDbRouteConfig) -> InfluxDbConfig:
+    """InfluxDB configuration for a route's destination, defaulting to the main configuration."""
+    return evolve(
+        influxdb,
+        url=route.url or influxdb.url,
+        org=route.org or influxdb.org,
+        token=route.token or influxdb.token,
+        bucket=route.bucket or influxdb.bucket,
+        rollups=[],
+        routes=[],
+    )
+
+
+def destination(influxdb: InfluxDbConfig, measurement: str, location: Optional[str]) -> InfluxDbConfig:
+    """InfluxDB configuration for the destination that points for a measurement and location are routed to."""
+    route = next((route for route in influxdb.routes if route_matches(route, measurement, location)), None)
+    return route_destination(influxdb, route) if route else influxdb
+
+
+def destinations(influxdb: InfluxDbConfig) -> List[InfluxDbConfig]:
+    """InfluxDB configuration for every distinct destination, starting with the default one."""
+    result = [influxdb]
+    for route in influxdb.routes:
+        target = route_destination(influxdb, route)
+        if all((target.url, target.org, target.bucket) != (other.url, other.org, other.bucket) for other in result):
+            result.append(target)
+    return result
+
+
+class Sink(ABC):
+    """A destination that points are written to."""
+
+    @abstractmethod
+    def write(self, points: List[Point], block: bool = False) -> None:
+        """Write points, raising an exception on failure; with block, wait for room in a full queue rather than rejecting them."""
+
+    def flush(self, final: bool = False) -> None:
+        """Write any buffered points that are due, or all buffered points if final."""
+
+    def pending(self) -> int:
+        """Number of points buffered and waiting to be written."""
+        return 0
+
+    def status(self) -> List["WriterStatus"]:
+        """Status of each writer queue, if points are written asynchronously."""
+        return []
+
+
+@frozen(kw_only=True)
+class WriterStatus:
+    """Current status of the writer queue for an InfluxDB destination."""
+
+    name: str
+    queued: int
+    written: int
+    failed: int  # points given up on, because InfluxDB rejected them as invalid or they still could not be written at shutdown
+    rejected: int  # points rejected because the queue was full or the destination was failing
+    retrying: bool  # whether a failed batch is being retried
+
+
+class InfluxDbSink(Sink):
+    """Writes points to InfluxDB."""
+
+    def __init__(self, influxdb: InfluxDbConfig) -> None:
+        self.influxdb = influxdb
+
+    def write(self, points: List[Point], block: bool = False) -> None:
+        with InfluxDBClient(url=self.influxdb.url, org=self.influxdb.org, token=self.influxdb.token) as client:
+            client.write_api(write_options=SYNCHRONOUS).write(bucket=self.influxdb.bucket, record=points)
+
+
+class InfluxDbWriter:  # pylint: disable=too-many-instance-attributes:
+    """Writes points to one InfluxDB destination in batches, from its own bounded queue on its own thread."""
+
+    def __init__(self, name: str, influxdb: InfluxDbConfig, settings: InfluxDbRouteConfig) -> None:
+        self.name = name
+        self.influxdb = influxdb
+        self.settings = settings
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+        self._retrying = False
+        self._queue: "Queue[Optional[Point]]" = Queue(maxsize=settings.queue_size)
+        self._thread: Optional[Thread] = None
+        self._stopping = Event()  # cuts short any wait between retries at shutdown
+        self._lock = Lock()  # guards starting and stopping the thread, and checking for room before queueing points
+        self._counts = Lock()  # guards the counters, which the thread updates while it's being stopped
+
+    def refusal(self, count: int) -> Optional[str]:
+        """The reason this writer can't accept a number of points right now, or None if it can; hold the lock to rely on it."""
+        with self._counts:
+            if self._retrying:
+                return "InfluxDB destination %s is failing" % self.name
+        if self._queue.qsize() + count > self.settings.queue_size:
+            return "Queue for InfluxDB destination %s is full" % self.name
+        return None
+
+    def reject(self, count: int) -> None:
+        """Count points that were rejected."""
+        with self._counts:
+            self.rejected += count
+
+    def offer(self, points: List[Point], block: bool = False) -> None:
+        """
+        Queue points to be written, raising WriteRejectedError if they can't be accepted.
+
+        Without block, either every point is queued or none are.  With block, each point waits
+        up to BLOCK_WAIT_SEC for room in a full queue, and the writer may be failing meanwhile.
+        """
+        if not block:
+            with self._lock:
+                refusal = self.refusal(len(points))
+                if refusal:
+                    self.reject(len(points))
+                    raise WriteRejectedError(refusal)
+                self._enqueue(points)
+            return
+        with self._lock:
+            self._start()
+        for index, point in enumerate(points):
+            try:
+                self._queue.put(point, timeout=BLOCK_WAIT_SEC)
+            except Full as e:
+                self.reject(len(points) - index)
+                raise WriteRejectedError("Queue for InfluxDB destination %s is full" % self.name) from e
+
+    def _start(self) -> None:
+        """Start the writer thread if it isn't running; the caller holds the lock."""
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name="influxdb-%s" % self.name, daemon=True)
+            self._thread.start()
+
+    def _enqueue(self, points: List[Point]) -> None:
+        """Queue points that refusal() has accepted; the caller holds the lock, so there's room for all of them."""
+        self._start()
+        for point in points:
+            self._queue.put_nowait(point)
+
+    def stop(self) -> None:
+        """Stop the writer thread once every queued point has been written; it's restarted if more points are offered."""
+        with self._lock:
+            if self._thread is not None:
+                self._stopping.set()
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+                self._stopping.clear()
+
+    def status(self) -> WriterStatus:
+        with self._counts:
+            return WriterStatus(
+                name=self.name,
+                queued=self._queue.qsize(),
+                written=self.written,
+                failed=self.failed,
+                rejected=self.rejected,
+                retrying=self._retrying,
+            )
+
+    def _run(self) -> None:
+        with InfluxDBClient(url=self.influxdb.url, org=self.influxdb.org, token=self.influxdb.token) as client:
+            write_api = client.write_api(write_options=SYNCHRONOUS)
+            stopping = False
+            while not stopping:
+                batch, stopping = self._batch()
+                if batch:
+                    self._write(write_api, batch)
+
+    def _batch(self) -> Tuple[List[Point], bool]:
+        """Wait for a batch of points, returning it along with whether the thread should stop afterwards."""
+        first = self._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.settings.flush_interval_sec
+        while len(batch) < self.settings.batch_size:
+            try:
+                point = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except Empty:
+                break
+            if point is None:
+                return batch, True
+            batch.append(point)
+        return batch, False
+
+    def _write(self, write_api: WriteApi, batch: List[Point]) -> None:
+        """Write a batch, retrying with backoff until it's written, it can't be retried, or it fails after the writer is stopped."""
+        wait_sec = RETRY_MIN_SEC
+        while True:
+            stopping = self._stopping.is_set()
+            try:
+                write_api.write(bucket=self.influxdb.bucket, record=batch)
+                with self._counts:
+                    self.written += len(batch)
+                    self._retrying = False
+                return
+            except Exception as e:  # pylint: disable=broad-except:
+                if stopping or not _retryable(e):
+                    reason = "at shutdown" if stopping else "and can't retry"
+                    logging.exception("Failed to write %d point(s) to InfluxDB for %s %s", len(batch), self.name, reason)
+                    with self._counts:
+                        self.failed += len(batch)
+                        self._retrying = False
+                    return
+                logging.exception("Failed to write %d point(s) to InfluxDB for %s, retrying", len(batch), self.name)
+                with self._counts:
+                    self._retrying = True
+            self._stopping.wait(wait_sec)
+            wait_sec = min(RETRY_MAX_SEC, wait_sec * 2)
+
+
+def _retryable(e: Exception) -> bool:
+    """Whether a failed write is worth retrying: only if InfluxDB couldn't be reached, or it couldn't handle the batch right now."""
+    if isinstance(e, ApiException):
+        return not 400 <= e.status < 500 or e.status in RETRY_STATUSES  # status 0 means there was no response
+    return isinstance(e, (OSError, HTTPError))
+
+
+def _matches(route: InfluxDbRouteConfig, point: Point) -> bool:
+    # Point has no public accessors, so we have to rely on its internals here
+    return route_matches(route, point._name, point._tags.get("location"))  # type: ignore[attr-defined]
+
+
+class RoutedInfluxDbSink(Sink):
+    """Routes points to InfluxDB destinations by location or measurement, each with its own writer queue."""
+
+    def __init__(self, influxdb: InfluxDbConfig) -> None:
+        if influxdb.rollups:
+            for route in influxdb.routes:
+                if route.measurement is None or route.measurement in RAW_MEASUREMENTS:
+                    raise ConfigError("InfluxDB route %s can't route raw points away from the rollup source bucket" % route.name)
+        self.default = InfluxDbWriter("default", influxdb, InfluxDbRouteConfig(name="default"))
+        self.routes = [(route, InfluxDbWriter(route.name, route_destination(influxdb, route), route)) for route in influxdb.routes]
+
+    @property
+    def writers(self) -> List[InfluxDbWriter]:
+        return [writer for _, writer in self.routes] + [self.default]
+
+    def target(self, point: Point) -> InfluxDbWriter:
+        """Return the writer for the first route that matches a point, or the default writer."""
+        return next((writer for route, writer in self.routes if _matches(route, point)), self.default)
+
+    def write(self, points: List[Point], block: bool = False) -> None:
+        targets: Dict[str, Tuple[InfluxDbWriter, List[Point]]] = {}
+        now = datetime.now(tz=timezone.utc)
+        for point in points:
+            if point._time is None:  # type: ignore[attr-defined]
+                point.time(now)  # the point may wait in a queue, so it's stamped with the time it was received
+            writer = self.target(point)
+            targets.setdefault(writer.name, (writer, []))[1].append(point)
+        if block:
+            for writer, batch in targets.values():
+                writer.offer(batch, block=True)
+            return
+        # Either every point is queued or none are, so a rejected request can simply be retried; writers are locked
+        # in a consistent order, so concurrent writes can't deadlock
+        with ExitStack() as stack:
+            for name in sorted(targets):
+                stack.enter_context(targets[name][0]._lock)
+            refusals = [(writer, batch, writer.refusal(len(batch))) for writer, batch in targets.values()]
+            if any(refusal for _, _, refusal in refusals):
+                for writer, batch, _ in refusals:
+                    writer.reject(len(batch))
+                raise WriteRejectedError("; ".join(refusal for _, _, refusal in refusals if refusal))
+            for writer, batch in targets.values():
+                writer._enqueue(batch)
+
+    def flush(self, final: bool = False) -> None:
+        if final:
+            for writer in self.writers:
+                writer.stop()
+
+    def pending(self) -> int:
+        return sum(writer.status().queued for writer in self.writers)
+
+    def status(self) -> List[WriterStatus]:
+        return [writer.status() for writer in self.writers]
+
+
+def _row(point: Point, now: float) -> Tuple[PartitionKey, Row]:
+    """Convert a point into a partition key and row; points without a timestamp are stamped with now."""
+    # Point has no public accessors, so we have to rely on its internals here
+    stamp = point._time  # type: ignore[attr-defined]
+    if stamp is None:
+        timestamp = datetime.fromtimestamp(now, tz=timezone.utc)
+    elif isinstance(stamp, datetime):
+        timestamp = stamp if stamp.tzinfo else stamp.replace(tzinfo=timezone.utc)
+    else:
+        timestamp = datetime.fromtimestamp(int(stamp) / 1_000_000_000, tz=timezone.utc)
+    row: Row = {"time": timestamp}
+    row.update(point._tags)  # type: ignore[attr-defined]
+    row.update(point._fields)  # type: ignore[attr-defined]
+    return (point._name, timestamp.strftime("%Y-%m-%d")), row  # type: ignore[attr-defined]
+
+
+class ColumnarFileSink(Sink):
+    """Writes points to local columnar files, partitioned by measurement and day."""
+
+    def __init__(self, columnar: ColumnarSinkConfig) -> None:
+        if find_spec("pyarrow") is None:
+            raise ConfigError("The columnar file sink requires pyarrow, which is not installed")
+        self.columnar = columnar
+        self._buffers: Dict[PartitionKey, List[Row]] = {}
+        self._started: Dict[PartitionKey, float] = {}
+        self._lock = Lock()
+
+    def write(self, points: List[Point], block: bool = False) -> None:
+        now = time.time()
+        rows = [_row(point, now) for point in points]  # converted up front, so either every row is buffered or none are
+        with self._lock:
+            for key, row in rows:
+                self._buffers.setdefault(key, []).append(row)
+                self._started.setdefault(key, now)
+            ready = self._take(lambda key: len(self._buffers[key]) >= self.columnar.max_rows)
+        try:
+            self._write_all(ready)
+        except Exception:  # pylint: disable=broad-except:
+            logging.exception("Failed to write columnar files, keeping the rows for the next flush")
+
+    def flush(self, final: bool = False) -> None:
+        now = time.time()
+        with self._lock:
+            ready = self._take(lambda key: final or now - self._started[key] >= self.columnar.max_age_sec)
+        self._write_all(ready)
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(rows) for rows in self._buffers.values())
+
+    def _take(self, due: Callable[[PartitionKey], bool]) -> List[Tuple[PartitionKey, List[Row], float]]:
+        """Remove and return the buffered rows for partitions that are due, which must be called with the lock held."""
+        ready = []
+        for key in [key for key in self._buffers if due(key)]:
+            ready.append((key, self._buffers.pop(key), self._started.pop(key)))
+        return ready
+
+    def _write_all(self, ready: List[Tuple[PartitionKey, List[Row], float]]) -> None:
+        """Write each partition, putting the rows back in the buffer for any that fail and then raising the first failure."""
+        failure: Optional[Exception] = None
+        for key, rows, started in ready:
+            try:
+                self._write_partition(key, rows)
+            except Exception as e:  # pylint: disable=broad-except:
+                with self._lock:
+                    self._buffers[key] = rows + self._buffers.get(key, [])  # ahead of anything buffered since
+                    self._started[key] = min(started, self._started.get(key, started))
+                failure = failure or e
+        if failure:
+            raise failure
+
+    def _write_partition(self, key: PartitionKey, rows: List[Row]) -> str:
+        """Write rows to a new file in a partition, returning the path of the file."""
+        import pyarrow  # pylint: disable=import-error:
+
+        measurement, date = key
+        directory = os.path.join(self.columnar.path, "measurement=%s" % measurement, "date=%s" % date)
+        os.makedirs(directory, exist_ok=True)
+        extension = "parquet" if self.columnar.format == ColumnarFormat.PARQUET else "arrow"
+        path = os.path.join(directory, "part-%d-%s.%s" % (time.time_ns(), uuid.uuid4().hex[:8], extension))
+        temporary = "%s.tmp" % path
+        # Rows in a partition can have different fields and optional tags, so the columns are the union across all rows;
+        # inferring them from the first row alone (as Table.from_pylist does) would silently drop the others
+        columns = list(dict.fromkeys(column for row in rows for column in row))
+        table = pyarrow.Table.from_pydict({column: [row.get(column) for row in rows] for column in columns})
+        if self.columnar.format == ColumnarFormat.PARQUET:
+            import pyarrow.parquet  # pylint: disable=import-error:
+
+            pyarrow.parquet.write_table(table, temporary)
+        else:
+            with pyarrow.OSFile(temporary, "wb") as fp:
+                with pyarrow.ipc.new_file(fp, table.schema) as writer:
+                    writer.write_table(table)
+        os.replace(temporary, path)  # so readers never see a partially-written file
+        logging.debug("Wrote %d row(s) to %s", len(rows), path)
+        return path
+
+
+class FanOutSink(Sink):
+    """Writes points to several sinks in order, stopping at the first failure; flushes attempt every sink."""
+
+    def __init__(self, sinks: List[Sink]) -> None:
+        self.sinks = sinks
+
+    def write(self, points: List[Point], block: bool = False) -> None:
+        for index, target in enumerate(self.sinks):
+            try:
+                target.write(points, block=block)
+            except Exception as e:
+                if index == 0:
+                    raise  # nothing was written, so the points can simply be written again
+                accepted = ", ".join(type(earlier).__name__ for earlier in self.sinks[:index])
+                logging.exception(
+                    "Failed to write %d point(s) to %s after %s accepted them", len(points), type(target).__name__, accepted
+                )
+                raise PartialWriteError(
+                    "Failed to write to %s after %s accepted the points: %s" % (type(target).__name__, accepted, e)
+                ) from e
+
+    def flush(self, final: bool = False) -> None:
+        self._each(lambda target: target.flush(final))
+
+    def pending(self) -> int:
+        return sum(target.pending() for target in self.sinks)
+
+    def status(self) -> List[WriterStatus]:
+        return [status for target in self.sinks for status in target.status()]
+
+    def _each(self, action: Callable[[Sink], None]) -> None:
+        failure: Optional[Exception] = None
+        for target in self.sinks:
+            try:
+                action(target)
+            except Exception as e:  # pylint: disable=broad-except:
+                logging.exception("Failed to write to %s", type(target).__name__)
+                failure = failure or e
+        if failure:
+            raise failure
+
+
+_SINK: Optional[Sink] = None
+
+
+def reset() -> None:
+    """Reset the sink singleton, discarding any buffered points."""
+    global _SINK  # pylint: disable=global-statement
+    _SINK = None
+
+
+def sink() -> Sink:
+    """Return the configured sink, creating it once and caching the instance."""
+    global _SINK  # pylint: disable=global-statement
+    if _SINK is None:
+        sinks: List[Sink] = []
+        columnar = config().sinks.columnar
+        if config().sinks.influxdb:
+            influxdb = config().influxdb
+            sinks.append(RoutedInfluxDbSink(influxdb) if influxdb.routes else InfluxDbSink(influxdb))
+        if columnar:
+            sinks.append(ColumnarFileSink(columnar))
+        if not sinks:
+            raise ConfigError("At least one output sink must be enabled")
+        _SINK = sinks[0] if len(sinks) == 1 else FanOutSink(sinks)
+    return _SINK
+
+
+def writer_status() -> List[WriterStatus]:
+    """Return the status of each writer queue, without creating the sink if it doesn't exist yet."""
+    return _SINK.status() if _SINK else []
@@ -6,17 +6,22 @@
 SmartThings API client
 """
 from contextvars import ContextVar
-from typing import Dict, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
 import requests
 from attrs import field, frozen
 from smartapp.converter import CONVERTER
 from smartapp.interface import EventRequest, InstallRequest, UpdateRequest
 
+from sensortrack.cache import Cache
 from sensortrack.config import config
-from sensortrack.rest import DECAYING_RETRY, raise_for_status
+from sensortrack.rest import decaying_retry, raise_for_status
 
 _CLIENT_TIMEOUT_SEC = 5.0  # we want some fairly large timeout so that requests can't hang forever
+_LOCATION_TTL_SEC = 60 * 60  # how long cached location details are used before being retrieved again
+
+UPSTREAM = "smartthings"  # name of the upstream, for circuit breaker and retry budget purposes
+DECAYING_RETRY = decaying_retry(UPSTREAM)
 
 
 @frozen(kw_only=True)
@@ -30,6 +35,23 @@ class Location:
     longitude: Optional[float]
 
 
+@frozen(kw_only=True)
+class Device:
+    """Details about a device."""
+
+    device_id: str
+    label: str
+    room_id: Optional[str]
+
+
+@frozen(kw_only=True)
+class Room:
+    """Details about a room."""
+
+    room_id: str
+    name: str
+
+
 @frozen(kw_only=True)
 class SmartThingsApiContext:
     token: str
@@ -112,9 +134,13 @@ def _subscribe_to_event(capability: str, attribute: str) -> None:
     raise_for_status(response)
 
 
-# Note: I originally cached this, but then decided against it.  Access to location
-# data is limited by permissions on the specific installed app, and it seems iffy
-# to have that data sitting around in cache to be retrieved only by location id.
+# Note: I originally decided against caching this, since access to location data is
+# limited by permissions on the specific installed app, and it seems iffy to have that
+# data sitting around in cache to be retrieved only by location id.  Now that the cache
+# may be shared across nodes, each one would otherwise look up the same location for
+# every weather lookup.  So, it's cached, but keyed by app id as well as location id,
+# holding only the few fields in Location, and only for a short time.
+_LOCATIONS = Cache("locations", _LOCATION_TTL_SEC)  # "app id:location id" -> Location
 
 
 @DECAYING_RETRY
@@ -127,8 +153,51 @@ def _retrieve_location(location_id: str) -> Location:
 
 
 def retrieve_location() -> Location:
-    """Retrieve details about the location."""
-    return _retrieve_location(CONTEXT.get().location_id)
+    """Retrieve details about the location, using the cache if possible."""
+    key = "%s:%s" % (CONTEXT.get().app_id, CONTEXT.get().location_id)
+    cached = _LOCATIONS.get(key)
+    if cached:
+        return CONVERTER.structure(cached, Location)
+    location = _retrieve_location(CONTEXT.get().location_id)
+    _LOCATIONS.set(key, CONVERTER.unstructure(location))
+    return location
+
+
+@DECAYING_RETRY
+def _retrieve_page(url: str) -> Dict[str, Any]:
+    """Retrieve a single page of a paged API response."""
+    response = requests.get(url=url, headers=CONTEXT.get().headers, timeout=_CLIENT_TIMEOUT_SEC)
+    raise_for_status(response)
+    return response.json()  # type: ignore[no-any-return]
+
+
+def _retrieve_items(url: str) -> List[Dict[str, Any]]:
+    """Retrieve the items from a paged API response, following links to subsequent pages."""
+    items: List[Dict[str, Any]] = []
+    next_url: Optional[str] = url
+    while next_url:
+        page = _retrieve_page(next_url)
+        items.extend(page.get("items") or [])
+        next_url = ((page.get("_links") or {}).get("next") or {}).get("href")
+    return items
+
+
+def retrieve_devices() -> List[Device]:
+    """Retrieve all devices at the location."""
+    return [
+        Device(
+            device_id=item["deviceId"], label=item.get("label") or item.get("name") or item["deviceId"], room_id=item.get("roomId")
+        )
+        for item in _retrieve_items(_url("/devices?locationId=%s" % CONTEXT.get().location_id))
+    ]
+
+
+def retrieve_rooms() -> List[Room]:
+    """Retrieve all rooms at the location."""
+    return [
+        Room(room_id=item["roomId"], name=item["name"])
+        for item in _retrieve_items(_url("/locations/%s/rooms" % CONTEXT.get().location_id))
+    ]
 
 
 def schedule_weather_lookup_timer(name: str, enabled: bool, cron: Optional[str]) -> None:
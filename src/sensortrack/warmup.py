@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+"""
+Startup warm-up, so the first requests after a restart don't pay for initialization.
+
+Without a warm-up, the first request after a restart loads the configuration, builds the
+dispatcher and the precomputed lifecycle responses, creates the output sinks, and
+resolves the SmartThings, weather.gov and InfluxDB hosts.  The warm-up does all of
+this eagerly at startup.  The first readiness check, which pings InfluxDB, is left to
+the periodic check the server starts right afterwards; until that check completes, the
+`/ready` endpoint reports that the server is not ready.
+
+Each step is timed and logged.  The steps run in order within a time budget.  Each step
+runs on a daemon thread and is only waited for until the budget is used up, so a step
+that hangs (for instance, on a slow DNS lookup) can't delay startup past the budget; it
+is abandoned and left to finish in the background.  Once the budget is used up the
+remaining steps are skipped, and anything skipped is initialized lazily on first use,
+just as it would be without a warm-up.  A failed step is logged and does not stop later
+steps.  Until the configuration has been loaded by the first step, the default budget
+applies.
+
+Outbound HTTP calls don't share a connection pool, so there are no connections that
+could be kept open for later requests.  Resolving each host ahead of time still primes
+any caching resolver on the host.
+"""
+import logging
+import socket
+import time
+from threading import Thread
+from typing import Any, Callable, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from attrs import frozen
+
+from sensortrack.admission import controller
+from sensortrack.config import config
+from sensortrack.dispatcher import dispatcher
+from sensortrack.responses import responses
+from sensortrack.sinks import sink
+
+DEFAULT_BUDGET_SEC = 10.0  # used if the configuration itself can't be loaded
+
+Step = Tuple[str, Callable[[], Any]]
+
+
+@frozen(kw_only=True)
+class WarmupResult:
+    """Result of a warm-up step."""
+
+    name: str
+    duration_sec: float
+    skipped: bool = False
+    abandoned: bool = False
+    error: Optional[str] = None
+
+
+def resolve(url: str) -> None:
+    """Resolve the host for a URL, priming any caching resolver."""
+    parsed = urlparse(url)
+    if parsed.hostname:
+        socket.getaddrinfo(parsed.hostname, parsed.port or (443 if parsed.scheme == "https" else 80), type=socket.SOCK_STREAM)
+
+
+def steps() -> List[Step]:
+    """Warm-up steps, in the order they run; configuration comes first, since everything else needs it."""
+    return [
+        ("config", config),
+        ("dispatcher", dispatcher),
+        ("admission", controller),  # so invalid limits are reported at startup, not on the first request
+        ("responses", responses),
+        ("sink", sink),
+        ("resolve smartthings", lambda: resolve(config().smartthings.base_url)),
+        ("resolve weather", lambda: resolve(config().weather.base_url)),
+        ("resolve influxdb", lambda: resolve(config().influxdb.url)),
+    ]
+
+
+def _budget_sec() -> float:
+    try:
+        return config().warmup.budget_sec
+    except Exception:  # pylint: disable=broad-except:
+        return DEFAULT_BUDGET_SEC
+
+
+def _run(step: Callable[[], Any], timeout_sec: float) -> Tuple[bool, Optional[str]]:
+    """Run a step on a daemon thread, returning whether it finished within the timeout, and any error."""
+    errors: List[str] = []
+
+    def target() -> None:
+        try:
+            step()
+        except Exception as e:  # pylint: disable=broad-except:
+            errors.append("%s" % e)
+
+    thread = Thread(target=target, name="warmup", daemon=True)
+    thread.start()
+    thread.join(timeout=timeout_sec)
+    finished = not thread.is_alive()
+    return finished, errors[0] if finished and errors else None
+
+
+def warm_up(warmup: Optional[List[Step]] = None) -> List[WarmupResult]:
+    """Run the warm-up steps within the configured budget, logging the duration of each step."""
+    results = []
+    started = time.monotonic()
+    deadline = started + DEFAULT_BUDGET_SEC  # the configured budget is only known once the first step has loaded it
+    configured = False
+    for name, step in warmup if warmup is not None else steps():
+        now = time.monotonic()
+        if now >= deadline:
+            logging.warning("Warm-up step %s skipped, budget used up", name)
+            results.append(WarmupResult(name=name, duration_sec=0.0, skipped=True))
+            continue
+        finished, error = _run(step, deadline - now)
+        duration_sec = time.monotonic() - now
+        if not finished:
+            logging.warning("Warm-up step %s abandoned after %.3f seconds, budget used up", name, duration_sec)
+        else:
+            if error:
+                logging.error("Warm-up step %s failed: %s", name, error)
+            logging.info("Warm-up step %s took %.3f seconds", name, duration_sec)
+        results.append(WarmupResult(name=name, duration_sec=duration_sec, abandoned=not finished, error=error))
+        if not configured:
+            configured = True
+            if finished:  # if loading the configuration hung, asking for it again would hang too
+                deadline = started + _budget_sec()
+    logging.info("Warm-up completed in %.3f seconds", time.monotonic() - started)
+    return results
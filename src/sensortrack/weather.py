@@ -16,6 +16,11 @@
 and also for non-U.S. locations.  However, I can find no documentation about how to
 actually subscribe to such a weather event.
 
+Station lookups are cached per latitude and longitude in the shared cache, since the
+closest station very rarely changes.  The same observation decoder is used for the
+latest observation and for historical observations retrieved over a time range, which
+are used to backfill gaps in the weather measurement.
+
 See: https://weather-gov.github.io/api/general-faqs
      https://api.weather.gov/openapi.json
      http://codes.wmo.int/common/unit
@@ -23,16 +28,25 @@
 """
 from __future__ import annotations  # so we can return a type from one of its own methods
 
-from typing import Any, Dict, Optional, Tuple
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, Optional, Tuple
+from urllib.parse import urlencode
 
 import jsonpath_ng
 import pytemperature
 import requests
+from attrs import frozen
 
+from sensortrack.cache import Cache
 from sensortrack.config import config
-from sensortrack.rest import DECAYING_RETRY, RestDataError, raise_for_status
+from sensortrack.rest import RestDataError, decaying_retry, raise_for_status
 
 _CLIENT_TIMEOUT_SEC = 5.0  # we want some fairly large timeout so that requests can't hang forever
+_STATION_TTL_SEC = 24 * 60 * 60  # how long a cached station URL is used before being looked up again
+_PAGE_LIMIT = 500  # observations requested per page of historical observations
+
+UPSTREAM = "weather"  # name of the upstream, for circuit breaker and retry budget purposes
+DECAYING_RETRY = decaying_retry(UPSTREAM)
 
 
 def _url(endpoint: str) -> str:
@@ -45,22 +59,45 @@ def _extract_float(json: Dict[str, Any], jsonpath: str) -> float:
     return jsonpath_ng.parse(jsonpath).find(json)[0].value  # type: ignore
 
 
-def _extract_temperature(response: requests.Response) -> Optional[float]:
-    """Extract temperature from the response, returning None if it can't be extracted."""
+@frozen(kw_only=True)
+class Observation:
+    """A weather observation, with None for any value that couldn't be extracted."""
+
+    timestamp: Optional[float]  # epoch seconds
+    temperature: Optional[float]  # degrees F
+    humidity: Optional[float]  # percent
+
+
+def _extract_temperature(json: Dict[str, Any]) -> Optional[float]:
+    """Extract temperature from an observation, returning None if it can't be extracted."""
     try:
-        return pytemperature.c2f(_extract_float(response.json(), "$.properties.temperature.value"))  # type: ignore
+        return pytemperature.c2f(_extract_float(json, "$.properties.temperature.value"))  # type: ignore
     except:  # pylint: disable=bare-except:
         return None
 
 
-def _extract_humidity(response: requests.Response) -> Optional[float]:
-    """Extract humidity from the response, returning None if it can't be extracted."""
+def _extract_humidity(json: Dict[str, Any]) -> Optional[float]:
+    """Extract humidity from an observation, returning None if it can't be extracted."""
     try:
-        return round(float(_extract_float(response.json(), "$.properties.relativeHumidity.value")), 2)
+        return round(float(_extract_float(json, "$.properties.relativeHumidity.value")), 2)
     except:  # pylint: disable=bare-except:
         return None
 
 
+def _extract_timestamp(json: Dict[str, Any]) -> Optional[float]:
+    """Extract the observation time from an observation, returning None if it can't be extracted."""
+    try:
+        stamp = datetime.fromisoformat(str(json["properties"]["timestamp"]).replace("Z", "+00:00"))
+        return (stamp if stamp.tzinfo else stamp.replace(tzinfo=timezone.utc)).timestamp()
+    except:  # pylint: disable=bare-except:
+        return None
+
+
+def decode_observation(json: Dict[str, Any]) -> Observation:
+    """Decode an observation, as returned for a single observation or as a feature in a list of observations."""
+    return Observation(timestamp=_extract_timestamp(json), temperature=_extract_temperature(json), humidity=_extract_humidity(json))
+
+
 @DECAYING_RETRY
 def _retrieve_station_url(latitude: float, longitude: float) -> str:
     """Retrieve the station URL for the closest station to a latitude and longitude."""
@@ -73,18 +110,50 @@ def _retrieve_station_url(latitude: float, longitude: float) -> str:
         raise RestDataError("Failed to retrieve any valid stations for %s,%s" % (latitude, longitude)) from e
 
 
+_STATIONS = Cache("stations", _STATION_TTL_SEC)  # "latitude,longitude" -> station URL
+
+
+def _cached_station_url(latitude: float, longitude: float) -> str:
+    """Return the station URL for the closest station to a latitude and longitude, using the cache if possible."""
+    key = "%s,%s" % (latitude, longitude)
+    cached = _STATIONS.get(key)
+    if cached:
+        return str(cached)
+    url = _retrieve_station_url(latitude, longitude)
+    _STATIONS.set(key, url)
+    return url
+
+
 @DECAYING_RETRY
-def _retrieve_latest_observation(station_url: str) -> Tuple[Optional[float], Optional[float]]:
-    """Return the latest (temperature in F, humidity) observation at a particular station, via its station URL."""
+def _retrieve_latest_observation(station_url: str) -> Observation:
+    """Return the latest observation at a particular station, via its station URL."""
     url = "%s/observations/latest" % station_url
     response = requests.get(url=url, timeout=_CLIENT_TIMEOUT_SEC)
     raise_for_status(response)
-    temperature = _extract_temperature(response)
-    humidity = _extract_humidity(response)
-    return temperature, humidity
+    return decode_observation(response.json())
+
+
+@DECAYING_RETRY
+def _retrieve_observation_page(url: str) -> Dict[str, Any]:
+    """Retrieve a single page of historical observations."""
+    response = requests.get(url=url, timeout=_CLIENT_TIMEOUT_SEC)
+    raise_for_status(response)
+    return response.json()  # type: ignore
 
 
 def retrieve_current_conditions(latitude: float, longitude: float) -> Tuple[Optional[float], Optional[float]]:
     """Retrieve current weather conditions a particular lat/long location."""
-    station_url = _retrieve_station_url(latitude, longitude)
-    return _retrieve_latest_observation(station_url)
+    observation = _retrieve_latest_observation(_cached_station_url(latitude, longitude))
+    return observation.temperature, observation.humidity
+
+
+def retrieve_observations(latitude: float, longitude: float, start: datetime, end: datetime) -> Iterator[Observation]:
+    """Stream historical observations for a particular lat/long location over a time range, one page at a time."""
+    params = {"start": start.isoformat(timespec="seconds"), "end": end.isoformat(timespec="seconds"), "limit": _PAGE_LIMIT}
+    url: Optional[str] = "%s/observations?%s" % (_cached_station_url(latitude, longitude), urlencode(params))
+    while url:
+        page = _retrieve_observation_page(url)
+        features = page.get("features") or []
+        for feature in features:
+            yield decode_observation(feature)
+        url = (page.get("pagination") or {}).get("next") if features else None  # an empty page is the last page
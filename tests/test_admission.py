@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+import asyncio
+from unittest.mock import MagicMock, patch
+
+import pytest
+from smartapp.interface import SignatureError, SmartAppDispatcherConfig
+
+from sensortrack.admission import (
+    DEFAULT,
+    AdmissionController,
+    Gate,
+    GateStatus,
+    OverloadedError,
+    admission_status,
+    admitted,
+    controller,
+    lifecycle,
+    reset,
+    signed,
+)
+from sensortrack.config import AdmissionConfig, AdmissionLimitConfig, ConfigError
+
+SETTINGS = AdmissionConfig(
+    limits={"EVENT": AdmissionLimitConfig(concurrency=1, queue_depth=1), "default": AdmissionLimitConfig(concurrency=2)},
+    queue_timeout_sec=0.05,
+    retry_after_sec=7,
+)
+SIGNED = {"Authorization": 'Signature keyId="k",signature="s",headers="date",algorithm="rsa-sha256"', "X-ST-Correlation": "c"}
+
+
+class TestLifecycle:
+    @pytest.mark.parametrize(
+        "body",
+        [
+            '{"lifecycle": "EVENT", "eventData": {}}',
+            b'{"executionId":"e","lifecycle":"EVENT"}',
+            ' { "settings" : {"lifecycle": "INSTALL"}, "note": "\\"lifecycle\\":\\"INSTALL\\"", "lifecycle" : "EVENT" } ',
+        ],
+    )
+    def test_lifecycle(self, body):
+        assert lifecycle(body) == "EVENT"  # only the top-level member counts
+
+    @pytest.mark.parametrize(
+        "body",
+        ["", b"", "{}", "[]", '{"lifecycle": 12}', '{"settings": {"lifecycle": "EVENT"}}', '{"a": 1 "lifecycle": "EVENT"}', "{"],
+    )
+    def test_lifecycle_missing(self, body):
+        assert lifecycle(body) is None
+
+    def test_lifecycle_prefix(self):
+        assert lifecycle('{"lifecycle": "EVENT", "eventData": {') == "EVENT"  # the rest of the body is never parsed
+
+
+class TestSigned:
+    @pytest.mark.parametrize(
+        "headers,expected",
+        [
+            (SIGNED, True),
+            ({"authorization": SIGNED["Authorization"]}, True),
+            ({}, False),
+            ({"Authorization": "Bearer token"}, False),
+            ({"Authorization": 'Signature keyId="k"'}, False),
+        ],
+    )
+    def test_signed(self, headers, expected):
+        assert signed(headers) is expected
+
+
+class TestGate:
+    pytestmark = pytest.mark.asyncio
+
+    async def test_admit(self):
+        gate = Gate("EVENT", concurrency=2, queue_depth=0)
+        assert await gate.acquire(1.0)
+        assert await gate.acquire(1.0)
+        assert not await gate.acquire(1.0)  # no queue, so shed right away
+        assert gate.status() == GateStatus(lifecycle="EVENT", active=2, queued=0, admitted=2, shed=1)
+        gate.release()
+        gate.release()
+        assert gate.status().active == 0
+
+    async def test_queue(self):
+        gate = Gate("EVENT", concurrency=1, queue_depth=2)
+        assert await gate.acquire(1.0)
+        first = asyncio.ensure_future(gate.acquire(1.0))
+        second = asyncio.ensure_future(gate.acquire(1.0))
+        await asyncio.sleep(0)
+        assert gate.status().queued == 2
+        assert not await gate.acquire(1.0)  # the queue is full
+        gate.release()  # the slot is handed to the first waiter
+        assert await first
+        assert not second.done()
+        gate.release()
+        assert await second
+        gate.release()
+        assert gate.status() == GateStatus(lifecycle="EVENT", active=0, queued=0, admitted=3, shed=1)
+
+    async def test_queue_timeout(self):
+        gate = Gate("EVENT", concurrency=1, queue_depth=1)
+        assert await gate.acquire(1.0)
+        assert not await gate.acquire(0.01)
+        assert gate.status() == GateStatus(lifecycle="EVENT", active=1, queued=0, admitted=1, shed=1)
+        gate.release()
+        assert gate.status().active == 0
+
+    async def test_cancelled_waiter(self):
+        gate = Gate("EVENT", concurrency=1, queue_depth=2)
+        assert await gate.acquire(1.0)
+        cancelled = asyncio.ensure_future(gate.acquire(1.0))
+        waiting = asyncio.ensure_future(gate.acquire(1.0))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        gate.release()  # handed to the cancelled waiter, which passes it along
+        assert await waiting
+        gate.release()
+        assert gate.status().active == 0
+
+
+class TestAdmissionController:
+    def test_gate(self):
+        admission = AdmissionController(SETTINGS)
+        assert admission.gate("EVENT").name == "EVENT"
+        assert admission.gate("INSTALL").name == "default"
+        assert admission.gate(None).name == "default"
+        assert [status.lifecycle for status in admission.status()] == ["EVENT", "default"]
+
+    def test_gate_no_default(self):
+        admission = AdmissionController(AdmissionConfig(limits={"EVENT": AdmissionLimitConfig(concurrency=1)}))
+        assert admission.gate("INSTALL") is None
+
+    @pytest.mark.parametrize(
+        "limits,message",
+        [
+            ({"EVENT": AdmissionLimitConfig(concurrency=0)}, "concurrency for EVENT must be greater than zero"),
+            ({"EVENT": AdmissionLimitConfig(concurrency=1, queue_depth=-1)}, "queue depth for EVENT must not be negative"),
+            (
+                {"EVENT": AdmissionLimitConfig(concurrency=32), DEFAULT: AdmissionLimitConfig(concurrency=8)},
+                r"Total admission concurrency \(40\) must be less than the thread pool size \(40\)",
+            ),
+        ],
+    )
+    def test_invalid(self, limits, message):
+        with pytest.raises(ConfigError, match=message):
+            AdmissionController(AdmissionConfig(limits=limits))
+
+
+@patch("sensortrack.admission.config")
+class TestSingleton:
+    @pytest.fixture(autouse=True)
+    def cleanup(self):
+        """Reset singleton before and after tests."""
+        reset()
+        yield
+        reset()
+
+    @pytest.mark.parametrize("admission", [None, AdmissionConfig()])
+    def test_disabled(self, config, admission):
+        config.return_value = MagicMock(admission=admission)
+        assert controller() is None
+        assert controller() is None
+        assert not admission_status()
+        config.assert_called_once()
+
+    def test_enabled(self, config):
+        config.return_value = MagicMock(admission=SETTINGS)
+        assert controller() is controller()
+        assert [status.lifecycle for status in admission_status()] == ["EVENT", "default"]
+
+    @pytest.mark.asyncio
+    async def test_admitted(self, config):
+        config.return_value = MagicMock(admission=SETTINGS, dispatcher=SmartAppDispatcherConfig())
+        async with admitted(b'{"lifecycle": "EVENT"}', SIGNED):
+            assert controller().gate("EVENT").active == 1
+            async with admitted(b'{"lifecycle": "INSTALL"}', SIGNED):  # lifecycle requests aren't held up by EVENT traffic
+                assert controller().gate("default").active == 1
+            with pytest.raises(OverloadedError) as e:
+                async with admitted(b'{"lifecycle": "EVENT"}', SIGNED):  # waits in the queue, and times out
+                    pass
+            assert e.value.retry_after_sec == 7
+        assert controller().gate("EVENT").status() == GateStatus(lifecycle="EVENT", active=0, queued=0, admitted=1, shed=1)
+
+    @pytest.mark.asyncio
+    async def test_admitted_unsigned(self, config):
+        config.return_value = MagicMock(admission=SETTINGS, dispatcher=SmartAppDispatcherConfig())
+        with pytest.raises(SignatureError) as e:
+            async with admitted(b'{"lifecycle": "EVENT"}', {"X-ST-Correlation": "c"}):
+                pass
+        assert e.value.correlation_id == "c"
+        assert controller().gate("EVENT").status() == GateStatus(lifecycle="EVENT", active=0, queued=0, admitted=0, shed=0)
+
+    @pytest.mark.asyncio
+    async def test_admitted_unsigned_unchecked(self, config):
+        config.return_value = MagicMock(admission=SETTINGS, dispatcher=SmartAppDispatcherConfig(check_signatures=False))
+        async with admitted(b'{"lifecycle": "EVENT"}', {}):
+            assert controller().gate("EVENT").active == 1
+
+    @pytest.mark.asyncio
+    async def test_admitted_disabled(self, config):
+        config.return_value = MagicMock(admission=None)
+        async with admitted(b'{"lifecycle": "EVENT"}', {}):
+            pass
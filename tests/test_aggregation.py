@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=protected-access:
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from sensortrack.aggregation import WindowAggregator, WindowResult, aggregator, reset
+from sensortrack.config import AggregationConfig
+
+KEY = ("l", "d", "temperature")
+OTHER = ("l", "e", "humidity")
+
+
+class TestWindowAggregator:
+    def test_collect_closed_windows(self):
+        target = WindowAggregator(60, "sensor_1m")
+        target.add(KEY, 0.0, 70.0)
+        target.add(KEY, 30.0, 72.0)
+        target.add(KEY, 59.9, 71.0)
+        target.add(OTHER, 10.0, 40.0)
+        target.add(KEY, 60.0, 75.0)
+        assert not target.collect(59.0)
+        assert target.collect(60.0) == [
+            WindowResult(start=0, key=KEY, count=3, low=70.0, high=72.0, mean=71.0),
+            WindowResult(start=0, key=OTHER, count=1, low=40.0, high=40.0, mean=40.0),
+        ]
+        assert not target.collect(60.0)  # already collected
+        assert not target.collect(119.0)
+        assert target.collect(120.0) == [WindowResult(start=60, key=KEY, count=1, low=75.0, high=75.0, mean=75.0)]
+
+    def test_collect_all(self):
+        target = WindowAggregator(60, "sensor_1m")
+        target.add(KEY, 0.0, 70.0)
+        target.add(KEY, 1000.0, 71.0)
+        assert [result.start for result in target.collect()] == [0, 960]
+        assert not target.collect()
+
+    def test_restore(self):
+        target = WindowAggregator(60, "sensor_1m")
+        target.add(KEY, 0.0, 70.0)
+        target.add(KEY, 10.0, 72.5)
+        collected = target.collect(60.0)
+        target.add(KEY, 60.0, 75.0)  # the next window is still open
+        target.restore(collected)  # as if the write had failed
+        target.add(KEY, 20.0, 69.0)  # a late reading for the restored window is merged with it
+        assert target.collect(60.0) == [WindowResult(start=0, key=KEY, count=3, low=69.0, high=72.5, mean=70.5)]
+        assert target.late == 0
+
+    def test_late(self):
+        target = WindowAggregator(60, "sensor_1m")
+        target.add(KEY, 0.0, 70.0)
+        target.add(KEY, 60.0, 75.0)
+        assert len(target.collect(60.0)) == 1  # as if written by another request
+        target.add(KEY, 30.0, 71.0)  # a late reading from a slow request mustn't create the window again
+        target.add(OTHER, 59.0, 40.0)  # for any series, since every series shares the same windows
+        target.add(KEY, 90.0, 76.0)
+        assert target.late == 2
+        assert target.collect() == [WindowResult(start=60, key=KEY, count=2, low=75.0, high=76.0, mean=75.5)]
+
+    def test_points(self):
+        target = WindowAggregator(60, "sensor_1m")
+        points = target.points([WindowResult(start=120, key=KEY, count=3, low=70.0, high=72.0, mean=71.0)])
+        assert len(points) == 1
+        assert points[0]._name == "sensor_1m"
+        assert points[0]._tags == {"location": "l", "device": "d"}
+        assert points[0]._fields == {"temperature": 71.0, "temperature_min": 70.0, "temperature_max": 72.0, "temperature_count": 3}
+        assert points[0]._time == datetime.fromtimestamp(120, tz=timezone.utc)
+
+
+@patch("sensortrack.aggregation.config")
+class TestSingleton:
+    @pytest.fixture(autouse=True)
+    def cleanup(self):
+        """Reset singleton before and after tests."""
+        reset()
+        yield
+        reset()
+
+    def test_disabled(self, config):
+        config.return_value = MagicMock(aggregation=None)
+        assert aggregator() is None
+        assert aggregator() is None
+        config.assert_called_once()
+
+    def test_enabled(self, config):
+        config.return_value = MagicMock(aggregation=AggregationConfig(window_sec=300, measurement="sensor_5m", keep_raw=True))
+        result = aggregator()
+        assert result is aggregator()
+        assert result.window_sec == 300
+        assert result.measurement == "sensor_5m"
+        assert result.keep_raw is True
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=protected-access:
+import json
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from sensortrack.alerts import Alert, AlertEngine, FileSink, LogSink, WebhookSink, alerts, create_sink, reset
+from sensortrack.config import AlertCondition, AlertRuleConfig, AlertsConfig, AlertSinkConfig, AlertSinkType, ConfigError
+
+FREEZING = AlertRuleConfig(name="freezing", attribute="temperature", condition=AlertCondition.BELOW, threshold=40.0, cooldown_sec=0)
+SPIKE = AlertRuleConfig(name="spike", attribute="humidity", condition=AlertCondition.ANOMALY, threshold=3.0, min_samples=5)
+
+ALERT = Alert(rule="r", location_id="l", device_id="d", attribute="a", value=1.0, timestamp=2.0, message="m")
+
+
+def _evaluate_all(target, attribute, values, device="d"):
+    return [alert.value for i, value in enumerate(values) for alert in target.evaluate("l", device, attribute, value, float(i))]
+
+
+class TestSinks:
+    def test_create_sink(self):
+        assert isinstance(create_sink(AlertSinkConfig(type=AlertSinkType.LOG)), LogSink)
+        assert create_sink(AlertSinkConfig(type=AlertSinkType.WEBHOOK, url="http://hook")).url == "http://hook"
+        assert create_sink(AlertSinkConfig(type=AlertSinkType.FILE, path="alerts.json")).path == "alerts.json"
+        with pytest.raises(ConfigError):
+            create_sink(AlertSinkConfig(type=AlertSinkType.WEBHOOK))
+        with pytest.raises(ConfigError):
+            create_sink(AlertSinkConfig(type=AlertSinkType.FILE))
+
+    @patch("sensortrack.alerts.requests")
+    def test_webhook(self, requests):
+        WebhookSink("http://hook").send(ALERT)
+        requests.post.assert_called_once_with(
+            url="http://hook",
+            json={
+                "rule": "r",
+                "location_id": "l",
+                "device_id": "d",
+                "attribute": "a",
+                "value": 1.0,
+                "timestamp": 2.0,
+                "message": "m",
+            },
+            timeout=5.0,
+        )
+        requests.post.return_value.raise_for_status.assert_called_once()
+
+    def test_file(self, tmp_path):
+        path = tmp_path / "alerts.json"
+        FileSink(str(path)).send(ALERT)
+        FileSink(str(path)).send(ALERT)
+        lines = path.read_text(encoding="utf-8").splitlines()
+        assert len(lines) == 2
+        assert json.loads(lines[0])["rule"] == "r"
+
+
+class TestEvaluate:
+    def test_threshold(self):
+        target = AlertEngine([FREEZING], [], queue_size=10)
+        assert _evaluate_all(target, "temperature", [45.0, 39.0, 38.0, 41.0, 37.0]) == [39.0, 37.0]  # fires on crossing only
+        assert _evaluate_all(target, "humidity", [10.0]) == []
+        assert _evaluate_all(target, "temperature", [39.0], device="e") == [39.0]  # state is per series
+
+    def test_threshold_device(self):
+        rule = AlertRuleConfig(name="hot", attribute="temperature", condition=AlertCondition.ABOVE, threshold=90.0, device="e")
+        target = AlertEngine([rule], [], queue_size=10)
+        assert _evaluate_all(target, "temperature", [95.0]) == []
+        assert _evaluate_all(target, "temperature", [95.0], device="e") == [95.0]
+
+    def test_cooldown(self):
+        rule = AlertRuleConfig(name="hot", attribute="temperature", condition=AlertCondition.ABOVE, threshold=90.0, cooldown_sec=10)
+        target = AlertEngine([rule], [], queue_size=10)
+        assert _evaluate_all(target, "temperature", [95.0, 85.0, 95.0, 85.0, 95.0]) == [95.0]  # second crossing is within cooldown
+
+    def test_cooldown_suppressed(self):
+        rule = AlertRuleConfig(name="hot", attribute="temperature", condition=AlertCondition.ABOVE, threshold=90.0, cooldown_sec=3)
+        target = AlertEngine([rule], [], queue_size=10)
+        # the suppressed crossing doesn't enter the alerting state, so it fires once the cooldown expires
+        assert _evaluate_all(target, "temperature", [95.0, 85.0, 95.0, 95.0, 96.0]) == [95.0, 95.0]
+
+    @patch("sensortrack.alerts._MAX_STATES", 2)
+    def test_states_bounded(self):
+        target = AlertEngine([FREEZING], [], queue_size=10)
+        _evaluate_all(target, "temperature", [39.0], device="a")
+        _evaluate_all(target, "temperature", [39.0], device="b")
+        _evaluate_all(target, "temperature", [38.0], device="a")  # still alerting, and now the most recently used
+        _evaluate_all(target, "temperature", [39.0], device="c")  # evicts b, the least recently used
+        assert [key[1][1] for key in target._states] == ["a", "c"]
+        assert _evaluate_all(target, "temperature", [37.0], device="a") == []  # state for a was kept
+
+    def test_anomaly(self):
+        target = AlertEngine([SPIKE], [], queue_size=10)
+        values = [50.0, 51.0, 49.0, 50.0, 51.0, 49.0, 50.0, 75.0, 50.0]
+        assert _evaluate_all(target, "humidity", values) == [75.0]
+
+    def test_anomaly_min_samples(self):
+        target = AlertEngine([SPIKE], [], queue_size=10)
+        assert _evaluate_all(target, "humidity", [50.0, 51.0, 75.0]) == []  # not enough history yet
+
+
+class TestEngine:
+    def test_offer_ignored(self):
+        target = AlertEngine([FREEZING], [], queue_size=1)
+        target.offer("l", "d", "humidity", 10.0)
+        assert target._queue.empty()
+
+    def test_offer_dropped(self):
+        target = AlertEngine([FREEZING], [], queue_size=1)
+        target.offer("l", "d", "temperature", 10.0)
+        target.offer("l", "d", "temperature", 10.0)
+        assert target.dropped == 1
+
+    def test_worker(self):
+        sink, broken = MagicMock(), MagicMock()
+        broken.send.side_effect = Exception("hello")
+        target = AlertEngine([FREEZING], [broken, sink], queue_size=10)
+        target.start()
+        target.offer("l", "d", "temperature", 45.0, 1.0)
+        target.offer("l", "d", "temperature", 35.0, 2.0)
+        target.stop()
+        alert = sink.send.call_args[0][0]
+        assert sink.send.call_count == 1  # delivered even though an earlier sink failed
+        assert alert.rule == "freezing"
+        assert alert.value == 35.0
+        assert alert.timestamp == 2.0
+        assert alert.message == "temperature on l/d: 35.0 is below 40.0"
+
+    def test_stop_full(self):
+        def slow(*_):
+            time.sleep(0.1)
+            return []
+
+        target = AlertEngine([FREEZING], [], queue_size=1)
+        target.evaluate = MagicMock(side_effect=slow)
+        target.start()
+        target.offer("l", "d", "temperature", 35.0, 1.0)
+        target.offer("l", "d", "temperature", 35.0, 2.0)
+        worker = target._worker
+        target.stop(timeout=5.0)  # the queue may be full, but stopping must not block on it
+        assert not worker.is_alive()
+        assert target._queue.empty()
+
+
+@patch("sensortrack.alerts.config")
+class TestSingleton:
+    @pytest.fixture(autouse=True)
+    def cleanup(self):
+        """Reset singleton before and after tests."""
+        reset()
+        yield
+        reset()
+
+    def test_disabled(self, config):
+        config.return_value = MagicMock(alerts=None)
+        assert alerts() is None
+        assert alerts() is None
+        config.assert_called_once()
+
+    def test_enabled(self, config):
+        sinks = [AlertSinkConfig(type=AlertSinkType.LOG)]
+        config.return_value = MagicMock(alerts=AlertsConfig(rules=[FREEZING], sinks=sinks, queue_size=5))
+        result = alerts()
+        assert result is alerts()
+        assert result.rules == [FREEZING]
+        assert isinstance(result.sinks[0], LogSink)
+        assert result._worker.is_alive()
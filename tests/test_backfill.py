@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+from sensortrack.backfill import BackfillResult, backfill_weather, weather_point
+from sensortrack.config import InfluxDbConfig, SinksConfig
+from sensortrack.weather import Observation
+
+INFLUXDB = InfluxDbConfig(url="url", org="org", token="token", bucket="bucket")
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+END = datetime(2024, 1, 2, tzinfo=timezone.utc)
+HOUR = 60 * 60
+
+
+def _observation(hour, temperature=70.0, humidity=50.0, minute=54):
+    return Observation(timestamp=START.timestamp() + hour * HOUR + minute * 60, temperature=temperature, humidity=humidity)
+
+
+def _stub_influxdb(influxdb, stamps):
+    # Ugh, the stubbing for a context manager is hideous
+    records = [MagicMock(values={"_time": stamp}) for stamp in stamps]
+    query_stream = MagicMock(return_value=iter(records))
+    influxdb.return_value = MagicMock(
+        __enter__=MagicMock(
+            return_value=MagicMock(
+                query_api=MagicMock(
+                    return_value=MagicMock(query_stream=query_stream),
+                ),
+            ),
+        ),
+    )
+    return query_stream
+
+
+class TestWeatherPoint:
+    def test_complete(self):
+        point = weather_point("l", _observation(0, temperature=90.0, humidity=50.0))
+        stamp = int(START.timestamp() + 54 * 60) * 1_000_000_000
+        expected = "weather,location=l dew_point=68.87,heat_index=94.6,humidity=50,temperature=90 %d" % stamp
+        assert point.to_line_protocol() == expected
+
+    def test_partial(self):
+        point = weather_point("l", _observation(0, temperature=None, humidity=50.0))
+        assert point.to_line_protocol().startswith("weather,location=l humidity=50 ")
+
+
+@patch("sensortrack.backfill.sink")
+@patch("sensortrack.backfill.retrieve_observations")
+@patch("sensortrack.backfill.InfluxDBClient")
+@patch("sensortrack.backfill.config")
+class TestBackfillWeather:
+    def test_backfill(self, config, influxdb, retrieve_observations, sink):
+        config.return_value = MagicMock(influxdb=INFLUXDB, sinks=SinksConfig())
+        query_stream = _stub_influxdb(influxdb, [datetime(2024, 1, 1, 1, 15, tzinfo=timezone.utc)])
+        retrieve_observations.return_value = iter(
+            [
+                _observation(0),
+                _observation(1),  # hour already has data
+                _observation(2, temperature=None, humidity=None),
+                Observation(timestamp=None, temperature=70.0, humidity=50.0),
+                _observation(3),
+                _observation(3, minute=20),
+            ]
+        )
+        result = backfill_weather("l", 12.3, 45.6, START, END, batch_size=2)
+        assert result == BackfillResult(observed=6, present=1, invalid=2, written=3)
+        assert query_stream.call_args[1]["params"] == {"start": START, "stop": END, "location": "l"}
+        retrieve_observations.assert_called_once_with(12.3, 45.6, START, END)
+        assert [len(call[0][0]) for call in sink.return_value.write.call_args_list] == [2, 1]
+        assert all(call.kwargs == {"block": True} for call in sink.return_value.write.call_args_list)
+        sink.return_value.flush.assert_called_once_with(final=True)
+
+    def test_influxdb_disabled(self, config, influxdb, retrieve_observations, sink):
+        config.return_value = MagicMock(influxdb=INFLUXDB, sinks=SinksConfig(influxdb=False))
+        retrieve_observations.return_value = iter([_observation(0)])
+        assert backfill_weather("l", 12.3, 45.6, START, END) == BackfillResult(observed=1, written=1)
+        influxdb.assert_not_called()
+        sink.return_value.write.assert_called_once()
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=redefined-outer-name,protected-access:
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from sensortrack.cache import Cache, CacheError, FileBackend, MemoryBackend, RedisBackend, backend, create_backend, reset
+from sensortrack.config import CacheBackendType, CacheConfig, ConfigError
+from sensortrack.fakes import FakeRedis
+from sensortrack.rest import CircuitState
+
+
+@pytest.fixture(autouse=True)
+def cleanup():
+    reset()
+    yield
+    reset()
+
+
+@pytest.fixture
+def redis():
+    server = FakeRedis()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def configured():
+    with patch("sensortrack.cache.config") as config:
+        config.return_value = MagicMock(cache=CacheConfig())
+        yield config
+
+
+class TestMemoryBackend:
+    def test_get_set(self):
+        memory = MemoryBackend(10)
+        assert memory.get("a") is None
+        memory.set("a", "1", 60)
+        assert memory.get("a") == "1"
+        memory.set("a", "2", 60)
+        assert memory.get("a") == "2"
+
+    def test_expired(self):
+        memory = MemoryBackend(10)
+        memory.set("a", "1", -1)
+        assert memory.get("a") is None
+        assert memory.add("a", "2", 60) is True  # expired, so it can be added again
+        assert memory.get("a") == "2"
+
+    def test_add(self):
+        memory = MemoryBackend(10)
+        assert memory.add("a", "1", 60) is True
+        assert memory.add("a", "2", 60) is False
+        assert memory.get("a") == "1"
+
+    def test_delete(self):
+        memory = MemoryBackend(10)
+        memory.set("a", "1", 60)
+        memory.delete("a")
+        memory.delete("b")
+        assert memory.get("a") is None
+        assert memory.add("a", "2", 60) is True
+
+    def test_lru(self):
+        memory = MemoryBackend(2)
+        memory.set("a", "1", 60)
+        memory.set("b", "2", 60)
+        assert memory.get("a") == "1"  # now most recently used
+        memory.set("c", "3", 60)
+        assert memory.get("a") == "1"
+        assert memory.get("b") is None
+        assert memory.get("c") == "3"
+
+
+class TestFileBackend:
+    def test_get_set(self, tmpdir):
+        files = FileBackend(str(tmpdir.join("cache")), 10)
+        assert files.get("a") is None
+        files.set("a", "1", 60)
+        assert files.get("a") == "1"
+        assert FileBackend(files.path, 10).get("a") == "1"  # shared with any other instance for the same path
+        files.set("a", "2", 60)
+        assert files.get("a") == "2"
+        assert [name for name in os.listdir(files.path) if name.endswith(".tmp")] == []
+
+    def test_expired(self, tmpdir):
+        files = FileBackend(str(tmpdir), 10)
+        files.set("a", "1", -1)
+        assert files.get("a") is None
+        assert files.add("a", "2", 60) is True
+        assert files.get("a") == "2"
+
+    def test_add(self, tmpdir):
+        files = FileBackend(str(tmpdir), 10)
+        other = FileBackend(str(tmpdir), 10)
+        assert files.add("a", "1", 60) is True
+        assert other.add("a", "2", 60) is False
+        assert other.get("a") == "1"
+
+    def test_add_concurrent(self, tmpdir):
+        files = FileBackend(str(tmpdir), 100)
+        files.set("a", "expired", -1)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            claimed = list(executor.map(lambda i: FileBackend(files.path, 100).add("a", str(i), 60), range(32)))
+        assert claimed.count(True) == 1
+        assert files.get("a") == str(claimed.index(True))
+
+    def test_delete(self, tmpdir):
+        files = FileBackend(str(tmpdir), 10)
+        files.set("a", "1", 60)
+        files.delete("a")
+        files.delete("b")
+        assert files.get("a") is None
+
+    def test_corrupt(self, tmpdir):
+        files = FileBackend(str(tmpdir), 10)
+        files.set("a", "1", 60)
+        with open(files._file("a"), "w", encoding="utf-8") as fp:
+            fp.write("{bogus")
+        assert files.get("a") is None
+
+    def test_prune(self, tmpdir):
+        files = FileBackend(str(tmpdir), 3)
+        for index in range(5):
+            files.set("key-%d" % index, "%d" % index, 60)
+            stamp = time.time() - 100 + index
+            os.utime(files._file("key-%d" % index), (stamp, stamp))
+        files.prune()
+        assert len(os.listdir(str(tmpdir))) == 3
+        assert files.get("key-0") is None
+        assert files.get("key-1") is None
+        assert files.get("key-4") == "4"
+
+    @patch("sensortrack.cache._PRUNE_EVERY", 2)
+    def test_prune_on_write(self, tmpdir):
+        files = FileBackend(str(tmpdir), 1)
+        files.set("a", "1", 60)
+        assert len(os.listdir(str(tmpdir))) == 1
+        files.set("b", "2", 60)
+        assert len(os.listdir(str(tmpdir))) == 1
+
+
+class TestRedisBackend:
+    def test_url(self):
+        client = RedisBackend("redis://:secret@cache.example.com:6380/2", 1.0)
+        assert client.host == "cache.example.com"
+        assert client.port == 6380
+        assert client.password == "secret"
+        assert client.db == 2
+        client = RedisBackend("redis://cache", 1.0)
+        assert client.port == 6379
+        assert client.password is None
+        assert client.db == 0
+
+    def test_url_invalid(self):
+        with pytest.raises(ConfigError, match="redis:// URL"):
+            RedisBackend("http://cache", 1.0)
+
+    def test_get_set(self, redis):
+        client = RedisBackend(redis.url, 1.0)
+        try:
+            assert client.get("a") is None
+            client.set("a", "value with spaces and ünicode", 60)
+            assert client.get("a") == "value with spaces and ünicode"
+            assert client.command("PING") == "PONG"
+            assert client.command("DEL", "a") == 1
+            assert client.get("a") is None
+        finally:
+            client.close()
+        assert ["SET", "a", "value with spaces and ünicode", "PX", "60000"] in redis.commands
+
+    def test_add(self, redis):
+        client = RedisBackend(redis.url, 1.0)
+        try:
+            assert client.add("a", "1", 60) is True
+            assert client.add("a", "2", 60) is False
+            assert client.get("a") == "1"
+            client.delete("a")
+            assert client.get("a") is None
+        finally:
+            client.close()
+
+    def test_expired(self, redis):
+        client = RedisBackend(redis.url, 1.0)
+        try:
+            client.set("a", "1", 0.01)
+            time.sleep(0.05)
+            assert client.get("a") is None
+        finally:
+            client.close()
+
+    def test_auth_select(self):
+        redis = FakeRedis(password="secret")
+        redis.start()
+        try:
+            client = RedisBackend(redis.url.replace("redis://", "redis://:secret@") + "/3", 1.0)
+            client.set("a", "1", 60)
+            client.close()
+            assert redis.commands[0] == ["AUTH", "secret"]
+            assert redis.commands[1] == ["SELECT", "3"]
+            other = RedisBackend(redis.url.replace("redis://", "redis://:secret@"), 1.0)
+            assert other.get("a") is None  # different db
+            other.close()
+            with pytest.raises(CacheError, match="WRONGPASS"):
+                RedisBackend(redis.url.replace("redis://", "redis://:wrong@"), 1.0).get("a")  # closed on failure
+        finally:
+            redis.stop()
+
+    def test_reconnect(self, redis):
+        client = RedisBackend(redis.url, 1.0)
+        try:
+            client.set("a", "1", 60)
+            client._idle[0].socket.shutdown(socket.SHUT_RDWR)  # as if the server had closed the connection
+            with pytest.raises(OSError):
+                client.get("a")
+            assert client.get("a") == "1"  # connected again
+        finally:
+            client.close()
+
+    def test_pool(self, redis):
+        client = RedisBackend(redis.url, 1.0, pool_size=2)
+        try:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                list(executor.map(lambda i: client.set("key-%d" % i, str(i), 60), range(20)))
+            assert 1 <= len(client._idle) <= 2  # connections opened for concurrent commands, but only a few kept
+            assert [client.get("key-%d" % i) for i in range(20)] == [str(i) for i in range(20)]
+        finally:
+            client.close()
+        assert not client._idle
+
+    def test_unavailable(self, redis):
+        url = redis.url
+        redis.stop()
+        client = RedisBackend(url, 0.5)
+        for _ in range(3):
+            with pytest.raises(OSError):
+                client.get("a")
+        assert client.breaker.state == CircuitState.OPEN
+        with pytest.raises(CacheError, match="is unavailable"):
+            client.get("a")  # fails fast, without trying to connect
+
+
+class TestCreateBackend:
+    def test_memory(self):
+        created = create_backend(CacheConfig(max_entries=5))
+        assert isinstance(created, MemoryBackend)
+        assert created.max_entries == 5
+
+    def test_file(self, tmpdir):
+        created = create_backend(CacheConfig(backend=CacheBackendType.FILE, path=str(tmpdir)))
+        assert isinstance(created, FileBackend)
+        assert created.path == str(tmpdir)
+
+    def test_file_no_path(self):
+        with pytest.raises(ConfigError, match="requires a path"):
+            create_backend(CacheConfig(backend=CacheBackendType.FILE))
+
+    def test_redis(self):
+        created = create_backend(CacheConfig(backend=CacheBackendType.REDIS, url="redis://cache", timeout_sec=0.25))
+        assert isinstance(created, RedisBackend)
+        assert created.timeout_sec == 0.25
+
+    def test_redis_no_url(self):
+        with pytest.raises(ConfigError, match="requires a url"):
+            create_backend(CacheConfig(backend=CacheBackendType.REDIS))
+
+
+class TestCache:
+    @pytest.mark.usefixtures("configured")
+    def test_namespaces(self):
+        first, second = Cache("first", 60), Cache("second", 60)
+        first.set("key", {"a": [1, 2]})
+        assert first.get("key") == {"a": [1, 2]}
+        assert second.get("key") is None
+        assert backend().get("sensortrack:first:key") == '{"a": [1, 2]}'
+
+    @pytest.mark.usefixtures("configured")
+    def test_add(self):
+        cache = Cache("deliveries", 60)
+        assert cache.add("key") is True
+        assert cache.add("key") is False
+        assert cache.get("key") is True
+        cache.delete("key")
+        assert cache.add("key", ttl_sec=-1) is True
+        assert cache.get("key") is None  # expired immediately
+
+    @patch("sensortrack.cache.backend")
+    def test_backend_failure(self, failing):
+        failing.return_value.get.side_effect = ConnectionError("down")
+        failing.return_value.set.side_effect = ConnectionError("down")
+        failing.return_value.add.side_effect = ConnectionError("down")
+        failing.return_value.delete.side_effect = ConnectionError("down")
+        cache = Cache("stations", 60)
+        assert cache.get("key") is None  # treated as a miss
+        cache.set("key", "value")
+        assert cache.add("key") is True  # as if missing, so the caller goes ahead
+        cache.delete("key")
+
+    def test_redis(self, configured, redis):
+        configured.return_value = MagicMock(cache=CacheConfig(backend=CacheBackendType.REDIS, url=redis.url))
+        cache = Cache("locations", 60)
+        cache.set("key", "value")
+        assert cache.get("key") == "value"
+        assert ["GET", "sensortrack:locations:key"] in redis.commands
+
+
+class TestSingleton:
+    @pytest.mark.usefixtures("configured")
+    def test_backend(self):
+        created = backend()
+        assert isinstance(created, MemoryBackend)
+        assert backend() is created
+        reset()
+        assert backend() is not created
+
+    def test_reset_closes_redis(self, configured, redis):
+        configured.return_value = MagicMock(cache=CacheConfig(backend=CacheBackendType.REDIS, url=redis.url))
+        created = backend()
+        created.set("a", "1", 60)
+        assert len(created._idle) == 1
+        reset()
+        assert not created._idle
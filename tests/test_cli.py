@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=too-many-positional-arguments:
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import pytest
+from influxdb_client.client.exceptions import InfluxDBError
+
+from sensortrack.backfill import BackfillResult
+from sensortrack.cli import main
+from sensortrack.config import ConfigError
+from sensortrack.export import ExportFormat
+from sensortrack.fakes import Faults
+from sensortrack.importer import BulkImportError, ImportResult
+from sensortrack.loadgen import LoadProfile
+from sensortrack.rest import RestDataError
+from sensortrack.sinks import WriteRejectedError
+
+
+@patch("sensortrack.cli.config")
+class TestMain:
+    @patch("sensortrack.cli.export")
+    def test_export(self, export, config, capsys):
+        export.return_value = 12
+        argv = ["--config", "app.yaml", "export", "--start", "2024-01-01", "--stop", "2024-01-02T00:00:00-05:00", "--output", "out"]
+        argv += ["--format", "parquet", "--measurement", "sensor", "--chunk-hours", "6", "--workers", "2"]
+        assert main(argv) == 0
+        config.assert_called_once_with("app.yaml")
+        export.assert_called_once_with(
+            output="out",
+            start=datetime(2024, 1, 1, tzinfo=timezone.utc),
+            stop=datetime(2024, 1, 2, tzinfo=timezone(timedelta(hours=-5))),
+            measurements=["sensor"],
+            file_format=ExportFormat.PARQUET,
+            chunk_sec=6 * 60 * 60,
+            workers=2,
+        )
+        assert capsys.readouterr().out == "Exported 12 row(s) to out\n"
+
+    @patch("sensortrack.cli.import_files")
+    def test_import(self, import_files, _config, capsys):
+        import_files.return_value = ImportResult(read=10, invalid=1, duplicate=2, written=7)
+        assert main(["import", "a.csv", "b.lp", "--batch-size", "100", "--rate", "500", "--no-dedup"]) == 0
+        import_files.assert_called_once_with(paths=["a.csv", "b.lp"], batch_size=100, workers=4, rate=500.0, deduplicate=False)
+        assert capsys.readouterr().out == "Read 10 row(s): wrote 7 reading(s), skipped 1 invalid and 2 duplicate\n"
+
+    @patch("sensortrack.cli.import_files")
+    def test_import_error(self, import_files, _config, capsys):
+        import_files.side_effect = BulkImportError("bad file")
+        assert main(["import", "a.csv"]) == 1
+        assert capsys.readouterr().err == "Error: bad file\n"
+
+    @patch("sensortrack.cli.import_files")
+    def test_import_rejected(self, import_files, _config, capsys):
+        import_files.side_effect = WriteRejectedError("Queue for InfluxDB destination default is full")
+        assert main(["import", "a.csv"]) == 1
+        assert capsys.readouterr().err == "Error: Queue for InfluxDB destination default is full\n"
+
+    @patch("sensortrack.cli.backfill_weather")
+    def test_backfill_weather(self, backfill_weather, _config, capsys):
+        backfill_weather.return_value = BackfillResult(observed=10, present=3, invalid=1, written=6)
+        argv = ["backfill-weather", "--location", "l", "--latitude", "12.3", "--longitude", "-45.6"]
+        assert main(argv + ["--start", "2024-01-01", "--end", "2024-01-02"]) == 0
+        backfill_weather.assert_called_once_with(
+            location_id="l",
+            latitude=12.3,
+            longitude=-45.6,
+            start=datetime(2024, 1, 1, tzinfo=timezone.utc),
+            end=datetime(2024, 1, 2, tzinfo=timezone.utc),
+            batch_size=500,
+        )
+        assert capsys.readouterr().out == "Retrieved 10 observation(s): wrote 6, skipped 3 already present and 1 invalid\n"
+
+    @patch("sensortrack.cli.backfill_weather")
+    def test_backfill_weather_error(self, backfill_weather, _config, capsys):
+        backfill_weather.side_effect = RestDataError("no stations")
+        argv = ["backfill-weather", "--location", "l", "--latitude", "12.3", "--longitude", "-45.6"]
+        assert main(argv + ["--start", "2024-01-01", "--end", "2024-01-02"]) == 1
+        assert capsys.readouterr().err == "Error: no stations\n"
+
+    @patch("sensortrack.cli.LoadGenerator")
+    @patch("sensortrack.cli.FakeKeyServer")
+    @patch("sensortrack.cli.load_key")
+    def test_loadgen(self, load_key, keyserver, generator, config, capsys):
+        keyserver.return_value.url = "http://localhost:8090"
+        generator.return_value.run.return_value.summary.return_value = "summary"
+        assert main(["loadgen", "--rate", "50", "--duration", "5", "--devices", "20", "--batch-size", "3"]) == 0
+        config.assert_not_called()  # the load generator doesn't need server configuration
+        keyserver.assert_called_once_with(load_key.return_value, "/loadgen", port=8090)
+        keyserver.return_value.stop.assert_called_once()
+        url, requests, signer = generator.call_args[0]
+        assert url == "http://localhost:8080/smartapp"
+        assert requests.profile == LoadProfile(locations=1, devices=20, batch_size=3, timer_ratio=0.0)
+        assert signer.path == "/smartthings/sensortrack/smartapp"
+        generator.return_value.run.assert_called_once_with(rate=50.0, duration_sec=5.0)
+        assert capsys.readouterr().out.endswith("summary\n")
+
+    @patch("sensortrack.cli.time")
+    @patch("sensortrack.cli.load_key")
+    @patch("sensortrack.cli.FakeKeyServer")
+    @patch("sensortrack.cli.FakeInfluxDb")
+    @patch("sensortrack.cli.FakeWeather")
+    @patch("sensortrack.cli.FakeSmartThings")
+    def test_fakes(self, smartthings, weather, influxdb, keyserver, load_key, time, config):
+        time.sleep.side_effect = KeyboardInterrupt()
+        assert main(["fakes", "--devices", "50", "--latency-ms", "20", "--error-rate", "0.01", "--throttle-rate", "100"]) == 0
+        config.assert_not_called()
+        faults = Faults(latency_sec=0.02, error_rate=0.01, throttle_rate=100.0)
+        smartthings.assert_called_once_with(devices=50, port=8091, faults=faults)
+        weather.assert_called_once_with(fixture_dir=None, port=8092, faults=faults)
+        influxdb.assert_called_once_with(port=8093, faults=faults)
+        keyserver.assert_called_once_with(load_key.return_value, "/loadgen", port=8090, faults=faults)
+        for fake in (smartthings, weather, influxdb, keyserver):
+            fake.return_value.start.assert_called_once()
+            fake.return_value.stop.assert_called_once()
+
+    @patch("sensortrack.cli.benchmark")
+    @patch("sensortrack.cli.FakeKeyServer")
+    @patch("sensortrack.cli.load_key")
+    def test_coldstart(self, load_key, keyserver, benchmark, config, capsys):
+        benchmark.return_value.summary.return_value = "summary"
+        assert main(["--config", "app.yaml", "coldstart", "--runs", "3"]) == 0
+        config.assert_not_called()  # the benchmark loads configuration in each fresh interpreter instead
+        keyserver.assert_called_once_with(load_key.return_value, "/loadgen", port=8090)
+        keyserver.return_value.stop.assert_called_once()
+        signer = benchmark.call_args[0][0]
+        assert signer.path == "/smartthings/sensortrack/smartapp"
+        assert benchmark.call_args[1] == {"runs": 3, "config_path": "app.yaml"}
+        assert capsys.readouterr().out == "summary\n"
+
+    def test_config_error(self, config, capsys):
+        config.side_effect = ConfigError("bad config")
+        assert main(["export", "--start", "2024-01-01", "--stop", "2024-01-02", "--output", "out"]) == 1
+        assert capsys.readouterr().err == "Error: bad config\n"
+
+    def test_invalid_timestamp(self, _config):
+        with pytest.raises(SystemExit):
+            main(["export", "--start", "yesterday", "--stop", "2024-01-02", "--output", "out"])
+
+    @pytest.mark.parametrize("option", ["--chunk-hours", "--workers"])
+    def test_export_not_positive(self, _config, capsys, option):
+        with pytest.raises(SystemExit):
+            main(["export", "--start", "2024-01-01", "--stop", "2024-01-02", "--output", "out", option, "0"])
+        assert "must be greater than zero: 0" in capsys.readouterr().err
+
+    @patch("sensortrack.cli.export")
+    def test_export_influxdb_error(self, export, _config, capsys):
+        export.side_effect = InfluxDBError(message="unauthorized access")
+        assert main(["export", "--start", "2024-01-01", "--stop", "2024-01-02", "--output", "out"]) == 1
+        assert capsys.readouterr().err == "Error: InfluxDB error: unauthorized access\n"
+
+    @patch("sensortrack.cli.export")
+    def test_export_os_error(self, export, _config, capsys):
+        export.side_effect = PermissionError(13, "Permission denied", "out")
+        assert main(["export", "--start", "2024-01-01", "--stop", "2024-01-02", "--output", "out"]) == 1
+        assert capsys.readouterr().err == "Error: [Errno 13] Permission denied: 'out'\n"
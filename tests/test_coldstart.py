@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+import json
+import os
+
+from Cryptodome.PublicKey import RSA
+
+from sensortrack.coldstart import ColdStartReport, benchmark, configuration_event
+from sensortrack.loadgen import RequestSigner
+
+KEY = RSA.generate(1024)
+SIGNER = RequestSigner(KEY, target_url="https://example.com/smartapp")
+FAKES_CONFIG = os.path.join(os.path.dirname(__file__), "..", "config", "local", "sensortrack", "server", "application-fakes.yaml")
+
+
+class TestConfigurationEvent:
+    def test_configuration_event(self):
+        event = configuration_event(SIGNER)
+        assert event["isBase64Encoded"] is False
+        assert event["headers"]["Authorization"].startswith('Signature keyId="/loadgen"')
+        request = json.loads(event["body"])
+        assert request["lifecycle"] == "CONFIGURATION"
+        assert request["configurationData"]["phase"] == "INITIALIZE"
+
+
+class TestColdStartReport:
+    def test_summary(self):
+        report = ColdStartReport(imports=[0.1, 0.3, 0.2], first_requests=[0.5, 0.4, 0.6], statuses=[200, 200, 200], loaded=[])
+        assert report.summary() == "\n".join(
+            [
+                "Runs: 3, status codes: 200",
+                "Import (ms): median=200.0 min=100.0 max=300.0",
+                "First request (ms): median=500.0 min=400.0 max=600.0",
+                "Avoided modules loaded: none",
+            ]
+        )
+
+
+class TestBenchmark:
+    def test_benchmark(self, tmp_path):
+        # Signatures aren't checked, so this needs no key server, and a CONFIGURATION request needs no other upstreams
+        with open(FAKES_CONFIG, "r", encoding="utf-8") as fp:
+            config = fp.read().replace("checkSignatures: true", "checkSignatures: false")
+        path = tmp_path / "application.yaml"
+        path.write_text(config)
+        report = benchmark(SIGNER, runs=2, config_path=str(path))
+        assert report.statuses == [200, 200]
+        assert report.loaded == []
+        assert len(report.imports) == 2 and all(value > 0 for value in report.imports)
+        assert len(report.first_requests) == 2 and all(value > 0 for value in report.first_requests)
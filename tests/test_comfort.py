@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+
+import pytest
+
+from sensortrack.comfort import Comfort, ComfortJoin, comfort, dew_point, heat_index, reset
+
+
+class TestFormulas:
+    @pytest.mark.parametrize(
+        "temperature,humidity,expected",
+        [
+            (70.0, 50.0, 50.51),
+            (90.0, 60.0, 74.25),
+            (50.0, 100.0, 50.0),
+            (78.9, 10.2, 18.15),
+        ],
+    )
+    def test_dew_point(self, temperature, humidity, expected):
+        assert dew_point(temperature, humidity) == expected
+
+    @pytest.mark.parametrize(
+        "temperature,humidity,expected",
+        [
+            (70.0, 50.0, 69.05),  # simple formula, below 80F
+            (32.0, 50.0, 27.25),  # simple formula, below 80F
+            (90.0, 60.0, 99.68),  # full regression, close to 100F in the NWS table
+            (96.0, 10.0, 90.36),  # low humidity adjustment
+            (85.0, 90.0, 101.78),  # high humidity adjustment
+        ],
+    )
+    def test_heat_index(self, temperature, humidity, expected):
+        assert heat_index(temperature, humidity) == expected
+
+
+class TestComfortJoin:
+    def test_update(self):
+        target = ComfortJoin()
+        assert target.update("l", "d", "temperature", 70.0) is None
+        assert target.update("l", "e", "humidity", 50.0) is None
+        assert target.update("l", "d", "battery", 50.0) is None
+        assert target.update("l", "d", "humidity", 50.0) == Comfort(dew_point=50.51, heat_index=69.05)
+        assert target.update("l", "d", "temperature", 90.0) == Comfort(dew_point=68.87, heat_index=94.6)
+
+    def test_update_celsius(self):
+        target = ComfortJoin()
+        assert target.update("l", "d", "temperature", 21.0, timestamp=1000.0, unit="C") is None
+        assert target.update("l", "d", "humidity", 50.0, timestamp=1010.0, unit="%") == Comfort(
+            dew_point=10.18, heat_index=20.46
+        )  # in C
+        assert target.update("l", "d", "temperature", 69.8, timestamp=1020.0, unit="F") == Comfort(
+            dew_point=50.33, heat_index=68.83
+        )  # in F
+
+    def test_update_unknown_unit(self):
+        target = ComfortJoin()
+        target.update("l", "d", "humidity", 50.0, timestamp=1000.0)
+        assert target.update("l", "d", "temperature", 294.0, timestamp=1000.0, unit="K") is None
+
+    def test_update_max_age(self):
+        target = ComfortJoin(max_age_sec=600)
+        target.update("l", "d", "temperature", 70.0, timestamp=1000.0)
+        assert target.update("l", "d", "humidity", 50.0, timestamp=1601.0) is None  # temperature is too old to pair with
+        assert target.update("l", "d", "temperature", 70.0, timestamp=1700.0) == Comfort(dew_point=50.51, heat_index=69.05)
+
+    def test_fields(self):
+        assert Comfort(dew_point=1.0, heat_index=2.0).fields() == [("dew_point", 1.0), ("heat_index", 2.0)]
+
+    def test_eviction(self):
+        target = ComfortJoin(max_devices=2)
+        target.update("l", "a", "temperature", 70.0)
+        target.update("l", "b", "temperature", 70.0)
+        target.update("l", "a", "temperature", 71.0)  # a is now most recently updated
+        target.update("l", "c", "temperature", 70.0)  # evicts b
+        assert target.update("l", "a", "humidity", 50.0) is not None
+        assert target.update("l", "b", "humidity", 50.0) is None
+
+
+class TestSingleton:
+    def test_comfort(self):
+        reset()
+        result = comfort()
+        assert result is comfort()
+        reset()
+        assert comfort() is not result
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from sensortrack.compression import Compressor, compressor, reset
+from sensortrack.config import CompressionConfig, CompressionMethod
+
+KEY = ("l", "d", "temperature")
+
+
+def _offer_all(target, readings):
+    written = []
+    for timestamp, value in readings:
+        written.extend(target.offer(KEY, timestamp, value))
+    return written
+
+
+class TestDeadband:
+    def test_deadband(self):
+        target = Compressor(CompressionMethod.DEADBAND, deviation=0.5, max_interval_sec=1000)
+        readings = [(0.0, 70.0), (10.0, 70.2), (20.0, 70.5), (30.0, 70.6), (40.0, 69.4), (50.0, 69.5)]
+        assert _offer_all(target, readings) == [(0.0, 70.0), (30.0, 70.6), (40.0, 69.4)]
+
+    def test_heartbeat(self):
+        target = Compressor(CompressionMethod.DEADBAND, deviation=0.5, max_interval_sec=100)
+        readings = [(0.0, 70.0), (50.0, 70.0), (100.0, 70.0), (150.0, 70.0), (200.0, 70.0)]
+        assert _offer_all(target, readings) == [(0.0, 70.0), (100.0, 70.0), (200.0, 70.0)]
+
+
+class TestSwingingDoor:
+    def test_linear_trend(self):
+        # A perfectly linear series can be represented by its endpoints, so nothing after the first point is written
+        target = Compressor(CompressionMethod.SWINGING_DOOR, deviation=0.1, max_interval_sec=1000)
+        readings = [(float(t), 70.0 + t / 10) for t in range(0, 100, 10)]
+        assert _offer_all(target, readings) == [(0.0, 70.0)]
+        assert target.flush() == [(KEY, (90.0, 79.0))]
+        assert not target.flush()
+
+    def test_change_in_direction(self):
+        target = Compressor(CompressionMethod.SWINGING_DOOR, deviation=0.1, max_interval_sec=1000)
+        readings = [(0.0, 70.0), (10.0, 71.0), (20.0, 72.0), (30.0, 71.0), (40.0, 70.0)]
+        assert _offer_all(target, readings) == [(0.0, 70.0), (20.0, 72.0)]  # the peak is archived with its original timestamp
+        assert target.flush() == [(KEY, (40.0, 70.0))]
+
+    def test_error_bound(self):
+        # Interpolating between the written points must stay within the deviation of every reading
+        deviation = 0.25
+        target = Compressor(CompressionMethod.SWINGING_DOOR, deviation=deviation, max_interval_sec=10000)
+        readings = [(float(t), 70.0 + ((t * 7919) % 13) / 10) for t in range(200)]
+        written = _offer_all(target, readings) + [reading for _, reading in target.flush()]
+        assert len(written) < len(readings)
+        for timestamp, value in readings:
+            for (t0, v0), (t1, v1) in zip(written, written[1:]):
+                if t0 <= timestamp <= t1:
+                    expected = v0 + (v1 - v0) * (timestamp - t0) / (t1 - t0)
+                    assert abs(expected - value) <= deviation + 1e-9
+                    break
+
+    @pytest.mark.parametrize(
+        "readings",
+        [
+            [(0.0, 0.0), (1.0, 0.0), (2.0, 3.0), (3.0, -10.0)],  # the held reading at 2 lies outside the doors
+            [(float(t), ((t * 7919) % 13) - 6.0) for t in range(200)],
+            [(float(t), ((t * 104729) % 17) * (-1) ** t) for t in range(200)],
+        ],
+    )
+    def test_error_bound_dropped(self, readings):
+        # Every reading that wasn't written must be within the deviation of the line between its neighbouring written points
+        deviation = 1.0
+        target = Compressor(CompressionMethod.SWINGING_DOOR, deviation=deviation, max_interval_sec=10000)
+        written = _offer_all(target, readings) + [reading for _, reading in target.flush()]
+        for timestamp, value in readings:
+            (t0, v0), (t1, v1) = max(r for r in written if r[0] <= timestamp), min(r for r in written if r[0] >= timestamp)
+            expected = v0 if t1 == t0 else v0 + (v1 - v0) * (timestamp - t0) / (t1 - t0)
+            assert abs(expected - value) <= deviation + 1e-9
+
+    def test_held_outside_doors(self):
+        target = Compressor(CompressionMethod.SWINGING_DOOR, deviation=1.0, max_interval_sec=1000)
+        assert _offer_all(target, [(0.0, 0.0), (1.0, 0.0), (2.0, 3.0), (3.0, -10.0)]) == [(0.0, 0.0), (2.0, 2.0)]
+
+    def test_heartbeat(self):
+        target = Compressor(CompressionMethod.SWINGING_DOOR, deviation=0.5, max_interval_sec=100)
+        readings = [(0.0, 70.0), (50.0, 70.0), (100.0, 70.0), (150.0, 70.0)]
+        assert _offer_all(target, readings) == [(0.0, 70.0), (50.0, 70.0), (100.0, 70.0)]  # the held reading is written too
+
+    def test_heartbeat_error_bound(self):
+        # Without the held reading, interpolating from (0, 0.0) to (900, 10.0) would give 9.33 at 840, where the reading was 0.0
+        target = Compressor(CompressionMethod.SWINGING_DOOR, deviation=0.5, max_interval_sec=900)
+        readings = [(float(t), 0.0) for t in range(0, 900, 60)] + [(900.0, 10.0)]
+        assert _offer_all(target, readings) == [(0.0, 0.0), (840.0, 0.0), (900.0, 10.0)]
+
+    def test_duplicate_timestamp(self):
+        target = Compressor(CompressionMethod.SWINGING_DOOR, deviation=0.5, max_interval_sec=100)
+        assert _offer_all(target, [(0.0, 70.0), (0.0, 75.0)]) == [(0.0, 70.0)]
+        assert target.dropped == 1
+
+
+class TestSeries:
+    def test_series_are_independent(self):
+        target = Compressor(CompressionMethod.DEADBAND, deviation=0.5, max_interval_sec=1000)
+        assert target.offer(("l", "a", "temperature"), 0.0, 70.0) == [(0.0, 70.0)]
+        assert target.offer(("l", "b", "temperature"), 0.0, 70.0) == [(0.0, 70.0)]
+        assert target.offer(("l", "a", "humidity"), 0.0, 70.0) == [(0.0, 70.0)]
+
+    def test_restore(self):
+        target = Compressor(CompressionMethod.SWINGING_DOOR, deviation=0.1, max_interval_sec=1000)
+        target.offer(KEY, 0.0, 70.0)
+        target.offer(KEY, 10.0, 71.0)
+        saved = {}
+        assert target.offer(KEY, 20.0, 70.0, saved) == [(10.0, 71.0)]
+        assert target.offer(("l", "new", "temperature"), 20.0, 70.0, saved) == [(20.0, 70.0)]
+        target.restore(saved)  # as if the write had failed
+        assert target.offer(KEY, 20.0, 70.0) == [(10.0, 71.0)]  # the same reading gives the same result
+        assert target.offer(("l", "new", "temperature"), 20.0, 70.0) == [(20.0, 70.0)]  # and the new series is new again
+
+    def test_restore_flush(self):
+        target = Compressor(CompressionMethod.SWINGING_DOOR, deviation=0.1, max_interval_sec=1000)
+        target.offer(KEY, 0.0, 70.0)
+        target.offer(KEY, 10.0, 71.0)
+        saved = {}
+        assert target.flush(saved) == [(KEY, (10.0, 71.0))]
+        target.restore(saved)
+        assert target.flush() == [(KEY, (10.0, 71.0))]
+
+    def test_max_series(self):
+        target = Compressor(CompressionMethod.DEADBAND, deviation=0.5, max_interval_sec=1000, max_series=1)
+        target.offer(("l", "a", "temperature"), 0.0, 70.0)
+        target.offer(("l", "b", "temperature"), 0.0, 70.0)
+        assert target.offer(("l", "a", "temperature"), 10.0, 70.0) == [(10.0, 70.0)]  # forgotten, so treated as new
+
+
+@patch("sensortrack.compression.config")
+class TestSingleton:
+    @pytest.fixture(autouse=True)
+    def cleanup(self):
+        """Reset singleton before and after tests."""
+        reset()
+        yield
+        reset()
+
+    def test_disabled(self, config):
+        config.return_value = MagicMock(compression=None)
+        assert compressor() is None
+        assert compressor() is None
+        config.assert_called_once()
+
+    def test_enabled(self, config):
+        config.return_value = MagicMock(
+            compression=CompressionConfig(method=CompressionMethod.DEADBAND, deviation=0.5, max_interval_sec=60)
+        )
+        result = compressor()
+        assert result is compressor()
+        assert result.method == CompressionMethod.DEADBAND
+        assert result.deviation == 0.5
+        assert result.max_interval_sec == 60
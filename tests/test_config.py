@@ -6,7 +6,38 @@
 import pytest
 from smartapp.interface import SmartAppDispatcherConfig
 
-from sensortrack.config import ConfigError, InfluxDbConfig, ServerConfig, SmartThingsApiConfig, WeatherApiConfig, config, reset
+from sensortrack.config import (
+    AdmissionConfig,
+    AdmissionLimitConfig,
+    AggregationConfig,
+    AlertCondition,
+    AlertRuleConfig,
+    AlertsConfig,
+    AlertSinkConfig,
+    AlertSinkType,
+    CacheBackendType,
+    CacheConfig,
+    ColumnarFormat,
+    ColumnarSinkConfig,
+    CompressionConfig,
+    CompressionMethod,
+    ConfigError,
+    DataApiConfig,
+    InfluxDbConfig,
+    InfluxDbRouteConfig,
+    LoggingConfig,
+    OverflowPolicy,
+    QuotaConfig,
+    ReadinessConfig,
+    RollupConfig,
+    ServerConfig,
+    SinksConfig,
+    SmartThingsApiConfig,
+    WarmupConfig,
+    WeatherApiConfig,
+    config,
+    reset,
+)
 
 
 def fixture(filename: str) -> str:
@@ -106,5 +137,57 @@ def _validate_config(result):
                 org=INFLUXDB_ORG,
                 token=INFLUXDB_TOKEN,
                 bucket=INFLUXDB_BUCKET,
+                rollups=[
+                    RollupConfig(bucket="%s_5m" % INFLUXDB_BUCKET, every="5m"),
+                    RollupConfig(bucket="%s_1h" % INFLUXDB_BUCKET, every="1h", retention_sec=31536000),
+                ],
+                routes=[
+                    InfluxDbRouteConfig(
+                        name="cabin",
+                        location="cabin-location",
+                        measurement="sensor_1m",
+                        bucket="cabin",
+                        batch_size=100,
+                        flush_interval_sec=0.5,
+                    ),
+                ],
             ),
+            compression=CompressionConfig(method=CompressionMethod.SWINGING_DOOR, deviation=0.5, max_interval_sec=600),
+            aggregation=AggregationConfig(window_sec=300, measurement="sensor_5m", keep_raw=True),
+            alerts=AlertsConfig(
+                rules=[
+                    AlertRuleConfig(name="freezing", attribute="temperature", condition=AlertCondition.BELOW, threshold=40.0),
+                    AlertRuleConfig(
+                        name="spike",
+                        attribute="humidity",
+                        condition=AlertCondition.ANOMALY,
+                        threshold=4.0,
+                        device="d",
+                        alpha=0.2,
+                        min_samples=10,
+                        cooldown_sec=60,
+                    ),
+                ],
+                sinks=[AlertSinkConfig(type=AlertSinkType.LOG), AlertSinkConfig(type=AlertSinkType.FILE, path="alerts.json")],
+                queue_size=100,
+            ),
+            sinks=SinksConfig(
+                influxdb=False,
+                columnar=ColumnarSinkConfig(path="/tmp/columnar", format=ColumnarFormat.ARROW, max_rows=500, max_age_sec=60),
+            ),
+            logging=LoggingConfig(queue_size=5000, body_sample_rate=0.01),
+            admission=AdmissionConfig(
+                limits={
+                    "EVENT": AdmissionLimitConfig(concurrency=16, queue_depth=64),
+                    "default": AdmissionLimitConfig(concurrency=4),
+                },
+                queue_timeout_sec=2.5,
+            ),
+            quotas=QuotaConfig(
+                points_per_sec=2.5, burst=50, max_series=200, overflow=OverflowPolicy.SPOOL, spool_path="/tmp/spool"
+            ),
+            readiness=ReadinessConfig(interval_sec=30, timeout_sec=2.5, max_pending_points=1000),
+            warmup=WarmupConfig(budget_sec=20),
+            cache=CacheConfig(backend=CacheBackendType.FILE, path="/tmp/cache", max_entries=5000),
+            data_api=DataApiConfig(token="secret"),
         )
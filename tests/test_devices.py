@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+from unittest.mock import patch
+
+import pytest
+
+from sensortrack.devices import DeviceDirectory, DeviceInfo, directory, normalize_tag, refresh_directory, reset
+from sensortrack.smartthings import Device, Room
+
+
+class TestNormalizeTag:
+    @pytest.mark.parametrize(
+        "value,expected",
+        [
+            ("Kitchen", "Kitchen"),
+            ("  Kitchen   Sensor ", "Kitchen Sensor"),
+            ("x" * 100, "x" * 64),
+        ],
+    )
+    def test_normalize_tag(self, value, expected):
+        assert normalize_tag(value) == expected
+
+
+@patch("sensortrack.devices.time")
+class TestDeviceDirectory:
+    def test_tags(self, time):
+        time.time.return_value = 1000.0
+        target = DeviceDirectory()
+        target.populate("l", {"d": DeviceInfo(name=" Kitchen  Sensor", room="Kitchen"), "e": DeviceInfo(name="Garage")})
+        assert target.tags("l", "d") == {"device_name": "Kitchen Sensor", "room": "Kitchen"}
+        assert target.tags("l", "e") == {"device_name": "Garage"}
+        assert not target.tags("l", "f")
+        assert not target.tags("m", "d")
+
+    def test_populate_replaces(self, time):
+        time.time.return_value = 1000.0
+        target = DeviceDirectory()
+        target.populate("l", {"d": DeviceInfo(name="Kitchen"), "e": DeviceInfo(name="Garage")})
+        target.populate("m", {"d": DeviceInfo(name="Cabin")})
+        target.populate("l", {"d": DeviceInfo(name="Pantry")})
+        assert target.tags("l", "d") == {"device_name": "Pantry"}
+        assert not target.tags("l", "e")
+        assert target.tags("m", "d") == {"device_name": "Cabin"}
+
+    def test_max_devices(self, time):
+        time.time.return_value = 1000.0
+        target = DeviceDirectory(max_devices=2)
+        target.populate("l", {"d": DeviceInfo(name="Kitchen")})
+        target.populate("m", {"d": DeviceInfo(name="Cabin"), "e": DeviceInfo(name="Porch")})
+        assert not target.tags("l", "d")
+        assert target.tags("m", "d") == {"device_name": "Cabin"}
+
+    def test_is_stale(self, time):
+        target = DeviceDirectory(ttl_sec=1000, retry_sec=100)
+        assert target.is_stale("l") is True
+        time.time.return_value = 1000.0
+        target.populate("l", {"d": DeviceInfo(name="Kitchen")})
+        time.time.return_value = 1999.0
+        assert target.is_stale("l") is False
+        time.time.return_value = 2000.0
+        assert target.is_stale("l") is True
+
+    def test_is_stale_unknown_device(self, time):
+        target = DeviceDirectory(ttl_sec=1000, retry_sec=100)
+        time.time.return_value = 1000.0
+        target.populate("l", {"d": DeviceInfo(name="Kitchen")})
+        target.tags("l", "e")
+        time.time.return_value = 1099.0
+        assert target.is_stale("l") is False
+        time.time.return_value = 1100.0
+        assert target.is_stale("l") is True
+
+    def test_failed(self, time):
+        target = DeviceDirectory(ttl_sec=1000, retry_sec=100)
+        time.time.return_value = 1000.0
+        target.failed("l")
+        time.time.return_value = 1099.0
+        assert target.is_stale("l") is False
+        time.time.return_value = 1100.0
+        assert target.is_stale("l") is True
+
+    def test_claim_refresh(self, time):
+        target = DeviceDirectory(ttl_sec=1000, retry_sec=100)
+        time.time.return_value = 1000.0
+        assert target.claim_refresh("l") is True
+        assert target.claim_refresh("l") is False  # already being refreshed
+        target.populate("l", {"d": DeviceInfo(name="Kitchen")})
+        assert target.claim_refresh("l") is False  # not stale
+        time.time.return_value = 2000.0
+        assert target.claim_refresh("l") is True
+        target.failed("l")
+        assert target.claim_refresh("l") is False  # not until the retry interval
+        time.time.return_value = 2100.0
+        assert target.claim_refresh("l") is True
+
+
+class TestSingleton:
+    @pytest.fixture(autouse=True)
+    def cleanup(self):
+        """Reset singleton before and after tests."""
+        reset()
+        yield
+        reset()
+
+    def test_directory(self):
+        result = directory()
+        assert result is directory()
+
+    @patch("sensortrack.devices.retrieve_devices")
+    @patch("sensortrack.devices.retrieve_rooms")
+    def test_refresh_directory(self, retrieve_rooms, retrieve_devices):
+        retrieve_rooms.return_value = [Room(room_id="r", name="Kitchen")]
+        retrieve_devices.return_value = [
+            Device(device_id="d", label="Kitchen Sensor", room_id="r"),
+            Device(device_id="e", label="Garage Sensor", room_id=None),
+            Device(device_id="f", label="Porch Sensor", room_id="unknown"),
+        ]
+        refresh_directory("l")
+        assert directory().tags("l", "d") == {"device_name": "Kitchen Sensor", "room": "Kitchen"}
+        assert directory().tags("l", "e") == {"device_name": "Garage Sensor"}
+        assert directory().tags("l", "f") == {"device_name": "Porch Sensor"}
+        assert directory().is_stale("l") is False
@@ -5,7 +5,7 @@
 import pytest
 from smartapp.interface import SmartAppDispatcherConfig
 
-from sensortrack.dispatcher import dispatcher, reset
+from sensortrack.dispatcher import definition, definition_version, dispatcher, reset
 from sensortrack.handler import EventHandler
 
 
@@ -30,3 +30,13 @@ def test_dispatcher(self, config):
 
         # Confirm that event handler is set as expected
         assert isinstance(dispatcher().event_handler, EventHandler)
+
+    def test_definition(self):
+        assert definition().id == "sensortrack"
+        assert definition().target_url.endswith("/smartthings/sensortrack/smartapp")
+
+    def test_definition_version(self):
+        version = definition_version()
+        assert len(version) == 64  # SHA-256 digest of the definition file
+        reset()
+        assert definition_version() == version  # reloading an unchanged file gives the same version
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+import csv
+import json
+import os
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+from attrs import evolve
+
+from sensortrack.config import InfluxDbConfig, InfluxDbRouteConfig
+from sensortrack.export import CHECKPOINT_FILE, COLUMNS, ExportError, ExportFormat, chunks, export, export_flux
+
+INFLUXDB = InfluxDbConfig(url="url", org="org", token="token", bucket="bucket")
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+STOP = datetime(2024, 1, 3, 12, tzinfo=timezone.utc)
+DAY = 24 * 60 * 60
+
+
+def _record(stamp, device, value, **tags):
+    values = {"_time": stamp, "_measurement": "sensor", "_field": "temperature", "_value": value, "location": "l", "device": device}
+    values.update(tags)
+    return MagicMock(values=values)
+
+
+def _stub_influxdb(influxdb, records):
+    # Ugh, the stubbing for a context manager is hideous
+    query_stream = MagicMock(side_effect=lambda query, org: iter(records))
+    influxdb.return_value = MagicMock(
+        __enter__=MagicMock(
+            return_value=MagicMock(
+                query_api=MagicMock(
+                    return_value=MagicMock(query_stream=query_stream),
+                ),
+            ),
+        ),
+    )
+    return query_stream
+
+
+class TestChunks:
+    def test_chunks(self):
+        start = int(START.timestamp())
+        assert chunks(START, STOP, DAY) == [
+            (start, start + DAY),
+            (start + DAY, start + 2 * DAY),
+            (start + 2 * DAY, start + 2 * DAY + DAY // 2),
+        ]
+
+    def test_empty(self):
+        assert not chunks(START, START, DAY)
+
+    def test_flux(self):
+        start = int(START.timestamp())
+        assert export_flux("bucket", ["sensor", "weather"], (start, start + DAY)) == (
+            'from(bucket: "bucket")\n'
+            "  |> range(start: 2024-01-01T00:00:00Z, stop: 2024-01-02T00:00:00Z)\n"
+            '  |> filter(fn: (r) => r._measurement == "sensor" or r._measurement == "weather")\n'
+            '  |> sort(columns: ["_time"])'
+        )
+
+
+@patch("sensortrack.export.config", MagicMock(return_value=MagicMock(influxdb=INFLUXDB)))
+@patch("sensortrack.export.InfluxDBClient")
+class TestExport:
+    def test_csv(self, influxdb, tmp_path):
+        query_stream = _stub_influxdb(
+            influxdb, [_record(START, "d", 70.5, device_name="Den", room="Office"), _record(START, "e", 71.0)]
+        )
+        assert export(str(tmp_path), START, STOP, workers=2) == 6  # 2 rows for each of 3 chunks
+        assert query_stream.call_count == 3
+        influxdb.assert_called_with(url="url", org="org", token="token")
+        with open(tmp_path / "part-20240101T000000Z.csv", "r", encoding="utf-8", newline="") as fp:
+            rows = list(csv.reader(fp))
+        assert rows == [
+            COLUMNS,
+            ["2024-01-01T00:00:00+00:00", "sensor", "l", "d", "Den", "Office", "temperature", "70.5"],
+            ["2024-01-01T00:00:00+00:00", "sensor", "l", "e", "", "", "temperature", "71.0"],
+        ]
+        assert sorted(os.listdir(tmp_path)) == [
+            CHECKPOINT_FILE,
+            "part-20240101T000000Z.csv",
+            "part-20240102T000000Z.csv",
+            "part-20240103T000000Z.csv",
+        ]
+
+    def test_routes(self, influxdb, tmp_path):
+        routes = [InfluxDbRouteConfig(name="cabin", location="cabin", url="http://cabin:8086")]
+        with patch("sensortrack.export.config", MagicMock(return_value=MagicMock(influxdb=evolve(INFLUXDB, routes=routes)))):
+            query_stream = _stub_influxdb(influxdb, [_record(START, "d", 70.5)])
+            assert export(str(tmp_path), START, START.replace(hour=12)) == 2  # one row from each destination
+        assert query_stream.call_count == 2
+        assert [call.kwargs["url"] for call in influxdb.call_args_list] == ["url", "http://cabin:8086"]
+
+    def test_resume(self, influxdb, tmp_path):
+        query_stream = _stub_influxdb(influxdb, [_record(START, "d", 70.5)])
+        export(str(tmp_path), START, STOP)
+        checkpoint = json.loads((tmp_path / CHECKPOINT_FILE).read_text(encoding="utf-8"))
+        start = int(START.timestamp())
+        assert checkpoint["completed"] == [start, start + DAY, start + 2 * DAY]
+
+        # simulate an interruption after the first chunk completed
+        checkpoint["completed"] = [start]
+        (tmp_path / CHECKPOINT_FILE).write_text(json.dumps(checkpoint), encoding="utf-8")
+        query_stream.reset_mock()
+        assert export(str(tmp_path), START, STOP) == 2
+        assert query_stream.call_count == 2
+        assert "2024-01-01T00:00:00Z" not in "".join(call.args[0] for call in query_stream.call_args_list)
+
+    def test_checkpoint_mismatch(self, influxdb, tmp_path):
+        _stub_influxdb(influxdb, [])
+        export(str(tmp_path), START, STOP)
+        with pytest.raises(ExportError, match="different export"):
+            export(str(tmp_path), START, STOP, chunk_sec=DAY // 2)
+
+    def test_failure(self, influxdb, tmp_path):
+        query_stream = _stub_influxdb(influxdb, [])
+        query_stream.side_effect = Exception("hello")
+        with pytest.raises(Exception, match="hello"):
+            export(str(tmp_path), START, STOP)
+        assert not os.listdir(tmp_path)  # no part files or checkpoint, only completed chunks are recorded
+
+    def test_invalid_measurement(self, _influxdb, tmp_path):
+        with pytest.raises(ExportError, match="Invalid measurement"):
+            export(str(tmp_path), START, STOP, measurements=['sensor" or true'])
+
+    def test_not_positive(self, _influxdb, tmp_path):
+        with pytest.raises(ExportError, match="Chunk size must be greater than zero"):
+            export(str(tmp_path), START, STOP, chunk_sec=0)
+        with pytest.raises(ExportError, match="Number of workers must be greater than zero"):
+            export(str(tmp_path), START, STOP, workers=0)
+
+    def test_pyarrow_missing(self, _influxdb, tmp_path):
+        with patch("sensortrack.export.find_spec", MagicMock(return_value=None)):
+            with pytest.raises(ExportError, match="requires pyarrow"):
+                export(str(tmp_path), START, STOP, file_format=ExportFormat.PARQUET)
+
+    def test_parquet(self, influxdb, tmp_path):
+        pytest.importorskip("pyarrow")
+        parquet = pytest.importorskip("pyarrow.parquet")
+        _stub_influxdb(influxdb, [_record(START, "d", 70.5, device_name="Den"), _record(START, "e", 71.0)])
+        export(str(tmp_path), START, START.replace(hour=1), file_format=ExportFormat.PARQUET)
+        table = parquet.read_table(tmp_path / "part-20240101T000000Z.parquet")
+        assert table.column_names == COLUMNS
+        assert table.column("device_name").to_pylist() == ["Den", None]
+        assert table.column("value").to_pylist() == [70.5, 71.0]
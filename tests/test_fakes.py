@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+import os
+import time
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+from influxdb_client import Point
+
+from sensortrack.cache import reset
+from sensortrack.config import CacheConfig, InfluxDbConfig
+from sensortrack.fakes import FakeInfluxDb, FakeSmartThings, FakeWeather, Faults
+from sensortrack.sinks import InfluxDbSink
+from sensortrack.smartthings import Room, SmartThings, retrieve_devices, retrieve_location, retrieve_rooms
+from sensortrack.weather import retrieve_current_conditions, retrieve_observations
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+REQUEST = MagicMock()
+REQUEST.token = MagicMock(return_value="token")
+REQUEST.app_id = MagicMock(return_value="app")
+REQUEST.location_id = MagicMock(return_value="location-0001")
+
+
+@pytest.fixture(name="running")
+def fixture_running():
+    """Start fakes, and stop them once the test completes."""
+    started = []
+
+    def start(service):
+        service.start()
+        started.append(service)
+        return service
+
+    yield start
+    for service in started:
+        service.stop()
+
+
+@pytest.fixture(autouse=True)
+def cleanup():
+    """Use an in-memory cache, reset before and after tests."""
+    with patch("sensortrack.cache.config", MagicMock(return_value=MagicMock(cache=CacheConfig()))):
+        reset()
+        yield
+        reset()
+
+
+class TestFakeSmartThings:
+    def test_clients(self, running):
+        fake = running(FakeSmartThings(devices=150, rooms=2))
+        with patch("sensortrack.smartthings.config", MagicMock(return_value=MagicMock(smartthings=MagicMock(base_url=fake.url)))):
+            with SmartThings(request=REQUEST):
+                location = retrieve_location()
+                devices = retrieve_devices()
+                rooms = retrieve_rooms()
+        assert location.location_id == "location-0001"
+        assert location.country_code == "USA"
+        assert len(devices) == 150  # across two pages
+        assert devices[3].device_id == "device-0001-0003"  # same scheme as the load generator
+        assert devices[3].label == "Sensor 3"
+        assert devices[3].room_id == "location-0001-room-1"
+        assert rooms == [Room(room_id="location-0001-room-0", name="Room 0"), Room(room_id="location-0001-room-1", name="Room 1")]
+        assert ("GET", "/devices?locationId=location-0001&page=1") in fake.requests
+
+    def test_schedules(self, running):
+        fake = running(FakeSmartThings())
+        assert requests.post("%s/installedapps/app/schedules" % fake.url, json={"name": "x"}, timeout=5.0).json() == {"name": "x"}
+        assert requests.delete("%s/installedapps/app/schedules/x" % fake.url, timeout=5.0).status_code == 200
+        assert requests.post("%s/installedapps/app/subscriptions" % fake.url, json={}, timeout=5.0).status_code == 200
+        assert requests.get("%s/unknown" % fake.url, timeout=5.0).status_code == 404
+
+
+@patch("sensortrack.weather.config")
+class TestFakeWeather:
+    def test_synthetic(self, config, running):
+        fake = running(FakeWeather())
+        config.return_value = MagicMock(weather=MagicMock(base_url=fake.url))
+        temperature, humidity = retrieve_current_conditions(12.3, 45.6)
+        assert 60.0 < temperature < 80.0
+        assert 40.0 < humidity < 55.0
+        start, end = datetime(2024, 1, 1, tzinfo=timezone.utc), datetime(2024, 1, 2, tzinfo=timezone.utc)
+        with patch("sensortrack.weather._PAGE_LIMIT", 10):
+            observations = list(retrieve_observations(12.3, 45.6, start, end))
+        assert len(observations) == 24  # hourly, across three pages
+        assert observations[0].timestamp == datetime(2024, 1, 1, 23, 54, tzinfo=timezone.utc).timestamp()
+        assert observations[-1].timestamp == datetime(2024, 1, 1, 0, 54, tzinfo=timezone.utc).timestamp()
+
+    def test_fixtures(self, config, running):
+        fake = running(FakeWeather(fixture_dir=FIXTURE_DIR))
+        config.return_value = MagicMock(weather=MagicMock(base_url=fake.url))
+        assert retrieve_current_conditions(12.3, 45.6) == (84.92, 41.59)
+        assert ("GET", "/stations/KALO/observations/latest") in fake.requests  # recorded station, served by the fake
+
+
+class TestFakeInfluxDb:
+    def test_write(self, running):
+        fake = running(FakeInfluxDb())
+        influxdb = InfluxDbConfig(url=fake.url, org="org", token="token", bucket="bucket")
+        InfluxDbSink(influxdb).write([Point("sensor").tag("device", "d").field("temperature", 70.5).time(1, "s")])
+        assert list(fake.lines) == ["sensor,device=d temperature=70.5 1"]
+        assert fake.written == 1
+
+
+class TestFaults:
+    def test_errors(self, running):
+        fake = running(FakeInfluxDb(faults=Faults(error_rate=1.0, error_status=503)))
+        assert requests.get("%s/health" % fake.url, timeout=5.0).status_code == 503
+
+    def test_latency(self, running):
+        fake = running(FakeInfluxDb(faults=Faults(latency_sec=0.1)))
+        started = time.monotonic()
+        assert requests.get("%s/health" % fake.url, timeout=5.0).status_code == 200
+        assert time.monotonic() - started >= 0.1
+
+    def test_throttle(self, running):
+        fake = running(FakeInfluxDb(faults=Faults(throttle_rate=2)))
+        responses = [requests.get("%s/health" % fake.url, timeout=5.0) for _ in range(3)]
+        assert [response.status_code for response in responses] == [200, 200, 429]
+        assert responses[2].headers["Retry-After"] == "1"
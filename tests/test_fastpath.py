@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+from unittest.mock import MagicMock, patch
+
+import pytest
+from influxdb_client.client.exceptions import InfluxDBError
+from smartapp.interface import BadRequestError, InternalError, SignatureError
+from starlette.testclient import TestClient
+
+from sensortrack.admission import OverloadedError
+from sensortrack.fastpath import API
+from sensortrack.rest import CircuitState, RestClientError, UpstreamStatus
+
+CLIENT = TestClient(API)
+
+
+@patch("sensortrack.fastpath.admitted", MagicMock())
+class TestSmartAppFastPath:
+    @patch("sensortrack.fastpath.log_exchange")
+    @patch("sensortrack.fastpath.dispatch")
+    def test_smartapp(self, dispatch_, log_exchange):
+        dispatch_.return_value = b'{"eventData":{}}'
+        response = CLIENT.post(url="/smartapp", headers={"a": "b", "X-ST-Correlation": "c"}, content="body")
+        assert response.status_code == 200
+        assert response.content == b'{"eventData":{}}'
+        assert response.headers["content-type"] == "application/json"
+        assert response.headers["content-length"] == "16"
+        headers, body = dispatch_.call_args[0]
+        assert headers["a"] == "b"  # just make sure our headers get passed, among others
+        assert body == b"body"
+        log_exchange.assert_called_once_with("c", b"body", b'{"eventData":{}}')
+
+    @patch("sensortrack.fastpath.dispatch")
+    @pytest.mark.parametrize(
+        "error,status_code",
+        [
+            (BadRequestError("hello"), 400),
+            (SignatureError("hello"), 401),
+            (InternalError("hello"), 500),
+            (RestClientError("hello"), 500),
+            (InfluxDBError(message="hello"), 500),
+            (Exception("hello"), 500),
+        ],
+    )
+    def test_smartapp_error(self, dispatch_, error, status_code):
+        dispatch_.side_effect = error
+        response = CLIENT.post(url="/smartapp", content="body")
+        assert response.status_code == status_code
+        assert response.content == b""
+
+    @patch("sensortrack.fastpath.dispatch")
+    def test_smartapp_overloaded(self, dispatch_):
+        with patch("sensortrack.fastpath.admitted") as admitted:
+            admitted.return_value.__aenter__.side_effect = OverloadedError("Over limits for EVENT", 7)
+            response = CLIENT.post(url="/smartapp", content="body")
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "7"
+        assert response.content == b""
+        dispatch_.assert_not_called()
+
+    @patch("sensortrack.server.upstream_status")
+    def test_passthrough(self, upstream_status):
+        upstream_status.return_value = [
+            UpstreamStatus(name="weather", state=CircuitState.CLOSED, consecutive_failures=0, rejected_calls=0, retry_tokens=10.0)
+        ]
+        response = CLIENT.get(url="/health")
+        assert response.status_code == 200
+        assert response.json() == {"status": "OK", "upstreams": {"weather": "CLOSED"}}
+
+    def test_passthrough_method(self):
+        assert CLIENT.get(url="/smartapp").status_code == 405  # only POST takes the fast path
@@ -2,16 +2,26 @@
 # vim: set ft=python ts=4 sw=4 expandtab:
 # pylint: disable=redefined-outer-name,protected-access,too-many-positional-arguments:
 
+from datetime import datetime, timezone
 from typing import List
-from unittest.mock import MagicMock, call, patch
+from unittest.mock import ANY, MagicMock, call, patch
 
 import pytest
 from influxdb_client import Point
 from smartapp.interface import EventType
 
-from sensortrack.handler import WEATHER_LOOKUP, EventHandler, is_weather_lookup
+from sensortrack.aggregation import WindowAggregator, WindowResult
+from sensortrack.cache import Cache, reset
+from sensortrack.comfort import ComfortJoin
+from sensortrack.compression import Compressor
+from sensortrack.config import CacheConfig, CompressionMethod, OverflowPolicy, QuotaConfig
+from sensortrack.handler import WEATHER_LOOKUP, EventHandler, flush, is_weather_lookup, write_points
+from sensortrack.quotas import QuotaManager, TenantUsage
+from sensortrack.recent import WEATHER_DEVICE
+from sensortrack.sinks import PartialWriteError
 
 CORRELATION_ID = "xxx"
+DIRECTORY = MagicMock(is_stale=MagicMock(return_value=False), tags=MagicMock(return_value={}))
 
 
 @pytest.fixture
@@ -19,6 +29,23 @@ def handler() -> EventHandler:
     return EventHandler()
 
 
+@pytest.fixture(autouse=True)
+def pipeline():
+    """Disable optional write pipeline stages and isolate derived state, unless a test patches them explicitly."""
+    with patch("sensortrack.handler.compressor", MagicMock(return_value=None)):
+        with patch("sensortrack.handler.aggregator", MagicMock(return_value=None)):
+            with patch("sensortrack.handler.comfort", MagicMock(return_value=ComfortJoin())):
+                with patch("sensortrack.handler.alerts", MagicMock(return_value=None)):
+                    with patch("sensortrack.handler.quotas", MagicMock(return_value=None)):
+                        with patch("sensortrack.handler.directory", MagicMock(return_value=DIRECTORY)):
+                            with patch("sensortrack.handler.refresh_directory"):
+                                with patch("sensortrack.handler.sink"):
+                                    with patch("sensortrack.cache.config", MagicMock(return_value=MagicMock(cache=CacheConfig()))):
+                                        reset()
+                                        yield
+                                        reset()
+
+
 class TestEventHandler:
     @pytest.mark.parametrize(
         "event,expected",
@@ -103,9 +130,9 @@ def test_handle_update(self, smartthings, schedule, humidity, temperature, handl
         else:
             request.as_str.assert_not_called()
 
-    @patch("sensortrack.handler.InfluxDBClient")
-    @patch("sensortrack.handler.config")
-    def test_handle_event_device(self, config, influxdb, handler):
+    @patch("sensortrack.handler.recent")
+    @patch("sensortrack.handler.sink")
+    def test_handle_event_device(self, sink, recent, handler):
         request = MagicMock()
         request.event_data = MagicMock()
         request.event_data.filter = MagicMock()
@@ -124,30 +151,8 @@ def test_handle_event_device(self, config, influxdb, handler):
             ],
         ]
 
-        config.return_value = MagicMock(
-            influxdb=MagicMock(
-                url="url",
-                org="org",
-                token="token",
-                bucket="bucket",
-            ),
-        )
-
-        # Ugh, the stubbing for a context manager is hideous
-        write = MagicMock()
-        influxdb.return_value = MagicMock(
-            __enter__=MagicMock(
-                return_value=MagicMock(
-                    write_api=MagicMock(
-                        return_value=MagicMock(write=write),
-                    ),
-                ),
-            ),
-        )
-
         handler.handle_event(CORRELATION_ID, request)
 
-        influxdb.assert_called_once_with(url="url", org="org", token="token")
         request.event_data.filter.assert_has_calls(
             [
                 call(event_type=EventType.TIMER_EVENT, predicate=is_weather_lookup),
@@ -156,10 +161,7 @@ def test_handle_event_device(self, config, influxdb, handler):
         )
 
         # there's no equality available on the Point class, so we have to do this the hard way
-        (_, kwargs) = write.call_args
-        bucket: str = kwargs["bucket"]
-        points: List[Point] = kwargs["record"]
-        assert bucket == "bucket"
+        points: List[Point] = sink.return_value.write.call_args[0][0]
         assert len(points) == 1
         assert len(points[0]._tags) == 2
         assert len(points[0]._fields) == 1
@@ -168,11 +170,261 @@ def test_handle_event_device(self, config, influxdb, handler):
         assert points[0]._tags["device"] == "d"
         assert points[0]._fields["t"] == 23.7
 
+        recent.return_value.record.assert_called_once_with("l", "d", "t", 23.7)
+
+    @patch("sensortrack.handler.recent", MagicMock())
+    @patch("sensortrack.handler.write_points")
+    def test_handle_event_redelivered(self, write_points, handler):
+        request = MagicMock(execution_id="execution")
+        request.event_data = MagicMock()
+        request.event_data.filter = MagicMock(return_value=[])
+        write_points.side_effect = [Exception("hello"), None]
+        with pytest.raises(Exception, match="hello"):
+            handler.handle_event(CORRELATION_ID, request)
+        handler.handle_event(CORRELATION_ID, request)  # handled again, since the first attempt failed
+        handler.handle_event(CORRELATION_ID, request)  # skipped, since it was already handled
+        assert write_points.call_count == 2
+        assert request.event_data.filter.call_count == 4
+
+    @patch("sensortrack.handler.recent", MagicMock())
+    @patch("sensortrack.handler.write_points")
+    def test_handle_event_claimed(self, write_points, handler):
+        request = MagicMock(execution_id="execution")
+        request.event_data = MagicMock()
+        request.event_data.filter = MagicMock(return_value=[])
+        assert Cache("deliveries", 60).add("execution") is True  # as if another node were handling it right now
+        handler.handle_event(CORRELATION_ID, request)
+        write_points.assert_not_called()
+
+    @patch("sensortrack.handler.recent")
+    @patch("sensortrack.handler.write_points")
+    def test_handle_event_device_comfort(self, write_points, recent, handler):
+        request = MagicMock()
+        request.event_data = MagicMock()
+        request.event_data.filter = MagicMock()
+        request.event_data.filter.side_effect = [
+            [],
+            [
+                {"locationId": "l", "deviceId": "d", "attribute": "temperature", "value": 70.0, "unit": "F"},
+                {"locationId": "l", "deviceId": "e", "attribute": "humidity", "value": 40.0, "unit": "%"},
+                {"locationId": "l", "deviceId": "d", "attribute": "humidity", "value": 50.0, "unit": "%"},
+                {"locationId": "l", "deviceId": "f", "attribute": "temperature", "value": 21.0, "unit": "C"},
+                {"locationId": "l", "deviceId": "f", "attribute": "humidity", "value": 50.0, "unit": "%"},
+            ],
+        ]
+
+        handler.handle_event(CORRELATION_ID, request)
+
+        points: List[Point] = write_points.call_args[0][0]
+        assert [(p._tags["device"], p._fields) for p in points] == [
+            ("d", {"temperature": 70.0}),
+            ("e", {"humidity": 40.0}),
+            ("d", {"humidity": 50.0}),
+            ("d", {"dew_point": 50.51}),  # derived once both temperature and humidity are known for device d
+            ("d", {"heat_index": 69.05}),
+            ("f", {"temperature": 21.0}),
+            ("f", {"humidity": 50.0}),
+            ("f", {"dew_point": 10.18}),  # in the same unit as the temperature
+            ("f", {"heat_index": 20.46}),
+        ]
+        recent.return_value.record.assert_has_calls([call("l", "d", "dew_point", 50.51), call("l", "d", "heat_index", 69.05)])
+
+    @patch("sensortrack.handler.subscribe_to_temperature_events", MagicMock())
+    @patch("sensortrack.handler.subscribe_to_humidity_events", MagicMock())
+    @patch("sensortrack.handler.schedule_weather_lookup_timer", MagicMock())
+    @patch("sensortrack.handler.SmartThings", MagicMock())
+    @patch("sensortrack.handler.directory")
+    @patch("sensortrack.handler.refresh_directory")
+    @pytest.mark.parametrize("failure", [None, Exception("hello")])
+    def test_handle_install_directory(self, refresh_directory, directory, handler, failure):
+        request = MagicMock()
+        request.location_id = MagicMock(return_value="l")
+        refresh_directory.side_effect = failure
+
+        handler.handle_install(CORRELATION_ID, request)  # a failure is logged, but doesn't fail the request
+
+        refresh_directory.assert_called_once_with("l")
+        if failure:
+            directory.return_value.failed.assert_called_once_with("l")
+        else:
+            directory.return_value.failed.assert_not_called()
+
+    @patch("sensortrack.handler.Thread")
+    @patch("sensortrack.handler.SmartThings")
+    @patch("sensortrack.handler.directory")
+    @patch("sensortrack.handler.refresh_directory")
+    @patch("sensortrack.handler.recent", MagicMock())
+    @patch("sensortrack.handler.write_points")
+    @pytest.mark.parametrize("stale", [True, False])
+    def test_handle_event_device_directory(self, write_points, refresh_directory, directory, smartthings, thread, handler, stale):
+        request = MagicMock()
+        request.location_id = MagicMock(return_value="l")
+        request.event_data = MagicMock()
+        request.event_data.filter = MagicMock()
+        request.event_data.filter.side_effect = [
+            [],
+            [{"locationId": "l", "deviceId": "d", "attribute": "t", "value": 23.7}],
+        ]
+        directory.return_value.claim_refresh.return_value = stale
+        directory.return_value.tags.return_value = {"device_name": "Kitchen Sensor", "room": "Kitchen"}
+
+        handler.handle_event(CORRELATION_ID, request)
+
+        directory.return_value.claim_refresh.assert_called_once_with("l")
+        refresh_directory.assert_not_called()  # not while handling the request, which is tagged from the stale directory
+        points: List[Point] = write_points.call_args[0][0]
+        assert points[0]._tags == {"location": "l", "device": "d", "device_name": "Kitchen Sensor", "room": "Kitchen"}
+        if stale:
+            thread.return_value.start.assert_called_once()
+            thread.call_args[1]["target"](*thread.call_args[1]["args"])  # run the background refresh
+            smartthings.assert_called_once_with(request=request)
+            refresh_directory.assert_called_once_with("l")
+        else:
+            thread.assert_not_called()
+
+    @patch("sensortrack.handler.time")
+    @patch("sensortrack.handler.alerts")
+    @patch("sensortrack.handler.recent", MagicMock())
+    @patch("sensortrack.handler.write_points", MagicMock())
+    def test_handle_event_device_alerts(self, alerts, time, handler):
+        request = MagicMock()
+        request.event_data = MagicMock()
+        request.event_data.filter = MagicMock()
+        request.event_data.filter.side_effect = [
+            [],
+            [{"locationId": "l", "deviceId": "d", "attribute": "t", "value": 23.7}],
+        ]
+        time.time.return_value = 1000.0
+
+        handler.handle_event(CORRELATION_ID, request)
+
+        alerts.return_value.offer.assert_called_once_with("l", "d", "t", 23.7, 1000.0)
+
+    @patch("sensortrack.handler.time")
+    @patch("sensortrack.handler.aggregator")
+    @patch("sensortrack.handler.recent", MagicMock())
+    @patch("sensortrack.handler.write_points")
+    @pytest.mark.parametrize("keep_raw", [False, True])
+    def test_handle_event_device_aggregated(self, write_points, aggregator, time, handler, keep_raw):
+        request = MagicMock()
+        request.event_data = MagicMock()
+        request.event_data.filter = MagicMock()
+        request.event_data.filter.side_effect = [
+            [],
+            [
+                {"locationId": "l", "deviceId": "d", "attribute": "t", "value": 23.7},
+                {"locationId": "l", "deviceId": "d", "attribute": "t", "value": 23.9},
+            ],
+        ]
+        time.time.return_value = 1030.0
+        aggregator.return_value = WindowAggregator(60, "sensor_1m", keep_raw=keep_raw)
+        aggregator.return_value.add(("l", "d", "t"), 990.0, 23.5)  # from an earlier request, in the previous window
+
+        handler.handle_event(CORRELATION_ID, request)
+
+        points: List[Point] = write_points.call_args[0][0]
+        raw = [p for p in points if p._name == "sensor"]
+        aggregated = [p for p in points if p._name == "sensor_1m"]
+        assert len(raw) == (2 if keep_raw else 0)
+        assert len(aggregated) == 1  # only the closed window is written
+        assert aggregated[0]._tags == {"location": "l", "device": "d"}
+        assert aggregated[0]._fields == {"t": 23.5, "t_min": 23.5, "t_max": 23.5, "t_count": 1}
+        assert aggregated[0]._time == datetime.fromtimestamp(960, tz=timezone.utc)
+
+    @patch("sensortrack.handler.time")
+    @patch("sensortrack.handler.quotas")
+    @patch("sensortrack.handler.recent", MagicMock())
+    @patch("sensortrack.handler.write_points")
+    def test_handle_event_device_quota(self, write_points, quotas, time, handler):
+        request = MagicMock()
+        request.event_data = MagicMock()
+        request.event_data.installed_app.installed_app_id = "app"
+        request.event_data.filter = MagicMock()
+        request.event_data.filter.side_effect = [
+            [],
+            [
+                {"locationId": "l", "deviceId": "d", "attribute": "t", "value": 23.7},
+                {"locationId": "l", "deviceId": "d", "attribute": "t", "value": 23.8},
+            ],
+        ]
+        time.time.return_value = 1000.0
+        quotas.return_value = QuotaManager(QuotaConfig(points_per_sec=1.0, overflow=OverflowPolicy.AGGREGATE, aggregate_sec=60))
+
+        handler.handle_event(CORRELATION_ID, request)
+
+        points: List[Point] = write_points.call_args[0][0]
+        assert len(points) == 1  # the second reading is over quota, and is held in an overflow window
+        assert points[0]._fields == {"t": 23.7}
+        assert quotas.return_value.usage() == [
+            TenantUsage(installed_app_id="app", series=1, written=1, dropped=0, aggregated=1, spooled=0)
+        ]
+        overflow = quotas.return_value.points(quotas.return_value.collect())
+        assert len(overflow) == 1
+        assert overflow[0]._name == "sensor_overflow"
+        assert overflow[0]._fields == {"t": 23.8, "t_min": 23.8, "t_max": 23.8, "t_count": 1}
+
+    @patch("sensortrack.handler.time")
+    @patch("sensortrack.handler.compressor")
+    @patch("sensortrack.handler.recent", MagicMock())
+    @patch("sensortrack.handler.write_points")
+    def test_handle_event_device_compressed(self, write_points, compressor, time, handler):
+        request = MagicMock()
+        request.event_data = MagicMock()
+        request.event_data.filter = MagicMock()
+        request.event_data.filter.side_effect = [
+            [],
+            [
+                {"locationId": "l", "deviceId": "d", "attribute": "t", "value": 23.7},
+                {"locationId": "l", "deviceId": "d", "attribute": "t", "value": 23.8},
+            ],
+        ]
+        time.time.return_value = 1000.0
+        compressor.return_value.offer.side_effect = [[], [(900.0, 23.6)]]
+
+        handler.handle_event(CORRELATION_ID, request)
+
+        compressor.return_value.offer.assert_has_calls(
+            [call(("l", "d", "t"), 1000.0, 23.7, ANY), call(("l", "d", "t"), 1000.0, 23.8, ANY)]
+        )
+        points: List[Point] = write_points.call_args[0][0]
+        assert len(points) == 1
+        assert points[0]._tags == {"location": "l", "device": "d"}
+        assert points[0]._fields["t"] == 23.6
+        assert points[0]._time == datetime.fromtimestamp(900.0, tz=timezone.utc)
+
+    @patch("sensortrack.handler.time")
+    @patch("sensortrack.handler.compressor")
+    @patch("sensortrack.handler.aggregator")
+    @patch("sensortrack.handler.recent", MagicMock())
+    @patch("sensortrack.handler.write_points")
+    def test_handle_event_device_write_failed(self, write_points, aggregator, compressor, time, handler):
+        request = MagicMock()
+        request.event_data = MagicMock()
+        request.event_data.filter = MagicMock()
+        events = [{"locationId": "l", "deviceId": "d", "attribute": "t", "value": 23.7}]
+        request.event_data.filter.side_effect = [[], events, [], events]
+        time.time.return_value = 1030.0
+        aggregator.return_value = WindowAggregator(60, "sensor_1m", keep_raw=True)
+        aggregator.return_value.add(("l", "d", "t"), 990.0, 23.5)  # from an earlier request, in the previous window
+        compressor.return_value = Compressor(CompressionMethod.DEADBAND, deviation=0.5, max_interval_sec=1000)
+        write_points.side_effect = [Exception("failed"), None]
+
+        with pytest.raises(Exception, match="failed"):
+            handler.handle_event(CORRELATION_ID, request)
+        handler.handle_event(CORRELATION_ID, request)  # redelivered
+
+        first: List[Point] = write_points.call_args_list[0][0][0]
+        second: List[Point] = write_points.call_args_list[1][0][0]
+        assert [(p._name, p._fields) for p in second] == [(p._name, p._fields) for p in first]  # nothing compressed away
+        assert aggregator.return_value.collect() == [  # the reading is only counted once
+            WindowResult(start=1020, key=("l", "d", "t"), count=1, low=23.7, high=23.7, mean=23.7)
+        ]
+
+    @patch("sensortrack.handler.recent")
     @patch("sensortrack.handler.retrieve_current_conditions")
     @patch("sensortrack.handler.retrieve_location")
     @patch("sensortrack.handler.SmartThings")
-    @patch("sensortrack.handler.InfluxDBClient")
-    @patch("sensortrack.handler.config")
+    @patch("sensortrack.handler.sink")
     @pytest.mark.parametrize(
         "location,eligible",
         [
@@ -185,7 +437,7 @@ def test_handle_event_device(self, config, influxdb, handler):
         ],
     )
     def test_handle_event_timer(
-        self, config, influxdb, smartthings, retrieve_location, retrieve_current_conditions, handler, location, eligible
+        self, sink, smartthings, retrieve_location, retrieve_current_conditions, recent, handler, location, eligible
     ):
         request = MagicMock()
         request.event_data = MagicMock()
@@ -202,30 +454,9 @@ def test_handle_event_timer(
             [],
         ]
 
-        config.return_value = MagicMock(
-            influxdb=MagicMock(
-                url="url",
-                org="org",
-                token="token",
-                bucket="bucket",
-            ),
-        )
-
         retrieve_location.return_value = location
         retrieve_current_conditions.return_value = 78.9, 10.2
 
-        # Ugh, the stubbing for a context manager is hideous
-        write = MagicMock()
-        influxdb.return_value = MagicMock(
-            __enter__=MagicMock(
-                return_value=MagicMock(
-                    write_api=MagicMock(
-                        return_value=MagicMock(write=write),
-                    ),
-                ),
-            ),
-        )
-
         handler.handle_event(CORRELATION_ID, request)
 
         request.event_data.filter.assert_has_calls(
@@ -235,7 +466,6 @@ def test_handle_event_timer(
             ]
         )
 
-        influxdb.assert_called_once_with(url="url", org="org", token="token")
         smartthings.assert_called_once_with(request=request)
         retrieve_location.assert_called_once()
         if eligible:
@@ -244,12 +474,9 @@ def test_handle_event_timer(
             retrieve_current_conditions.assert_not_called()
 
         # there's no equality available on the Point class, so we have to do this the hard way
-        (_, kwargs) = write.call_args
-        bucket: str = kwargs["bucket"]
-        points: List[Point] = kwargs["record"]
-        assert bucket == "bucket"
+        points: List[Point] = sink.return_value.write.call_args[0][0]
         if eligible:
-            assert len(points) == 2
+            assert len(points) == 3
             assert len(points[0]._tags) == 1
             assert len(points[0]._fields) == 1
             assert points[0]._name == "weather"
@@ -260,5 +487,110 @@ def test_handle_event_timer(
             assert points[1]._name == "weather"
             assert points[1]._tags["location"] == "l"
             assert points[1]._fields["humidity"] == 10.2
+            assert points[2]._name == "weather"
+            assert points[2]._tags["location"] == "l"
+            assert points[2]._fields == {"dew_point": 18.15, "heat_index": 76.97}
+            recent.return_value.record.assert_has_calls(
+                [
+                    call("l", WEATHER_DEVICE, "temperature", 78.9),
+                    call("l", WEATHER_DEVICE, "humidity", 10.2),
+                    call("l", WEATHER_DEVICE, "dew_point", 18.15),
+                    call("l", WEATHER_DEVICE, "heat_index", 76.97),
+                ]
+            )
         else:
             assert len(points) == 0
+            recent.return_value.record.assert_not_called()
+
+
+class TestFlush:
+    @patch("sensortrack.handler.sink")
+    def test_write_points(self, sink):
+        points = [Point("sensor")]
+        write_points(points)
+        sink.return_value.write.assert_called_once_with(points)
+
+    @patch("sensortrack.handler.sink")
+    @patch("sensortrack.handler.write_points")
+    @patch("sensortrack.handler.compressor")
+    def test_flush(self, compressor, write_points, sink):
+        compressor.return_value.flush.return_value = [(("l", "d", "t"), (900.0, 23.6))]
+        flush()
+        sink.return_value.flush.assert_called_once_with(True)
+        points: List[Point] = write_points.call_args[0][0]
+        assert len(points) == 1
+        assert points[0]._fields["t"] == 23.6
+        assert points[0]._time == datetime.fromtimestamp(900.0, tz=timezone.utc)
+
+    @patch("sensortrack.handler.sink")
+    @patch("sensortrack.handler.time")
+    @patch("sensortrack.handler.write_points")
+    @patch("sensortrack.handler.compressor")
+    @patch("sensortrack.handler.aggregator")
+    def test_flush_periodic(self, aggregator, compressor, write_points, time, sink):
+        time.time.return_value = 1000.0
+        aggregator.return_value = WindowAggregator(60, "sensor_1m")
+        aggregator.return_value.add(("l", "d", "t"), 900.0, 23.6)
+        flush(final=False)
+        sink.return_value.flush.assert_called_once_with(False)
+        compressor.return_value.flush.assert_not_called()  # compression only flushes held readings at shutdown
+        points: List[Point] = write_points.call_args[0][0]
+        assert len(points) == 1
+        assert points[0]._name == "sensor_1m"
+        assert points[0]._fields == {"t": 23.6, "t_min": 23.6, "t_max": 23.6, "t_count": 1}
+
+    @patch("sensortrack.handler.sink", MagicMock())
+    @patch("sensortrack.handler.time")
+    @patch("sensortrack.handler.write_points")
+    @patch("sensortrack.handler.compressor")
+    @patch("sensortrack.handler.aggregator")
+    def test_flush_failed(self, aggregator, compressor, write_points, time):
+        time.time.return_value = 1000.0
+        aggregator.return_value = WindowAggregator(60, "sensor_1m")
+        aggregator.return_value.add(("l", "d", "t"), 900.0, 23.6)
+        write_points.side_effect = Exception("failed")
+        with pytest.raises(Exception, match="failed"):
+            flush(final=False)
+        compressor.return_value.restore.assert_called_once()
+        assert len(aggregator.return_value.collect()) == 1  # the window is kept, to be written next time
+
+    @patch("sensortrack.handler.sink")
+    @patch("sensortrack.handler.time")
+    @patch("sensortrack.handler.write_points")
+    @patch("sensortrack.handler.compressor")
+    @patch("sensortrack.handler.aggregator")
+    def test_flush_partial(self, aggregator, compressor, write_points, time, _sink):
+        time.time.return_value = 1000.0
+        aggregator.return_value = WindowAggregator(60, "sensor_1m")
+        aggregator.return_value.add(("l", "d", "t"), 900.0, 23.6)
+        write_points.side_effect = PartialWriteError("disk full")
+        flush(final=False)  # some sinks have the points, so writing them again would duplicate them there
+        compressor.return_value.restore.assert_not_called()
+        assert aggregator.return_value.collect() == []
+
+    @patch("sensortrack.handler.sink")
+    @patch("sensortrack.handler.time")
+    @patch("sensortrack.handler.write_points")
+    @patch("sensortrack.handler.quotas")
+    def test_flush_failed_overflow(self, quotas, write_points, time, _sink):
+        time.time.return_value = 1000.0
+        quotas.return_value = QuotaManager(QuotaConfig(points_per_sec=1.0, overflow=OverflowPolicy.AGGREGATE, aggregate_sec=60))
+        quotas.return_value.overflow("app", ("l", "d", "t"), 900.0, 23.6, point=MagicMock())
+        write_points.side_effect = Exception("failed")
+        with pytest.raises(Exception, match="failed"):
+            flush(final=False)
+        assert len(quotas.return_value.collect()) == 1  # the overflow window is kept too
+
+    @patch("sensortrack.handler.write_points")
+    @patch("sensortrack.handler.compressor")
+    def test_flush_nothing_held(self, compressor, write_points):
+        compressor.return_value.flush.return_value = []
+        flush()
+        write_points.assert_not_called()
+
+    @patch("sensortrack.handler.write_points")
+    @patch("sensortrack.handler.compressor")
+    def test_flush_disabled(self, compressor, write_points):
+        compressor.return_value = None
+        flush()
+        write_points.assert_not_called()
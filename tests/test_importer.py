@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from sensortrack.config import InfluxDbConfig, SinksConfig
+from sensortrack.importer import (
+    BulkImportError,
+    ImportResult,
+    RateLimiter,
+    Reading,
+    existing_flux,
+    import_files,
+    parse_csv_row,
+    parse_line_protocol,
+    read_file,
+    reading,
+)
+
+INFLUXDB = InfluxDbConfig(url="url", org="org", token="token", bucket="bucket")
+STAMP = datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+NS = int(STAMP.timestamp()) * 1_000_000_000
+
+CSV = """time,measurement,location,device,device_name,room,field,value
+2024-01-02T03:04:05+00:00,sensor,l,d,Den,Office,temperature,70.5
+2024-01-02T03:04:05+00:00,weather,l,,,,humidity,55
+2024-01-02T03:04:05+00:00,sensor,l,,,,temperature,70.5
+2024-01-02T03:04:05+00:00,sensor,l,d,,,temperature,bogus
+"""
+
+LINE_PROTOCOL = """# comment
+sensor,location=l,device=d,device_name=Living\\ Room temperature=70.5,humidity=40i 1704164645000000000
+
+weather,location=l humidity=55 1704164645000000000
+sensor,location=l,device=d state="on" 1704164645000000000
+"""
+
+
+def _sensor(device, value, timestamp=NS, **tags):
+    return reading("sensor", {"location": "l", "device": device, **tags}, "temperature", value, timestamp)
+
+
+def _stub_influxdb(influxdb, records):
+    # Ugh, the stubbing for a context manager is hideous
+    query_stream = MagicMock(side_effect=lambda query, org: iter(records))
+    influxdb.return_value = MagicMock(
+        __enter__=MagicMock(
+            return_value=MagicMock(
+                query_api=MagicMock(
+                    return_value=MagicMock(query_stream=query_stream),
+                ),
+            ),
+        ),
+    )
+    return query_stream
+
+
+class TestReading:
+    def test_valid(self):
+        result = reading("sensor", {"location": "l", "device": "d", "room": "Office"}, "temperature", 70.456, NS)
+        assert result == Reading(
+            measurement="sensor",
+            tags=(("device", "d"), ("location", "l"), ("room", "Office")),
+            field="temperature",
+            value=70.46,
+            timestamp=NS,
+        )
+        assert result.point().to_line_protocol() == "sensor,device=d,location=l,room=Office temperature=70.46 %d" % NS
+
+    @pytest.mark.parametrize(
+        "measurement,tags,name,value,message",
+        [
+            ("other", {"location": "l"}, "temperature", 1.0, "unknown measurement"),
+            ("sensor", {"location": "l"}, "temperature", 1.0, "missing tag: device"),
+            ("weather", {"location": "l", "color": "red"}, "temperature", 1.0, "unexpected tag: color"),
+            ("weather", {"location": "l"}, "pressure", 1.0, "unknown field"),
+            ("weather", {"location": "l"}, "temperature", float("nan"), "invalid value"),
+        ],
+    )
+    def test_invalid(self, measurement, tags, name, value, message):  # pylint: disable=too-many-positional-arguments:
+        with pytest.raises(ValueError, match=message):
+            reading(measurement, tags, name, value, NS)
+
+    def test_key(self):
+        assert _sensor("d", 1.0, NS + 1_234_567).key() == _sensor("d", 2.0, NS + 1_234_000).key()
+
+
+class TestParse:
+    def test_csv_row(self):
+        row = {"time": "2024-01-02T03:04:05.123456Z", "measurement": "weather", "location": "l", "device": "", "field": "humidity"}
+        assert parse_csv_row({**row, "value": "55"}) == reading("weather", {"location": "l"}, "humidity", 55.0, NS + 123_456_000)
+
+    def test_line_protocol(self):
+        line = "sensor,location=l,device=d,room=Living\\ Room temperature=70.5,humidity=40i %d" % NS
+        tags = {"location": "l", "device": "d", "room": "Living Room"}
+        assert parse_line_protocol(line) == [
+            reading("sensor", tags, "temperature", 70.5, NS),
+            reading("sensor", tags, "humidity", 40.0, NS),
+        ]
+
+    @pytest.mark.parametrize(
+        "line",
+        [
+            "sensor,location=l,device=d temperature=70.5",
+            'sensor,location=l,device=d state="on" 1',
+            "sensor,location=l,device=d temperature=hot 1",
+            "sensor,location=l,device=d temperature=70.5 soon",
+        ],
+    )
+    def test_line_protocol_invalid(self, line):
+        with pytest.raises(ValueError):
+            parse_line_protocol(line)
+
+
+class TestReadFile:
+    def test_csv(self, tmp_path):
+        path = tmp_path / "data.csv"
+        path.write_text(CSV, encoding="utf-8")
+        result = ImportResult()
+        readings = list(read_file(str(path), result))
+        assert readings == [
+            _sensor("d", 70.5, device_name="Den", room="Office"),
+            reading("weather", {"location": "l"}, "humidity", 55.0, NS),
+        ]
+        assert result == ImportResult(read=4, invalid=2)
+
+    def test_csv_columns(self, tmp_path):
+        path = tmp_path / "data.csv"
+        path.write_text("time,value\n", encoding="utf-8")
+        with pytest.raises(BulkImportError, match="expected columns"):
+            list(read_file(str(path), ImportResult()))
+
+    def test_line_protocol(self, tmp_path):
+        path = tmp_path / "data.lp"
+        path.write_text(LINE_PROTOCOL, encoding="utf-8")
+        result = ImportResult()
+        readings = list(read_file(str(path), result))
+        assert [(item.field, item.value) for item in readings] == [("temperature", 70.5), ("humidity", 40.0), ("humidity", 55.0)]
+        assert dict(readings[0].tags)["device_name"] == "Living Room"
+        assert result == ImportResult(read=3, invalid=1)
+
+
+class TestRateLimiter:
+    @patch("sensortrack.importer.time")
+    def test_acquire(self, time):
+        time.monotonic.return_value = 100.0
+        limiter = RateLimiter(1000.0)
+        limiter.acquire(500)
+        time.sleep.assert_not_called()
+        limiter.acquire(1000)
+        time.sleep.assert_called_once_with(0.5)
+
+    @patch("sensortrack.importer.time")
+    def test_unlimited(self, time):
+        RateLimiter(None).acquire(1_000_000)
+        time.sleep.assert_not_called()
+
+
+class TestExistingFlux:
+    def test_flux(self):
+        batch = [_sensor("d", 1.0), reading("weather", {"location": "l"}, "humidity", 2.0, NS + 60_000_000_000)]
+        assert existing_flux("bucket", batch) == (
+            'from(bucket: "bucket")\n'
+            "  |> range(start: 2024-01-02T03:04:05Z, stop: 2024-01-02T03:05:06Z)\n"
+            '  |> filter(fn: (r) => r._measurement == "sensor" or r._measurement == "weather")\n'
+            '  |> drop(columns: ["_start", "_stop", "_value"])'
+        )
+
+
+@patch("sensortrack.importer.sink")
+@patch("sensortrack.importer.InfluxDBClient")
+@patch("sensortrack.importer.config")
+class TestImportFiles:
+    def test_import(self, config, influxdb, sink, tmp_path):
+        config.return_value = MagicMock(influxdb=INFLUXDB, sinks=SinksConfig())
+        existing = {"result": "_result", "table": 0, "_time": STAMP, "_measurement": "sensor", "_field": "temperature"}
+        existing.update({"location": "l", "device": "d", "device_name": "Den", "room": "Office"})
+        query_stream = _stub_influxdb(influxdb, [MagicMock(values=existing)])
+        first, second = tmp_path / "first.csv", tmp_path / "second.csv"
+        first.write_text(CSV, encoding="utf-8")
+        second.write_text(CSV.replace("sensor,l,d,Den,Office", "sensor,l,e,,"), encoding="utf-8")
+        result = import_files([str(first), str(second)], batch_size=2, workers=2, rate=1_000_000.0)
+        assert result == ImportResult(read=8, invalid=4, duplicate=1, written=3)
+        assert query_stream.call_count == 2
+        assert all(args.kwargs == {"block": True} for args in sink.return_value.write.call_args_list)  # bulk writes wait for room
+        written = sorted(point.to_line_protocol() for args in sink.return_value.write.call_args_list for point in args[0][0])
+        assert written == [
+            "sensor,device=e,location=l temperature=70.5 %d" % NS,
+            "weather,location=l humidity=55 %d" % NS,
+            "weather,location=l humidity=55 %d" % NS,
+        ]
+        sink.return_value.flush.assert_called_once_with(final=True)
+
+    def test_within_batch(self, config, influxdb, sink, tmp_path):
+        config.return_value = MagicMock(influxdb=INFLUXDB, sinks=SinksConfig(influxdb=False))
+        path = tmp_path / "data.lp"
+        path.write_text("weather,location=l humidity=55 %d\n" % NS * 3, encoding="utf-8")
+        result = import_files([str(path)])
+        assert result == ImportResult(read=3, duplicate=2, written=1)
+        influxdb.assert_not_called()  # InfluxDB is not checked unless it is an enabled sink
+        sink.return_value.write.assert_called_once()
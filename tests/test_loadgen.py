@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from Cryptodome.PublicKey import RSA
+from smartapp.converter import CONVERTER
+from smartapp.interface import EventRequest, EventType, SignatureError, SmartAppDispatcherConfig, SmartAppRequestContext
+from smartapp.signature import SignatureVerifier
+
+from sensortrack.dispatcher import definition
+from sensortrack.fakes import FakeKeyServer
+from sensortrack.handler import is_weather_lookup
+from sensortrack.loadgen import (
+    KEY_ID,
+    LoadGenerator,
+    LoadProfile,
+    LoadReport,
+    RequestGenerator,
+    RequestSigner,
+    device_event,
+    event_request,
+    timer_event,
+)
+
+
+@pytest.fixture(scope="module", name="key")
+def fixture_key():
+    return RSA.generate(1024)  # small key, so tests are fast
+
+
+@pytest.fixture(name="keyserver")
+def fixture_keyserver(key):
+    keyserver = FakeKeyServer(key, KEY_ID)
+    keyserver.start()
+    yield keyserver
+    keyserver.stop()
+
+
+class TestRequests:
+    def test_event_request(self):
+        events = [device_event("l", "d", "temperature", 70.5), device_event("l", "e", "humidity", 45.0), timer_event()]
+        request = CONVERTER.from_json(json.dumps(event_request("l", events)), EventRequest)
+        assert request.location_id() == "l"
+        assert request.event_data.installed_app.as_bool("retrieve-weather-enabled") is True
+        device_events = request.event_data.filter(event_type=EventType.DEVICE_EVENT)
+        assert [(e["deviceId"], e["attribute"], e["value"]) for e in device_events] == [
+            ("d", "temperature", 70.5),
+            ("e", "humidity", 45.0),
+        ]
+        assert len(request.event_data.filter(event_type=EventType.TIMER_EVENT, predicate=is_weather_lookup)) == 1
+
+    def test_generator(self):
+        generator = RequestGenerator(LoadProfile(locations=2, devices=3, batch_size=4), seed=1)
+        for _ in range(10):
+            request = CONVERTER.from_json(json.dumps(generator.next()), EventRequest)
+            events = request.event_data.filter(event_type=EventType.DEVICE_EVENT)
+            assert len(events) == 4
+            for event in events:
+                assert event["locationId"] == request.location_id()
+                assert event["deviceId"].startswith(request.location_id().replace("location", "device"))
+                assert 60.0 < event["value"] < 80.0 if event["attribute"] == "temperature" else 35.0 < event["value"] < 55.0
+
+    def test_generator_timer(self):
+        generator = RequestGenerator(LoadProfile(timer_ratio=1.0), seed=1)
+        request = CONVERTER.from_json(json.dumps(generator.next()), EventRequest)
+        assert request.event_data.filter(event_type=EventType.TIMER_EVENT, predicate=is_weather_lookup)
+        assert not request.event_data.filter(event_type=EventType.DEVICE_EVENT)
+
+
+class TestSigning:
+    def test_verified(self, key, keyserver):
+        body = json.dumps(event_request("l", [device_event("l", "d", "temperature", 70.5)]))
+        headers = RequestSigner(key, definition().target_url).headers(body.encode())
+        context = SmartAppRequestContext(headers=headers, body=body)
+        config = SmartAppDispatcherConfig(keyserver_url=keyserver.url)
+        verifier = SignatureVerifier(context=context, config=config, definition=definition())
+        assert verifier.key_id == KEY_ID
+        verifier.verify()  # the dispatcher's own verifier accepts the signature
+
+    def test_wrong_target(self, key, keyserver):
+        body = json.dumps(event_request("l", []))
+        headers = RequestSigner(key, "https://elsewhere/smartapp").headers(body.encode())
+        context = SmartAppRequestContext(headers=headers, body=body)
+        config = SmartAppDispatcherConfig(keyserver_url=keyserver.url)
+        with pytest.raises(SignatureError):
+            SignatureVerifier(context=context, config=config, definition=definition()).verify()
+
+
+class TestReport:
+    def test_summary(self):
+        report = LoadReport(elapsed=2.0, latencies=[0.001 * i for i in range(1, 101)], errors={"500": 3, "ConnectionError": 1})
+        assert report.requests == 100
+        assert report.throughput() == 50.0
+        assert report.error_rate() == 0.04
+        assert report.percentile(50) == 0.05
+        assert report.percentile(99) == 0.099
+        assert report.summary() == (
+            "Requests: 100 in 2.0 seconds (50.0/sec)\n"
+            "Errors: 4 (4.00%) 500=3 ConnectionError=1\n"
+            "Latency (ms): p50=50.0 p90=90.0 p95=95.0 p99=99.0 p99.9=100.0 p100=100.0"
+        )
+
+    def test_empty(self):
+        assert LoadReport().summary().startswith("Requests: 0 in 0.0 seconds (0.0/sec)")
+
+
+class TestLoadGenerator:
+    def test_run(self, key):
+        received = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):  # pylint: disable=invalid-name:
+                received.append((self.path, self.headers["Authorization"], self.rfile.read(int(self.headers["Content-Length"]))))
+                self.send_response(500 if len(received) % 5 == 0 else 200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("localhost", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = "http://localhost:%d/smartapp" % server.server_address[1]
+            signer = RequestSigner(key, definition().target_url)
+            report = LoadGenerator(url, RequestGenerator(LoadProfile(), seed=1), signer, concurrency=4).run(
+                rate=100.0, duration_sec=0.2
+            )
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert report.requests == 20
+        assert report.errors == {"500": 4}
+        assert len(received) == 20
+        assert all(path == "/smartapp" and authorization.startswith("Signature ") for path, authorization, _ in received)
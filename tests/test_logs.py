@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+import logging
+from queue import Queue
+from typing import List
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from sensortrack.logs import DroppingQueueHandler, LogPipeline, log_exchange, pipeline, reset, sampled
+
+
+class CapturingHandler(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.records: List[str] = []
+
+    def emit(self, record):
+        self.records.append(self.format(record))
+
+
+class TestDroppingQueueHandler:
+    def test_enqueue(self):
+        queue = Queue(maxsize=2)
+        handler = DroppingQueueHandler(queue)
+        for message in ["one", "two", "three"]:
+            handler.handle(logging.makeLogRecord({"msg": "%s", "args": (message,)}))
+        assert queue.qsize() == 2
+        assert handler.dropped == 1
+
+    def test_prepare(self):
+        value = {"a": 1}
+        record = logging.makeLogRecord({"msg": "value %s", "args": (value,)})
+        prepared = DroppingQueueHandler(Queue()).prepare(record)
+        value["a"] = 2  # changed by the caller before the listener formats the record
+        assert prepared.getMessage() == "value {'a': 1}"
+        assert prepared.args is None
+        assert record.args == (value,)  # the original is left alone for any other handlers
+
+
+class TestSampled:
+    @pytest.mark.parametrize("rate", [0.0, -1.0])
+    def test_never(self, rate):
+        assert not any(sampled("id-%d" % i, rate) for i in range(100))
+
+    @pytest.mark.parametrize("rate", [1.0, 2.0])
+    def test_always(self, rate):
+        assert all(sampled("id-%d" % i, rate) for i in range(100))
+
+    def test_consistent(self):
+        first = [sampled("id-%d" % i, 0.5) for i in range(100)]
+        assert [sampled("id-%d" % i, 0.5) for i in range(100)] == first
+
+    def test_rate(self):
+        count = sum(sampled("id-%d" % i, 0.1) for i in range(10000))
+        assert 800 < count < 1200
+
+    @patch("sensortrack.logs.random")
+    def test_no_correlation_id(self, random):
+        random.random.return_value = 0.05
+        assert sampled(None, 0.1)
+        random.random.return_value = 0.5
+        assert not sampled("", 0.1)
+
+
+class TestLogPipeline:
+    @pytest.fixture
+    def root(self):
+        """Replace the root logger's handlers with a capturing handler for the duration of a test."""
+        root = logging.getLogger()
+        original, level = list(root.handlers), root.level
+        capturing = CapturingHandler()
+        root.handlers = [capturing]
+        root.setLevel(logging.DEBUG)
+        yield capturing
+        root.handlers = original
+        root.setLevel(level)
+
+    def test_pipeline(self, root):
+        logs = LogPipeline(queue_size=100)
+        logs.start()
+        assert logs.handler in logging.getLogger().handlers and root not in logging.getLogger().handlers
+        logging.info("hello %s", "world")
+        logs.stop()
+        assert logs.handler not in logging.getLogger().handlers and root in logging.getLogger().handlers
+        assert root.records == ["hello world"]
+        assert logs.dropped == 0
+
+    def test_log_exchange(self, root):
+        logs = LogPipeline(queue_size=100, sample_rate=1.0)
+        logs.log_exchange("c", b"request", "response")
+        assert root.records == ["[c] Request body: \nrequest", "[c] Response body: \nresponse"]
+
+    def test_log_exchange_not_sampled(self, root):
+        logs = LogPipeline(queue_size=100, sample_rate=0.0)
+        logs.log_exchange("c", b"request", "response")
+        assert not root.records
+
+
+class TestSingleton:
+    @pytest.fixture(autouse=True)
+    def cleanup(self):
+        """Reset singleton before and after tests."""
+        reset()
+        yield
+        reset()
+
+    @patch("sensortrack.logs.config")
+    def test_pipeline_disabled(self, config):
+        config.return_value = MagicMock(logging=None)
+        assert pipeline() is None
+        log_exchange("c", "request", "response")  # no-op when disabled
+
+    @patch("sensortrack.logs.LogPipeline")
+    @patch("sensortrack.logs.config")
+    def test_pipeline_enabled(self, config, log_pipeline):
+        config.return_value = MagicMock(logging=MagicMock(queue_size=10, body_sample_rate=0.5))
+        assert pipeline() is log_pipeline.return_value
+        assert pipeline() is log_pipeline.return_value
+        log_pipeline.assert_called_once_with(10, 0.5)
+        log_pipeline.return_value.start.assert_called_once()
+        log_exchange("c", "request", "response")
+        log_pipeline.return_value.log_exchange.assert_called_once_with("c", "request", "response")
+        reset()
+        log_pipeline.return_value.stop.assert_called_once()
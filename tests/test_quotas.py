@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=protected-access:
+import os
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+from influxdb_client import Point
+
+from sensortrack.config import ConfigError, OverflowPolicy, QuotaConfig
+from sensortrack.quotas import QuotaManager, Spool, TenantUsage, TokenBucket, quotas, reset, tenant_usage
+
+KEY = ("l", "d", "temperature")
+
+
+@pytest.fixture(autouse=True)
+def cleanup():
+    reset()
+    yield
+    reset()
+
+
+def point() -> Point:
+    return (
+        Point("sensor")
+        .tag("location", "l")
+        .tag("device", "d")
+        .field("temperature", 23.7)
+        .time(datetime.fromtimestamp(1000, tz=timezone.utc))
+    )
+
+
+class TestTokenBucket:
+    def test_take(self):
+        bucket = TokenBucket(rate=2.0, burst=3.0, now=1000.0)
+        assert bucket.take(1000.0)
+        assert bucket.take(1000.0)
+        assert bucket.take(1000.0)
+        assert not bucket.take(1000.0)  # burst is used up
+        assert bucket.take(1000.5)  # refilled at 2 per second
+        assert not bucket.take(1000.5)
+        assert bucket.take(1100.0)
+        assert bucket.tokens == 2.0  # never refills above the burst
+
+
+class TestSpool:
+    def test_spool(self, tmpdir):
+        spool = Spool(os.path.join(tmpdir, "spool"))
+        assert spool.backlog() == 0
+        spool.append("app/1", point())
+        spool.append("app/1", point())
+        path = os.path.join(tmpdir, "spool", "app_1.lp")
+        with open(path, "r", encoding="utf-8") as fp:
+            lines = fp.read().splitlines()
+        assert lines == [point().to_line_protocol(), point().to_line_protocol()]
+        assert spool.backlog() == os.path.getsize(path)
+
+
+class TestQuotaManager:
+    def test_rate_limit(self):
+        manager = QuotaManager(QuotaConfig(points_per_sec=1.0, burst=2))
+        assert manager.admit("a", KEY, 1000.0)
+        assert manager.admit("a", KEY, 1000.0)
+        assert not manager.admit("a", KEY, 1000.0)
+        assert manager.admit("b", KEY, 1000.0)  # every installed app has its own bucket
+        assert manager.admit("a", KEY, 1001.0)
+        assert [usage.written for usage in manager.usage()] == [3, 1]
+
+    def test_max_series(self):
+        manager = QuotaManager(QuotaConfig(points_per_sec=100.0, max_series=2))
+        assert manager.admit("a", ("l", "d1", "temperature"), 1000.0)
+        assert manager.admit("a", ("l", "d2", "temperature"), 1000.0)
+        assert not manager.admit("a", ("l", "d3", "temperature"), 1000.0)  # would be a third series
+        assert manager.admit("a", ("l", "d1", "temperature"), 1000.0)  # existing series are still accepted
+        assert manager.usage() == [TenantUsage(installed_app_id="a", series=2, written=3, dropped=0, aggregated=0, spooled=0)]
+
+    @patch("sensortrack.quotas._MAX_SERIES", 2)
+    def test_series_bounded(self):
+        manager = QuotaManager(QuotaConfig(points_per_sec=100.0))
+        for device in ["d1", "d2", "d1", "d3"]:
+            assert manager.admit("a", ("l", device, "temperature"), 1000.0)
+        assert list(manager._tenants["a"].series) == [("l", "d1", "temperature"), ("l", "d3", "temperature")]
+
+    @patch("sensortrack.quotas._MAX_TENANTS", 2)
+    def test_tenants_bounded(self):
+        manager = QuotaManager(QuotaConfig(points_per_sec=100.0))
+        for installed_app_id in ["a", "b", "a", "c"]:
+            manager.admit(installed_app_id, KEY, 1000.0)
+        assert [usage.installed_app_id for usage in manager.usage()] == ["a", "c"]
+
+    def test_overflow_drop(self):
+        manager = QuotaManager(QuotaConfig(points_per_sec=1.0))
+        factory = MagicMock()
+        manager.overflow("a", KEY, 1000.0, 23.7, point=factory)
+        factory.assert_not_called()
+        assert not manager.collect()
+        assert manager.usage() == [TenantUsage(installed_app_id="a", series=0, written=0, dropped=1, aggregated=0, spooled=0)]
+
+    def test_overflow_aggregate(self):
+        manager = QuotaManager(QuotaConfig(points_per_sec=1.0, overflow=OverflowPolicy.AGGREGATE, aggregate_sec=60))
+        manager.overflow("a", KEY, 1000.0, 23.0, point=MagicMock())
+        manager.overflow("a", KEY, 1010.0, 24.0, point=MagicMock())
+        assert not manager.collect(1010.0)  # the window is still open
+        collected = manager.collect(1100.0)
+        manager.restore(collected)  # as if the write had failed
+        points = manager.points(manager.collect(1100.0))
+        assert len(points) == 1
+        assert points[0]._name == "sensor_overflow"
+        assert points[0]._fields == {"temperature": 23.5, "temperature_min": 23.0, "temperature_max": 24.0, "temperature_count": 2}
+        assert manager.usage()[0].aggregated == 2
+
+    def test_overflow_spool(self, tmpdir):
+        path = os.path.join(tmpdir, "spool")
+        manager = QuotaManager(QuotaConfig(points_per_sec=1.0, overflow=OverflowPolicy.SPOOL, spool_path=path))
+        manager.overflow("a", KEY, 1000.0, 23.7, point=point)
+        assert manager.spool
+        assert manager.spool.backlog() > 0
+        assert manager.usage()[0].spooled == 1
+
+    def test_overflow_spool_no_path(self):
+        with pytest.raises(ConfigError, match="spoolPath"):
+            QuotaManager(QuotaConfig(points_per_sec=1.0, overflow=OverflowPolicy.SPOOL))
+
+
+class TestSingleton:
+    @patch("sensortrack.quotas.config")
+    def test_quotas_disabled(self, config):
+        config.return_value = MagicMock(quotas=None)
+        assert quotas() is None
+        assert not tenant_usage()
+
+    @patch("sensortrack.quotas.config")
+    def test_quotas(self, config):
+        config.return_value = MagicMock(quotas=QuotaConfig(points_per_sec=1.0))
+        manager = quotas()
+        assert manager is not None
+        assert quotas() is manager
+        manager.admit("a", KEY, 1000.0)
+        assert tenant_usage() == manager.usage()
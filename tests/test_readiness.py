@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=redefined-outer-name:
+from unittest.mock import MagicMock, patch
+
+import pytest
+from attrs import evolve
+
+from sensortrack.config import InfluxDbConfig, InfluxDbRouteConfig, ReadinessConfig
+from sensortrack.readiness import NOT_CHECKED, ReadinessChecker, checker, ping_influxdb, readiness_status, reset
+from sensortrack.rest import CircuitState, UpstreamStatus
+
+INFLUXDB = InfluxDbConfig(url="url", org="org", token="token", bucket="bucket")
+UPSTREAMS = [UpstreamStatus(name="weather", state=CircuitState.OPEN, consecutive_failures=5, rejected_calls=2, retry_tokens=1.5)]
+
+
+@pytest.fixture(autouse=True)
+def cleanup():
+    reset()
+    yield
+    reset()
+
+
+@pytest.fixture
+def dependencies():
+    with patch("sensortrack.readiness.config") as config:
+        config.return_value = MagicMock(influxdb=INFLUXDB, sinks=MagicMock(influxdb=True))
+        with patch("sensortrack.readiness.ping_influxdb", MagicMock(return_value=True)) as ping:
+            with patch("sensortrack.readiness.sink") as sink:
+                sink.return_value.pending.return_value = 10
+                with patch("sensortrack.readiness.spool_backlog", MagicMock(return_value=2048)):
+                    with patch("sensortrack.readiness.upstream_status", MagicMock(return_value=UPSTREAMS)):
+                        yield config, ping
+
+
+@patch("sensortrack.readiness.InfluxDBClient")
+def test_ping_influxdb(influxdb):
+    influxdb.return_value = MagicMock(__enter__=MagicMock(return_value=MagicMock(ping=MagicMock(return_value=True))))
+    assert ping_influxdb(INFLUXDB, 2.5) is True
+    influxdb.assert_called_once_with(url="url", org="org", token="token", timeout=2500)
+
+
+class TestReadinessChecker:
+    def test_ready(self, dependencies):
+        _, ping = dependencies
+        status = ReadinessChecker(ReadinessConfig(timeout_sec=2.0)).check()
+        ping.assert_called_once_with(INFLUXDB, 2.0)
+        assert status.ready
+        assert status.influxdb is True
+        assert status.pending_points == 10
+        assert status.spool_bytes == 2048
+        assert status.upstreams == {"weather": "OPEN"}  # reported, but doesn't affect readiness
+        assert status.reasons == []
+
+    def test_routes(self, dependencies):
+        config, ping = dependencies
+        routes = [InfluxDbRouteConfig(name="cabin", location="cabin", url="http://cabin:8086")]
+        config.return_value.influxdb = evolve(INFLUXDB, routes=routes)
+        ping.side_effect = lambda influxdb, _: influxdb.url == "url"
+        status = ReadinessChecker(ReadinessConfig()).check()
+        assert [call.args[0].url for call in ping.call_args_list] == ["url", "http://cabin:8086"]
+        assert not status.ready
+        assert status.influxdb is False
+        assert status.reasons == ["InfluxDB at http://cabin:8086 did not respond to ping"]
+
+    def test_influxdb_disabled(self, dependencies):
+        config, ping = dependencies
+        config.return_value.sinks.influxdb = False
+        status = ReadinessChecker(ReadinessConfig()).check()
+        ping.assert_not_called()
+        assert status.ready
+        assert status.influxdb is None
+
+    def test_not_ready(self, dependencies):
+        _, ping = dependencies
+        ping.return_value = False
+        status = ReadinessChecker(ReadinessConfig(max_pending_points=5, max_spool_bytes=1024)).check()
+        assert not status.ready
+        assert status.reasons == [
+            "InfluxDB at url did not respond to ping",
+            "10 points waiting to be written",
+            "2048 bytes spooled",
+        ]
+
+    @pytest.mark.usefixtures("dependencies")
+    def test_refresh(self):
+        readiness = ReadinessChecker(ReadinessConfig(interval_sec=10.0))
+        assert readiness.status() is NOT_CHECKED
+        readiness.refresh()
+        status = readiness.status()
+        assert status.ready
+        assert status.checked_at
+        assert readiness.status(status.checked_at + 30.0) is status
+        stale = readiness.status(status.checked_at + 31.0)
+        assert not stale.ready
+        assert stale.reasons == ["Last checked 31 seconds ago"]
+
+
+class TestSingleton:
+    def test_readiness_status_not_created(self):
+        assert readiness_status() is NOT_CHECKED
+
+    @patch("sensortrack.readiness.config")
+    def test_checker(self, config):
+        config.return_value = MagicMock(readiness=ReadinessConfig(interval_sec=5.0))
+        readiness = checker()
+        assert readiness.settings.interval_sec == 5.0
+        assert checker() is readiness
+        assert readiness_status() is NOT_CHECKED  # created, but nothing has been checked yet
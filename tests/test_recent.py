@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+from unittest.mock import patch
+
+import pytest
+
+from sensortrack.recent import DeviceStatus, RecentReadings, RingBuffer, recent, reset
+
+
+class TestRingBuffer:
+    def test_empty(self):
+        buffer = RingBuffer(3)
+        assert buffer.latest() is None
+        assert not buffer.window(0.0)
+
+    def test_wraparound(self):
+        buffer = RingBuffer(3)
+        for i in range(5):
+            buffer.append(float(i), float(i * 10))
+        assert buffer.size == 3
+        assert buffer.latest() == (4.0, 40.0)
+        assert buffer.window(0.0) == [(2.0, 20.0), (3.0, 30.0), (4.0, 40.0)]
+        assert buffer.window(3.0) == [(3.0, 30.0), (4.0, 40.0)]
+        assert not buffer.window(5.0)
+
+
+class TestRecentReadings:
+    def test_latest_and_window(self):
+        readings = RecentReadings(capacity=10, max_series=10)
+        readings.record("l", "d", "temperature", 70.0, timestamp=100.0)
+        readings.record("l", "d", "temperature", 71.0, timestamp=200.0)
+        assert readings.latest("l", "d", "temperature") == (200.0, 71.0)
+        assert readings.latest("l", "d", "humidity") is None
+        with patch("sensortrack.recent.time.time", return_value=250.0):
+            assert readings.window("l", "d", "temperature", 100.0) == [(200.0, 71.0)]
+            assert readings.window("l", "d", "temperature", 200.0) == [(100.0, 70.0), (200.0, 71.0)]
+            assert readings.window("l", "x", "temperature", 200.0) is None
+
+    def test_evicts_least_recently_updated(self):
+        readings = RecentReadings(capacity=10, max_series=2)
+        readings.record("l", "a", "temperature", 1.0, timestamp=1.0)
+        readings.record("l", "b", "temperature", 2.0, timestamp=2.0)
+        readings.record("l", "a", "temperature", 3.0, timestamp=3.0)
+        readings.record("l", "c", "temperature", 4.0, timestamp=4.0)
+        assert readings.latest("l", "a", "temperature") == (3.0, 3.0)
+        assert readings.latest("l", "b", "temperature") is None
+        assert readings.latest("l", "c", "temperature") == (4.0, 4.0)
+        assert [status.device_id for status in readings.devices("l")] == ["a", "c"]  # evicted series leave the index too
+        readings.record("other", "d", "temperature", 5.0, timestamp=5.0)
+        readings.record("other", "e", "temperature", 6.0, timestamp=6.0)
+        assert not readings.devices("l")
+
+    def test_devices(self):
+        readings = RecentReadings()
+        readings.record("l", "d", "temperature", 70.0, timestamp=100.0)
+        readings.record("l", "d", "humidity", 40.0, timestamp=150.0)
+        readings.record("l", "e", "temperature", 65.0, timestamp=120.0)
+        readings.record("other", "f", "temperature", 60.0, timestamp=120.0)
+        with patch("sensortrack.recent.time.time", return_value=200.0):
+            assert readings.devices("l") == [
+                DeviceStatus(
+                    location_id="l",
+                    device_id="d",
+                    last_seen=150.0,
+                    staleness_sec=50.0,
+                    values={"humidity": 40.0, "temperature": 70.0},
+                ),
+                DeviceStatus(location_id="l", device_id="e", last_seen=120.0, staleness_sec=80.0, values={"temperature": 65.0}),
+            ]
+        assert not readings.devices("bogus")
+
+
+class TestSingleton:
+    @pytest.fixture(autouse=True)
+    def cleanup(self):
+        """Reset singleton before and after tests."""
+        reset()
+        yield
+        reset()
+
+    def test_recent(self):
+        assert recent() is recent()
+        recent().record("l", "d", "temperature", 70.0)
+        reset()
+        assert recent().latest("l", "d", "temperature") is None
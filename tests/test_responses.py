@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+import json
+from unittest.mock import MagicMock, patch
+
+import pytest
+from smartapp.converter import CONVERTER
+from smartapp.dispatcher import SmartAppDispatcher, StaticConfigManager
+from smartapp.interface import (
+    BadRequestError,
+    ConfirmationResponse,
+    EventResponse,
+    InternalError,
+    LifecycleRequest,
+    SmartAppDispatcherConfig,
+    SmartAppRequestContext,
+)
+
+from sensortrack.dispatcher import definition
+from sensortrack.loadgen import device_event, event_request
+from sensortrack.responses import PrecomputedResponses, dispatch, encode, reset, responses
+
+EVENT = event_request("l", [device_event("l", "d", "temperature", 70.1)])
+CONFIGURATION = {
+    "lifecycle": "CONFIGURATION",
+    "executionId": "e",
+    "locale": "en",
+    "version": "0.1.0",
+    "configurationData": {"installedAppId": "i", "phase": "INITIALIZE", "pageId": "", "previousPageId": "", "config": {}},
+    "settings": {},
+}
+PAGE_DATA = {**CONFIGURATION["configurationData"], "phase": "PAGE", "pageId": "1"}  # type: ignore
+PAGE = {**CONFIGURATION, "configurationData": PAGE_DATA}
+CONFIRMATION = {
+    "lifecycle": "CONFIRMATION",
+    "executionId": "e",
+    "appId": "a",
+    "locale": "en",
+    "version": "0.1.0",
+    "confirmationData": {"appId": "a", "confirmationUrl": "https://example.com"},
+    "settings": {},
+}
+
+
+def _dispatcher(check_signatures: bool) -> SmartAppDispatcher:
+    return SmartAppDispatcher(
+        config=SmartAppDispatcherConfig(check_signatures=check_signatures), definition=definition(), event_handler=MagicMock()
+    )
+
+
+@patch("sensortrack.responses.dispatcher")
+class TestDispatch:
+    @pytest.mark.parametrize(
+        "request_json", [EVENT, CONFIGURATION, PAGE, CONFIRMATION], ids=["event", "initialize", "page", "confirmation"]
+    )
+    def test_dispatch(self, dispatcher, request_json):
+        # the response must be the same as the one from the SDK dispatcher, other than formatting
+        dispatcher.return_value = _dispatcher(check_signatures=False)
+        body = json.dumps(request_json)
+        expected = json.loads(dispatcher.return_value.dispatch(SmartAppRequestContext(body=body)))
+        assert json.loads(dispatch({}, body.encode())) == expected
+
+    def test_dispatch_precomputed(self, dispatcher):
+        dispatcher.return_value = _dispatcher(check_signatures=False)
+        assert dispatch({}, json.dumps(PAGE).encode()) is responses().pages[1]
+        dispatcher.return_value.event_handler.handle_configuration.assert_called_once()
+        assert dispatch({}, json.dumps(CONFIRMATION).encode()) is responses().confirmation
+        dispatcher.return_value.event_handler.handle_confirmation.assert_called_once()
+
+    def test_dispatch_invalid_page(self, dispatcher):
+        dispatcher.return_value = _dispatcher(check_signatures=False)
+        page = {**PAGE, "configurationData": {**PAGE_DATA, "pageId": "99"}}
+        with pytest.raises(BadRequestError, match="Page not found"):
+            dispatch({}, json.dumps(page).encode())
+
+    @pytest.mark.parametrize(
+        "request_json,verifier_path",
+        [(EVENT, "smartapp.dispatcher.SignatureVerifier"), (CONFIRMATION, "sensortrack.responses.SignatureVerifier")],
+        ids=["dispatcher", "precomputed"],
+    )
+    def test_dispatch_signature(self, dispatcher, request_json, verifier_path):
+        dispatcher.return_value = _dispatcher(check_signatures=True)
+        with patch(verifier_path) as verifier:
+            dispatch({"Authorization": "signature"}, json.dumps(request_json).encode())
+            context = verifier.call_args.kwargs["context"]
+            assert context.signature == "signature"
+            assert context.body == json.dumps(request_json)  # the signature covers the body, so it's needed as a string
+            verifier.return_value.verify.assert_called_once()
+
+    def test_dispatch_public(self, dispatcher):
+        dispatcher.return_value = MagicMock(wraps=_dispatcher(check_signatures=False))
+        assert json.loads(dispatch({}, json.dumps(EVENT).encode())) == {"eventData": {}}
+        context = dispatcher.return_value.dispatch.call_args[0][0]  # through the SDK's public dispatch
+        assert context.body == json.dumps(EVENT)
+
+    def test_dispatch_invalid_json(self, dispatcher):
+        dispatcher.return_value = _dispatcher(check_signatures=False)
+        with pytest.raises(BadRequestError, match="Invalid JSON"):
+            dispatch({}, b"{")
+
+    def test_dispatch_invalid_request(self, dispatcher):
+        dispatcher.return_value = _dispatcher(check_signatures=False)
+        with pytest.raises(BadRequestError):
+            dispatch({}, b'{"lifecycle": "BOGUS"}')
+
+    def test_dispatch_handler_error(self, dispatcher):
+        dispatcher.return_value = _dispatcher(check_signatures=False)
+        dispatcher.return_value.event_handler.handle_event.side_effect = Exception("error")
+        with pytest.raises(InternalError):
+            dispatch({}, json.dumps(EVENT).encode())
+
+
+def _request(lifecycle: str, **data: str) -> LifecycleRequest:
+    body = {"lifecycle": lifecycle, "executionId": "e", "locale": "en", "version": "0.1.0", "settings": {}}
+    if lifecycle == "CONFIRMATION":
+        body.update({"appId": "a", "confirmationData": {"appId": "a", "confirmationUrl": "https://example.com"}})
+    elif lifecycle == "CONFIGURATION":
+        body["configurationData"] = {"installedAppId": "i", "previousPageId": "", "config": {}, **data}
+    else:
+        body["eventData"] = {
+            "authToken": "t",
+            "installedApp": {"installedAppId": "i", "locationId": "l", "config": {}, "permissions": []},
+            "events": [],
+        }
+    return CONVERTER.from_json(json.dumps(body), LifecycleRequest)  # type: ignore
+
+
+class TestEncode:
+    def test_encode(self):
+        assert json.loads(encode(EventResponse())) == {"eventData": {}}
+        assert encode(EventResponse()) is encode(EventResponse())  # encoded once, up front
+        assert json.loads(encode(ConfirmationResponse(target_url="url"))) == {"targetUrl": "url"}
+
+
+class TestPrecomputedResponses:
+    def test_responses(self):
+        # the precomputed responses must be the same as the ones the SDK builds, other than formatting
+        manager = StaticConfigManager()
+        precomputed = PrecomputedResponses(definition(), "v")
+        initialize = _request("CONFIGURATION", phase="INITIALIZE", pageId="")
+        page = _request("CONFIGURATION", phase="PAGE", pageId="1")
+        confirmation = _request("CONFIRMATION")
+        assert json.loads(precomputed.lookup(initialize)) == json.loads(
+            CONVERTER.to_json(manager.handle_initialize(initialize, definition()))
+        )
+        assert json.loads(precomputed.lookup(page)) == json.loads(CONVERTER.to_json(manager.handle_page(page, definition(), 1)))
+        assert json.loads(precomputed.lookup(confirmation)) == {"targetUrl": definition().target_url}
+        assert list(precomputed.pages.keys()) == [1]
+
+    @pytest.mark.parametrize("page_id", ["2", "bogus"])
+    def test_lookup_unknown_page(self, page_id):
+        precomputed = PrecomputedResponses(definition(), "v")
+        assert precomputed.lookup(_request("CONFIGURATION", phase="PAGE", pageId=page_id)) is None
+
+    def test_lookup_other(self):
+        precomputed = PrecomputedResponses(definition(), "v")
+        assert precomputed.lookup(_request("EVENT")) is None
+
+
+class TestResponses:
+    @pytest.fixture(autouse=True)
+    def cleanup(self):
+        """Reset singleton before and after tests."""
+        reset()
+        yield
+        reset()
+
+    def test_responses(self):
+        assert responses() is responses()
+        assert json.loads(responses().confirmation) == {"targetUrl": definition().target_url}
+
+    @patch("sensortrack.responses.definition_version")
+    def test_responses_version(self, definition_version):
+        definition_version.return_value = "1"
+        first = responses()
+        assert first.version == "1"
+        assert responses() is first  # same version, so not rebuilt
+        definition_version.return_value = "2"
+        second = responses()
+        assert second is not first  # rebuilt for the new version
+        assert second.version == "2"
+        assert second.confirmation == first.confirmation
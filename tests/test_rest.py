@@ -1,20 +1,203 @@
 # -*- coding: utf-8 -*-
 # vim: set ft=python ts=4 sw=4 expandtab:
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 import pytest
-from requests.exceptions import HTTPError
+from requests.exceptions import HTTPError, ReadTimeout
 
-from sensortrack.rest import RestClientError, raise_for_status
+from sensortrack.rest import (
+    CircuitBreaker,
+    CircuitOpenError,
+    CircuitState,
+    RestClientError,
+    RestDataError,
+    RetryBudget,
+    decaying_retry,
+    raise_for_status,
+    reset,
+    upstream,
+    upstream_status,
+)
 
 
 class TestFunctions:
     def test_raise_for_status(self):
         request = MagicMock(body="request")
-        response = MagicMock(request=request, text="response")
+        response = MagicMock(request=request, text="response", status_code=404)
         response.raise_for_status = MagicMock()
         response.raise_for_status.side_effect = HTTPError("hello")
         with pytest.raises(RestClientError) as e:
             raise_for_status(response)
         assert e.value.request_body == "request"
         assert e.value.response_body == "response"
+        assert e.value.status_code == 404
+
+
+class TestCircuitBreaker:
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout_sec=60.0)
+        assert breaker.allow() is True
+        breaker.record_failure()
+        assert breaker.state == CircuitState.CLOSED
+        breaker.record_failure()
+        assert breaker.state == CircuitState.OPEN
+        assert breaker.allow() is False
+        assert breaker.rejected_calls == 1
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        assert breaker.state == CircuitState.CLOSED
+        assert breaker.consecutive_failures == 1
+
+    def test_half_open_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout_sec=0.0, half_open_max_calls=1)
+        breaker.record_failure()
+        assert breaker.state == CircuitState.HALF_OPEN
+        assert breaker.allow() is True  # the probe
+        assert breaker.allow() is False  # only one probe at a time
+        breaker.record_success()
+        assert breaker.state == CircuitState.CLOSED
+
+    def test_half_open_probe_failure(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout_sec=60.0)
+        breaker.record_failure()
+        with patch("sensortrack.rest.time.monotonic", return_value=10_000_000.0):
+            assert breaker.state == CircuitState.HALF_OPEN
+            assert breaker.allow() is True
+            breaker.record_failure()
+            assert breaker.state == CircuitState.OPEN
+
+    def test_half_open_probe_release(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout_sec=0.0, half_open_max_calls=1)
+        breaker.record_failure()
+        assert breaker.allow() is True
+        breaker.release()
+        assert breaker.state == CircuitState.HALF_OPEN
+        assert breaker.allow() is True  # another probe is allowed
+
+
+class TestRetryBudget:
+    def test_withdraw_until_exhausted(self):
+        budget = RetryBudget(ratio=0.5, min_per_sec=0.0, max_tokens=2.0)
+        assert budget.withdraw() is True
+        assert budget.withdraw() is True
+        assert budget.withdraw() is False
+
+    def test_deposit(self):
+        budget = RetryBudget(ratio=0.5, min_per_sec=0.0, max_tokens=2.0)
+        budget.withdraw()
+        budget.withdraw()
+        budget.deposit()
+        assert budget.withdraw() is False
+        budget.deposit()
+        assert budget.withdraw() is True
+
+    def test_max_tokens(self):
+        budget = RetryBudget(ratio=5.0, min_per_sec=0.0, max_tokens=2.0)
+        budget.deposit()
+        assert budget.tokens == 2.0
+
+
+class TestDecayingRetry:
+    @pytest.fixture(autouse=True)
+    def cleanup(self):
+        """Reset upstream state before and after tests."""
+        reset()
+        yield
+        reset()
+
+    @patch("tenacity.nap.time.sleep")
+    def test_retry_then_success(self, _):
+        func = MagicMock(side_effect=[RestClientError("hello"), "result"])
+        wrapped = decaying_retry("test-success")(func)
+        assert wrapped() == "result"
+        assert func.call_count == 2
+        assert upstream("test-success").breaker.state == CircuitState.CLOSED
+
+    @patch("tenacity.nap.time.sleep")
+    def test_breaker_stops_retries_and_fails_fast(self, _):
+        func = MagicMock(side_effect=RestClientError("hello"))
+        wrapped = decaying_retry("test-failure")(func)
+        with pytest.raises(Exception):
+            wrapped()
+        assert func.call_count == 4  # the backoff limit stops the retries before the 5th attempt
+        with pytest.raises(Exception):
+            wrapped()
+        assert func.call_count == 5  # the breaker opens on the 5th consecutive failure
+        assert upstream("test-failure").breaker.state == CircuitState.OPEN
+        with pytest.raises(CircuitOpenError):
+            wrapped()
+        assert func.call_count == 5  # no further attempts while the breaker is open
+
+    @patch("tenacity.nap.time.sleep")
+    def test_budget_limits_retries(self, _):
+        target = upstream("test-budget")
+        target.budget = RetryBudget(ratio=0.0, min_per_sec=0.0, max_tokens=1.0)
+        func = MagicMock(side_effect=RestClientError("hello"))
+        wrapped = decaying_retry("test-budget")(func)
+        with pytest.raises(Exception):
+            wrapped()
+        assert func.call_count == 2  # one attempt plus the single retry the budget allows
+
+    @patch("tenacity.nap.time.sleep")
+    def test_backoff_limited(self, sleep):
+        func = MagicMock(side_effect=RestClientError("hello"))
+        wrapped = decaying_retry("test-backoff")(func)
+        with pytest.raises(Exception):
+            wrapped()
+        assert [c.args[0] for c in sleep.call_args_list] == [0.25, 0.5, 1.0]  # the next wait would exceed the limit
+
+    def test_client_error(self):
+        func = MagicMock(side_effect=RestClientError("hello", status_code=404))
+        wrapped = decaying_retry("test-client")(func)
+        with pytest.raises(RestClientError):
+            wrapped()
+        assert func.call_count == 1  # not retried
+        assert upstream("test-client").breaker.consecutive_failures == 0  # and not counted against the breaker
+
+    @patch("tenacity.nap.time.sleep")
+    @pytest.mark.parametrize("status_code", [408, 429, 503])
+    def test_retryable_status(self, _, status_code):
+        func = MagicMock(side_effect=[RestClientError("hello", status_code=status_code), "result"])
+        wrapped = decaying_retry("test-status-%d" % status_code)(func)
+        assert wrapped() == "result"
+        assert func.call_count == 2
+
+    def test_non_retryable(self):
+        func = MagicMock(side_effect=ValueError("hello"))
+        wrapped = decaying_retry("test-other")(func)
+        with pytest.raises(ValueError):
+            wrapped()
+        assert func.call_count == 1
+        assert upstream("test-other").breaker.consecutive_failures == 0
+
+    def test_timeout(self):
+        func = MagicMock(side_effect=ReadTimeout("hello"))
+        wrapped = decaying_retry("test-timeout")(func)
+        with pytest.raises(ReadTimeout):
+            wrapped()
+        assert func.call_count == 1  # not retried
+        assert upstream("test-timeout").breaker.consecutive_failures == 1  # but counted against the breaker
+
+    def test_non_retryable_half_open(self):
+        target = upstream("test-half-open")
+        target.breaker = CircuitBreaker(failure_threshold=1, reset_timeout_sec=0.0)
+        target.breaker.record_failure()
+        func = MagicMock(side_effect=[RestDataError("hello"), "result"])
+        wrapped = decaying_retry("test-half-open")(func)
+        with pytest.raises(RestDataError):
+            wrapped()
+        assert target.breaker.state == CircuitState.HALF_OPEN  # the probe was released, not held
+        assert wrapped() == "result"
+        assert target.breaker.state == CircuitState.CLOSED
+
+    def test_upstream_status(self):
+        upstream("test-status")
+        status = [s for s in upstream_status() if s.name == "test-status"][0]
+        assert status.state == CircuitState.CLOSED
+        assert status.consecutive_failures == 0
+        assert status.rejected_calls == 0
+        assert status.retry_tokens == 10.0
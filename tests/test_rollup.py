@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=protected-access:
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, call, patch
+
+import pytest
+
+from sensortrack.config import ConfigError, InfluxDbConfig, RollupConfig, SinksConfig
+from sensortrack.rollup import backfill_rollup, parse_duration, provision_rollups, rollup_flux, task_flux, task_name
+
+ROLLUP_5M = RollupConfig(bucket="metrics_5m", every="5m")
+ROLLUP_1H = RollupConfig(bucket="metrics_1h", every="1h", retention_sec=3600)
+INFLUXDB = InfluxDbConfig(url="url", org="org", token="token", bucket="metrics", rollups=[ROLLUP_5M, ROLLUP_1H])
+
+
+def _client(influxdb):
+    client = MagicMock()
+    influxdb.return_value = MagicMock(__enter__=MagicMock(return_value=client))
+    return client
+
+
+class TestFunctions:
+    @pytest.mark.parametrize("duration,expected", [("30s", 30), ("5m", 300), ("1h", 3600), ("2d", 172800), ("1w", 604800)])
+    def test_parse_duration(self, duration, expected):
+        assert parse_duration(duration) == expected
+
+    @pytest.mark.parametrize("duration", ["", "5", "m", "0m", "5y", "1h30m"])
+    def test_parse_duration_invalid(self, duration):
+        with pytest.raises(ConfigError):
+            parse_duration(duration)
+
+    def test_task_name(self):
+        assert task_name(ROLLUP_5M) == "sensortrack-rollup-metrics_5m"
+
+    def test_rollup_flux(self):
+        flux = rollup_flux(INFLUXDB, ROLLUP_5M, "2023-01-01T00:00:00Z", "2023-01-08T00:00:00Z")
+        assert 'from(bucket: "metrics")' in flux
+        assert "range(start: 2023-01-01T00:00:00Z, stop: 2023-01-08T00:00:00Z)" in flux
+        assert "aggregateWindow(every: 5m, fn: mean, createEmpty: false)" in flux
+        assert "aggregateWindow(every: 5m, fn: min, createEmpty: false)" in flux
+        assert "aggregateWindow(every: 5m, fn: max, createEmpty: false)" in flux
+        assert 'r._field + "_min"' in flux
+        assert 'r._field + "_max"' in flux
+        assert 'to(bucket: "metrics_5m", org: "org")' in flux
+
+    def test_task_flux(self):
+        flux = task_flux(INFLUXDB, ROLLUP_1H)
+        assert flux.startswith('option task = {name: "sensortrack-rollup-metrics_1h", every: 1h, offset: 1m}')
+        assert "range(start: -7200s)" in flux
+
+
+@patch("sensortrack.rollup.InfluxDBClient")
+class TestBackfill:
+    def test_backfill_rollup(self, influxdb):
+        client = _client(influxdb)
+        start = datetime(2023, 1, 1, 0, 7, tzinfo=timezone.utc)  # not aligned to the window
+        stop = datetime(2023, 1, 15, 0, 0, tzinfo=timezone.utc)
+        backfill_rollup(INFLUXDB, ROLLUP_1H, start, stop)
+        influxdb.assert_called_once_with(url="url", org="org", token="token")
+        queries = [args[0] for args, _ in client.query_api.return_value.query.call_args_list]
+        assert len(queries) == 2
+        assert "range(start: 2023-01-01T00:00:00Z, stop: 2023-01-08T00:00:00Z)" in queries[0]
+        assert "range(start: 2023-01-08T00:00:00Z, stop: 2023-01-15T00:00:00Z)" in queries[1]
+        writes = client.write_api.return_value.write.call_args_list
+        assert [kwargs["bucket"] for _, kwargs in writes] == ["metrics_1h", "metrics_1h"]
+        assert [kwargs["record"]._fields for _, kwargs in writes] == [  # checkpointed after each chunk
+            {"through": int(datetime(2023, 1, 8, tzinfo=timezone.utc).timestamp()), "stop": int(stop.timestamp())},
+            {"through": int(stop.timestamp()), "stop": int(stop.timestamp())},
+        ]
+
+
+@patch("sensortrack.rollup.backfill_rollup")
+@patch("sensortrack.rollup.InfluxDBClient")
+@patch("sensortrack.rollup.config")
+class TestProvision:
+    def test_no_rollups(self, config, influxdb, backfill):
+        config.return_value = MagicMock(influxdb=InfluxDbConfig(url="url", org="org", token="token", bucket="metrics"))
+        assert provision_rollups() is None
+        influxdb.assert_not_called()
+        backfill.assert_not_called()
+
+    def test_influxdb_disabled(self, config, influxdb, backfill):
+        config.return_value = MagicMock(influxdb=INFLUXDB, sinks=SinksConfig(influxdb=False))
+        assert provision_rollups() is None
+        influxdb.assert_not_called()
+        backfill.assert_not_called()
+
+    def test_provision(self, config, influxdb, backfill):
+        config.return_value = MagicMock(influxdb=INFLUXDB)
+        client = _client(influxdb)
+        earliest = datetime(2023, 1, 1, tzinfo=timezone.utc)
+
+        # metrics_5m is new, metrics_1h already exists with stale task flux and existing data
+        client.buckets_api.return_value.find_bucket_by_name.side_effect = [None, MagicMock()]
+        stale = MagicMock(id="stale")
+        stale.name = "sensortrack-rollup-metrics_old"
+        other = MagicMock(id="other")
+        other.name = "unrelated"
+        client.tasks_api.return_value.find_tasks.side_effect = [[], [MagicMock(id="1h", flux="old")], [stale, other]]
+        client.query_api.return_value.query_stream.side_effect = [
+            [],  # metrics_5m has no checkpoint
+            [],  # metrics_5m is empty
+            [],  # metrics_1h has no checkpoint
+            [MagicMock(values={"_time": earliest})],  # metrics_1h has data
+            [MagicMock(values={"_time": earliest})],  # earliest raw data
+        ]
+
+        provision_rollups(background=False)
+
+        client.buckets_api.return_value.create_bucket.assert_called_once_with(
+            bucket_name="metrics_5m", retention_rules=None, org="org"
+        )
+        (_, kwargs) = client.tasks_api.return_value.create_task.call_args
+        assert kwargs["task_create_request"].flux == task_flux(INFLUXDB, ROLLUP_5M)
+        (args, _) = client.tasks_api.return_value.update_task_request.call_args
+        assert args[0] == "1h"
+        assert args[1].flux == task_flux(INFLUXDB, ROLLUP_1H)
+        client.tasks_api.return_value.delete_task.assert_called_once_with("stale")
+        assert backfill.call_count == 1
+        assert backfill.call_args[0][:3] == (INFLUXDB, ROLLUP_5M, earliest)
+        (_, kwargs) = client.write_api.return_value.write.call_args  # checkpointed before the backfill starts
+        assert kwargs["bucket"] == "metrics_5m"
+        assert kwargs["record"]._fields == {"through": int(earliest.timestamp()), "stop": int(backfill.call_args[0][3].timestamp())}
+
+    def test_provision_resume(self, config, influxdb, backfill):
+        config.return_value = MagicMock(influxdb=INFLUXDB)
+        client = _client(influxdb)
+        through, stop = datetime(2023, 1, 8, tzinfo=timezone.utc), datetime(2023, 2, 1, tzinfo=timezone.utc)
+        client.tasks_api.return_value.find_tasks.side_effect = [[], [], []]
+        client.query_api.return_value.query_stream.side_effect = [
+            [  # metrics_5m was interrupted part way through
+                MagicMock(values={"_field": "through", "_value": int(through.timestamp())}),
+                MagicMock(values={"_field": "stop", "_value": int(stop.timestamp())}),
+            ],
+            [  # metrics_1h was completed
+                MagicMock(values={"_field": "through", "_value": int(stop.timestamp())}),
+                MagicMock(values={"_field": "stop", "_value": int(stop.timestamp())}),
+            ],
+        ]
+        provision_rollups(background=False)
+        backfill.assert_called_once_with(INFLUXDB, ROLLUP_5M, through, stop)
+        client.write_api.assert_not_called()
+
+    def test_provision_background(self, config, influxdb, backfill):
+        config.return_value = MagicMock(influxdb=INFLUXDB)
+        client = _client(influxdb)
+        earliest = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        client.tasks_api.return_value.find_tasks.side_effect = [[], [], []]
+        client.query_api.return_value.query_stream.side_effect = [[], [], [], [], [MagicMock(values={"_time": earliest})]]
+        thread = provision_rollups()
+        assert thread is not None
+        thread.join()
+        backfill.assert_has_calls([call(INFLUXDB, ROLLUP_5M, earliest, backfill.call_args[0][3])], any_order=True)
+        assert backfill.call_count == 2
+
+    def test_provision_no_raw_data(self, config, influxdb, backfill):
+        config.return_value = MagicMock(influxdb=INFLUXDB)
+        client = _client(influxdb)
+        client.tasks_api.return_value.find_tasks.side_effect = [[], [], []]
+        client.query_api.return_value.query_stream.side_effect = [[], [], [], [], []]
+        assert provision_rollups() is None
+        backfill.assert_not_called()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=protected-access:
+from array import array
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from sensortrack.config import InfluxDbConfig, InfluxDbRouteConfig
+from sensortrack.series import _CHUNK_SEC, _MAX_CHUNKS, ChunkCache, Downsample, lttb, minmax, reset, retrieve_series
+
+
+def _arrays(values):
+    return array("d", [float(i) for i in range(len(values))]), array("d", values)
+
+
+class TestLttb:
+    def test_below_threshold(self):
+        timestamps, values = _arrays([1.0, 2.0, 3.0])
+        assert lttb(timestamps, values, 10) == (timestamps, values)
+
+    def test_keeps_endpoints_and_peaks(self):
+        timestamps, values = _arrays([0.0, 1.0, 0.0, 0.0, 10.0, 0.0, 0.0, -10.0, 0.0, 0.0])
+        out_t, out_v = lttb(timestamps, values, 4)
+        assert len(out_t) == 4
+        assert (out_t[0], out_v[0]) == (0.0, 0.0)
+        assert (out_t[-1], out_v[-1]) == (9.0, 0.0)
+        assert 10.0 in out_v
+        assert -10.0 in out_v
+        assert list(out_t) == sorted(out_t)
+
+
+class TestMinMax:
+    def test_below_threshold(self):
+        timestamps, values = _arrays([1.0, 2.0, 3.0])
+        assert minmax(timestamps, values, 2) == (timestamps, values)
+
+    def test_keeps_min_and_max_per_bucket(self):
+        timestamps, values = _arrays([5.0, 1.0, 9.0, 5.0, 5.0, 2.0, 8.0, 5.0])
+        out_t, out_v = minmax(timestamps, values, 2)
+        assert list(out_t) == [1.0, 2.0, 5.0, 6.0]
+        assert list(out_v) == [1.0, 9.0, 2.0, 8.0]
+
+
+class TestChunkCache:
+    def test_evicts_least_recently_used(self):
+        cache = ChunkCache(max_chunks=2)
+        cache.put(("l", "d", "a", 1), _arrays([1.0]))
+        cache.put(("l", "d", "a", 2), _arrays([2.0]))
+        assert cache.get(("l", "d", "a", 1)) is not None
+        cache.put(("l", "d", "a", 3), _arrays([3.0]))
+        assert cache.get(("l", "d", "a", 1)) is not None
+        assert cache.get(("l", "d", "a", 2)) is None
+        assert cache.get(("l", "d", "a", 3)) is not None
+
+    def test_evicts_by_points(self):
+        cache = ChunkCache(max_chunks=10, max_points=4)
+        cache.put(("l", "d", "a", 1), _arrays([1.0, 1.0]))
+        cache.put(("l", "d", "a", 2), _arrays([2.0, 2.0]))
+        cache.put(("l", "d", "a", 2), _arrays([2.0]))  # replacing a chunk doesn't count it twice
+        assert cache.points == 3
+        cache.put(("l", "d", "a", 3), _arrays([3.0, 3.0]))
+        assert cache.get(("l", "d", "a", 1)) is None
+        assert cache.points == 3
+        cache.put(("l", "d", "a", 4), _arrays([4.0] * 5))  # larger than the whole cache, so not cached at all
+        assert cache.get(("l", "d", "a", 4)) is None
+        assert cache.get(("l", "d", "a", 3)) is not None
+
+
+def _record(timestamp, value):
+    return MagicMock(values={"_time": datetime.fromtimestamp(timestamp, tz=timezone.utc), "_value": value})
+
+
+@patch("sensortrack.series.config")
+@patch("sensortrack.series.InfluxDBClient")
+class TestRetrieveSeries:
+    @pytest.fixture(autouse=True)
+    def cleanup(self):
+        """Reset cache before and after tests."""
+        reset()
+        yield
+        reset()
+
+    def test_retrieve_series(self, influxdb, config):
+        config.return_value = MagicMock(influxdb=MagicMock(url="url", org="org", token="token", bucket="bucket"))
+        query_stream = MagicMock(return_value=[_record(10.0, 1.0), _record(20.0, 2.0), _record(_CHUNK_SEC + 10.0, 3.0)])
+        influxdb.return_value = MagicMock(
+            __enter__=MagicMock(return_value=MagicMock(query_api=MagicMock(return_value=MagicMock(query_stream=query_stream))))
+        )
+
+        # The first retrieval fetches both chunks with a single query
+        assert retrieve_series("l", "d", "temperature", 15.0, 2 * _CHUNK_SEC, 100) == [(20.0, 2.0), (_CHUNK_SEC + 10.0, 3.0)]
+        influxdb.assert_called_once_with(url="url", org="org", token="token")
+        query_stream.assert_called_once()
+        (query,), kwargs = query_stream.call_args
+        assert 'from(bucket: "bucket")' in query
+        assert "r.device == params.device" in query
+        assert kwargs["params"]["measurement"] == "sensor"
+        assert kwargs["params"]["field"] == "temperature"
+        assert kwargs["params"]["location"] == "l"
+        assert kwargs["params"]["device"] == "d"
+        assert kwargs["params"]["start"] == datetime.fromtimestamp(0, tz=timezone.utc)
+        assert kwargs["params"]["stop"] == datetime.fromtimestamp(2 * _CHUNK_SEC, tz=timezone.utc)
+
+        # The second retrieval is served from the cache, since both chunks are settled
+        assert retrieve_series("l", "d", "temperature", 0.0, _CHUNK_SEC, 100, Downsample.MINMAX) == [(10.0, 1.0), (20.0, 2.0)]
+        query_stream.assert_called_once()
+
+    def test_retrieve_series_beyond_cache(self, influxdb, config):
+        config.return_value = MagicMock(influxdb=MagicMock(url="url", org="org", token="token", bucket="bucket"))
+        query_stream = MagicMock(return_value=[_record(10.0, 1.0), _record(20.0, 2.0)])
+        influxdb.return_value = MagicMock(
+            __enter__=MagicMock(return_value=MagicMock(query_api=MagicMock(return_value=MagicMock(query_stream=query_stream))))
+        )
+        stop = (_MAX_CHUNKS + 1) * _CHUNK_SEC
+        assert retrieve_series("l", "d", "temperature", 15.0, stop, 100) == [(20.0, 2.0)]
+        _, kwargs = query_stream.call_args
+        assert kwargs["params"]["start"] == datetime.fromtimestamp(15.0, tz=timezone.utc)
+        assert kwargs["params"]["stop"] == datetime.fromtimestamp(stop, tz=timezone.utc)
+
+        # Nothing was cached, so a narrower retrieval queries again
+        assert retrieve_series("l", "d", "temperature", 0.0, _CHUNK_SEC, 100) == [(10.0, 1.0), (20.0, 2.0)]
+        assert query_stream.call_count == 2
+
+    def test_retrieve_series_weather(self, influxdb, config):
+        config.return_value = MagicMock(influxdb=MagicMock(url="url", org="org", token="token", bucket="bucket"))
+        query_stream = MagicMock(return_value=[])
+        influxdb.return_value = MagicMock(
+            __enter__=MagicMock(return_value=MagicMock(query_api=MagicMock(return_value=MagicMock(query_stream=query_stream))))
+        )
+        assert not retrieve_series("l", "weather", "humidity", 0.0, 10.0, 100)
+        (query,), kwargs = query_stream.call_args
+        assert "r.device" not in query
+        assert kwargs["params"]["measurement"] == "weather"
+
+    def test_retrieve_series_routed(self, influxdb, config):
+        routes = [InfluxDbRouteConfig(name="cabin", location="l", url="http://cabin:8086", bucket="cabin")]
+        config.return_value = MagicMock(
+            influxdb=InfluxDbConfig(url="url", org="org", token="token", bucket="bucket", routes=routes)
+        )
+        query_stream = MagicMock(return_value=[])
+        influxdb.return_value = MagicMock(
+            __enter__=MagicMock(return_value=MagicMock(query_api=MagicMock(return_value=MagicMock(query_stream=query_stream))))
+        )
+        assert not retrieve_series("l", "d", "temperature", 0.0, 10.0, 100)
+        influxdb.assert_called_once_with(url="http://cabin:8086", org="org", token="token")
+        (query,), _ = query_stream.call_args
+        assert 'from(bucket: "cabin")' in query
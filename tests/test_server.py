@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
 # vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=redefined-outer-name:
 import codecs
+import json
 from unittest.mock import MagicMock, patch
 
 import pytest
 from fastapi.testclient import TestClient
 from influxdb_client.client.exceptions import InfluxDBError
-from smartapp.interface import BadRequestError, InternalError, SignatureError, SmartAppRequestContext
+from smartapp.interface import BadRequestError, InternalError, SignatureError, SmartAppDispatcherConfig
 
-from sensortrack.rest import RestClientError
+from sensortrack.admission import GateStatus, OverloadedError
+from sensortrack.config import DataApiConfig
+from sensortrack.quotas import TenantUsage
+from sensortrack.readiness import NOT_CHECKED, ReadinessStatus
+from sensortrack.recent import DeviceStatus
+from sensortrack.responses import responses
+from sensortrack.rest import CircuitState, RestClientError, UpstreamStatus
+from sensortrack.series import Downsample
 from sensortrack.server import (
     API,
     API_VERSION,
@@ -19,8 +28,32 @@
     signature_error_handler,
     smartapp_error_handler,
 )
+from sensortrack.sinks import WriterStatus
 
 CLIENT = TestClient(API)
+AUTHORIZED = {"Authorization": "Bearer secret"}
+CONFIRMATION = {
+    "lifecycle": "CONFIRMATION",
+    "executionId": "e",
+    "appId": "a",
+    "locale": "en",
+    "version": "0.1.0",
+    "confirmationData": {"appId": "a", "confirmationUrl": "https://example.com"},
+    "settings": {},
+}
+
+
+@pytest.fixture
+def data_api():
+    with patch("sensortrack.server.config") as config:
+        config.return_value = MagicMock(data_api=DataApiConfig(token="secret"))
+        yield config
+
+
+UPSTREAMS = [
+    UpstreamStatus(name="smartthings", state=CircuitState.CLOSED, consecutive_failures=0, rejected_calls=0, retry_tokens=10.0),
+    UpstreamStatus(name="weather", state=CircuitState.OPEN, consecutive_failures=5, rejected_calls=2, retry_tokens=1.5),
+]
 
 
 class TestErrorHandlers:
@@ -57,11 +90,115 @@ async def test_exception_handler(self):
         assert response.status_code == 500
 
 
+class TestLifespan:
+    @patch("sensortrack.server.warm_up")
+    @patch("sensortrack.server.checker")
+    @patch("sensortrack.server.shutdown_logging")
+    @patch("sensortrack.server.pipeline")
+    @patch("sensortrack.server.shutdown_alerts")
+    @patch("sensortrack.server.flush")
+    @patch("sensortrack.server.provision_rollups")
+    def test_lifespan(  # pylint: disable=too-many-positional-arguments:
+        self, provision_rollups, flush, shutdown_alerts, pipeline, shutdown_logging, checker, warm_up
+    ):
+        checker.return_value.settings.interval_sec = 60.0
+        with TestClient(API) as client:
+            client.get(url="/health")  # by now, the background checks have started
+            checker.return_value.refresh.assert_called_once()
+            pipeline.assert_called_once()
+            warm_up.assert_called_once()
+            provision_rollups.assert_called_once()
+            flush.assert_not_called()
+            shutdown_alerts.assert_not_called()
+            shutdown_logging.assert_not_called()
+        flush.assert_called_once()
+        shutdown_alerts.assert_called_once()
+        shutdown_logging.assert_called_once()
+
+    @patch("sensortrack.server.warm_up", MagicMock())
+    @patch("sensortrack.server.checker", MagicMock(side_effect=Exception("hello")))
+    @patch("sensortrack.server.shutdown_logging", MagicMock())
+    @patch("sensortrack.server.shutdown_alerts", MagicMock())
+    @patch("sensortrack.server.pipeline")
+    @patch("sensortrack.server.flush")
+    @patch("sensortrack.server.provision_rollups")
+    def test_lifespan_failure(self, provision_rollups, flush, pipeline):
+        pipeline.side_effect = Exception("hello")
+        provision_rollups.side_effect = Exception("hello")
+        flush.side_effect = Exception("hello")
+        with TestClient(API) as client:
+            assert client.get(url="/health").status_code == 200  # failure is logged, but server still starts
+
+
 class TestRoutes:
-    def test_health(self):
+    @patch("sensortrack.server.upstream_status")
+    def test_health(self, upstream_status):
+        upstream_status.return_value = UPSTREAMS
         response = CLIENT.get(url="/health")
         assert response.status_code == 200
-        assert response.json() == {"status": "OK"}
+        assert response.json() == {"status": "OK", "upstreams": {"smartthings": "CLOSED", "weather": "OPEN"}}
+
+    @patch("sensortrack.server.readiness_status")
+    def test_ready(self, readiness_status):
+        readiness_status.return_value = ReadinessStatus(
+            ready=True,
+            checked_at=1000.0,
+            influxdb=True,
+            pending_points=5,
+            spool_bytes=0,
+            upstreams={"smartthings": "CLOSED"},
+            reasons=[],
+        )
+        response = CLIENT.get(url="/ready")
+        assert response.status_code == 200
+        assert response.json() == {
+            "ready": True,
+            "checked_at": 1000.0,
+            "influxdb": True,
+            "pending_points": 5,
+            "spool_bytes": 0,
+            "upstreams": {"smartthings": "CLOSED"},
+            "reasons": [],
+        }
+
+    @patch("sensortrack.server.readiness_status")
+    def test_ready_not_ready(self, readiness_status):
+        readiness_status.return_value = NOT_CHECKED
+        response = CLIENT.get(url="/ready")
+        assert response.status_code == 503
+        assert response.json()["ready"] is False
+        assert response.json()["reasons"] == NOT_CHECKED.reasons
+
+    @patch("sensortrack.server.writer_status")
+    @patch("sensortrack.server.tenant_usage")
+    @patch("sensortrack.server.admission_status")
+    @patch("sensortrack.server.pipeline")
+    @patch("sensortrack.server.alerts")
+    @patch("sensortrack.server.upstream_status")
+    @pytest.mark.parametrize("engine,dropped", [(None, 0), (MagicMock(dropped=3), 3)])
+    @pytest.mark.parametrize("logs,logs_dropped", [(None, 0), (MagicMock(dropped=5), 5)])
+    def test_metrics(  # pylint: disable=too-many-arguments,too-many-positional-arguments:
+        self, upstream_status, alerts, pipeline, admission_status, tenant_usage, writer_status, engine, dropped, logs, logs_dropped
+    ):
+        upstream_status.return_value = UPSTREAMS
+        admission_status.return_value = [GateStatus(lifecycle="EVENT", active=2, queued=1, admitted=10, shed=3)]
+        tenant_usage.return_value = [TenantUsage(installed_app_id="app", series=4, written=20, dropped=1, aggregated=0, spooled=0)]
+        writer_status.return_value = [WriterStatus(name="default", queued=3, written=100, failed=2, rejected=0, retrying=True)]
+        alerts.return_value = engine
+        pipeline.return_value = logs
+        response = CLIENT.get(url="/metrics")
+        assert response.status_code == 200
+        assert response.json() == {
+            "upstreams": [
+                {"name": "smartthings", "state": "CLOSED", "consecutive_failures": 0, "rejected_calls": 0, "retry_tokens": 10.0},
+                {"name": "weather", "state": "OPEN", "consecutive_failures": 5, "rejected_calls": 2, "retry_tokens": 1.5},
+            ],
+            "admission": [{"lifecycle": "EVENT", "active": 2, "queued": 1, "admitted": 10, "shed": 3}],
+            "tenants": [{"installed_app_id": "app", "series": 4, "written": 20, "dropped": 1, "aggregated": 0, "spooled": 0}],
+            "writers": [{"name": "default", "queued": 3, "written": 100, "failed": 2, "rejected": 0, "retrying": True}],
+            "alerts_dropped": dropped,
+            "logs_dropped": logs_dropped,
+        }
 
     @patch("sensortrack.server.metadata_version")
     def test_version(self, metadata_version):
@@ -70,15 +207,111 @@ def test_version(self, metadata_version):
         assert response.status_code == 200
         assert response.json() == {"package": "xxx", "api": API_VERSION}
 
-    @patch("sensortrack.server.dispatcher")
-    def test_smartapp(self, d):
-        d.return_value = MagicMock(dispatch=MagicMock(return_value="result"))
-        response = CLIENT.post(url="/smartapp", headers={"a": "b"}, content="body")
+    @pytest.mark.usefixtures("data_api")
+    @patch("sensortrack.server.recent")
+    def test_recent_devices(self, recent):
+        recent.return_value = MagicMock(
+            devices=MagicMock(
+                return_value=[
+                    DeviceStatus(location_id="l", device_id="d", last_seen=100.0, staleness_sec=5.0, values={"temperature": 70.1}),
+                ]
+            )
+        )
+        response = CLIENT.get(headers=AUTHORIZED, url="/recent/l")
+        assert response.status_code == 200
+        assert response.json() == [{"device": "d", "last_seen": 100.0, "staleness_sec": 5.0, "values": {"temperature": 70.1}}]
+        recent.return_value.devices.assert_called_once_with("l")
+
+    @pytest.mark.usefixtures("data_api")
+    @patch("sensortrack.server.recent")
+    def test_recent_readings(self, recent):
+        recent.return_value = MagicMock(window=MagicMock(return_value=[(100.0, 70.1), (200.0, 70.2)]))
+        response = CLIENT.get(headers=AUTHORIZED, url="/recent/l/d/temperature?seconds=600")
+        assert response.status_code == 200
+        assert response.json() == {
+            "location": "l",
+            "device": "d",
+            "attribute": "temperature",
+            "readings": [[100.0, 70.1], [200.0, 70.2]],
+        }
+        recent.return_value.window.assert_called_once_with("l", "d", "temperature", 600.0)
+
+    @pytest.mark.usefixtures("data_api")
+    @patch("sensortrack.server.recent")
+    def test_recent_readings_not_found(self, recent):
+        recent.return_value = MagicMock(window=MagicMock(return_value=None))
+        response = CLIENT.get(headers=AUTHORIZED, url="/recent/l/d/temperature")
+        assert response.status_code == 404
+        recent.return_value.window.assert_called_once_with("l", "d", "temperature", 3600.0)
+
+    @pytest.mark.usefixtures("data_api")
+    @patch("sensortrack.server.retrieve_series")
+    def test_series(self, retrieve_series):
+        retrieve_series.return_value = [(100.0, 70.1), (200.0, 70.2)]
+        response = CLIENT.get(headers=AUTHORIZED, url="/series/l/d/temperature?start=0&stop=1000&width=500&method=minmax")
+        assert response.status_code == 200
+        assert response.json() == {
+            "location": "l",
+            "device": "d",
+            "attribute": "temperature",
+            "method": "minmax",
+            "readings": [[100.0, 70.1], [200.0, 70.2]],
+        }
+        retrieve_series.assert_called_once_with("l", "d", "temperature", 0.0, 1000.0, 500, Downsample.MINMAX)
+
+    @patch("sensortrack.server.recent")
+    @pytest.mark.parametrize("url", ["/recent/l", "/recent/l/d/temperature", "/series/l/d/temperature?start=0&stop=1000"])
+    @pytest.mark.parametrize(
+        "headers", [{}, {"Authorization": "Bearer wrong"}, {"Authorization": "Basic secret"}, {"Authorization": "secret"}]
+    )
+    def test_data_api_unauthorized(self, recent, data_api, url, headers):
+        response = CLIENT.get(headers=headers, url=url)
+        assert response.status_code == 401
+        assert response.headers["WWW-Authenticate"] == "Bearer"
+        recent.assert_not_called()
+        data_api.return_value = MagicMock(data_api=None)
+        assert CLIENT.get(headers=AUTHORIZED, url=url).status_code == 404  # disabled unless configured
+
+    @pytest.mark.usefixtures("data_api")
+    @patch("sensortrack.server.retrieve_series")
+    @pytest.mark.parametrize("start,stop", [("1000", "0"), ("0", "1e300"), ("-1e300", "0"), ("0", "inf"), ("nan", "1000")])
+    def test_series_invalid_range(self, retrieve_series, start, stop):
+        response = CLIENT.get(headers=AUTHORIZED, url="/series/l/d/temperature?start=%s&stop=%s" % (start, stop))
+        assert response.status_code == 400
+        retrieve_series.assert_not_called()
+
+    @patch("sensortrack.server.admitted", MagicMock())
+    @patch("sensortrack.server.log_exchange")
+    @patch("sensortrack.server.dispatch")
+    def test_smartapp(self, dispatch, log_exchange):
+        dispatch.return_value = b"result"
+        response = CLIENT.post(url="/smartapp", headers={"a": "b", "x-st-correlation": "c"}, content="body")
         assert response.status_code == 200
         assert codecs.decode(response.content) == "result"
         assert response.headers["content-type"] == "application/json"
-        d.return_value.dispatch.assert_called_once()
-        (_, kwargs) = d.return_value.dispatch.call_args  # needed because FastAPI enhances the headers; we can't check equality
-        context: SmartAppRequestContext = kwargs["context"]
-        assert context.headers["a"] == "b"  # just make sure our headers get passed, among others
-        assert context.body == "body"
+        dispatch.assert_called_once()
+        headers, body = dispatch.call_args[0]  # needed because FastAPI enhances the headers; we can't check equality
+        assert headers["a"] == "b"  # just make sure our headers get passed, among others
+        assert body == b"body"
+        log_exchange.assert_called_once_with("c", b"body", b"result")
+
+    @patch("sensortrack.server.admitted", MagicMock())
+    @patch("sensortrack.server.log_exchange", MagicMock())
+    @patch("sensortrack.responses.dispatcher")
+    def test_smartapp_precomputed(self, d):
+        d.return_value = MagicMock(config=SmartAppDispatcherConfig(check_signatures=False))
+        response = CLIENT.post(url="/smartapp", content=json.dumps(CONFIRMATION))
+        assert response.status_code == 200
+        assert response.content == responses().confirmation  # served from the precomputed responses, like the fast path
+        d.return_value.event_handler.handle_confirmation.assert_called_once()
+        d.return_value.dispatch.assert_not_called()
+
+    @patch("sensortrack.server.admitted")
+    @patch("sensortrack.server.dispatch")
+    def test_smartapp_overloaded(self, dispatch, admitted):
+        admitted.return_value.__aenter__.side_effect = OverloadedError("Over limits for EVENT", 7)
+        response = CLIENT.post(url="/smartapp", content="body")
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "7"
+        assert admitted.call_args[0][0] == b"body"
+        dispatch.assert_not_called()
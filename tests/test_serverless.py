@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+import base64
+import subprocess
+import sys
+from unittest.mock import MagicMock, patch
+
+import pytest
+from smartapp.interface import BadRequestError, InternalError, SignatureError, SmartAppRequestContext
+
+from sensortrack.serverless import handler
+
+
+@patch("sensortrack.handler.flush")
+@patch("sensortrack.dispatcher.dispatcher")
+class TestHandler:
+    def test_handler(self, dispatcher, flush):
+        dispatcher.return_value = MagicMock(dispatch=MagicMock(return_value="result"))
+        response = handler({"headers": {"a": "b"}, "body": "body", "isBase64Encoded": False}, None)
+        assert response == {
+            "statusCode": 200,
+            "headers": {"Content-Type": "application/json"},
+            "body": "result",
+            "isBase64Encoded": False,
+        }
+        context = dispatcher.return_value.dispatch.call_args.kwargs["context"]
+        assert context == SmartAppRequestContext(headers={"a": "b"}, body="body")
+        flush.assert_called_once_with(final=False)
+
+    def test_handler_base64(self, dispatcher, _flush):
+        dispatcher.return_value = MagicMock(dispatch=MagicMock(return_value="result"))
+        body = base64.b64encode("bödy".encode("UTF-8")).decode()
+        assert handler({"headers": None, "body": body, "isBase64Encoded": True})["statusCode"] == 200
+        context = dispatcher.return_value.dispatch.call_args.kwargs["context"]
+        assert context == SmartAppRequestContext(headers={}, body="bödy")
+
+    def test_handler_invalid_base64(self, dispatcher, flush):
+        assert handler({"body": "\xff", "isBase64Encoded": True}) == {"statusCode": 400}
+        dispatcher.return_value.dispatch.assert_not_called()
+        flush.assert_not_called()
+
+    @pytest.mark.parametrize(
+        "error,status_code",
+        [
+            (BadRequestError("error", "id"), 400),
+            (SignatureError("error", "id"), 401),
+            (InternalError("error", "id"), 500),
+            (Exception("error"), 500),
+        ],
+    )
+    def test_handler_error(self, dispatcher, flush, error, status_code):
+        dispatcher.return_value = MagicMock(dispatch=MagicMock(side_effect=error))
+        assert handler({"headers": {}, "body": "body"}) == {"statusCode": status_code}
+        flush.assert_not_called()
+
+    def test_handler_flush_error(self, dispatcher, flush):
+        dispatcher.return_value = MagicMock(dispatch=MagicMock(return_value="result"))
+        flush.side_effect = Exception("error")
+        assert handler({"headers": {}, "body": "body"})["statusCode"] == 200
+
+
+class TestImports:
+    def test_avoids_server_modules(self):
+        # this has to run in a fresh interpreter, since the test suite itself imports the FastAPI server
+        script = "import sys, sensortrack.serverless, sensortrack.dispatcher; "
+        script += "print(','.join(m for m in ('fastapi', 'pydantic', 'starlette', 'uvicorn') if m in sys.modules))"
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+        assert result.stdout.strip() == ""
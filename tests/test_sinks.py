@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+# pylint: disable=protected-access:
+import os
+import time
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, call, patch
+
+import pytest
+from attrs import evolve
+from influxdb_client import Point
+from influxdb_client.client.exceptions import InfluxDBError
+from influxdb_client.rest import ApiException
+from urllib3.exceptions import ProtocolError
+
+from sensortrack.config import (
+    ColumnarFormat,
+    ColumnarSinkConfig,
+    ConfigError,
+    InfluxDbConfig,
+    InfluxDbRouteConfig,
+    RollupConfig,
+    SinksConfig,
+)
+from sensortrack.sinks import (
+    ColumnarFileSink,
+    FanOutSink,
+    InfluxDbSink,
+    InfluxDbWriter,
+    PartialWriteError,
+    RoutedInfluxDbSink,
+    WriteRejectedError,
+    WriterStatus,
+    _retryable,
+    _row,
+    destination,
+    destinations,
+    reset,
+    sink,
+    writer_status,
+)
+
+INFLUXDB = InfluxDbConfig(url="url", org="org", token="token", bucket="bucket")
+ROUTES = [
+    InfluxDbRouteConfig(name="cabin", location="cabin", url="http://cabin:8086"),
+    InfluxDbRouteConfig(name="batched", measurement="sensor_1m", batch_size=1000),  # same destination, different batching
+    InfluxDbRouteConfig(name="cabin-weather", location="cabin", measurement="weather", url="http://other:8086"),
+]
+STAMP = datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+
+
+def _point(device, value, stamp=STAMP):
+    return Point("sensor").tag("location", "l").tag("device", device).field("temperature", value).time(stamp)
+
+
+class TestInfluxDbSink:
+    @patch("sensortrack.sinks.InfluxDBClient")
+    def test_write(self, influxdb):
+        # Ugh, the stubbing for a context manager is hideous
+        write = MagicMock()
+        influxdb.return_value = MagicMock(
+            __enter__=MagicMock(
+                return_value=MagicMock(
+                    write_api=MagicMock(
+                        return_value=MagicMock(write=write),
+                    ),
+                ),
+            ),
+        )
+        points = [_point("d", 70.0)]
+        InfluxDbSink(INFLUXDB).write(points)
+        influxdb.assert_called_once_with(url="url", org="org", token="token")
+        write.assert_called_once_with(bucket="bucket", record=points)
+
+
+def _influxdb(write):
+    """Stub an InfluxDB client whose write API calls write."""
+    return MagicMock(
+        return_value=MagicMock(
+            __enter__=MagicMock(return_value=MagicMock(write_api=MagicMock(return_value=MagicMock(write=write))))
+        )
+    )
+
+
+def _wait_for(condition):
+    deadline = time.monotonic() + 5.0
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class TestRoutedInfluxDbSink:
+    def test_target(self):
+        routes = [
+            InfluxDbRouteConfig(name="rollup", measurement="sensor_1m", bucket="rollups"),
+            InfluxDbRouteConfig(name="cabin", location="cabin", url="http://cabin:8086", org="cabin"),
+        ]
+        target = RoutedInfluxDbSink(evolve(INFLUXDB, routes=routes))
+        assert target.target(_point("d", 70.0)) is target.default
+        cabin = target.target(Point("sensor").tag("location", "cabin").field("temperature", 70.0))
+        assert cabin.name == "cabin"
+        assert cabin.influxdb == InfluxDbConfig(url="http://cabin:8086", org="cabin", token="token", bucket="bucket")
+        rollup = target.target(Point("sensor_1m").tag("location", "cabin").field("temperature", 70.0))
+        assert rollup.name == "rollup"  # the first matching route wins
+        assert rollup.influxdb.bucket == "rollups"
+
+    def test_write(self):
+        write = MagicMock()
+        routes = [InfluxDbRouteConfig(name="cabin", location="cabin", bucket="cabin")]
+        target = RoutedInfluxDbSink(evolve(INFLUXDB, routes=routes))
+        unstamped = Point("sensor").tag("location", "cabin").field("temperature", 70.0)
+        with patch("sensortrack.sinks.InfluxDBClient", _influxdb(write)):
+            target.write([_point("d", 70.0), unstamped, _point("e", 71.0)])
+            target.flush()  # queued points are only written by the writer threads, or when flushed at shutdown
+            target.flush(final=True)
+        assert unstamped._time is not None  # stamped when received, since it may wait in a queue
+        assert sorted(write.call_args_list, key=lambda c: c.kwargs["bucket"]) == [
+            call(bucket="bucket", record=[_point("d", 70.0), _point("e", 71.0)]),
+            call(bucket="cabin", record=[unstamped]),
+        ]
+        assert target.pending() == 0
+        assert target.status() == [
+            WriterStatus(name="cabin", queued=0, written=1, failed=0, rejected=0, retrying=False),
+            WriterStatus(name="default", queued=0, written=2, failed=0, rejected=0, retrying=False),
+        ]
+
+    @patch("sensortrack.sinks.RETRY_MIN_SEC", 0.01)
+    def test_retry(self):
+        cabin = MagicMock(side_effect=[OSError("hello"), ApiException(status=503), None])
+
+        def write(bucket, record):
+            if bucket == "cabin":
+                cabin(record)
+
+        routes = [InfluxDbRouteConfig(name="cabin", location="cabin", bucket="cabin")]
+        target = RoutedInfluxDbSink(evolve(INFLUXDB, routes=routes))
+        with patch("sensortrack.sinks.InfluxDBClient", _influxdb(MagicMock(side_effect=write))):
+            target.write([Point("sensor").tag("location", "cabin").field("temperature", 70.0), _point("d", 70.0)])
+            _wait_for(lambda: cabin.call_count == 3)
+            target.flush(final=True)
+        assert [(status.name, status.written, status.failed) for status in target.status()] == [("cabin", 1, 0), ("default", 1, 0)]
+
+    def test_failure(self):
+        def write(bucket, **_):
+            if bucket == "cabin":
+                raise OSError("hello")
+
+        routes = [InfluxDbRouteConfig(name="cabin", location="cabin", bucket="cabin")]
+        target = RoutedInfluxDbSink(evolve(INFLUXDB, routes=routes))
+        with patch("sensortrack.sinks.InfluxDBClient", _influxdb(MagicMock(side_effect=write))):
+            target.write([Point("sensor").tag("location", "cabin").field("temperature", 70.0), _point("d", 70.0)])
+            _wait_for(lambda: target.status()[0].retrying)
+            with pytest.raises(WriteRejectedError, match="cabin is failing"):
+                target.write([Point("sensor").tag("location", "cabin").field("temperature", 71.0), _point("e", 71.0)])
+            target.flush(final=True)  # failures are isolated to the route, and given up on at shutdown
+        assert [(status.name, status.written, status.failed, status.rejected) for status in target.status()] == [
+            ("cabin", 0, 1, 1),
+            ("default", 1, 0, 1),  # the whole request is rejected, not just the points for the failing destination
+        ]
+
+    @patch("sensortrack.sinks.Thread")
+    def test_queue_full(self, thread):
+        routes = [InfluxDbRouteConfig(name="cabin", location="cabin", queue_size=1)]
+        target = RoutedInfluxDbSink(evolve(INFLUXDB, routes=routes))
+        cabin = Point("sensor").tag("location", "cabin").field("temperature", 70.0)
+        target.write([cabin])
+        with pytest.raises(WriteRejectedError, match="cabin is full"):
+            target.write([cabin, _point("d", 70.0)])
+        thread.return_value.start.assert_called_once()
+        assert target.status() == [
+            WriterStatus(name="cabin", queued=1, written=0, failed=0, rejected=1, retrying=False),
+            WriterStatus(name="default", queued=0, written=0, failed=0, rejected=1, retrying=False),
+        ]
+
+    def test_invalid(self):
+        def write(bucket, record):
+            if bucket == "cabin" and record[0]._fields["temperature"] == "bogus":
+                raise ApiException(status=422, reason="field type conflict")
+
+        routes = [InfluxDbRouteConfig(name="cabin", location="cabin", bucket="cabin")]
+        target = RoutedInfluxDbSink(evolve(INFLUXDB, routes=routes))
+        with patch("sensortrack.sinks.InfluxDBClient", _influxdb(MagicMock(side_effect=write))):
+            target.write([Point("sensor").tag("location", "cabin").field("temperature", "bogus")])
+            _wait_for(lambda: target.status()[0].failed == 1)
+            target.write([Point("sensor").tag("location", "cabin").field("temperature", 70.0)])  # not blocked by the dropped batch
+            target.flush(final=True)
+        assert target.status()[0] == WriterStatus(name="cabin", queued=0, written=1, failed=1, rejected=0, retrying=False)
+
+    @patch("sensortrack.sinks.Thread")
+    def test_offer_full(self, _thread):
+        writer = InfluxDbWriter("default", INFLUXDB, InfluxDbRouteConfig(name="default", queue_size=1))
+        writer.offer([_point("d", 70.0)])
+        with pytest.raises(WriteRejectedError, match="default is full"):
+            writer.offer([_point("e", 71.0), _point("f", 72.0)])
+        assert writer.status() == WriterStatus(name="default", queued=1, written=0, failed=0, rejected=2, retrying=False)
+
+    @patch("sensortrack.sinks.BLOCK_WAIT_SEC", 0.01)
+    @patch("sensortrack.sinks.Thread")
+    def test_offer_block_full(self, _thread):
+        writer = InfluxDbWriter("default", INFLUXDB, InfluxDbRouteConfig(name="default", queue_size=1))
+        with pytest.raises(WriteRejectedError, match="default is full"):
+            writer.offer([_point("d", 70.0), _point("e", 71.0)], block=True)  # nothing drains the queue
+        assert writer.status() == WriterStatus(name="default", queued=1, written=0, failed=0, rejected=1, retrying=False)
+
+    def test_write_block(self):
+        write = MagicMock()
+        routes = [InfluxDbRouteConfig(name="cabin", location="cabin", queue_size=2, batch_size=1)]
+        target = RoutedInfluxDbSink(evolve(INFLUXDB, routes=routes))
+        points = [Point("sensor").tag("location", "cabin").field("temperature", float(value)) for value in range(10)]
+        with patch("sensortrack.sinks.InfluxDBClient", _influxdb(write)):
+            target.write(points, block=True)  # more points than the queue holds, so this waits for the writer
+            target.flush(final=True)
+        assert [point for args in write.call_args_list for point in args.kwargs["record"]] == points
+        assert target.status()[0].rejected == 0
+
+    @pytest.mark.parametrize(
+        "error,retryable",
+        [
+            (OSError("refused"), True),
+            (ProtocolError("reset"), True),
+            (ApiException(status=0, reason="no response"), True),
+            (ApiException(status=503), True),
+            (ApiException(status=429), True),
+            (ApiException(status=400), False),
+            (ApiException(status=422), False),
+            (InfluxDBError(message="bucket is required"), False),
+            (ValueError("bogus"), False),
+        ],
+    )
+    def test_retryable(self, error, retryable):
+        assert _retryable(error) is retryable
+
+    @pytest.mark.parametrize(
+        "route",
+        [InfluxDbRouteConfig(name="cabin", location="cabin"), InfluxDbRouteConfig(name="weather", measurement="weather")],
+    )
+    def test_rollups(self, route):
+        with pytest.raises(ConfigError, match="rollup source bucket"):
+            RoutedInfluxDbSink(evolve(INFLUXDB, rollups=[RollupConfig(bucket="rollup", every="5m")], routes=[route]))
+        RoutedInfluxDbSink(
+            evolve(INFLUXDB, rollups=[RollupConfig(bucket="rollup", every="5m")], routes=[evolve(route, measurement="sensor_1m")])
+        )
+
+
+class TestDestinations:
+    def test_destination(self):
+        influxdb = evolve(INFLUXDB, routes=ROUTES)
+        assert destination(influxdb, "sensor", "home") is influxdb
+        assert destination(influxdb, "sensor", "cabin").url == "http://cabin:8086"
+        assert destination(influxdb, "weather", "cabin").url == "http://cabin:8086"  # the first matching route wins
+        assert destination(influxdb, "sensor_1m", "home") == INFLUXDB
+
+    def test_destinations(self):
+        influxdb = evolve(INFLUXDB, routes=ROUTES)
+        assert [target.url for target in destinations(influxdb)] == ["url", "http://cabin:8086", "http://other:8086"]
+        assert destinations(INFLUXDB) == [INFLUXDB]
+
+
+class TestRow:
+    def test_datetime(self):
+        assert _row(_point("d", 70.0), 0.0) == (
+            ("sensor", "2024-01-02"),
+            {"time": STAMP, "location": "l", "device": "d", "temperature": 70.0},
+        )
+
+    def test_nanoseconds(self):
+        key, row = _row(_point("d", 70.0, int(STAMP.timestamp()) * 1_000_000_000), 0.0)
+        assert key == ("sensor", "2024-01-02")
+        assert row["time"] == STAMP
+
+    def test_no_timestamp(self):
+        key, row = _row(Point("weather").tag("location", "l").field("humidity", 50.0), STAMP.timestamp())
+        assert key == ("weather", "2024-01-02")
+        assert row == {"time": STAMP, "location": "l", "humidity": 50.0}
+
+
+@patch("sensortrack.sinks.find_spec", MagicMock(return_value=MagicMock()))
+@patch("sensortrack.sinks.time")
+class TestColumnarFileSink:
+    def test_max_rows(self, clock):
+        clock.time.return_value = 1000.0
+        target = ColumnarFileSink(ColumnarSinkConfig(path="path", max_rows=2))
+        with patch.object(target, "_write_partition") as write_partition:
+            target.write([_point("d", 70.0), _point("e", 71.0, datetime(2024, 1, 3, tzinfo=timezone.utc))])
+            write_partition.assert_not_called()
+            target.write([_point("f", 72.0)])
+            write_partition.assert_called_once_with(
+                ("sensor", "2024-01-02"),
+                [
+                    {"time": STAMP, "location": "l", "device": "d", "temperature": 70.0},
+                    {"time": STAMP, "location": "l", "device": "f", "temperature": 72.0},
+                ],
+            )
+            assert list(target._buffers) == [("sensor", "2024-01-03")]
+            assert target.pending() == 1
+
+    def test_flush(self, clock):
+        target = ColumnarFileSink(ColumnarSinkConfig(path="path", max_age_sec=300))
+        with patch.object(target, "_write_partition") as write_partition:
+            clock.time.return_value = 1000.0
+            target.write([_point("d", 70.0)])
+            clock.time.return_value = 1100.0
+            target.write([_point("e", 71.0, datetime(2024, 1, 3, tzinfo=timezone.utc))])
+            clock.time.return_value = 1299.0
+            target.flush()
+            write_partition.assert_not_called()
+            clock.time.return_value = 1300.0
+            target.flush()
+            assert write_partition.call_args_list == [call(("sensor", "2024-01-02"), [_row(_point("d", 70.0), 0.0)[1]])]
+            target.flush(final=True)
+            assert write_partition.call_count == 2
+            assert not target._buffers
+
+    def test_write_failed(self, clock):
+        clock.time.return_value = 1000.0
+        target = ColumnarFileSink(ColumnarSinkConfig(path="path", max_rows=2))
+        with patch.object(target, "_write_partition") as write_partition:
+            write_partition.side_effect = OSError("disk full")
+            target.write([_point("d", 70.0), _point("e", 71.0)])  # the rows are buffered, so the write itself succeeds
+            target.write([_point("f", 72.0)])
+            assert [row["device"] for row in target._buffers[("sensor", "2024-01-02")]] == ["d", "e", "f"]
+            write_partition.side_effect = None
+            target.flush(final=True)
+            write_partition.assert_called_with(
+                ("sensor", "2024-01-02"), [_row(_point(d, v), 0.0)[1] for d, v in zip("def", [70.0, 71.0, 72.0])]
+            )
+            assert target.pending() == 0
+
+    def test_flush_failed(self, clock):
+        clock.time.return_value = 1000.0
+        target = ColumnarFileSink(ColumnarSinkConfig(path="path"))
+        with patch.object(target, "_write_partition") as write_partition:
+            target.write([_point("d", 70.0), _point("e", 71.0, datetime(2024, 1, 3, tzinfo=timezone.utc))])
+            write_partition.side_effect = [OSError("disk full"), None]
+            with pytest.raises(OSError, match="disk full"):
+                target.flush(final=True)
+            assert write_partition.call_count == 2  # every partition is still attempted
+            assert list(target._buffers) == [("sensor", "2024-01-02")]  # and the failed one is kept
+            assert target._started == {("sensor", "2024-01-02"): 1000.0}
+
+    def test_pyarrow_missing(self, _time):
+        with patch("sensortrack.sinks.find_spec", MagicMock(return_value=None)):
+            with pytest.raises(ConfigError, match="requires pyarrow"):
+                ColumnarFileSink(ColumnarSinkConfig(path="path"))
+
+
+class TestColumnarFiles:
+    @pytest.mark.parametrize("file_format", [ColumnarFormat.PARQUET, ColumnarFormat.ARROW])
+    def test_write_partition(self, tmp_path, file_format):
+        pyarrow = pytest.importorskip("pyarrow")
+        pytest.importorskip("pyarrow.parquet")
+        target = ColumnarFileSink(ColumnarSinkConfig(path=str(tmp_path), format=file_format))
+        rows = [_row(_point("d", 70.0), 0.0)[1], _row(_point("e", 71.0), 0.0)[1]]
+        path = target._write_partition(("sensor", "2024-01-02"), rows)
+        assert os.path.dirname(path) == os.path.join(str(tmp_path), "measurement=sensor", "date=2024-01-02")
+        assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]  # no temporary file left behind
+        if file_format == ColumnarFormat.PARQUET:
+            table = pyarrow.parquet.read_table(path)
+        else:
+            with pyarrow.memory_map(path) as source:
+                table = pyarrow.ipc.open_file(source).read_all()
+        assert table.column("device").to_pylist() == ["d", "e"]
+        assert table.column("temperature").to_pylist() == [70.0, 71.0]
+
+    def test_write_partition_mixed(self, tmp_path):
+        pyarrow = pytest.importorskip("pyarrow")
+        pytest.importorskip("pyarrow.parquet")
+        target = ColumnarFileSink(ColumnarSinkConfig(path=str(tmp_path)))
+        humidity = Point("sensor").tag("location", "l").tag("device", "e").tag("room", "Office").field("humidity", 55.0).time(STAMP)
+        rows = [_row(_point("d", 70.0), 0.0)[1], _row(humidity, 0.0)[1]]
+        table = pyarrow.parquet.read_table(target._write_partition(("sensor", "2024-01-02"), rows))
+        assert table.column_names == ["time", "location", "device", "temperature", "room", "humidity"]
+        assert table.column("temperature").to_pylist() == [70.0, None]
+        assert table.column("humidity").to_pylist() == [None, 55.0]
+        assert table.column("room").to_pylist() == [None, "Office"]
+
+
+class TestFanOutSink:
+    def test_write(self):
+        first, second = MagicMock(), MagicMock()
+        points = [_point("d", 70.0)]
+        FanOutSink([first, second]).write(points)
+        first.write.assert_called_once_with(points, block=False)
+        second.write.assert_called_once_with(points, block=False)
+
+    def test_write_first_failed(self):
+        first, second = MagicMock(), MagicMock()
+        first.write.side_effect = WriteRejectedError("full")
+        with pytest.raises(WriteRejectedError, match="full"):
+            FanOutSink([first, second]).write([_point("d", 70.0)])
+        second.write.assert_not_called()  # so a redelivery doesn't write the points to it twice
+
+    def test_write_partial(self):
+        first, second = MagicMock(), MagicMock()
+        second.write.side_effect = OSError("disk full")
+        with pytest.raises(PartialWriteError, match="disk full"):
+            FanOutSink([first, second]).write([_point("d", 70.0)])
+        first.write.assert_called_once()
+
+    def test_failure(self):
+        first, second = MagicMock(), MagicMock()
+        first.flush.side_effect = Exception("hello")
+        with pytest.raises(Exception, match="hello"):
+            FanOutSink([first, second]).flush(True)
+        second.flush.assert_called_once_with(True)  # still attempted, even though the first sink failed
+
+    def test_pending(self):
+        assert FanOutSink([InfluxDbSink(INFLUXDB), MagicMock(pending=MagicMock(return_value=3))]).pending() == 3
+
+
+@patch("sensortrack.sinks.config")
+class TestSingleton:
+    @pytest.fixture(autouse=True)
+    def cleanup(self):
+        """Reset singleton before and after tests."""
+        reset()
+        yield
+        reset()
+
+    def test_default(self, config):
+        config.return_value = MagicMock(influxdb=INFLUXDB, sinks=SinksConfig())
+        result = sink()
+        assert result is sink()
+        assert isinstance(result, InfluxDbSink)
+        assert result.influxdb is INFLUXDB
+
+    @patch("sensortrack.sinks.find_spec", MagicMock(return_value=MagicMock()))
+    def test_columnar(self, config):
+        columnar = ColumnarSinkConfig(path="path")
+        config.return_value = MagicMock(influxdb=INFLUXDB, sinks=SinksConfig(influxdb=False, columnar=columnar))
+        result = sink()
+        assert isinstance(result, ColumnarFileSink)
+        assert result.columnar is columnar
+
+    @patch("sensortrack.sinks.find_spec", MagicMock(return_value=MagicMock()))
+    def test_fan_out(self, config):
+        columnar = ColumnarSinkConfig(path="path")
+        config.return_value = MagicMock(influxdb=INFLUXDB, sinks=SinksConfig(influxdb=True, columnar=columnar))
+        result = sink()
+        assert isinstance(result, FanOutSink)
+        assert [type(target) for target in result.sinks] == [InfluxDbSink, ColumnarFileSink]
+
+    def test_routed(self, config):
+        influxdb = evolve(INFLUXDB, routes=[InfluxDbRouteConfig(name="cabin", location="cabin")])
+        config.return_value = MagicMock(influxdb=influxdb, sinks=SinksConfig())
+        result = sink()
+        assert isinstance(result, RoutedInfluxDbSink)
+        assert writer_status() == result.status()
+
+    def test_writer_status_no_sink(self, _config):
+        assert not writer_status()
+
+    def test_none(self, config):
+        config.return_value = MagicMock(influxdb=INFLUXDB, sinks=SinksConfig(influxdb=False))
+        with pytest.raises(ConfigError, match="At least one"):
+            sink()
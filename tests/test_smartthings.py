@@ -9,10 +9,16 @@
 from responses import matchers
 from responses.registries import OrderedRegistry
 
+from sensortrack.cache import reset
+from sensortrack.config import CacheConfig
 from sensortrack.smartthings import (
+    Device,
     Location,
+    Room,
     SmartThings,
+    retrieve_devices,
     retrieve_location,
+    retrieve_rooms,
     schedule_weather_lookup_timer,
     subscribe_to_humidity_events,
     subscribe_to_temperature_events,
@@ -38,6 +44,15 @@
 HEADERS_MATCHER = matchers.header_matcher(HEADERS)
 
 
+@pytest.fixture(autouse=True)
+def cleanup():
+    """Use an in-memory cache, reset before and after tests."""
+    with patch("sensortrack.cache.config", MagicMock(return_value=MagicMock(cache=CacheConfig()))):
+        reset()
+        yield
+        reset()
+
+
 @patch("sensortrack.smartthings.config")
 class TestPublicFunctions:
     @pytest.mark.parametrize(
@@ -91,15 +106,64 @@ def test_retrieve_location(self, config):
                 body=load_file(os.path.join(FIXTURE_DIR, "smartthings", "location.json")),
                 match=[TIMEOUT_MATCHER, HEADERS_MATCHER],
             )
+            expected = Location(
+                location_id="15526d0a-XXXX-XXXX-XXXX-b6247aacbbb2",
+                name="My House",
+                country_code="USA",
+                latitude=41.024654,
+                longitude=-97.37219,
+            )
             with SmartThings(request=REQUEST):
-                assert retrieve_location() == Location(
-                    location_id="15526d0a-XXXX-XXXX-XXXX-b6247aacbbb2",
-                    name="My House",
-                    country_code="USA",
-                    latitude=41.024654,
-                    longitude=-97.37219,
-                )
-            assert len(r.calls) == 2  # one for the the failed attempt, one for the retry
+                assert retrieve_location() == expected
+                assert retrieve_location() == expected
+            assert len(r.calls) == 2  # one for the the failed attempt, one for the retry, and then cached
+
+    def test_retrieve_devices(self, config):
+        config.return_value = CONFIG
+        with responses.RequestsMock(registry=OrderedRegistry) as r:
+            r.get(
+                url="https://base/devices?locationId=location",
+                status=500,
+                match=[TIMEOUT_MATCHER, HEADERS_MATCHER],
+            )
+            r.get(
+                url="https://base/devices?locationId=location",
+                status=200,
+                body=load_file(os.path.join(FIXTURE_DIR, "smartthings", "devices-1.json")),
+                match=[TIMEOUT_MATCHER, HEADERS_MATCHER],
+            )
+            r.get(
+                url="https://base/devices?locationId=location&page=1",
+                status=200,
+                body=load_file(os.path.join(FIXTURE_DIR, "smartthings", "devices-2.json")),
+                match=[TIMEOUT_MATCHER, HEADERS_MATCHER],
+            )
+            with SmartThings(request=REQUEST):
+                assert retrieve_devices() == [
+                    Device(
+                        device_id="6f8b1b8c-XXXX-XXXX-XXXX-2d1e0c0b9a01",
+                        label="Kitchen  Sensor",
+                        room_id="0e1a4c37-XXXX-XXXX-XXXX-5a4b3c2d1e01",
+                    ),
+                    Device(
+                        device_id="9a3c2b1d-XXXX-XXXX-XXXX-7e6f5d4c3b02",
+                        label="c2c-temperature",  # falls back to name when there is no label
+                        room_id=None,
+                    ),
+                ]
+            assert len(r.calls) == 3  # one for the the failed attempt, one for the retry, one for the second page
+
+    def test_retrieve_rooms(self, config):
+        config.return_value = CONFIG
+        with responses.RequestsMock(registry=OrderedRegistry) as r:
+            r.get(
+                url="https://base/locations/location/rooms",
+                status=200,
+                body=load_file(os.path.join(FIXTURE_DIR, "smartthings", "rooms.json")),
+                match=[TIMEOUT_MATCHER, HEADERS_MATCHER],
+            )
+            with SmartThings(request=REQUEST):
+                assert retrieve_rooms() == [Room(room_id="0e1a4c37-XXXX-XXXX-XXXX-5a4b3c2d1e01", name="Kitchen")]
 
     @pytest.mark.parametrize(
         "enabled,cron",
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# vim: set ft=python ts=4 sw=4 expandtab:
+from threading import Event
+from unittest.mock import MagicMock, call, patch
+
+import pytest
+
+from sensortrack.warmup import DEFAULT_BUDGET_SEC, WarmupResult, resolve, steps, warm_up
+
+
+class TestResolve:
+    @patch("sensortrack.warmup.socket")
+    @pytest.mark.parametrize(
+        "url,host,port",
+        [
+            ("https://api.smartthings.com", "api.smartthings.com", 443),
+            ("http://localhost:8086", "localhost", 8086),
+            ("http://influxdb", "influxdb", 80),
+        ],
+    )
+    def test_resolve(self, socket, url, host, port):
+        resolve(url)
+        socket.getaddrinfo.assert_called_once_with(host, port, type=socket.SOCK_STREAM)
+
+    @patch("sensortrack.warmup.socket")
+    def test_resolve_no_host(self, socket):
+        resolve("bogus")
+        socket.getaddrinfo.assert_not_called()
+
+
+class TestWarmUp:
+    def test_steps(self):
+        names = [name for name, _ in steps()]
+        assert names[0] == "config"
+        assert "readiness" not in names  # left to the periodic readiness check
+
+    @patch("sensortrack.warmup.config")
+    @patch("sensortrack.warmup.time")
+    def test_warm_up(self, time, config):
+        config.return_value.warmup.budget_sec = 10.0
+        time.monotonic.side_effect = [100.0, 100.0, 101.0, 101.0, 102.5, 102.5]
+        first, second = MagicMock(), MagicMock(side_effect=Exception("hello"))
+        results = warm_up([("first", first), ("second", second)])
+        first.assert_called_once()
+        second.assert_called_once()
+        assert results == [
+            WarmupResult(name="first", duration_sec=1.0),
+            WarmupResult(name="second", duration_sec=1.5, error="hello"),  # failures don't stop startup
+        ]
+
+    @patch("sensortrack.warmup.config")
+    @patch("sensortrack.warmup.time")
+    def test_warm_up_budget(self, time, config):
+        config.return_value.warmup.budget_sec = 5.0
+        time.monotonic.side_effect = [100.0, 100.0, 106.0, 106.0, 106.0]
+        first, second = MagicMock(), MagicMock()
+        results = warm_up([("first", first), ("second", second)])
+        second.assert_not_called()
+        assert results == [
+            WarmupResult(name="first", duration_sec=6.0),
+            WarmupResult(name="second", duration_sec=0.0, skipped=True),
+        ]
+
+    @patch("sensortrack.warmup.config")
+    @patch("sensortrack.warmup.time")
+    def test_warm_up_no_config(self, time, config):
+        config.side_effect = Exception("not configured")
+        time.monotonic.side_effect = [100.0, 100.0, 100.0 + DEFAULT_BUDGET_SEC, 100.0 + DEFAULT_BUDGET_SEC, 200.0]
+        results = warm_up([("config", config), ("other", MagicMock())])
+        assert config.call_args_list == [call(), call()]  # once as a step, and once for the budget
+        assert results[0].error == "not configured"
+        assert results[1].skipped  # the default budget applies
+
+    @patch("sensortrack.warmup.config")
+    def test_warm_up_abandoned(self, config):
+        config.return_value.warmup.budget_sec = 0.1
+        released = Event()
+        later = MagicMock()
+        try:
+            results = warm_up([("config", MagicMock()), ("hung", released.wait), ("later", later)])
+        finally:
+            released.set()
+        later.assert_not_called()
+        assert [result.name for result in results] == ["config", "hung", "later"]
+        assert results[1].abandoned and results[1].duration_sec < 1.0  # not waited for past the budget
+        assert results[2].skipped
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 # vim: set ft=python ts=4 sw=4 expandtab:
+import json
 import os
+from datetime import datetime, timezone
 from unittest.mock import MagicMock, patch
 
 import pytest
@@ -8,14 +10,25 @@
 from responses import matchers
 from responses.registries import OrderedRegistry
 
+from sensortrack.cache import reset
+from sensortrack.config import CacheConfig
 from sensortrack.rest import RestDataError
-from sensortrack.weather import retrieve_current_conditions
+from sensortrack.weather import Observation, decode_observation, retrieve_current_conditions, retrieve_observations
 from tests.testutil import load_file
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
 TIMEOUT_MATCHER = matchers.request_kwargs_matcher({"timeout": 5.0})
 
 
+@pytest.fixture(autouse=True)
+def cleanup():
+    """Use an in-memory cache, reset before and after tests."""
+    with patch("sensortrack.cache.config", MagicMock(return_value=MagicMock(cache=CacheConfig()))):
+        reset()
+        yield
+        reset()
+
+
 class TestPublicFunctions:
     @patch("sensortrack.weather.config")
     def test_retrieve_current_conditions(self, config):
@@ -86,3 +99,87 @@ def test_retrieve_current_conditions_bad_data(self, config, input_file, expected
             )
             # expected temperature taken from Google, to sanity-check library
             assert retrieve_current_conditions(latitude=12.3, longitude=45.6) == expected
+
+    @patch("sensortrack.weather.config")
+    def test_retrieve_current_conditions_cached_station(self, config):
+        config.return_value = MagicMock(weather=MagicMock(base_url="https://base"))
+        with responses.RequestsMock(registry=OrderedRegistry) as r:
+            r.get(
+                url="https://base/points/12.3,45.6/stations",
+                status=200,
+                body=load_file(os.path.join(FIXTURE_DIR, "weather/stations", "stations.json")),
+                match=[TIMEOUT_MATCHER],
+            )
+            for _ in range(2):
+                r.get(
+                    url="https://api.weather.gov/stations/KALO/observations/latest",
+                    status=200,
+                    body=load_file(os.path.join(FIXTURE_DIR, "weather", "observations", "valid.json")),
+                    match=[TIMEOUT_MATCHER],
+                )
+            assert retrieve_current_conditions(latitude=12.3, longitude=45.6) == (84.92, 41.59)
+            assert retrieve_current_conditions(latitude=12.3, longitude=45.6) == (84.92, 41.59)
+            assert len(r.calls) == 3  # station is only looked up once
+
+    @patch("sensortrack.weather.config")
+    def test_retrieve_observations(self, config):
+        config.return_value = MagicMock(weather=MagicMock(base_url="https://base"))
+        start = datetime(2022, 6, 17, tzinfo=timezone.utc)
+        end = datetime(2022, 6, 18, tzinfo=timezone.utc)
+        with responses.RequestsMock(registry=OrderedRegistry) as r:
+            r.get(
+                url="https://base/points/12.3,45.6/stations",
+                status=200,
+                body=load_file(os.path.join(FIXTURE_DIR, "weather/stations", "stations.json")),
+                match=[TIMEOUT_MATCHER],
+            )
+            r.get(
+                url="https://api.weather.gov/stations/KALO/observations",
+                status=500,
+                match=[TIMEOUT_MATCHER],
+            )
+            r.get(
+                url="https://api.weather.gov/stations/KALO/observations",
+                status=200,
+                body=load_file(os.path.join(FIXTURE_DIR, "weather", "history", "page-1.json")),
+                match=[
+                    TIMEOUT_MATCHER,
+                    matchers.query_param_matcher(
+                        {"start": "2022-06-17T00:00:00+00:00", "end": "2022-06-18T00:00:00+00:00", "limit": "500"}
+                    ),
+                ],
+            )
+            r.get(
+                url="https://api.weather.gov/stations/KALO/observations?cursor=abc",
+                status=200,
+                body=load_file(os.path.join(FIXTURE_DIR, "weather", "history", "page-2.json")),
+                match=[TIMEOUT_MATCHER],
+            )
+            r.get(
+                url="https://api.weather.gov/stations/KALO/observations?cursor=def",
+                status=200,
+                body=load_file(os.path.join(FIXTURE_DIR, "weather", "history", "empty.json")),
+                match=[TIMEOUT_MATCHER],
+            )
+            assert list(retrieve_observations(12.3, 45.6, start, end)) == [
+                Observation(
+                    timestamp=datetime(2022, 6, 17, 19, 54, tzinfo=timezone.utc).timestamp(), temperature=84.92, humidity=41.59
+                ),
+                Observation(
+                    timestamp=datetime(2022, 6, 17, 18, 54, tzinfo=timezone.utc).timestamp(), temperature=None, humidity=45.0
+                ),
+                Observation(
+                    timestamp=datetime(2022, 6, 17, 17, 54, tzinfo=timezone.utc).timestamp(), temperature=77.0, humidity=50.0
+                ),
+            ]
+            assert len(r.calls) == 5
+
+
+class TestDecodeObservation:
+    def test_valid(self):
+        observation = decode_observation(json.loads(load_file(os.path.join(FIXTURE_DIR, "weather", "observations", "valid.json"))))
+        assert observation.timestamp == datetime(2022, 6, 17, 19, 54, tzinfo=timezone.utc).timestamp()
+        assert (observation.temperature, observation.humidity) == (84.92, 41.59)
+
+    def test_missing(self):
+        assert decode_observation({}) == Observation(timestamp=None, temperature=None, humidity=None)